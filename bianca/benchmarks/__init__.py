@@ -0,0 +1,5 @@
+"""
+Benchmarks of the pipeline stages on synthetic cohorts (bianca.benchmarks.cohort) with stand-ins for the FSL/ANTs
+executables (bianca.benchmarks.standins), i.e. graph build, scheduling and I/O overhead without the real data and
+tools. Results are recorded per commit (bianca.benchmarks.run).
+"""
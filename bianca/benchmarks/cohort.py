@@ -0,0 +1,193 @@
+"""
+Synthetic cohorts with the layout the pipeline reads: BIDS dir (T1w, FLAIR per acquisition), smriprep dir (subject
+template, brain mask, CSF pve, orig->template affines), manual masks of training subjects and an FSLDIR with the
+standard images (and the stand-in executables, see bianca.benchmarks.standins).
+Images are rendered from a phantom (ellipsoid brain with a grey matter rim, two ventricles, random spherical lesions)
+on the grid of each image, so all images of a subject are aligned in world coordinates.
+"""
+import json
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import nibabel as nb
+from scipy import ndimage
+
+FOV_MM = (160., 192., 160.)
+MNI_SHAPES = {1: (182, 218, 182), 2: (91, 109, 91)}
+# tissue intensities: background, csf, gm, wm, lesion
+T1W_INTENSITIES = (20, 250, 650, 1000, 700)
+FLAIR_INTENSITIES = (10, 80, 650, 500, 1100)
+
+
+def grid(shape, voxel_size):
+    """affine with the image centre at world (0, 0, 0) and the world coordinates (mm) of the voxels"""
+    shape, voxel_size = np.asarray(shape), np.asarray(voxel_size, dtype=float)
+    affine = np.diag(np.r_[voxel_size, 1])
+    affine[:3, 3] = -(shape - 1) / 2 * voxel_size
+    coords = np.ogrid[tuple(slice(0, n) for n in shape)]
+    return affine, [c * v + o for c, v, o in zip(coords, voxel_size, affine[:3, 3])]
+
+
+def _ellipsoid(xyz, centre, radii):
+    return sum(((c - m) / r) ** 2 for c, m, r in zip(xyz, centre, radii))
+
+
+def random_subject(rng, n_lesions=20):
+    """phantom parameters: brain and ventricle size, lesion centres (mm) and radii"""
+    brain_scale = rng.uniform(.92, 1.05)
+    vent_scale = rng.uniform(.8, 1.6)
+    brain_radii = np.array([.4, .42, .38]) * FOV_MM * brain_scale
+    lesions = []
+    while len(lesions) < n_lesions:
+        # half periventricular, half deep wm
+        if len(lesions) % 2:
+            centre = np.array([rng.choice([-1, 1]) * 12 * vent_scale, rng.uniform(-25, 25), rng.uniform(-2, 18)])
+        else:
+            centre = rng.uniform(-.6, .6, 3) * brain_radii
+        lesions.append((centre.tolist(), float(rng.uniform(1.5, 5))))
+    return {"brain_radii": brain_radii.tolist(), "vent_scale": vent_scale, "lesions": lesions}
+
+
+def render(params, shape, voxel_size, lesions=None):
+    """
+    tissue labels (0 background, 1 csf, 2 gm, 3 wm, 4 lesion) and CSF partial volume of a phantom on a grid
+    :param lesions: number of the phantom's lesions to draw (default all)
+    :return: affine, labels, csf_pve
+    """
+    affine, xyz = grid(shape, voxel_size)
+    brain_radii = np.asarray(params["brain_radii"])
+    r = _ellipsoid(xyz, (0, 0, 0), brain_radii)
+    labels = np.zeros(np.broadcast_shapes(*[c.shape for c in xyz]), np.uint8)
+    labels[r <= (1 + 4 / brain_radii.min()) ** 2] = 1
+    labels[r <= 1] = 2
+    labels[r <= (1 - 4 / brain_radii.min()) ** 2] = 3
+    v = params["vent_scale"]
+    ventricles = np.zeros_like(labels, dtype=bool)
+    for side in (-1, 1):
+        ventricles |= _ellipsoid(xyz, (side * 7 * v, 0, 8), (5 * v, 22, 8 * v)) <= 1
+    labels[ventricles] = 1
+    for centre, radius in params["lesions"][:lesions]:
+        lesion = (_ellipsoid(xyz, centre, (radius,) * 3) <= 1) & (labels == 3)
+        labels[lesion] = 4
+    csf_pve = ndimage.gaussian_filter((labels == 1).astype(np.float32), .5 / np.asarray(voxel_size))
+    csf_pve[labels == 0] = 0
+    return affine, labels, csf_pve
+
+
+def intensities(labels, values, rng, noise=.02, bias=.1):
+    """image of tissue labels with a smooth multiplicative bias field and gaussian noise"""
+    img = np.asarray(values, np.float32)[labels]
+    ramp = np.linspace(1 - bias, 1 + bias, labels.shape[1], dtype=np.float32)[np.newaxis, :, np.newaxis]
+    img = img * ramp
+    img += rng.normal(0, noise * max(values), labels.shape).astype(np.float32)
+    return np.clip(img, 0, None)
+
+
+def save(data, affine, out_file, dtype=np.float32):
+    out_file = Path(out_file)
+    out_file.parent.mkdir(parents=True, exist_ok=True)
+    img = nb.Nifti1Image(np.asarray(data).astype(dtype), affine)
+    img.set_data_dtype(dtype)
+    img.header.set_xyzt_units("mm")
+    nb.save(img, str(out_file))
+    return out_file
+
+
+ITK_IDENTITY = """#Insight Transform File V1.0
+#Transform 0
+Transform: MatrixOffsetTransformBase_double_3_3
+Parameters: 1 0 0 0 1 0 0 0 1 0 0 0
+FixedParameters: 0 0 0
+"""
+
+
+def _write_subject(root, subject, sessions, acqs, params, resolution, training, smriprep06, seed):
+    rng = np.random.default_rng(seed)
+    bids_dir, smriprep_dir, training_dir = root / "sourcedata", root / "smriprep", root / "masks_training_data"
+    shape = tuple(int(round(f / resolution)) for f in FOV_MM)
+    voxel = (resolution,) * 3
+
+    affine, labels, csf_pve = render(params, shape, voxel, lesions=len(params["lesions"]) // 2)
+    anat = smriprep_dir / f"sub-{subject}" / "anat"
+    names = ("desc-preproc_T1w", "desc-brain_mask", "label-CSF_probseg") if smriprep06 else \
+        ("T1w_preproc", "T1w_brainmask", "T1w_class-CSF_probtissue")
+    save(intensities(labels, T1W_INTENSITIES, rng, bias=0), affine, anat / f"sub-{subject}_{names[0]}.nii.gz")
+    save(labels > 0, affine, anat / f"sub-{subject}_{names[1]}.nii.gz", np.uint8)
+    save(csf_pve, affine, anat / f"sub-{subject}_{names[2]}.nii.gz")
+
+    n_lesions = len(params["lesions"])
+    for i, session in enumerate(sessions):
+        # lesion load grows over sessions
+        n = n_lesions // 2 + (n_lesions - n_lesions // 2) * (i + 1) // len(sessions)
+        sub_ses = f"sub-{subject}_ses-{session}"
+        ses_anat = bids_dir / f"sub-{subject}" / f"ses-{session}" / "anat"
+        affine, labels, _ = render(params, shape, voxel, lesions=n)
+        save(intensities(labels, T1W_INTENSITIES, rng), affine, ses_anat / f"{sub_ses}_run-1_T1w.nii.gz", np.int16)
+        xfm = smriprep_dir / f"sub-{subject}" / f"ses-{session}" / "anat" / \
+            f"{sub_ses}_run-1_T1w_space-orig_target-T1w_affine.txt"
+        xfm.parent.mkdir(parents=True, exist_ok=True)
+        xfm.write_text(ITK_IDENTITY)
+        for acq in acqs:
+            # 2D FLAIRs with thick slices
+            flair_voxel = (resolution, resolution, max(3., resolution)) if acq == "2D" else voxel
+            flair_shape = tuple(int(round(f / v)) for f, v in zip(FOV_MM, flair_voxel))
+            affine, labels, _ = render(params, flair_shape, flair_voxel, lesions=n)
+            save(intensities(labels, FLAIR_INTENSITIES, rng), affine,
+                 ses_anat / f"{sub_ses}_acq-{acq}_run-1_FLAIR.nii.gz", np.int16)
+            if training:
+                save(labels == 4, affine, training_dir / f"sub-{subject}" / f"ses-{session}" /
+                     f"{sub_ses}_acq-{acq}_run-1_FLAIR_mask_goldstandard_new.nii.gz", np.uint8)
+
+
+def write_fsldir(fsldir, version="6.0.5"):
+    """standard images (phantom without lesions on the MNI grids) and bianca's masks for make_bianca_mask"""
+    fsldir = Path(fsldir)
+    standard = fsldir / "data" / "standard"
+    params = {"brain_radii": (np.array([.4, .42, .38]) * FOV_MM).tolist(), "vent_scale": 1., "lesions": []}
+    rng = np.random.default_rng(0)
+    for mm, shape in MNI_SHAPES.items():
+        affine, labels, _ = render(params, shape, (mm,) * 3)
+        t1 = intensities(labels, T1W_INTENSITIES, rng, noise=0, bias=0)
+        save(t1, affine, standard / f"MNI152_T1_{mm}mm.nii.gz", np.int16)
+        save(t1 * (labels > 1), affine, standard / f"MNI152_T1_{mm}mm_brain.nii.gz", np.int16)
+        save(labels > 1, affine, standard / f"MNI152_T1_{mm}mm_brain_mask.nii.gz", np.uint8)
+        if mm == 1:
+            # csf inside the brain
+            ventricles = (labels == 1) & ndimage.binary_fill_holes(labels > 1)
+            save(ndimage.binary_dilation(ventricles, iterations=3), affine,
+                 standard / "bianca" / "HarvardOxford-1mm-latvent-dilated.nii.gz", np.uint8)
+            save(labels == 3, affine, standard / "bianca" / "bianca_exclusion_mask.nii.gz", np.uint8)
+    (fsldir / "etc").mkdir(parents=True, exist_ok=True)
+    (fsldir / "etc" / "fslversion").write_text(version + "\n")
+    return fsldir
+
+
+def make_cohort(root, n_subjects=10, n_sessions=2, acqs=("2D",), resolution=2., n_training=None, n_lesions=20,
+                smriprep06=False, seed=0, n_cpu=1):
+    """
+    Writes a synthetic cohort to root: sourcedata (BIDS), smriprep, masks_training_data (manual masks of the first
+    n_training subjects, default half of them), fsl (FSLDIR with standard images) and cohort.json (parameters).
+    Subjects are named bench001, bench002, ...; sessions tp1, tp2, ...
+    :param resolution: voxel size (mm) of the T1w and 3D FLAIR images; 2D FLAIRs have slices of at least 3 mm
+    :return: dict of the cohort's dirs
+    """
+    root = Path(root)
+    rng = np.random.default_rng(seed)
+    n_training = n_subjects // 2 if n_training is None else n_training
+    subjects = [f"bench{i + 1:03d}" for i in range(n_subjects)]
+    sessions = [f"tp{i + 1}" for i in range(n_sessions)]
+    params = [random_subject(rng, n_lesions) for _ in subjects]
+    with ProcessPoolExecutor(max_workers=n_cpu) as executor:
+        futures = [executor.submit(_write_subject, root, s, sessions, acqs, p, resolution, i < n_training, smriprep06,
+                                   seed + i + 1) for i, (s, p) in enumerate(zip(subjects, params))]
+        for f in futures:
+            f.result()
+        fsl = executor.submit(write_fsldir, root / "fsl").result()
+    (root / "sourcedata" / "dataset_description.json").write_text(
+        json.dumps({"Name": "bianca benchmark cohort", "BIDSVersion": "1.4.0"}))
+    cohort = dict(n_subjects=n_subjects, n_sessions=n_sessions, acqs=list(acqs), resolution=resolution,
+                  n_training=n_training, n_lesions=n_lesions, smriprep06=smriprep06, seed=seed)
+    (root / "cohort.json").write_text(json.dumps(cohort, indent=2))
+    return {"bids_dir": root / "sourcedata", "smriprep_dir": root / "smriprep",
+            "training_data_dir": root / "masks_training_data", "fsldir": fsl}
@@ -0,0 +1,175 @@
+"""
+Runs pipeline stages on a synthetic cohort with the stand-in executables and records per-stage timings, e.g.
+python -m bianca benchmark BENCH_DIR --n-subjects 20
+python -m bianca compare_benchmarks BENCH_DIR/results.jsonl
+"""
+import os
+import json
+import time
+import shutil
+import socket
+import subprocess
+from pathlib import Path
+from datetime import datetime
+
+import pandas as pd
+
+from .. import __version__
+from .cohort import make_cohort
+from .standins import install_standins
+
+DEFAULT_STAGES = ["template", "t1w", "flair", "intnorm", "masterfile", "bianca", "threshold"]
+
+
+def git_commit(path=None):
+    """commit of the checkout the package runs from (+ "-dirty" with uncommitted changes), None outside git"""
+    path = path or Path(__file__).parents[2]
+    try:
+        commit = subprocess.run(["git", "-C", str(path), "rev-parse", "--short", "HEAD"], capture_output=True,
+                                text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "-C", str(path), "status", "--porcelain", "--untracked-files=no"],
+                               capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ("-dirty" if dirty else "")
+
+
+def get_cohort(cohort_dir, n_cpu=1, **cohort_kwargs):
+    """the cohort in cohort_dir, (re)generated if it does not exist or was made with other parameters"""
+    cohort_dir = Path(cohort_dir)
+    cohort_file = cohort_dir / "cohort.json"
+    if cohort_file.is_file():
+        existing = json.loads(cohort_file.read_text())
+        if all(existing.get(k) == (list(v) if isinstance(v, tuple) else v) for k, v in cohort_kwargs.items()):
+            return {"bids_dir": cohort_dir / "sourcedata", "smriprep_dir": cohort_dir / "smriprep",
+                    "training_data_dir": cohort_dir / "masks_training_data", "fsldir": cohort_dir / "fsl"}, existing
+        shutil.rmtree(cohort_dir)
+    print(f"generating cohort in {cohort_dir}")
+    dirs = make_cohort(cohort_dir, n_cpu=n_cpu, **cohort_kwargs)
+    return dirs, json.loads(cohort_file.read_text())
+
+
+def standin_env(fsldir):
+    """environment with the stand-ins first on the PATH"""
+    fsldir = Path(fsldir)
+    install_standins(fsldir / "bin")
+    return {"FSLDIR": str(fsldir), "FSLOUTPUTTYPE": "NIFTI_GZ",
+            "PATH": f"{fsldir / 'bin'}{os.pathsep}{os.environ.get('PATH', '')}"}
+
+
+def stage_timing(wd_dir):
+    """graph build, expansion and run times (from run_shards' <workflow>_shards.tsv) and node runtimes of a stage"""
+    from ..runtime_report import load_runtimes, critical_path
+    row = {}
+    wd_dir = Path(wd_dir)
+    shard_files = sorted(wd_dir.glob("*_shards.tsv")) if wd_dir.is_dir() else []
+    if shard_files:
+        shards = pd.concat([pd.read_csv(f, sep="\t") for f in shard_files])
+        row.update(n_shards=len(shards), **{c: shards[c].sum() for c in ["build_s", "expand_s", "run_s"]
+                                            if c in shards})
+    nodes = load_runtimes(wd_dir) if wd_dir.is_dir() else pd.DataFrame()
+    if not nodes.empty:
+        row.update(n_nodes=len(nodes), node_s=nodes.duration_s.sum(),
+                   critical_path_s=critical_path(nodes, wd_dir).cumulative_s.max())
+    return row
+
+
+def run_benchmark(bench_dir, stages=None, n_cpu=None, label=None, stage_options=None, keep=False, **cohort_kwargs):
+    """
+    Runs stages (default DEFAULT_STAGES, in pipeline order) on the synthetic cohort in bench_dir/cohort (see
+    bianca.benchmarks.cohort.make_cohort for cohort_kwargs; kept for the next run with the same parameters) with the
+    stand-in executables, in a new run dir bench_dir/runs/<run_id> (removed afterwards unless keep).
+    Per stage: wall time, graph build, expansion and MultiProc run time, number of nodes, summed node runtime,
+    critical path and size of outputs and working dir. Appended as one json line per run to bench_dir/results.jsonl,
+    with the package's git commit (see compare_benchmarks).
+    :param stage_options: keyword arguments of the stage functions, as stages in the pipeline config
+    :return: DataFrame with one row per stage (and acquisition)
+    """
+    from ..pipeline import Pipeline, STAGES
+    from ..workdir import dir_size
+
+    bench_dir = Path(bench_dir).resolve()
+    stages = [s for s in STAGES if s in (stages or DEFAULT_STAGES)]
+    dirs, cohort = get_cohort(bench_dir / "cohort", n_cpu=n_cpu or 1, **cohort_kwargs)
+    run_id = datetime.now().strftime("%Y%m%d-%H%M%S")
+    run_dir = bench_dir / "runs" / run_id
+    options = {"smriprep06": cohort["smriprep06"]}
+    stage_options = dict(stage_options or {})
+    for stage in ["template", "t1w", "stream"]:
+        stage_options[stage] = dict(options, **stage_options.get(stage, {}))
+    config = {"bids_dir": dirs["bids_dir"], "smriprep_dir": dirs["smriprep_dir"],
+              "training_data_dir": dirs["training_data_dir"], "base_dir": run_dir / "out",
+              "work_dir": run_dir / "work", "acqs": cohort["acqs"], "n_cpu": n_cpu, "stages": stage_options}
+
+    env = standin_env(dirs["fsldir"])
+    previous_env = {k: os.environ.get(k) for k in env}
+    os.environ.update(env)
+    rows = []
+    try:
+        pipeline = Pipeline(config)
+        for stage in stages:
+            for acq in ([None] if stage in ["template", "t1w"] else cohort["acqs"]):
+                print(f"\n### benchmark {stage} {acq or ''}")
+                start = time.time()
+                getattr(pipeline, stage)(*([acq] if acq else []))
+                row = {"stage": stage, "acq": acq, "wall_s": time.time() - start}
+                out_dir, wd_dir, _ = pipeline.dirs(stage, acq)
+                row.update(stage_timing(wd_dir))
+                row.update(out_mb=dir_size(out_dir) / 1e6, wd_mb=dir_size(wd_dir) / 1e6)
+                rows.append(row)
+    finally:
+        for k, v in previous_env.items():
+            if v is None:
+                os.environ.pop(k, None)
+            else:
+                os.environ[k] = v
+        if not keep:
+            shutil.rmtree(run_dir, ignore_errors=True)
+
+    record = {"run_id": run_id, "label": label, "commit": git_commit(), "version": __version__,
+              "host": socket.gethostname(), "n_cpu": n_cpu, "cohort": cohort, "stages": rows}
+    with open(bench_dir / "results.jsonl", "a") as fi:
+        fi.write(json.dumps(record, default=float) + "\n")
+    df = pd.DataFrame(rows)
+    print(df.to_string(index=False, float_format=lambda x: f"{x:.2f}"))
+    return df
+
+
+def load_results(results_file):
+    """one row per run and stage of a results.jsonl, with the run's commit, label and cohort size"""
+    rows = []
+    for line in Path(results_file).read_text().splitlines():
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        run = {k: record.get(k) for k in ["run_id", "label", "commit", "host", "n_cpu"]}
+        run.update(n_subjects=record["cohort"]["n_subjects"], n_sessions=record["cohort"]["n_sessions"],
+                   resolution=record["cohort"]["resolution"])
+        rows += [dict(run, **s) for s in record["stages"]]
+    return pd.DataFrame(rows)
+
+
+def compare_benchmarks(results_file, a=None, b=None, metric="wall_s"):
+    """
+    metric per stage of two runs (run_id, label or commit; default: the last two runs), with the ratio b / a.
+    Runs should be on the same cohort and host.
+    """
+    df = load_results(results_file)
+    runs = df.drop_duplicates("run_id").run_id.tolist()
+
+    def run_of(key, default):
+        if key is None:
+            return default
+        matches = df[(df.run_id == key) | (df.label == key) | (df.commit == key)].run_id
+        if matches.empty:
+            raise ValueError(f"No run with id, label or commit {key} in {results_file}")
+        return matches.iloc[-1]
+
+    if len(runs) < 2 and (a is None or b is None):
+        raise ValueError(f"{results_file} has fewer than two runs")
+    run_a, run_b = run_of(a, runs[-2]), run_of(b, runs[-1])
+    table = df[df.run_id.isin([run_a, run_b])].fillna({"acq": ""}).pivot_table(
+        index=["stage", "acq"], columns="run_id", values=metric, sort=False)[[run_a, run_b]]
+    names = {r: "{} ({})".format(r, df[df.run_id == r].commit.iloc[0]) for r in [run_a, run_b]}
+    table["ratio"] = table[run_b] / table[run_a]
+    return table.rename(columns=names)
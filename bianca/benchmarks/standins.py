@@ -0,0 +1,491 @@
+"""
+Stand-ins for the FSL and ANTs executables the pipeline calls (incl. the ones make_bianca_mask runs), for benchmarks
+without FSL/ANTs. They take the same command lines and write outputs with the expected names, grids and data types,
+computed with cheap numpy/scipy operations instead of the real algorithms: registrations resample with the images'
+affines (the synthetic cohort's images are aligned) and write identity matrices and zero warps, N4 copies its input,
+bianca writes an intensity-based lesion probability map. scipy is imported only by the tools that need it, as
+interpreter start-up dominates the runtime of most calls.
+python -m bianca.benchmarks.standins TOOL [ARGS], installed as executables by install_standins
+"""
+import os
+import re
+import sys
+import shutil
+from decimal import Decimal
+from pathlib import Path
+
+import numpy as np
+import nibabel as nb
+
+FSL_TOOLS = ["flirt", "fnirt", "invwarp", "applywarp", "convert_xfm", "fslreorient2std", "fslmaths", "fslstats",
+             "fslroi", "fslmerge", "fslval", "fslcpgeom", "imcp", "cluster", "distancemap", "bianca",
+             "bianca_cluster_stats", "bianca_overlap_measures"]
+ANTS_TOOLS = ["N4BiasFieldCorrection", "antsRegistration"]
+DTYPES = {"char": np.uint8, "short": np.int16, "int": np.int32, "float": np.float32, "double": np.float64}
+
+
+def _is_number(s):
+    try:
+        float(s)
+        return True
+    except ValueError:
+        return False
+
+
+def _parse(args, takes_value=()):
+    """-k value / --key=value options and positional arguments; options not in takes_value are flags"""
+    opts, positional = {}, []
+    it = iter(args)
+    for a in it:
+        if a.startswith("-") and len(a) > 1 and not _is_number(a):
+            key, eq, value = a.lstrip("-").partition("=")
+            opts[key] = value if eq else (next(it) if key in takes_value else True)
+        else:
+            positional.append(a)
+    return opts, positional
+
+
+def _get(opts, *keys):
+    for k in keys:
+        if k in opts:
+            return opts[k]
+    return None
+
+
+def image_path(p):
+    """existing image p, with fsl's extension completion (p, p.nii.gz, p.nii)"""
+    for f in [p, p + ".nii.gz", p + ".nii"]:
+        if Path(f).is_file():
+            return f
+    raise FileNotFoundError(f"Image {p} not found")
+
+
+def out_path(p):
+    if p.endswith((".nii", ".nii.gz")):
+        return p
+    return p + (".nii" if os.environ.get("FSLOUTPUTTYPE") == "NIFTI" else ".nii.gz")
+
+
+def load(p):
+    return nb.load(image_path(p))
+
+
+def data(img):
+    return np.asanyarray(img.dataobj).astype(np.float32)
+
+
+def save(d, like, out, dtype=None):
+    dtype = dtype or like.get_data_dtype()
+    if np.issubdtype(dtype, np.integer):
+        d = np.rint(d)
+    header = like.header.copy()
+    header.set_data_shape(d.shape)
+    img = nb.Nifti1Image(np.asarray(d).astype(dtype), like.affine, header)
+    img.set_data_dtype(dtype)
+    img.header.set_slope_inter(None, None)
+    out = out_path(out)
+    nb.save(img, out)
+    return out
+
+
+def resample(img, ref, order=1):
+    """img's data on ref's grid (world coordinates from the affines)"""
+    from scipy import ndimage
+    m = np.linalg.inv(img.affine) @ ref.affine
+    return ndimage.affine_transform(data(img)[..., 0] if len(img.shape) > 3 else data(img), m[:3, :3], m[:3, 3],
+                                    output_shape=ref.shape[:3], order=order, mode="constant", cval=0)
+
+
+def _write_mat(f, m):
+    np.savetxt(f, m, fmt="%.10f", delimiter="  ")
+
+
+def flirt(args):
+    opts, _ = _parse(args, {"in", "ref", "out", "omat", "init", "interp", "dof", "cost", "searchcost", "bins",
+                            "datatype", "applyisoxfm", "wmseg", "refweight", "inweight"})
+    ref = load(opts["ref"])
+    mat = np.loadtxt(opts["init"]) if "init" in opts else np.eye(4)
+    if "out" in opts:
+        img = load(opts["in"])
+        order = 0 if opts.get("interp") == "nearestneighbour" else 1
+        save(resample(img, ref, order), ref, opts["out"], np.float32)
+    if "omat" in opts:
+        _write_mat(opts["omat"], mat)
+
+
+def fnirt(args):
+    opts, _ = _parse(args)
+    ref = load(opts["ref"])
+    if "iout" in opts:
+        save(resample(load(opts["in"]), ref), ref, opts["iout"], np.float32)
+    for k in ["fout", "cout"]:
+        if k in opts:
+            save(np.zeros(ref.shape[:3] + (3,)), ref, opts[k], np.float32)
+    if "jout" in opts:
+        save(np.ones(ref.shape[:3]), ref, opts["jout"], np.float32)
+    if "logout" in opts:
+        Path(opts["logout"]).write_text("fnirt stand-in\n")
+
+
+def invwarp(args):
+    opts, _ = _parse(args, {"w", "r", "o"})
+    ref = load(_get(opts, "ref", "r"))
+    save(np.zeros(ref.shape[:3] + (3,)), ref, _get(opts, "out", "o"), np.float32)
+
+
+def applywarp(args):
+    opts, _ = _parse(args, {"i", "o", "r", "w", "premat", "postmat"})
+    ref = load(_get(opts, "ref", "r"))
+    order = 0 if opts.get("interp") == "nn" else 1
+    save(resample(load(_get(opts, "in", "i")), ref, order), ref, _get(opts, "out", "o"), np.float32)
+
+
+def convert_xfm(args):
+    opts, positional = _parse(args, {"omat", "concat"})
+    if "concat" in opts:
+        # -concat B A: A is applied first
+        mat = np.loadtxt(opts["concat"]) @ np.loadtxt(positional[0])
+    elif "inverse" in opts:
+        mat = np.linalg.inv(np.loadtxt(positional[0]))
+    else:
+        mat = np.loadtxt(positional[0])
+    _write_mat(opts["omat"], mat)
+
+
+def fslreorient2std(args):
+    if len(args) == 1:
+        print("\n".join("  ".join(f"{v:.6f}" for v in row) for row in np.eye(4)))
+        return
+    img = load(args[0])
+    save(data(img), img, args[1])
+
+
+def imcp(args):
+    src, dst = image_path(args[0]), args[1]
+    if not dst.endswith((".nii", ".nii.gz")):
+        dst += ".nii.gz" if src.endswith(".gz") else ".nii"
+    shutil.copyfile(src, dst)
+
+
+def _kernel(kind, size, zooms):
+    if kind == "sphere":
+        radius = np.ceil(size / np.asarray(zooms)).astype(int)
+        grid = np.ogrid[tuple(slice(-r, r + 1) for r in radius)]
+        return sum((g * z / size) ** 2 for g, z in zip(grid, zooms)) <= 1
+    if kind == "box":
+        radius = np.floor(size / np.asarray(zooms) / 2).astype(int)
+        return np.ones(tuple(2 * r + 1 for r in radius), bool)
+    if kind == "boxv":
+        return np.ones((int(size),) * 3, bool)
+    return np.ones((3, 3, 3), bool)
+
+
+def _morphology(op, d, footprint):
+    from scipy import ndimage
+    if op == "-dilF":
+        return ndimage.grey_dilation(d, footprint=footprint)
+    if op in ["-dilM", "-dilD"]:
+        return np.where(d != 0, d, ndimage.grey_dilation(d, footprint=footprint))
+    if op in ["-ero", "-eroF"]:
+        return d * ndimage.binary_erosion(d != 0, structure=footprint)
+    return ndimage.binary_fill_holes(d > 0).astype(np.float64)
+
+
+def fslmaths(args):
+    args = list(args)
+    if args[0] == "-dt":
+        args = args[2:]
+    img = load(args[0])
+    zooms = img.header.get_zooms()[:3]
+    d = data(img).astype(np.float64)
+    out, dtype = None, img.get_data_dtype()
+    footprint = np.ones((3, 3, 3), bool)
+
+    def operand(v):
+        if _is_number(v):
+            return float(v)
+        o = data(load(v))
+        return o[..., np.newaxis] if o.ndim < d.ndim else o
+
+    it = iter(args[1:])
+    for a in it:
+        if a == "-thr":
+            d[d < float(next(it))] = 0
+        elif a == "-uthr":
+            d[d > float(next(it))] = 0
+        elif a == "-bin":
+            d = (d > 0).astype(np.float64)
+        elif a == "-binv":
+            d = (d <= 0).astype(np.float64)
+        elif a in ["-add", "-sub", "-mul", "-div", "-max", "-min", "-mas"]:
+            o = operand(next(it))
+            if a == "-add":
+                d = d + o
+            elif a == "-sub":
+                d = d - o
+            elif a == "-mul":
+                d = d * o
+            elif a == "-div":
+                d = np.divide(d, o, out=np.zeros_like(d), where=np.asarray(o) != 0)
+            elif a == "-max":
+                d = np.maximum(d, o)
+            elif a == "-min":
+                d = np.minimum(d, o)
+            else:
+                d = d * (np.asarray(o) > 0)
+        elif a == "-kernel":
+            kind = next(it)
+            size = float(next(it)) if kind in ["sphere", "box", "boxv", "gauss"] else None
+            footprint = _kernel(kind, size, zooms)
+        elif a in ["-dilF", "-dilM", "-dilD", "-ero", "-eroF", "-fillh", "-fillh26"]:
+            d = np.stack([_morphology(a, d[..., t], footprint) for t in range(d.shape[3])], -1) if d.ndim > 3 \
+                else _morphology(a, d, footprint)
+        elif a in ["-Tmean", "-Tmax", "-Tmin", "-Tstd"]:
+            if d.ndim > 3:
+                d = {"-Tmean": np.mean, "-Tmax": np.max, "-Tmin": np.min, "-Tstd": np.std}[a](d, axis=3)
+        elif a == "-abs":
+            d = np.abs(d)
+        elif a == "-odt":
+            value = next(it)
+            dtype = img.get_data_dtype() if value == "input" else DTYPES[value]
+        elif a.startswith("-") and not _is_number(a):
+            raise SystemExit(f"fslmaths stand-in: unsupported operation {a}")
+        else:
+            out = a
+    save(d, img, out, dtype)
+
+
+def fslstats(args):
+    args = [a for a in args if a != "-t"]
+    d = data(load(args[0]))
+    lower, upper, mask = -np.inf, np.inf, None
+    results = []
+    it = iter(args[1:])
+    for a in it:
+        selected = (d != 0) & (d > lower) & (d < upper)
+        if mask is not None:
+            selected &= mask
+        values = d[selected]
+        if a == "-l":
+            lower = float(next(it))
+        elif a == "-u":
+            upper = float(next(it))
+        elif a == "-k":
+            mask = data(load(next(it))) > 0
+        elif a in ["-P", "-p"]:
+            p = float(next(it))
+            v = values if a == "-P" else d[(d > lower) & (d < upper)]
+            results.append(np.percentile(v, p) if v.size else 0)
+        elif a in ["-V", "-v"]:
+            n = int(selected.sum()) if a == "-V" else int(((d > lower) & (d < upper)).sum())
+            results += [n, n * float(np.prod(load(args[0]).header.get_zooms()[:3]))]
+        elif a in ["-M", "-m"]:
+            v = values if a == "-M" else d
+            results.append(v.mean() if v.size else 0)
+        elif a in ["-R", "-r"]:
+            v = values if a == "-R" and values.size else d
+            results += [v.min(), v.max()]
+        elif a in ["-S", "-s"]:
+            v = values if a == "-S" else d
+            results.append(v.std() if v.size else 0)
+        elif a == "-w":
+            idx = np.argwhere(d != 0)
+            if not idx.size:
+                results += [0] * 8
+            else:
+                lo, hi = idx.min(0), idx.max(0)
+                ext = [x for i in range(3) for x in (lo[i], hi[i] - lo[i] + 1)]
+                results += [int(x) for x in ext] + [0, 1]
+        else:
+            raise SystemExit(f"fslstats stand-in: unsupported option {a}")
+    print(" ".join(f"{r:.6f}" if isinstance(r, (float, np.floating)) else str(r) for r in results) + " ")
+
+
+def fslroi(args):
+    img = load(args[0])
+    d = data(img)
+    bounds = [int(v) for v in args[2:]]
+    if len(bounds) == 2:
+        bounds = [0, -1, 0, -1, 0, -1] + bounds
+    index = []
+    for axis, (start, size) in enumerate(zip(bounds[::2], bounds[1::2])):
+        if axis < d.ndim:
+            index.append(slice(start, None if size < 0 else start + size))
+    roi = d[tuple(index)]
+    # keep the world position of the roi
+    affine = img.affine.copy()
+    affine[:3, 3] = (img.affine @ np.r_[[s.start for s in index[:3]], 1])[:3]
+    save(roi, nb.Nifti1Image(roi, affine, img.header), args[1])
+
+
+def fslmerge(args):
+    axis = {"-x": 0, "-y": 1, "-z": 2, "-t": 3, "-a": 3, "-tr": 3}[args[0]]
+    out = args[1]
+    inputs = args[2:-1] if args[0] == "-tr" else args[2:]
+    imgs = [load(f) for f in inputs]
+    ds = [data(i) for i in imgs]
+    if axis == 3:
+        ds = [x[..., np.newaxis] if x.ndim == 3 else x for x in ds]
+    save(np.concatenate(ds, axis=axis), imgs[0], out)
+
+
+def fslval(args):
+    header = load(args[0]).header
+    m = re.fullmatch(r"(pix)?dim(\d)", args[1])
+    print(f"{header['pixdim'][int(m[2])]:.6f}" if m[1] else header["dim"][int(m[2])])
+
+
+def fslcpgeom(args):
+    src = load(args[0])
+    dst_file = image_path(args[1])
+    dst = nb.load(dst_file)
+    d = data(dst)
+    save(d, nb.Nifti1Image(d, src.affine, dst.header), dst_file, dst.get_data_dtype())
+
+
+def cluster(args):
+    from scipy import ndimage
+    opts, _ = _parse(args, {"i", "t", "o"})
+    img = load(_get(opts, "in", "i"))
+    d = data(img)
+    thresh = float(_get(opts, "thresh", "t"))
+    connectivity = {"6": 1, "18": 2, "26": 3}[str(opts.get("connectivity", "26"))]
+    labels, n = ndimage.label(d > thresh, structure=ndimage.generate_binary_structure(3, connectivity))
+    sizes = np.bincount(labels.ravel(), minlength=n + 1)
+    sizes[0] = 0
+    # fsl's cluster index: 1 for the smallest, n for the largest cluster
+    rank = np.zeros(n + 1, int)
+    rank[1:][np.argsort(sizes[1:], kind="stable")] = np.arange(1, n + 1)
+    index_file = _get(opts, "oindex", "o")
+    if index_file:
+        save(rank[labels], img, index_file, np.int32)
+    if "osize" in opts:
+        save(sizes[labels], img, opts["osize"], np.int32)
+
+
+def distancemap(args):
+    from scipy import ndimage
+    opts, _ = _parse(args, {"i", "o", "m"})
+    img = load(_get(opts, "in", "i"))
+    zooms = img.header.get_zooms()[:3]
+    d = ndimage.distance_transform_edt(data(img) == 0, sampling=zooms)
+    if "secondim" in opts:
+        second = data(load(opts["secondim"])) > 0
+        d = np.where(second, -ndimage.distance_transform_edt(second, sampling=zooms), d)
+    mask = _get(opts, "mask", "m")
+    if mask:
+        d = d * (data(load(mask)) > 0)
+    save(d, img, _get(opts, "out", "o"), np.float32)
+
+
+def bianca(args):
+    """LPM of the query subject: FLAIR intensities above the brain's 90th percentile, scaled to [0, 1]"""
+    opts, _ = _parse(args, {"o"})
+    rows = [line.split() for line in Path(opts["singlefile"]).read_text().splitlines() if line.strip()]
+    query = rows[int(opts["querysubjectnum"]) - 1]
+    features = [int(i) - 1 for i in opts.get("featuresubset", "1").split(",")]
+    flair = load(query[features[0]])
+    brain = data(load(query[int(opts.get("brainmaskfeaturenum", features[0] + 1)) - 1])) > 0
+    d = data(flair)
+    lo, hi = np.percentile(d[brain], [90, 99.9]) if brain.any() else (0, 1)
+    lpm = np.clip((d - lo) / max(hi - lo, 1e-6), 0, 1) * brain
+    save(lpm, flair, opts.get("o", "output_bianca.nii.gz"), np.float32)
+    if "saveclassifierdata" in opts:
+        Path("classifier").write_text(f"bianca stand-in classifier, training subjects {opts.get('trainingnums')}\n")
+        Path("classifier_labels").write_text("\n".join("0" for _ in rows) + "\n")
+
+
+def bianca_cluster_stats(args):
+    from bianca.threshold_engine import cluster_stats, format_cluster_stats
+    img = load(args[0])
+    d = data(img)
+    if len(args) > 3:
+        d = d * (data(load(args[3])) > 0)
+    s = cluster_stats(d >= float(args[1]), float(np.prod(img.header.get_zooms()[:3])), int(args[2]))
+    print(format_cluster_stats(s), end="")
+
+
+def bianca_overlap_measures(args):
+    from bianca.threshold_engine import overlap_sweep
+    lpm = image_path(args[0])
+    # the LPM's nonzero voxels as wm mask
+    df = overlap_sweep(lpm, lpm, image_path(args[2]), [float(args[1])])
+    values = " ".join(str(v) for v in df.iloc[0, 1:].tolist())
+    out = Path(lpm).parent / ("Overlap_and_Volumes_" + Path(lpm).name.replace(".nii.gz", f"_{args[1]}.txt"))
+    if len(args) > 3 and args[3] == "1":
+        out.write_text(values + "\n")
+    else:
+        print(values)
+
+
+def N4BiasFieldCorrection(args):
+    opts, positional = _parse(args, {"i", "o", "x", "d", "s", "c", "b", "w", "r", "t", "v", "input-image", "output",
+                                     "mask-image", "image-dimensionality", "shrink-factor", "convergence",
+                                     "bspline-fitting", "weight-image", "rescale-intensities", "histogram-sharpening",
+                                     "verbose"})
+    img = load(_get(opts, "input-image", "i"))
+    output = _get(opts, "output", "o")
+    if output.startswith("[") and not output.endswith("]"):
+        # nipype writes --output [ corrected, bias ], i.e. over several arguments
+        output = " ".join([output] + positional[:positional.index("]") + 1])
+    outputs = [o.strip() for o in output.strip("[] ").split(",")]
+    save(data(img), img, outputs[0], np.float32)
+    if len(outputs) > 1:
+        save(np.ones(img.shape), img, outputs[1], np.float32)
+
+
+def antsRegistration(args):
+    print("ANTs Version: 2.3.5 (stand-in)")
+
+
+def bc(args):
+    """the subset of bc make_bianca_mask uses: arithmetic and if ( a <op> b ) { 1 }"""
+    def number(m):
+        return f"Decimal('{m[0]}')"
+
+    for line in sys.stdin.read().splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        m = re.fullmatch(r"if\s*\((.+)\)\s*\{\s*(\S+)\s*\}", line)
+        expr = m[1] if m else line
+        if not re.fullmatch(r"[\d.\s+\-*/()<>=!]+", expr):
+            raise SystemExit(f"bc stand-in: unsupported expression {line}")
+        value = eval(re.sub(r"\d+\.?\d*|\.\d+", number, expr), {"Decimal": Decimal})
+        if m:
+            if value:
+                print(m[2])
+        else:
+            print("0" if value == 0 else str(value))
+
+
+TOOLS = {name: globals()[name] for name in FSL_TOOLS + ANTS_TOOLS + ["bc"]}
+
+
+def install_standins(bin_dir, python=sys.executable):
+    """
+    Writes an executable wrapper per tool into bin_dir. bc (used by make_bianca_mask) is only installed if it is not
+    on the PATH.
+    :return: list of installed tools
+    """
+    bin_dir = Path(bin_dir)
+    bin_dir.mkdir(parents=True, exist_ok=True)
+    package_root = Path(__file__).parents[2]
+    tools = FSL_TOOLS + ANTS_TOOLS + ([] if shutil.which("bc") else ["bc"])
+    for tool in tools:
+        f = bin_dir / tool
+        f.write_text(f'#!/bin/sh\nPYTHONPATH="{package_root}:$PYTHONPATH" exec "{python}" -m '
+                     f'bianca.benchmarks.standins {tool} "$@"\n')
+        f.chmod(0o755)
+    return tools
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] not in TOOLS:
+        raise SystemExit(f"usage: python -m bianca.benchmarks.standins TOOL [ARGS], tools: {', '.join(TOOLS)}")
+    TOOLS[argv[0]](argv[1:])
+
+
+if __name__ == "__main__":
+    main()
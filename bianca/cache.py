@@ -0,0 +1,119 @@
+import os
+import gzip
+import json
+import shutil
+import hashlib
+from pathlib import Path
+from functools import lru_cache
+
+
+@lru_cache(maxsize=None)
+def _file_checksum(path, size, mtime_ns):
+    h = hashlib.sha1()
+    with open(path, "rb") as fi:
+        for block in iter(lambda: fi.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def file_checksum(path):
+    """sha1 of the file content; memoized per process on (path, size, mtime)"""
+    st = os.stat(path)
+    return _file_checksum(str(path), st.st_size, st.st_mtime_ns)
+
+
+@lru_cache(maxsize=None)
+def _gzip_content_checksum(path, size, mtime_ns):
+    h = hashlib.sha1()
+    with gzip.open(path, "rb") as fi:
+        for block in iter(lambda: fi.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def content_checksum(path):
+    """like file_checksum, but of the uncompressed content of .gz files (their headers hold a timestamp)"""
+    if not str(path).endswith(".gz"):
+        return file_checksum(path)
+    st = os.stat(path)
+    return _gzip_content_checksum(str(path), st.st_size, st.st_mtime_ns)
+
+
+def hash_dict(d):
+    """sha1 of a json-serializable object"""
+    return hashlib.sha1(json.dumps(d, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class ContentCache:
+    """
+    Directory of cache entries (one sub-directory per key) with LRU eviction under a size budget.
+    Entries are written to a temporary directory and renamed, so concurrent readers never see partial entries.
+    The mtime of an entry's directory is its last use.
+    """
+
+    def __init__(self, cache_dir, max_size_gb=20):
+        self.cache_dir = Path(cache_dir)
+        self.max_size = max_size_gb * 1024 ** 3
+
+    def get(self, key):
+        """returns the entry directory of key (and marks it as used) or None"""
+        entry = self.cache_dir / key
+        if not (entry / "meta.json").is_file():
+            return None
+        os.utime(entry)
+        return entry
+
+    def checkout(self, key, dest_dir, names):
+        """
+        Copies the files names of key's entry to dest_dir (and marks the entry as used), so they can be used while
+        other processes evict entries.
+        :return: dest_dir, or None if there is no entry (also if it is evicted while copying)
+        """
+        entry = self.get(key)
+        if entry is None:
+            return None
+        dest_dir = Path(dest_dir)
+        dest_dir.mkdir(parents=True, exist_ok=True)
+        try:
+            for name in names:
+                shutil.copyfile(entry / name, dest_dir / name)
+        except FileNotFoundError:
+            return None
+        return dest_dir
+
+    def put(self, key, files, meta=None):
+        """
+        :param files: dict name in entry -> source file
+        :param meta: json-serializable information stored in meta.json
+        :return: entry directory
+        """
+        entry = self.cache_dir / key
+        tmp_entry = self.cache_dir / f".tmp_{key}_{os.getpid()}"
+        tmp_entry.mkdir(parents=True, exist_ok=True)
+        for name, f in files.items():
+            shutil.copyfile(f, tmp_entry / name)
+        (tmp_entry / "meta.json").write_text(json.dumps(meta or {}, indent=2, default=str))
+        try:
+            tmp_entry.rename(entry)
+        except OSError:
+            # entry written by another process in the meantime
+            shutil.rmtree(tmp_entry)
+        os.utime(entry)
+        self.evict()
+        return entry
+
+    @staticmethod
+    def _entry_size(entry):
+        return sum(f.stat().st_size for f in entry.iterdir() if f.is_file())
+
+    def evict(self):
+        """removes least recently used entries until the cache is within its size budget"""
+        entries = [e for e in self.cache_dir.iterdir() if e.is_dir() and not e.name.startswith(".")]
+        entries.sort(key=lambda e: e.stat().st_mtime)
+        sizes = {e: self._entry_size(e) for e in entries}
+        total = sum(sizes.values())
+        for e in entries[:-1]:  # never evict the most recent entry
+            if total <= self.max_size:
+                break
+            shutil.rmtree(e, ignore_errors=True)
+            total -= sizes[e]
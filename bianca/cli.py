@@ -0,0 +1,234 @@
+"""
+Command line interface for the pipeline stages, e.g.
+python -m bianca prepare_t1w BIDS_DIR SMRIPREP_DIR OUT_DIR WD_DIR CRASH_DIR --shard 2/4
+python -m bianca merge OUT_DIR prepare_t1w
+python -m bianca report WD_DIR
+python -m bianca benchmark BENCH_DIR --n-subjects 20
+python -m bianca run template t1w flair masterfile bianca threshold locate --config config.yml
+"""
+import argparse
+from pathlib import Path
+
+from .pipeline import STAGES
+
+
+def _sessions(args, bids_dir, flair_acq="*"):
+    from .utils import get_subject_sessions
+    subjects_sessions = get_subject_sessions(bids_dir, flair_acq)
+    if args.participant_label:
+        subjects_sessions = [s for s in subjects_sessions if s[0] in args.participant_label]
+    return subjects_sessions
+
+
+def _lpm_sessions(args):
+    from .dataset_index import get_dataset_index, parse_entities
+    lpms = get_dataset_index(args.bianca_dir).glob(f"sub-*/ses-*/anat/*_acq-{args.flair_acq}_*_FLAIR_LPM.nii.gz")
+    subjects_sessions = sorted({(d["subject"], d["session"]) for d in (parse_entities(f.name) for f in lpms)})
+    if args.participant_label:
+        subjects_sessions = [s for s in subjects_sessions if s[0] in args.participant_label]
+    return subjects_sessions
+
+
+def _common(kwargs, args):
+    kwargs.update(n_cpu=args.n_cpu, skip_completed=not args.no_skip_completed, shard=args.shard)
+    if args.shard_size:
+        kwargs.update(shard_size=args.shard_size)
+    return kwargs
+
+
+def _node_cache(kwargs, args):
+    if args.node_cache_dir:
+        kwargs.update(node_cache_dir=args.node_cache_dir, node_cache_max_gb=args.node_cache_max_gb)
+    return kwargs
+
+
+def prepare_template_cmd(args):
+    from .workflows.prepare_template import prepare_template
+    subjects = sorted({s for s, _ in _sessions(args, args.bids_dir)})
+    prepare_template(args.bids_dir, args.smriprep_dir, args.out_dir, args.wd_dir, args.crash_dir, subjects,
+                     **_common(_node_cache(dict(omp_nthreads=args.omp_nthreads, smriprep06=args.smriprep06,
+                                                smriprep_mni_space=args.smriprep_mni_space), args), args))
+
+
+def prepare_t1w_cmd(args):
+    from .workflows.prepare_t1w import prepare_t1w
+    prepare_t1w(args.bids_dir, args.smriprep_dir, args.out_dir, args.wd_dir, args.crash_dir,
+                _sessions(args, args.bids_dir),
+                **_common(_node_cache(dict(omp_nthreads=args.omp_nthreads, smriprep06=args.smriprep06,
+                                           smriprep_affines=args.smriprep_affines,
+                                           affine_min_corr=args.affine_min_corr), args), args))
+
+
+def prepare_flair_cmd(args):
+    from .workflows.prepare_flair import prepare_bianca_data
+    prepare_bianca_data(args.bids_dir, args.template_prep_dir, args.t1w_prep_dir, args.out_dir, args.wd_dir,
+                        args.crash_dir, _sessions(args, args.bids_dir, args.flair_acq), flair_acq=args.flair_acq,
+                        **_common(_node_cache(dict(omp_nthreads=args.omp_nthreads), args), args))
+
+
+def prepare_flair_intNorm_cmd(args):
+    from .workflows.prepare_flair_intNorm import prepare_flair_intNorm
+    prepare_flair_intNorm(args.flair_prep_dir, args.out_dir, args.wd_dir, args.crash_dir,
+                          _sessions(args, args.bids_dir, args.flair_acq), flair_acq=args.flair_acq,
+                          **_common({}, args))
+
+
+def run_bianca_cmd(args):
+    from .workflows.bianca import run_bianca
+    run_bianca(args.out_dir, args.wd_dir, args.crash_dir, engine=args.engine,
+               **_common(dict(clf_cache_dir=args.clf_cache_dir), args))
+
+
+def bianca_threshold_cmd(args):
+    from .workflows.bianca_threshold import bianca_threshold
+    bianca_threshold(args.bianca_dir, args.mask_dir, args.flair_prep_dir, args.wd_dir, args.crash_dir, args.out_dir,
+                     _lpm_sessions(args), args.flair_acq, args.thresholds, engine=args.engine,
+                     run_BiancaOverlapMeasures=args.overlap_measures, **_common({}, args))
+
+
+def merge_cmd(args):
+    from .shards import merge_shards
+    report = merge_shards(args.out_dir, args.stage, tables=args.tables)
+    problems = report[~report.status.isin(["done", "previous"])]
+    if len(problems):
+        print(problems.to_string(index=False))
+        raise SystemExit(f"{len(problems)} sessions were not done exactly once")
+
+
+def report_cmd(args):
+    from .runtime_report import runtime_report
+    runtime_report(args.wd_dir, args.out_dir)
+
+
+def benchmark_cmd(args):
+    from .pipeline import load_config
+    from .benchmarks.run import run_benchmark
+    stage_options = (load_config(args.config).get("stages") or {}) if args.config else None
+    run_benchmark(args.bench_dir, stages=args.stages, n_cpu=args.n_cpu, label=args.label, stage_options=stage_options,
+                  keep=args.keep, n_subjects=args.n_subjects, n_sessions=args.n_sessions, acqs=args.acqs,
+                  resolution=args.resolution)
+
+
+def compare_benchmarks_cmd(args):
+    from .benchmarks.run import compare_benchmarks
+    print(compare_benchmarks(args.results_file, args.a, args.b, args.metric).to_string(
+        float_format=lambda x: f"{x:.2f}"))
+
+
+def run_cmd(args):
+    from .pipeline import run_pipeline
+    run_pipeline(args.config, args.stages)
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(prog="bianca", description="bianca pipeline stages")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    def add(name, func, dirs, help):
+        p = subparsers.add_parser(name, help=help)
+        for d in dirs:
+            p.add_argument(d, type=Path)
+        p.add_argument("--participant-label", nargs="+", help="only these subjects")
+        p.add_argument("--n-cpu", type=int, help="default: all CPUs available (host or cgroup limit)")
+        p.add_argument("--shard", help="i/N: run shard i of N (1-based), e.g. 2/4; merge with `bianca merge`")
+        p.add_argument("--shard-size", type=int, help="run the (shard's) sessions in sub-graphs of this size")
+        p.add_argument("--no-skip-completed", action="store_true",
+                       help="also run sessions that are complete according to the stage's manifest")
+        p.set_defaults(func=func)
+        return p
+
+    def add_node_cache(p):
+        p.add_argument("--node-cache-dir", type=Path,
+                       help="persistent cache of FNIRT, InvWarp and N4 outputs, keyed by input contents and parameters")
+        p.add_argument("--node-cache-max-gb", type=float, default=50)
+
+    p = add("prepare_template", prepare_template_cmd,
+            ["bids_dir", "smriprep_dir", "out_dir", "wd_dir", "crash_dir"], "1. prepare template")
+    p.add_argument("--omp-nthreads", type=int, default=1)
+    p.add_argument("--smriprep06", action="store_true")
+    p.add_argument("--smriprep-mni-space",
+                   help="reuse smriprep's template<->MNI transforms of this space (e.g. MNI152NLin6Asym, fsl's MNI152) "
+                        "instead of FLIRT+FNIRT")
+    add_node_cache(p)
+
+    p = add("prepare_t1w", prepare_t1w_cmd, ["bids_dir", "smriprep_dir", "out_dir", "wd_dir", "crash_dir"],
+            "2. prepare t1w")
+    p.add_argument("--omp-nthreads", type=int, default=1)
+    p.add_argument("--smriprep06", action="store_true")
+    p.add_argument("--smriprep-affines", action="store_true",
+                   help="use smriprep's orig->template affines, FLIRT only for runs without one or failing the check")
+    p.add_argument("--affine-min-corr", type=float, default=0.9,
+                   help="minimal correlation of a run resampled with its affine with the template (brain mask)")
+    add_node_cache(p)
+
+    p = add("prepare_flair", prepare_flair_cmd,
+            ["bids_dir", "template_prep_dir", "t1w_prep_dir", "out_dir", "wd_dir", "crash_dir"], "3. prepare flair")
+    p.add_argument("--flair-acq", required=True)
+    p.add_argument("--omp-nthreads", type=int, default=1)
+    add_node_cache(p)
+
+    p = add("prepare_flair_intNorm", prepare_flair_intNorm_cmd,
+            ["bids_dir", "flair_prep_dir", "out_dir", "wd_dir", "crash_dir"], "FLAIR intensity normalization")
+    p.add_argument("--flair-acq", required=True)
+
+    p = add("run_bianca", run_bianca_cmd, ["out_dir", "wd_dir", "crash_dir"],
+            "5. run bianca (query subjects of out_dir/masterfile.txt)")
+    p.add_argument("--engine", default="fsl", choices=["fsl", "native"])
+    p.add_argument("--clf-cache-dir", type=Path)
+
+    p = add("bianca_threshold", bianca_threshold_cmd,
+            ["bianca_dir", "mask_dir", "flair_prep_dir", "wd_dir", "crash_dir", "out_dir"],
+            "7. bianca threshold (sessions with an LPM in bianca_dir)")
+    p.add_argument("--flair-acq", required=True)
+    p.add_argument("--thresholds", type=float, nargs="+", default=[.9])
+    p.add_argument("--engine", default="fsl", choices=["fsl", "numpy"])
+    p.add_argument("--overlap-measures", action="store_true", help="run_BiancaOverlapMeasures")
+
+    p = subparsers.add_parser("merge", help="check that every session of a sharded run was done exactly once and "
+                                            "combine the shards' manifests")
+    p.add_argument("out_dir", type=Path)
+    p.add_argument("stage", choices=["prepare_template", "prepare_t1w", "prepare_bianca_data",
+                                     "prepare_flair_intNorm", "run_bianca", "bianca_threshold"])
+    p.add_argument("--tables", nargs="*", default=["cluster_stats"],
+                   help="per-shard tables (out_dir/{table}_shard-*.tsv) to combine")
+    p.set_defaults(func=merge_cmd)
+
+    p = subparsers.add_parser("report", help="runtime report of a stage's working dir (runtime_nodes.csv and "
+                                             "runtime_report.html)")
+    p.add_argument("wd_dir", type=Path)
+    p.add_argument("--out-dir", type=Path, help="default: wd_dir")
+    p.set_defaults(func=report_cmd)
+
+    p = subparsers.add_parser("benchmark", help="run stages on a synthetic cohort with stand-in FSL/ANTs tools and "
+                                                "record their timing in bench_dir/results.jsonl")
+    p.add_argument("bench_dir", type=Path)
+    p.add_argument("--stages", nargs="+", choices=STAGES, help="default: template t1w flair intnorm masterfile "
+                                                                "bianca threshold")
+    p.add_argument("--n-subjects", type=int, default=10)
+    p.add_argument("--n-sessions", type=int, default=2)
+    p.add_argument("--acqs", nargs="+", default=["2D"])
+    p.add_argument("--resolution", type=float, default=2., help="voxel size (mm)")
+    p.add_argument("--n-cpu", type=int, help="default: all CPUs available (host or cgroup limit)")
+    p.add_argument("--label", help="name of the run for compare_benchmarks")
+    p.add_argument("--config", type=Path, help="pipeline config, only its stages options are used")
+    p.add_argument("--keep", action="store_true", help="keep outputs and working dirs (bench_dir/runs/<run id>)")
+    p.set_defaults(func=benchmark_cmd)
+
+    p = subparsers.add_parser("compare_benchmarks", help="stage timings of two benchmark runs (default: the last two)")
+    p.add_argument("results_file", type=Path)
+    p.add_argument("a", nargs="?", help="run id, label or commit")
+    p.add_argument("b", nargs="?", help="run id, label or commit")
+    p.add_argument("--metric", default="wall_s", help="e.g. wall_s, build_s, expand_s, run_s, node_s, wd_mb")
+    p.set_defaults(func=compare_benchmarks_cmd)
+
+    p = subparsers.add_parser("run", help="run several stages in one process, configured by a yaml/toml file "
+                                          "(see bianca.pipeline)")
+    p.add_argument("stages", nargs="+", choices=STAGES, help="stages, run in pipeline order")
+    p.add_argument("--config", type=Path, required=True)
+    p.set_defaults(func=run_cmd)
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    args.func(args)
@@ -0,0 +1,187 @@
+import os
+import sqlite3
+import hashlib
+from contextlib import closing, contextmanager
+from fnmatch import fnmatchcase
+from pathlib import Path
+
+ENTITIES = ["subject", "session", "acq", "run", "space", "desc"]
+_ENTITY_KEYS = {"sub": "subject", "ses": "session", "acq": "acq", "run": "run", "space": "space", "desc": "desc"}
+
+
+def parse_entities(name):
+    """
+    Splits a BIDS-like filename into its entities, suffix and extension.
+    parse_entities("sub-01_ses-tp1_acq-2D_run-1_FLAIR.nii.gz") ->
+        {"subject": "01", "session": "tp1", "acq": "2D", "run": "1", "space": None, "desc": None,
+         "suffix": "FLAIR", "extension": ".nii.gz"}
+    """
+    stem, dot, ext = name.partition(".")
+    d = {e: None for e in ENTITIES}
+    suffix = []
+    for part in stem.split("_"):
+        key, sep, value = part.partition("-")
+        if sep and key in _ENTITY_KEYS and not suffix:
+            d[_ENTITY_KEYS[key]] = value
+        else:
+            suffix.append(part)
+    d["suffix"] = "_".join(suffix) if suffix else None
+    d["extension"] = dot + ext
+    return d
+
+
+def _default_index_file(root):
+    index_dir = Path(os.environ.get("BIANCA_INDEX_DIR", Path.home() / ".cache" / "bianca"))
+    root_hash = hashlib.sha1(str(root).encode()).hexdigest()[:16]
+    return index_dir / f"index_{root_hash}.sqlite"
+
+
+class DatasetIndex:
+    """
+    Persistent index of all files below root, stored in sqlite.
+    Index file is kept outside of root (default: ~/.cache/bianca, or $BIANCA_INDEX_DIR), as input dirs are
+    often mounted read-only.
+    update() only re-lists directories whose mtime changed since the last scan, unchanged directories cost one
+    stat. Symlinked directories are followed (as by Path.glob), except links to one of their own ancestors.
+    """
+
+    def __init__(self, root, index_file=None):
+        self.root = Path(os.path.abspath(root))
+        self.index_file = Path(index_file) if index_file else _default_index_file(self.root)
+
+    @contextmanager
+    def _connect(self):
+        """Connection to the index file, committed (or rolled back on error) and closed on exit"""
+        self.index_file.parent.mkdir(parents=True, exist_ok=True)
+        with closing(sqlite3.connect(str(self.index_file), timeout=60)) as con, con:
+            con.execute("CREATE TABLE IF NOT EXISTS dirs (relpath TEXT PRIMARY KEY, parent TEXT, mtime_ns INTEGER)")
+            con.execute(f"CREATE TABLE IF NOT EXISTS files (relpath TEXT PRIMARY KEY, dir TEXT, "
+                        f"{', '.join(e + ' TEXT' for e in ENTITIES)}, suffix TEXT, extension TEXT)")
+            con.execute("CREATE INDEX IF NOT EXISTS files_dir ON files (dir)")
+            con.execute("CREATE INDEX IF NOT EXISTS files_suse ON files (subject, session)")
+            con.execute("CREATE INDEX IF NOT EXISTS dirs_parent ON dirs (parent)")
+            yield con
+
+    @property
+    def exists(self):
+        return self.index_file.is_file()
+
+    def update(self):
+        """Incrementally syncs the index with the file system. Returns number of re-listed directories."""
+        n_listed = 0
+        with self._connect() as con:
+            known = dict(con.execute("SELECT relpath, mtime_ns FROM dirs"))
+            seen = set()
+            stack = [""]
+            while stack:
+                rel = stack.pop()
+                try:
+                    mtime_ns = os.stat(self.root / rel).st_mtime_ns
+                except FileNotFoundError:
+                    continue
+                seen.add(rel)
+
+                if known.get(rel) == mtime_ns:
+                    stack.extend(r for r, in con.execute("SELECT relpath FROM dirs WHERE parent=?", (rel,)))
+                    continue
+
+                n_listed += 1
+                files, subdirs = [], []
+                with os.scandir(self.root / rel) as it:
+                    for entry in it:
+                        if entry.name.startswith("."):
+                            continue
+                        entry_rel = f"{rel}/{entry.name}" if rel else entry.name
+                        if entry.is_dir():
+                            if entry.is_symlink() and self._is_cycle(entry.path):
+                                continue
+                            subdirs.append(entry_rel)
+                        elif entry.is_file():
+                            files.append(entry_rel)
+
+                con.execute("DELETE FROM files WHERE dir=?", (rel,))
+                con.executemany(f"INSERT INTO files VALUES ({', '.join(['?'] * (len(ENTITIES) + 4))})",
+                                [self._file_row(f, rel) for f in files])
+                old_subdirs = {r for r, in con.execute("SELECT relpath FROM dirs WHERE parent=?", (rel,))}
+                con.executemany("DELETE FROM dirs WHERE relpath=?", [(s,) for s in old_subdirs - set(subdirs)])
+                con.executemany("INSERT OR IGNORE INTO dirs VALUES (?, ?, NULL)", [(s, rel) for s in subdirs])
+                parent = rel.rsplit("/", 1)[0] if "/" in rel else ("" if rel else None)
+                con.execute("INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)", (rel, parent, mtime_ns))
+                stack.extend(subdirs)
+
+            gone = set(known) - seen
+            con.executemany("DELETE FROM dirs WHERE relpath=?", [(g,) for g in gone])
+            con.executemany("DELETE FROM files WHERE dir=?", [(g,) for g in gone])
+        return n_listed
+
+    @staticmethod
+    def _is_cycle(link):
+        """True if the directory symlink link points to its own parent dir or one of its ancestors"""
+        target = os.path.realpath(link)
+        parent = os.path.realpath(os.path.dirname(link))
+        return parent == target or parent.startswith(target.rstrip(os.sep) + os.sep)
+
+    @staticmethod
+    def _file_row(relpath, dir):
+        d = parse_entities(relpath.rsplit("/", 1)[-1])
+        return [relpath, dir] + [d[e] for e in ENTITIES] + [d["suffix"], d["extension"]]
+
+    def glob(self, pattern):
+        """
+        Drop-in for sorted(Path(root).glob(pattern)) for patterns without "**", answered from the index.
+        """
+        pattern = str(pattern)
+        n_parts = pattern.count("/")
+        with self._connect() as con:
+            rows = con.execute("SELECT relpath FROM files WHERE relpath GLOB ?", (pattern,)).fetchall()
+        pattern_parts = pattern.split("/")
+        matches = [r for r, in rows if r.count("/") == n_parts and
+                   all(fnmatchcase(p, pp) for p, pp in zip(r.split("/"), pattern_parts))]
+        return [self.root / m for m in sorted(matches)]
+
+    def query(self, **entities):
+        """
+        Returns files matching all given entities, e.g. query(subject="01", session="tp1", suffix="FLAIR",
+        extension=".nii.gz").
+        """
+        unknown = set(entities) - set(ENTITIES + ["suffix", "extension"])
+        if unknown:
+            raise ValueError(f"Unknown entities {unknown}")
+        where = " AND ".join(f"{k}=?" for k in entities) or "1"
+        with self._connect() as con:
+            rows = con.execute(f"SELECT relpath FROM files WHERE {where} ORDER BY relpath",
+                               list(entities.values())).fetchall()
+        return [self.root / r for r, in rows]
+
+
+# (root, index file) of the indexes synced by this process (inherited by forked workers)
+_SYNCED = set()
+
+
+def get_dataset_index(root, index_file=None, update=True):
+    """
+    Returns the DatasetIndex of root.
+    update=True syncs the index with the file system (incremental), update=False only syncs it if this process has
+    not synced it yet (i.e. once per root and process). Stage entry points update, grabber nodes running in the
+    workflow read with update=False, which is current as of the entry point's sync in the main process (MultiProc
+    workers are forked from it) and is synced once by other processes.
+    """
+    index = DatasetIndex(root, index_file=index_file)
+    key = (index.root, index.index_file)
+    if update or key not in _SYNCED:
+        index.update()
+        _SYNCED.add(key)
+    return index
+
+
+def index_glob(pattern, root=None):
+    """
+    Globs an absolute pattern through the index of root (default: static, wildcard-free, leading directory of
+    pattern).
+    """
+    if root is None:
+        parts = Path(pattern).parts
+        n_static = next(i for i, p in enumerate(parts) if any(c in p for c in "*?[") or i == len(parts) - 1)
+        root = Path(*parts[:n_static])
+    index = get_dataset_index(root, update=False)
+    return index.glob(Path(os.path.abspath(pattern)).relative_to(index.root))
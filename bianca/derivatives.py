@@ -0,0 +1,88 @@
+import os
+import gzip
+import json
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from .utils import derivative_path, write_text_atomic
+
+
+GZIP_BLOCK_SIZE = 1 << 24
+
+
+def gzip_file(in_file, out_file, compress_level=6, n_threads=4):
+    """
+    Multi-threaded gzip: blocks of in_file are compressed in parallel and written as consecutive gzip members, which
+    gzip/zlib readers (incl. nibabel and fsl) read as one stream.
+    """
+    def compress_block(block):
+        return gzip.compress(block, compresslevel=compress_level, mtime=0)
+
+    with open(in_file, "rb") as fi, open(out_file, "wb") as fo, ThreadPoolExecutor(max_workers=n_threads) as executor:
+        blocks = iter(lambda: fi.read(GZIP_BLOCK_SIZE), b"")
+        for compressed in executor.map(compress_block, blocks):
+            fo.write(compressed)
+    return out_file
+
+
+def _tmp_path(out_file):
+    return out_file.with_name(f".{out_file.name}.{os.uname().nodename}.{os.getpid()}.{threading.get_ident()}")
+
+
+def copy_derivative(in_file, out_file, compress_level=6, n_threads=4):
+    """
+    copies in_file to out_file, (de)compresses if only one of them ends with .gz
+    The file is written next to out_file and renamed, so readers (and other hosts sharing the output tree) never see
+    partial files.
+    """
+    in_file, out_file = Path(in_file), Path(out_file)
+    out_file.parent.mkdir(exist_ok=True, parents=True)
+    tmp_file = _tmp_path(out_file)
+    in_gz, out_gz = in_file.suffix == ".gz", out_file.suffix == ".gz"
+    if in_gz == out_gz:
+        shutil.copyfile(in_file, tmp_file)
+    elif out_gz:
+        gzip_file(in_file, tmp_file, compress_level, n_threads)
+    else:
+        with gzip.open(in_file, "rb") as fi, open(tmp_file, "wb") as fo:
+            shutil.copyfileobj(fi, fo, 1 << 20)
+    os.replace(tmp_file, out_file)
+    return out_file
+
+
+def derivative_out_file(out_dir, in_file, source_file, compress=True, **kwargs):
+    """
+    derivative_path with DerivativesDataSink's compress behaviour
+    (True: .nii -> .nii.gz, False: .nii.gz -> .nii, None: keep in_file's extension).
+    Default True, as intermediates are written uncompressed and only compressed when sunk.
+    """
+    out_file = derivative_path(out_dir, source_file, in_file, **kwargs)
+    if compress is True and out_file.name.endswith(".nii"):
+        out_file = out_file.with_name(out_file.name + ".gz")
+    elif compress is False and out_file.name.endswith(".nii.gz"):
+        out_file = out_file.with_name(out_file.name[:-3])
+    return out_file
+
+
+def sink_derivatives(out_dir, items, n_threads=4, compress_level=6):
+    """
+    Writes many derivatives at once (multi-threaded compression), with the names DerivativesDataSink would give them.
+    :param items: list of dicts with in_file, source_file, optional compress (default True) and meta (dict, written to
+    a json sidecar) and derivative_path kwargs (space, desc, suffix, keep_dtype, entities such as from/to)
+    :return: list of out files
+    """
+    jobs = []
+    for item in items:
+        item = dict(item)
+        meta = item.pop("meta", None)
+        out_file = derivative_out_file(out_dir, **item)
+        jobs.append((item["in_file"], out_file))
+        if meta:
+            out_file.parent.mkdir(exist_ok=True, parents=True)
+            sidecar = out_file.parent / (out_file.name.split(".")[0] + ".json")
+            write_text_atomic(sidecar, json.dumps(meta, sort_keys=True, indent=2))
+
+    # files are written one after the other, compression of each file uses all threads
+    return [copy_derivative(in_file, out_file, compress_level, n_threads) for in_file, out_file in jobs]
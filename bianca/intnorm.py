@@ -0,0 +1,63 @@
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import nibabel as nb
+
+from .utils import derivative_path
+from .resources import available_cpus
+
+
+def intensity_range(data, mask, percentiles=None):
+    """
+    Intensity range of data within mask.
+    percentiles=None: min/max (as fslstats -k mask -R), percentiles=(low, high), e.g. (1, 99): robust range
+    """
+    values = data[mask]
+    if not len(values):
+        raise ValueError("empty brain mask, no intensity range")
+    if percentiles is None:
+        return values.min(), values.max()
+    low, high = np.percentile(values, percentiles)
+    return low, high
+
+
+def normalize_flair(flair_file, brain_mask, out_file, percentiles=None):
+    """
+    Reads the FLAIR and brain mask once and writes (flair - min) / (max - min) to out_file, with min/max computed
+    within the brain mask (see intensity_range)
+    """
+    flair_img = nb.load(str(flair_file))
+    flair = np.asanyarray(flair_img.dataobj).astype(np.float32)
+    mask = np.asanyarray(nb.load(str(brain_mask)).dataobj) != 0
+    try:
+        min_val, max_val = intensity_range(flair, mask, percentiles)
+    except ValueError as e:
+        raise ValueError(f"{flair_file}: {e} ({brain_mask})") from e
+    if max_val <= min_val:
+        raise ValueError(f"{flair_file} is constant ({min_val}) within the brain mask {brain_mask}, cannot normalize "
+                         f"intensities")
+
+    out_img = nb.Nifti1Image((flair - min_val) / (max_val - min_val), flair_img.affine, flair_img.header)
+    out_img.set_data_dtype(np.float32)
+    out_file = Path(out_file)
+    out_file.parent.mkdir(exist_ok=True, parents=True)
+    out_img.to_filename(str(out_file))
+    return out_file
+
+
+def _normalize_session(out_dir, flair_file, brain_mask, percentiles):
+    out_file = derivative_path(out_dir, flair_file, flair_file, suffix="FLAIR_biascorrIntNorm")
+    return normalize_flair(flair_file, brain_mask, out_file, percentiles)
+
+
+def normalize_sessions(out_dir, session_files, n_cpu=1, percentiles=None):
+    """
+    Runs normalize_flair for all sessions in a process pool, outputs are named as by the nipype workflow.
+    :param session_files: list of (flair_file, brain_mask)
+    """
+    n_cpu = available_cpus(n_cpu)
+    with ProcessPoolExecutor(max_workers=n_cpu) as executor:
+        futures = [executor.submit(_normalize_session, out_dir, flair_file, brain_mask, percentiles)
+                   for flair_file, brain_mask in session_files]
+        return [f.result() for f in futures]
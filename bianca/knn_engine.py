@@ -0,0 +1,285 @@
+"""
+Experimental native (numpy/KD-tree) k-nearest-neighbour lesion segmentation modelled on fsl's bianca. It is NOT
+equivalent to fsl's bianca with the same BIANCA_OPTIONS: LPMs differ, and they have not been validated against fsl's
+output (the tests have no fsl LPM). compare_lpms reports the agreement with an fsl LPM of the same subject.
+Uses the same masterfile columns as run_bianca_wf (featuresubset: flair, t1w; brainmask: t1w (nonzero voxels);
+label: manual_mask; mat: flair->MNI flirt matrix). Choices of this engine, not taken from fsl's bianca:
+- intensity features are z-scored within the brain mask of each subject
+- MNI coordinates are variance-normalized across training points and multiplied by spatial_weight
+- per training subject, up to training_pts lesion voxels and non_les_pts (default 10 * the sampled lesion voxels)
+  non-lesion voxels are sampled; a training subject with an empty manual mask contributes no points (with a warning)
+- LPM value = fraction of lesion voxels among the k nearest training points
+"""
+import os
+import json
+from warnings import warn
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import nibabel as nb
+from scipy.spatial import cKDTree
+
+from .utils import derivative_path
+from .resources import available_cpus
+from .resample import fsl_voxel_to_mm
+from .cache import file_checksum, hash_dict, ContentCache
+
+FEATURE_COLS = ["flair", "t1w"]
+BRAINMASK_COL = "t1w"
+LABEL_COL = "manual_mask"
+MAT_COL = "mat"
+# bump if the feature extraction changes, invalidates the feature cache
+FEATURES_VERSION = 1
+FEATURE_CACHE_MAX_GB = 20
+
+
+def subject_features(row, with_labels=False):
+    """
+    Features of all brain voxels of one masterfile row.
+    :return: dict with intensities (n_vox x n_features), mni (n_vox x 3), voxel index (flat), labels (if with_labels),
+    image (reference nibabel image)
+    """
+    ref = nb.load(str(row[BRAINMASK_COL]))
+    brainmask = np.asanyarray(ref.dataobj) > 0
+    index = np.flatnonzero(brainmask)
+
+    intensities = []
+    for col in FEATURE_COLS:
+        x = np.asanyarray(nb.load(str(row[col])).dataobj).astype(np.float32)[brainmask]
+        intensities.append((x - x.mean()) / (x.std() or 1))
+    intensities = np.stack(intensities, axis=1)
+
+    ijk = np.stack(np.unravel_index(index, brainmask.shape) + (np.ones(len(index)),), axis=0)
+    mat = np.loadtxt(str(row[MAT_COL]))
+    mni = (mat @ fsl_voxel_to_mm(ref) @ ijk)[:3].T.astype(np.float32)
+
+    d = {"intensities": intensities, "mni": mni, "index": index, "image": ref}
+    if with_labels:
+        d["labels"] = np.asanyarray(nb.load(str(row[LABEL_COL])).dataobj)[brainmask] > 0
+    return d
+
+
+def training_features(row, training_pts=2000, non_les_pts=None, seed=0):
+    """randomly samples lesion and non-lesion training points of one training subject"""
+    d = subject_features(row, with_labels=True)
+    rng = np.random.default_rng(seed)
+    les = np.flatnonzero(d["labels"])
+    non_les = np.flatnonzero(~d["labels"])
+    if not len(les) and non_les_pts is None:
+        warn(f"Empty manual mask {row[LABEL_COL]}: training subject contributes no points")
+    les = rng.choice(les, min(len(les), training_pts), replace=False)
+    n_non_les = non_les_pts if non_les_pts is not None else 10 * len(les)
+    non_les = rng.choice(non_les, min(len(non_les), n_non_les), replace=False)
+    idx = np.concatenate([les, non_les])
+    return np.hstack([d["intensities"][idx], d["mni"][idx]]), d["labels"][idx]
+
+
+def _subject_seed(row, seed):
+    # independent of the row's position in the masterfile, so cached features stay valid if rows are added
+    return int(hash_dict([seed, row["subject"], row["session"]])[:8], 16)
+
+
+def cached_training_features(row, cache_dir=None, training_pts=2000, non_les_pts=None, seed=0,
+                             cache_max_gb=FEATURE_CACHE_MAX_GB):
+    """
+    training_features with a per-subject cache of the sampled features and labels (compressed .npz in a ContentCache
+    in cache_dir), keyed by checksums of the subject's input files and the sampling parameters. Entries of other keys
+    (e.g. other training_pts or seed) are kept; least recently used entries are removed above cache_max_gb.
+    """
+    if cache_dir is None:
+        return training_features(row, training_pts, non_les_pts, _subject_seed(row, seed))
+
+    key = hash_dict({"files": [file_checksum(row[c]) for c in FEATURE_COLS + [BRAINMASK_COL, LABEL_COL, MAT_COL]],
+                     "training_pts": training_pts, "non_les_pts": non_les_pts, "seed": seed,
+                     "features": FEATURE_COLS, "version": FEATURES_VERSION})
+    key = f"sub-{row['subject']}_ses-{row['session']}_features_{key[:16]}"
+    cache = ContentCache(cache_dir, max_size_gb=cache_max_gb)
+    entry = cache.get(key)
+    if entry is not None:
+        try:
+            with np.load(entry / "features.npz") as f:
+                return f["features"], f["labels"]
+        except FileNotFoundError:
+            # evicted by another process in the meantime
+            pass
+
+    features, labels = training_features(row, training_pts, non_les_pts, _subject_seed(row, seed))
+    tmp_file = Path(cache_dir) / f".{key}.{os.getpid()}.npz"
+    tmp_file.parent.mkdir(parents=True, exist_ok=True)
+    np.savez_compressed(tmp_file, features=features, labels=labels)
+    try:
+        cache.put(key, {"features.npz": tmp_file}, meta={"subject": row["subject"], "session": row["session"],
+                                                         "training_pts": training_pts, "non_les_pts": non_les_pts,
+                                                         "seed": seed})
+    finally:
+        tmp_file.unlink()
+    return features, labels
+
+
+def _share(a):
+    # python >= 3.8, imported here so that importing the fsl workflows does not require it
+    from multiprocessing import shared_memory
+    shm = shared_memory.SharedMemory(create=True, size=max(a.nbytes, 1))
+    np.ndarray(a.shape, a.dtype, buffer=shm.buf)[:] = a
+    return shm, (shm.name, a.shape, a.dtype.str)
+
+
+def _attach(spec):
+    from multiprocessing import shared_memory
+    name, shape, dtype = spec
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, np.dtype(dtype), buffer=shm.buf)
+
+
+_worker = {}
+
+
+def _init_worker(features_spec, labels_spec, subject_spec, scale, k):
+    _worker["shm"] = []
+    for key, spec in [("features", features_spec), ("labels", labels_spec), ("subject", subject_spec)]:
+        shm, _worker[key] = _attach(spec)
+        _worker["shm"].append(shm)
+    _worker["scale"] = scale
+    _worker["k"] = k
+    _worker["trees"] = {}
+
+
+def _get_tree(exclude_subjects=()):
+    """KD-tree over all training points, or over all but some subjects' points (leave-one-out, k-fold)"""
+    trees = _worker["trees"]
+    if exclude_subjects not in trees:
+        keep = ~np.isin(_worker["subject"], exclude_subjects)
+        trees.clear()  # keep at most one tree per worker
+        trees[exclude_subjects] = (cKDTree(_worker["features"][keep] * _worker["scale"]), _worker["labels"][keep])
+    return trees[exclude_subjects]
+
+
+def predict_lpm(row, exclude_subjects=(), chunk_size=200000):
+    """LPM (nibabel image) of one query subject from the training data of the worker"""
+    tree, labels = _get_tree(exclude_subjects)
+    d = subject_features(row)
+    features = np.hstack([d["intensities"], d["mni"]]) * _worker["scale"]
+    prob = np.empty(len(features), dtype=np.float32)
+    for start in range(0, len(features), chunk_size):
+        _, nn = tree.query(features[start:start + chunk_size], k=_worker["k"])
+        prob[start:start + chunk_size] = labels[nn].mean(axis=1)
+
+    ref = d["image"]
+    lpm = np.zeros(ref.shape, dtype=np.float32)
+    lpm.flat[d["index"]] = prob
+    img = nb.Nifti1Image(lpm, ref.affine, ref.header)
+    img.set_data_dtype(np.float32)
+    return img
+
+
+def _predict_and_save(out_dir, query_rows, training_subjects_sessions, masterfile, exclude_subjects):
+    """segments all query_rows with the same training data (one tree)"""
+    out_files = []
+    for row in query_rows:
+        lpm = predict_lpm(row, exclude_subjects=exclude_subjects)
+        out_file = derivative_path(out_dir, row["flair"], "output_bianca.nii.gz", suffix="LPM")
+        out_file.parent.mkdir(parents=True, exist_ok=True)
+        lpm.to_filename(str(out_file))
+        meta = {"masterfile": str(masterfile),
+                "query_subject_session": [row["subject"], row["session"]],
+                "query_flair": row["flair"],
+                "training_subjects_sessions": training_subjects_sessions,
+                "engine": "native"}
+        out_file.with_name(out_file.name.replace(".nii.gz", ".json")).write_text(json.dumps(meta, indent=4))
+        out_files.append(str(out_file))
+    return out_files
+
+
+def _run(masterfile, out_dir, df, training_subject_idx, jobs, n_cpu=4, k=40, training_pts=2000, non_les_pts=None,
+         spatial_weight=1., seed=0, feature_cache_dir=None):
+    """
+    Extracts training features once (in parallel), puts them into shared memory and runs jobs in a process pool.
+    :param jobs: list of (query_subject_idx list, excluded training_subject_idx tuple)
+    :param feature_cache_dir: if given, sampled training features are cached per subject (cached_training_features)
+    """
+    n_cpu = available_cpus(n_cpu)
+    rows = df.to_dict("records")
+
+    with ProcessPoolExecutor(max_workers=n_cpu) as executor:
+        n = len(training_subject_idx)
+        training = list(executor.map(cached_training_features, [rows[i] for i in training_subject_idx],
+                                     [feature_cache_dir] * n, [training_pts] * n, [non_les_pts] * n, [seed] * n))
+    features = np.vstack([f for f, _ in training]).astype(np.float32)
+    labels = np.concatenate([l for _, l in training]).astype(np.float32)
+    subject = np.concatenate([np.full(len(l), i) for i, (_, l) in zip(training_subject_idx, training)])
+
+    # variance-normalized features, spatial features weighted
+    n_int = len(FEATURE_COLS)
+    scale = 1 / features.std(axis=0)
+    scale[n_int:] *= spatial_weight
+    scale = scale.astype(np.float32)
+
+    shms, specs = zip(*[_share(a) for a in [features, labels, subject]])
+    try:
+        with ProcessPoolExecutor(max_workers=n_cpu, initializer=_init_worker, initargs=(*specs, scale, k)) as ex:
+            futures = []
+            for query_idx, exclude in jobs:
+                tr = [[rows[i]["subject"], rows[i]["session"]] for i in training_subject_idx if i not in exclude]
+                futures.append(ex.submit(_predict_and_save, out_dir, [rows[q] for q in query_idx], tr, masterfile,
+                                         exclude))
+            out_files = [o for f in futures for o in f.result()]
+    finally:
+        for shm in shms:
+            shm.close()
+            shm.unlink()
+    return out_files
+
+
+def run_bianca_native(masterfile, out_dir, df, training_subject_idx, query_subject_idx, n_cpu=4, **kwargs):
+    """
+    Native alternative to run_bianca_wf. Training features are extracted once (in parallel), put into shared memory
+    and all query subjects are segmented from a process pool. Query subjects that are training subjects are
+    segmented without their own training points (leave-one-out), as run_bianca_wf does.
+    Writes {out_dir}/sub-*/ses-*/anat/*_FLAIR_LPM.nii.gz (+ .json), like run_bianca_wf.
+    kwargs: k, training_pts, non_les_pts, spatial_weight, seed, feature_cache_dir
+    """
+    training_subject_idx = [int(i) for i in training_subject_idx]
+    # queries without exclusions first, so workers can keep their tree
+    jobs = [([int(q)], (int(q),) if q in training_subject_idx else ())
+            for q in sorted(query_subject_idx, key=lambda q: q in training_subject_idx)]
+    return _run(masterfile, out_dir, df, training_subject_idx, jobs, n_cpu=n_cpu, **kwargs)
+
+
+def cv_folds(training_subject_idx, n_folds=None, seed=0):
+    """
+    :param n_folds: None: leave-one-out; int: k-fold with subjects randomly assigned to folds (seed)
+    :return: list of folds (sorted lists of training_subject_idx)
+    """
+    training_subject_idx = [int(i) for i in training_subject_idx]
+    if n_folds is None:
+        return [[i] for i in training_subject_idx]
+    shuffled = np.random.default_rng(seed).permutation(training_subject_idx)
+    return [sorted(f.tolist()) for f in np.array_split(shuffled, n_folds) if len(f)]
+
+
+def run_bianca_native_cv(masterfile, out_dir, df, training_subject_idx, n_folds=None, n_cpu=4, seed=0, **kwargs):
+    """
+    Cross-validated LPMs of all training subjects: training features of every subject are extracted once and each
+    fold is predicted with the rows of its subjects excluded. Folds run in parallel.
+    :param n_folds: see cv_folds
+    """
+    training_subject_idx = [int(i) for i in training_subject_idx]
+    folds = cv_folds(training_subject_idx, n_folds, seed)
+    jobs = [(fold, tuple(fold)) for fold in folds]
+    return _run(masterfile, out_dir, df, training_subject_idx, jobs, n_cpu=n_cpu, seed=seed, **kwargs)
+
+
+def compare_lpms(lpm_file_a, lpm_file_b, threshold=.9):
+    """
+    Agreement of two LPMs (e.g. native vs. fsl bianca output of the same query subject): correlation of
+    probabilities within the union of nonzero voxels and dice of the thresholded maps
+    """
+    a = np.asanyarray(nb.load(str(lpm_file_a)).dataobj).astype(float)
+    b = np.asanyarray(nb.load(str(lpm_file_b)).dataobj).astype(float)
+    m = (a != 0) | (b != 0)
+    bin_a, bin_b = a >= threshold, b >= threshold
+    denom = bin_a.sum() + bin_b.sum()
+    return pd.Series({"r": np.corrcoef(a[m], b[m])[0, 1],
+                      "dice": 2 * (bin_a & bin_b).sum() / denom if denom else np.nan})
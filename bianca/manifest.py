@@ -0,0 +1,127 @@
+import os
+import json
+import time
+from pathlib import Path
+
+from . import __version__
+from .cache import file_checksum, hash_dict
+from .utils import shard_label, write_text_atomic
+from .dataset_index import parse_entities
+from .workdir import node_subject_key
+
+
+def session_key(subject, session=None):
+    return f"sub-{subject}" + (f"_ses-{session}" if session else "")
+
+
+def file_session_key(f):
+    """sub-X_ses-Y (or sub-X) from a derivative's file name"""
+    d = parse_entities(Path(f).name)
+    return session_key(d["subject"], d["session"])
+
+
+def file_state(f):
+    st = os.stat(f)
+    return [st.st_size, st.st_mtime_ns, file_checksum(f)]
+
+
+def read_manifest(manifest_file):
+    try:
+        return json.loads(Path(manifest_file).read_text())
+    except FileNotFoundError:
+        return {}
+
+
+def manifest_files(out_dir, stage):
+    """the stage's manifest and its shard manifests"""
+    out_dir = Path(out_dir)
+    return [f for f in [out_dir / f"_manifest_{stage}.json"] + sorted(out_dir.glob(f"_manifest_{stage}_shard-*.json"))
+            if f.is_file()]
+
+
+class CompletionManifest:
+    """
+    Per-stage record of completed subject(-sessions) in out_dir/_manifest_{stage}.json: output files with size, mtime
+    and sha1, and a hash of the stage parameters (incl. pipeline version).
+    A session is complete if it was recorded with the same parameters and its outputs are unchanged (sha1 is only
+    recomputed if size or mtime differ). pending() drops complete sessions before a graph is built.
+    Nipype stages record sessions with status_callback and commit (sink outputs of subjects without failed nodes, see
+    run_workflow), in-process engines with record().
+    With a shard (i/N), sessions are recorded in out_dir/_manifest_{stage}_shard-{i}of{N}.json, so shards on several
+    hosts do not overwrite each other's records; merge_shard_manifests combines them.
+    """
+
+    def __init__(self, out_dir, stage, params=None, shard=None):
+        self.out_dir = Path(out_dir)
+        self.stage = stage
+        self.params_hash = hash_dict({"params": params, "version": __version__})
+        name = f"_manifest_{stage}" + (f"_{shard_label(shard)}" if shard else "")
+        self.manifest_file = self.out_dir / f"{name}.json"
+        # entries written by this manifest and all entries (incl. other shards') used by is_complete
+        self.entries = read_manifest(self.manifest_file)
+        self.manifest = {}
+        for f in manifest_files(self.out_dir, stage):
+            self.manifest.update(read_manifest(f))
+        self.manifest.update(self.entries)
+        self._sunk = {}
+        self._failed = set()
+
+    def save(self):
+        self.out_dir.mkdir(exist_ok=True, parents=True)
+        write_text_atomic(self.manifest_file, json.dumps(self.entries, indent=1, sort_keys=True))
+
+    def is_complete(self, subject, session=None):
+        """True if subject(-session) was recorded with the current parameters and its outputs are unchanged"""
+        entry = self.manifest.get(session_key(subject, session))
+        if entry is None or entry["params"] != self.params_hash:
+            return False
+        for f, (size, mtime_ns, sha1) in entry["outputs"].items():
+            try:
+                st = os.stat(f)
+                if (st.st_size, st.st_mtime_ns) != (size, mtime_ns) and file_checksum(f) != sha1:
+                    return False
+            except FileNotFoundError:
+                return False
+        return True
+
+    def is_complete_file(self, f):
+        """is_complete for the session of file f (e.g. a masterfile's FLAIR), by its file name"""
+        d = parse_entities(Path(f).name)
+        return self.is_complete(d["subject"], d["session"])
+
+    def pending(self, subjects_sessions):
+        """subjects_sessions (tuples or subjects) without the complete ones"""
+        pending = [s for s in subjects_sessions if not self.is_complete(*(s if isinstance(s, (tuple, list)) else (s,)))]
+        n_skipped = len(subjects_sessions) - len(pending)
+        if n_skipped:
+            print(f"{self.stage}: skipping {n_skipped} complete sessions ({self.out_dir}/_manifest_{self.stage}*.json)")
+        return pending
+
+    def record(self, out_files, save=True):
+        """records the sessions of out_files (grouped by file name) as complete"""
+        by_session = {}
+        for f in out_files:
+            by_session.setdefault(file_session_key(f), []).append(str(f))
+        for key, files in by_session.items():
+            self.entries[key] = {"outputs": {f: file_state(f) for f in files}, "params": self.params_hash,
+                                 "time": time.strftime("%Y-%m-%d %H:%M:%S")}
+            self.manifest[key] = self.entries[key]
+        if save:
+            self.save()
+
+    def status_callback(self, node, status):
+        """nipype status_callback: collects sink outputs per subject (node_subject_key), notes failed subjects"""
+        if status == "exception":
+            self._failed.add(node_subject_key(node))
+        elif status == "end" and type(node.interface).__name__ in ("DerivativesBulkSink", "DerivativesDataSink"):
+            outputs = node.result.outputs
+            out_files = list(outputs.out_files.values()) if hasattr(outputs, "out_files") else outputs.out_file
+            out_files = out_files if isinstance(out_files, list) else [out_files]
+            self._sunk.setdefault(node_subject_key(node), []).extend(out_files)
+
+    def commit(self):
+        """records the sunk outputs of all subjects without a failed node"""
+        out_files = [f for k, files in self._sunk.items() if k not in self._failed for f in files]
+        self._sunk, self._failed = {}, set()
+        if out_files:
+            self.record(out_files)
@@ -0,0 +1,203 @@
+"""
+Runs several stages in one process from one config file, e.g. python -m bianca run template t1w flair --config cfg.yml
+
+Config (yaml or toml):
+    bids_dir: /data/sourcedata
+    smriprep_dir: /data/derivatives/smriprep
+    training_data_dir: /data/masks_training_data    # manual masks (masterfile, threshold overlap, locate)
+    base_dir: /data/BIANCA/full_sample              # outputs: base_dir/[acq/]<stage dir>
+    work_dir: /tmp/bianca                           # working and crash dirs: work_dir/_wd|_crash/[acq/]<stage dir>
+    acqs: [2D, 3D]
+    n_cpu: 25                                       # optional, default: all CPUs of the host or cgroup
+    participant_label: [lhabX0001, lhabX0002]       # optional
+    node_cache_dir: /data/bianca_node_cache         # optional, FNIRT/InvWarp/N4 outputs kept across working dirs
+    node_cache_max_gb: 50                           # optional
+    stages:                                         # optional keyword arguments of the stage functions
+        template: {smriprep06: false}
+        t1w: {exclude_sessions: [[lhabX0196, tp1], lhabX0125]}
+        threshold: {thresholds: [0.99], engine: numpy, run_BiancaOverlapMeasures: false}
+
+exclude_sessions is not passed to the stage function: the stage skips these sessions ([subject, session]) and subjects
+(all stages with a session list, i.e. not masterfile and bianca, which use the masterfile's rows).
+toml configs need Python >= 3.11 (tomllib) or tomli.
+"""
+from pathlib import Path
+
+# stream: template, t1w, flair and intnorm in one graph (bianca.workflows.streaming)
+STAGES = ["template", "t1w", "flair", "intnorm", "stream", "masterfile", "bianca", "threshold", "locate"]
+# output dir name of each stage (below base_dir, or base_dir/acq for flair-acq dependent stages)
+STAGE_DIRS = {"template": "prepare_template", "t1w": "prepare_t1w", "flair": "prepare_flair",
+              "intnorm": "prepare_flair", "stream": "prepare_flair", "masterfile": "bianca", "bianca": "bianca",
+              "threshold": "bianca_threshold", "locate": "locate"}
+WD_NAMES = {"intnorm": "prep_flair_intNorm", "stream": "prepare_streaming"}
+
+
+def load_config(config_file):
+    config_file = Path(config_file)
+    if config_file.suffix == ".toml":
+        try:
+            import tomllib
+        except ImportError:
+            try:
+                import tomli as tomllib
+            except ImportError:
+                raise ImportError("toml configs require Python >= 3.11 or tomli (pip install tomli), or use a yaml "
+                                  "config")
+        with open(config_file, "rb") as fi:
+            return tomllib.load(fi)
+    try:
+        import yaml
+    except ImportError:
+        raise ImportError("yaml configs require pyyaml (pip install pyyaml), or use a .toml config")
+    return yaml.safe_load(config_file.read_text())
+
+
+def masterfile_templates(acq):
+    """file templates of create_masterfile for a flair acquisition"""
+    space = f"flair{acq}"
+    anat = "sub-{subject}/ses-{session}/anat/sub-{subject}_ses-{session}"
+    return dict(flair_tmpl=f"{anat}_acq-{acq}_*_FLAIR_biascorr.nii.gz",
+                t1w_tmpl=f"{anat}_space-{space}_desc-t1w_brain.nii.gz",
+                manual_mask_tmpl="sub-{subject}/ses-{session}/sub-{subject}_ses-{session}_acq-" + acq +
+                                 "_run-1_FLAIR_mask_goldstandard_new.nii.gz",
+                mat_tmpl=f"{anat}_desc-12dof_from-{space}_to-MNI.mat")
+
+
+class Pipeline:
+    """
+    Calls the stage functions in sequence. The subject(-session) list of each acquisition is taken from the BIDS
+    dir's dataset index once and reused by all stages. Stages skip sessions that are complete according to their
+    manifests (see CompletionManifest), i.e. a stage with complete outputs returns before building a graph.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.bids_dir = Path(config["bids_dir"])
+        self.base_dir = Path(config["base_dir"])
+        self.work_dir = Path(config.get("work_dir", self.base_dir))
+        self.training_data_dir = Path(config["training_data_dir"]) if config.get("training_data_dir") else None
+        self.acqs = config.get("acqs", ["2D", "3D"])
+        self._sessions = {}
+
+    def subjects_sessions(self, acq="*", stage=None):
+        """subjects_sessions of acq, without the ones in the stage's exclude_sessions"""
+        from .utils import get_subject_sessions
+        if acq not in self._sessions:
+            subjects_sessions = get_subject_sessions(self.bids_dir, acq)
+            if self.config.get("participant_label"):
+                subjects_sessions = [s for s in subjects_sessions if s[0] in self.config["participant_label"]]
+            self._sessions[acq] = subjects_sessions
+        exclude = self.stage_config(stage).get("exclude_sessions") or []
+        exclude = {tuple(e) if isinstance(e, (list, tuple)) else e for e in exclude}
+        return [s for s in self._sessions[acq] if s not in exclude and s[0] not in exclude]
+
+    def dirs(self, stage, acq=None):
+        """out_dir, wd_dir, crash_dir of a stage"""
+        rel = Path(acq) if acq else Path()
+        wd_name = WD_NAMES.get(stage, STAGE_DIRS[stage])
+        return (self.base_dir / rel / STAGE_DIRS[stage], self.work_dir / "_wd" / rel / wd_name,
+                self.work_dir / "_crash" / rel / wd_name)
+
+    def stage_config(self, stage):
+        return (self.config.get("stages") or {}).get(stage) or {}
+
+    def options(self, stage, **defaults):
+        """n_cpu and the stage's options from the config (without exclude_sessions), on top of defaults"""
+        options = dict(defaults, n_cpu=self.config.get("n_cpu"))
+        options.update((k, v) for k, v in self.stage_config(stage).items() if k != "exclude_sessions")
+        return options
+
+    def node_cache(self):
+        """node_cache_dir and node_cache_max_gb from the config, for the stages running FNIRT, InvWarp or N4"""
+        return {k: self.config[k] for k in ["node_cache_dir", "node_cache_max_gb"] if self.config.get(k)}
+
+    def template(self):
+        from .workflows.prepare_template import prepare_template
+        subjects = sorted({s for s, _ in self.subjects_sessions(stage="template")})
+        out_dir, wd_dir, crash_dir = self.dirs("template")
+        prepare_template(self.bids_dir, self.config["smriprep_dir"], out_dir, wd_dir, crash_dir, subjects,
+                         **self.options("template", **self.node_cache()))
+
+    def t1w(self):
+        from .workflows.prepare_t1w import prepare_t1w
+        out_dir, wd_dir, crash_dir = self.dirs("t1w")
+        prepare_t1w(self.bids_dir, self.config["smriprep_dir"], out_dir, wd_dir, crash_dir,
+                    self.subjects_sessions(stage="t1w"), **self.options("t1w", **self.node_cache()))
+
+    def flair(self, acq):
+        from .workflows.prepare_flair import prepare_bianca_data
+        out_dir, wd_dir, crash_dir = self.dirs("flair", acq)
+        prepare_bianca_data(self.bids_dir, self.dirs("template")[0], self.dirs("t1w")[0], out_dir, wd_dir, crash_dir,
+                            self.subjects_sessions(acq, "flair"), flair_acq=acq,
+                            **self.options("flair", **self.node_cache()))
+
+    def intnorm(self, acq):
+        from .workflows.prepare_flair_intNorm import prepare_flair_intNorm
+        out_dir, wd_dir, crash_dir = self.dirs("intnorm", acq)
+        prepare_flair_intNorm(self.dirs("flair", acq)[0], out_dir, wd_dir, crash_dir,
+                              self.subjects_sessions(acq, "intnorm"), acq, **self.options("intnorm"))
+
+    def stream(self, acq):
+        from .workflows.streaming import prepare_streaming
+        _, wd_dir, crash_dir = self.dirs("stream", acq)
+        bianca_options = self.stage_config("bianca")
+        bianca_dir = self.dirs("bianca", acq)[0]
+        masterfile_tmpls = dict(masterfile_templates(acq), **self.stage_config("masterfile"))
+        masterfile_tmpls = {k: v for k, v in masterfile_tmpls.items() if k.endswith("_tmpl")}
+        # train for the bianca stage: native features, or fsl's classifier if the bianca stage caches classifiers
+        engine = bianca_options.get("engine", "fsl")
+        if engine == "fsl" and not bianca_options.get("clf_cache_dir"):
+            engine = None
+        prepare_streaming(self.bids_dir, self.config["smriprep_dir"], self.dirs("template")[0], self.dirs("t1w")[0],
+                          self.dirs("flair", acq)[0], self.dirs("intnorm", acq)[0], wd_dir, crash_dir,
+                          self.subjects_sessions(acq, "stream"), acq, training_data_dir=self.training_data_dir,
+                          masterfile_tmpls=masterfile_tmpls, engine=engine, bianca_dir=bianca_dir,
+                          feature_cache_dir=bianca_dir / "feature_cache" if engine == "native" else None,
+                          clf_cache_dir=bianca_options.get("clf_cache_dir") if engine == "fsl" else None,
+                          clf_cache_max_gb=bianca_options.get("clf_cache_max_gb", 20),
+                          **self.options("stream", **self.node_cache()))
+
+    def masterfile(self, acq):
+        from .utils import create_masterfile
+        options = dict(masterfile_templates(acq), update=True)
+        options.update(self.stage_config("masterfile"))
+        create_masterfile(self.dirs("flair", acq)[0], self.training_data_dir, self.dirs("masterfile", acq)[0],
+                          **options)
+
+    def bianca(self, acq):
+        from .workflows.bianca import run_bianca
+        out_dir, wd_dir, crash_dir = self.dirs("bianca", acq)
+        run_bianca(out_dir, wd_dir, crash_dir, **self.options("bianca"))
+
+    def threshold(self, acq):
+        from .workflows.bianca_threshold import bianca_threshold
+        out_dir, wd_dir, crash_dir = self.dirs("threshold", acq)
+        options = self.options("threshold", thresholds=[.99], run_BiancaOverlapMeasures=False)
+        thresholds = options.pop("thresholds")
+        bianca_threshold(self.dirs("bianca", acq)[0], self.training_data_dir, self.dirs("flair", acq)[0], wd_dir,
+                         crash_dir, out_dir, self.subjects_sessions(acq, "threshold"), acq, thresholds, **options)
+
+    def locate(self, acq):
+        from .prepare_locate import prepare_locate
+        session_dir = Path("sub-{subject}/ses-{session}")
+        prepare_locate(self.dirs("flair", acq)[0] / session_dir / "anat", self.dirs("bianca", acq)[0] / session_dir /
+                       "anat", self.training_data_dir / session_dir, self.dirs("locate", acq)[0],
+                       self.subjects_sessions(acq, "locate"), acq)
+
+    def run(self, stages):
+        """runs stages (names in STAGES) in pipeline order; acquisition dependent stages for all acqs"""
+        unknown = set(stages) - set(STAGES)
+        if unknown:
+            raise ValueError(f"Unknown stages {sorted(unknown)}, stages are {STAGES}")
+        for stage in [s for s in STAGES if s in stages]:
+            if stage in ["template", "t1w"]:
+                print(f"\n### {stage}")
+                getattr(self, stage)()
+            else:
+                for acq in self.acqs:
+                    print(f"\n### {stage} {acq}")
+                    getattr(self, stage)(acq)
+
+
+def run_pipeline(config_file, stages):
+    Pipeline(load_config(config_file)).run(stages)
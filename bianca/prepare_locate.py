@@ -1,6 +1,6 @@
 from pathlib import Path
-from glob import glob
 import os
+from .dataset_index import get_dataset_index, index_glob
 
 
 def _format_path(p, subject, session, acq):
@@ -9,9 +9,14 @@ def _format_path(p, subject, session, acq):
     return Path(pf)
 
 
+def _template_root(p):
+    # last directory before the first placeholder
+    return str(p).split("{")[0].rsplit("/", 1)[0]
+
+
 def _format_glob_path(p, subject, session, acq, raise_empty=True):
     pf = str(_format_path(p, subject, session, acq))
-    files = glob(pf)
+    files = index_glob(pf, root=_template_root(p))
     if len(files) > 1:
         raise Exception(f"more than one file found {files}")
     if raise_empty and len(files) == 0:
@@ -42,6 +47,10 @@ def prepare_locate(flair_dir, bianca_dir, training_data_dir, locate_out_dir, sub
         (flair_dir / "*_desc-wmmask.nii.gz", "{sub_ses}_biancamask.nii.gz")
     ]
 
+    # sync the index of each input dir once, lookups in the loop are answered from the index
+    for root in set(_template_root(tpl) for tpl in [mapping_manual_labels[0]] + [m[0] for m in mapping]):
+        get_dataset_index(root)
+
     def _create_symlink(f_in, f_out):
         f_in_rel = os.path.relpath(f_in, f_out.parent)
         f_out.symlink_to(f_in_rel)
@@ -0,0 +1,44 @@
+from pathlib import Path
+
+import numpy as np
+import nibabel as nb
+
+
+def distance_bands(distance, brainmask, cutoffs):
+    """
+    Labels brain voxels by their ventricle distance: label i (1-based) for cutoffs[i-2] < d <= cutoffs[i-1],
+    len(cutoffs) + 1 for d > cutoffs[-1]. Voxels with d == 0 (ventricles) and outside the brain mask are 0.
+    e.g. cutoffs (3, 5, 10, 20): 1: (0, 3], 2: (3, 5], 3: (5, 10], 4: (10, 20], 5: > 20 mm
+    """
+    cutoffs = np.sort(np.asarray(cutoffs, dtype=float))
+    bands = np.searchsorted(cutoffs, distance, side="left") + 1
+    bands[(distance <= 0) | ~brainmask] = 0
+    return bands.astype(np.uint8)
+
+
+def ventricle_distance_regions(distancemap_file, brainmask_file, out_dir, cutoffs=(10,), perivent_cutoff=10,
+                               ext=".nii.gz"):
+    """
+    Reads the distancemap and brain mask once and writes
+    - the labeled band image for cutoffs (see distance_bands)
+    - the periventricular (0 < d <= perivent_cutoff) and deep WM (d >= perivent_cutoff) masks within the brain mask,
+      as fslmaths -uthr/-thr perivent_cutoff -bin -mas brainmask
+    :return: bands_file, perivent_file, deepWM_file
+    """
+    out_dir = Path(out_dir)
+    dist_img = nb.load(str(distancemap_file))
+    distance = np.asanyarray(dist_img.dataobj).astype(np.float32)
+    brainmask = np.asanyarray(nb.load(str(brainmask_file)).dataobj) != 0
+
+    out = {"ventdistbands": distance_bands(distance, brainmask, cutoffs),
+           "periventmask": ((distance > 0) & (distance <= perivent_cutoff) & brainmask).astype(np.float32),
+           "deepWMmask": ((distance >= perivent_cutoff) & brainmask).astype(np.float32)}
+    out_files = []
+    for name, data in out.items():
+        img = nb.Nifti1Image(data, dist_img.affine, dist_img.header)
+        img.set_data_dtype(data.dtype)
+        img.header.set_slope_inter(None, None)
+        out_file = out_dir / f"{name}{ext}"
+        img.to_filename(str(out_file))
+        out_files.append(str(out_file))
+    return out_files
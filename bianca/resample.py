@@ -0,0 +1,156 @@
+from pathlib import Path
+
+import numpy as np
+import nibabel as nb
+from scipy import ndimage
+
+INTERP_ORDER = {"nearestneighbour": 0, "trilinear": 1}
+
+
+def fsl_voxel_to_mm(img):
+    """matrix from voxel indices to fsl's scaled-voxel coordinates (used by flirt matrices)"""
+    zooms = np.array(img.header.get_zooms()[:3], dtype=float)
+    m = np.diag(np.append(zooms, 1))
+    if np.linalg.det(img.affine) > 0:
+        # fsl uses radiological voxel order, i.e. x is flipped for images with a positive determinant
+        m[0, 0] = -zooms[0]
+        m[0, 3] = (img.shape[0] - 1) * zooms[0]
+    return m
+
+
+def reference_to_input_coords(in_img, ref_img, xfm):
+    """input voxel coordinates (3 x n_ref_voxels) of all reference voxels, for a flirt matrix input -> reference"""
+    ref_vox_to_in_vox = np.linalg.inv(fsl_voxel_to_mm(in_img)) @ np.linalg.inv(xfm) @ fsl_voxel_to_mm(ref_img)
+    ijk = np.indices(ref_img.shape[:3], dtype=np.float32).reshape(3, -1)
+    return (ref_vox_to_in_vox[:3, :3] @ ijk + ref_vox_to_in_vox[:3, 3:]).astype(np.float32)
+
+
+def apply_xfm(in_files, reference, matrix_file, interps, out_files, mask_file=None, masked=()):
+    """
+    In-process version of flirt -applyxfm for several images with the same matrix and reference: the reference
+    voxel -> input voxel mapping is computed once (per input grid) and applied to all images.
+    :param in_files: dict name -> input image
+    :param interps: dict name -> "trilinear" or "nearestneighbour"
+    :param out_files: dict name -> output file
+    :param mask_file: name of an (output) image to mask the images in masked with (as fslmaths -mas)
+    :return: dict name -> output file
+    """
+    ref_img = nb.load(str(reference))
+    xfm = np.loadtxt(str(matrix_file))
+    coords_cache = {}
+    resampled = {}
+    for name, in_file in in_files.items():
+        in_img = nb.load(str(in_file))
+        grid = (in_img.shape[:3], tuple(np.round(in_img.affine, 6).ravel()))
+        if grid not in coords_cache:
+            coords_cache[grid] = reference_to_input_coords(in_img, ref_img, xfm)
+        data = np.asanyarray(in_img.dataobj)
+        out = ndimage.map_coordinates(data.astype(np.float32), coords_cache[grid], order=INTERP_ORDER[interps[name]],
+                                      mode="constant", cval=0).reshape(ref_img.shape[:3])
+        resampled[name] = (out, in_img.get_data_dtype())
+
+    if mask_file is not None:
+        mask = resampled[mask_file][0] != 0
+        for name in masked:
+            resampled[name] = (resampled[name][0] * mask, resampled[name][1])
+
+    for name, (out, dtype) in resampled.items():
+        if np.issubdtype(dtype, np.integer):
+            out = np.round(out)
+        out_img = nb.Nifti1Image(out.astype(dtype), ref_img.affine, ref_img.header)
+        out_img.set_data_dtype(dtype)
+        out_img.header.set_slope_inter(None, None)
+        Path(out_files[name]).parent.mkdir(exist_ok=True, parents=True)
+        out_img.to_filename(str(out_files[name]))
+    return out_files
+
+
+# nifti intent code of fnirt's displacement fields (relative warps)
+FSL_FNIRT_DISPLACEMENT_FIELD = 2006
+
+
+def _itk_field_points(field_img):
+    """voxel indices (3 x n) of an ITK displacement field's grid and the world (RAS mm) points they map to"""
+    d = np.asarray(field_img.dataobj, dtype=np.float32).reshape(field_img.shape[:3] + (3,))
+    ijk = np.indices(field_img.shape[:3], dtype=np.float32).reshape(3, -1)
+    world = field_img.affine[:3, :3].astype(np.float32) @ ijk + field_img.affine[:3, 3:].astype(np.float32)
+    # ITK vectors are in LPS
+    return ijk, world + d.reshape(-1, 3).T * np.array([[-1], [-1], [1]], dtype=np.float32)
+
+
+def _fsl_mm_points(itk_field, in_file):
+    """fsl mm coordinates (3 x n) of the field's grid points and of the points of in_file they map to"""
+    field_img, in_img = nb.load(str(itk_field)), nb.load(str(in_file))
+    ijk, points = _itk_field_points(field_img)
+    ref_mm = fsl_voxel_to_mm(field_img).astype(np.float32)
+    in_mm = (fsl_voxel_to_mm(in_img) @ np.linalg.inv(in_img.affine)).astype(np.float32)
+    return field_img, ref_mm[:3, :3] @ ijk + ref_mm[:3, 3:], in_mm[:3, :3] @ points + in_mm[:3, 3:]
+
+
+def itk_field_to_fsl_warp(itk_field, in_file, out_file):
+    """
+    fsl warp (relative displacements in fsl's scaled-voxel mm, like fnirt --fout or invwarp) for
+    applywarp -i in_file -r <field's grid> from an ITK displacement field, e.g. antsApplyTransforms --output [field, 1]
+    with in_file's space as input and the reference's grid
+    """
+    field_img, ref_mm, in_mm = _fsl_mm_points(itk_field, in_file)
+    warp = (in_mm - ref_mm).T.reshape(field_img.shape[:3] + (3,))
+    img = nb.Nifti1Image(warp, field_img.affine)
+    img.header.set_xyzt_units("mm")
+    img.header["intent_code"] = FSL_FNIRT_DISPLACEMENT_FIELD
+    Path(out_file).parent.mkdir(exist_ok=True, parents=True)
+    img.to_filename(str(out_file))
+    return out_file
+
+
+def itk_field_to_flirt_matrix(itk_field, in_file, mask_file, out_file):
+    """
+    Least-squares affine of an ITK displacement field (see itk_field_to_fsl_warp) within mask_file (on the field's
+    grid), as flirt matrix of -in <field's grid> -ref in_file
+    """
+    _, ref_mm, in_mm = _fsl_mm_points(itk_field, in_file)
+    mask = np.asanyarray(nb.load(str(mask_file)).dataobj).reshape(-1) > 0
+    ref_h = np.vstack([ref_mm[:, mask], np.ones((1, mask.sum()), np.float32)]).astype(np.float64)
+    coef, *_ = np.linalg.lstsq(ref_h.T, in_mm[:, mask].T.astype(np.float64), rcond=None)
+    xfm = np.vstack([coef.T, [0, 0, 0, 1]])
+    np.savetxt(str(out_file), xfm, fmt="%.10f")
+    return out_file
+
+
+def read_itk_affine(xfm_file):
+    """
+    4x4 matrix (RAS mm) of an ITK affine text transform (e.g. smriprep's *_space-orig_target-T1w_affine.txt), which maps
+    points of the fixed (reference) image to the moving (input) image, like antsApplyTransforms uses it
+    """
+    fields = {}
+    for line in Path(xfm_file).read_text().splitlines():
+        key, _, value = line.partition(":")
+        fields.setdefault(key.strip(), []).append(value.split())
+    if len(fields.get("Transform", [])) != 1 or not fields["Transform"][0][0].endswith("_double_3_3"):
+        raise ValueError(f"{xfm_file} is not a single 3D affine ITK transform")
+    params = np.array(fields["Parameters"][0], dtype=float)
+    center = np.array(fields["FixedParameters"][0], dtype=float)
+    a, t = params[:9].reshape(3, 3), params[9:]
+    lps = np.eye(4)
+    lps[:3, :3] = a
+    lps[:3, 3] = t + center - a @ center
+    flip = np.diag([-1., -1., 1., 1.])
+    return flip @ lps @ flip
+
+
+def itk_affine_to_flirt_matrix(xfm_file, in_file, reference, out_file):
+    """flirt matrix of -in in_file -ref reference for an ITK affine with reference as fixed and in_file as moving"""
+    in_img, ref_img = nb.load(str(in_file)), nb.load(str(reference))
+    ref_to_in = fsl_voxel_to_mm(in_img) @ np.linalg.inv(in_img.affine) @ read_itk_affine(xfm_file) @ \
+        ref_img.affine @ np.linalg.inv(fsl_voxel_to_mm(ref_img))
+    np.savetxt(str(out_file), np.linalg.inv(ref_to_in), fmt="%.10f")
+    return out_file
+
+
+def masked_correlation(in_file, reference, mask_file):
+    """Pearson correlation of two images on the same grid within mask_file, a quick check of their alignment"""
+    mask = np.asanyarray(nb.load(str(mask_file)).dataobj) > 0
+    a, b = (np.asarray(nb.load(str(f)).dataobj, dtype=np.float32)[mask] for f in [in_file, reference])
+    if a.std() == 0 or b.std() == 0:
+        return 0.
+    return float(np.corrcoef(a, b)[0, 1])
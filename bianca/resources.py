@@ -0,0 +1,97 @@
+import os
+from pathlib import Path
+
+# estimated peak memory (GB) of interfaces (by class name) for 1mm T1w/FLAIR images; MultiProc only runs jobs together
+# whose estimates fit into the memory limit. elastic: the node's threads (num_threads) are raised when fewer jobs are
+# left than cores (ResourceMultiProcPlugin). Threads set explicitly on a node (e.g. omp_nthreads) are kept as minimum.
+RESOURCE_PROFILES = {
+    "FNIRT": dict(mem_gb=4.),
+    "InvWarp": dict(mem_gb=2.),
+    "FLIRT": dict(mem_gb=1.),
+    "ApplyXFM": dict(mem_gb=1.),
+    "MakeBiancaMask": dict(mem_gb=2.),
+    "N4BiasFieldCorrection": dict(mem_gb=1.5, elastic=True),
+    # fsl bianca is single-threaded; memory grows with the number of training subjects
+    "BIANCA": dict(mem_gb=6.),
+}
+
+
+def _read(path):
+    try:
+        return Path(path).read_text().split()
+    except OSError:
+        return None
+
+
+def cgroup_cpu_limit():
+    """CPU quota of the process' cgroup (v2 cpu.max or v1 cfs quota) in cores, None if unlimited"""
+    cpu_max = _read("/sys/fs/cgroup/cpu.max")
+    if cpu_max and cpu_max[0] != "max":
+        return int(cpu_max[0]) / int(cpu_max[1])
+    quota, period = _read("/sys/fs/cgroup/cpu/cpu.cfs_quota_us"), _read("/sys/fs/cgroup/cpu/cpu.cfs_period_us")
+    if quota and period and int(quota[0]) > 0:
+        return int(quota[0]) / int(period[0])
+    return None
+
+
+def cgroup_memory_limit_gb():
+    """memory limit of the process' cgroup (v2 memory.max or v1 limit_in_bytes) in GB, None if unlimited"""
+    for f in ["/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"]:
+        limit = _read(f)
+        # v1 reports unlimited as a huge page-aligned number
+        if limit and limit[0] != "max" and int(limit[0]) < 1 << 60:
+            return int(limit[0]) / 1024 ** 3
+    return None
+
+
+def detect_limits():
+    """
+    CPUs and memory (GB) available to this process: the host's (CPU affinity, physical memory) or, if lower, the
+    cgroup's (e.g. docker --cpus/--memory, slurm)
+    :return: n_cpu, mem_gb
+    """
+    n_cpu = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+    cpu_quota = cgroup_cpu_limit()
+    if cpu_quota is not None:
+        n_cpu = min(n_cpu, max(1, int(cpu_quota)))
+    mem_gb = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 1024 ** 3
+    cgroup_mem_gb = cgroup_memory_limit_gb()
+    if cgroup_mem_gb is not None:
+        mem_gb = min(mem_gb, cgroup_mem_gb)
+    return n_cpu, mem_gb
+
+
+def available_cpus(n_cpu=None):
+    """n_cpu, capped at the detected CPUs; all detected CPUs if n_cpu is None or < 1"""
+    detected, _ = detect_limits()
+    if n_cpu is None or n_cpu < 1:
+        return detected
+    return min(n_cpu, detected)
+
+
+def interface_profile(interface, profiles=None):
+    """profile of an interface by its class name, or the name of its closest base class with a profile (e.g. FNIRT
+    for CachedFNIRT); None without profile"""
+    profiles = RESOURCE_PROFILES if profiles is None else profiles
+    return next((profiles[c.__name__] for c in type(interface).__mro__ if c.__name__ in profiles), None)
+
+
+def apply_resource_profiles(wf, profiles=None):
+    """
+    Sets mem_gb of all nodes of wf from profiles (default RESOURCE_PROFILES), by interface class name (see
+    interface_profile). Estimates only raise a node's mem_gb.
+    :return: number of nodes with a profile
+    """
+    n = 0
+    for node in wf._get_all_nodes():
+        profile = interface_profile(node.interface, profiles)
+        if profile is None:
+            continue
+        node._mem_gb = max(node.mem_gb, profile.get("mem_gb", 0))
+        n += 1
+    return n
+
+
+def elastic_interfaces(profiles=None):
+    profiles = RESOURCE_PROFILES if profiles is None else profiles
+    return {name for name, profile in profiles.items() if profile.get("elastic")}
@@ -0,0 +1,185 @@
+"""
+Runtime report of a stage's working dir from nipype's result files (runtime and, with the resource monitor enabled,
+peak memory and CPU use of every node), e.g. python -m bianca report WD_DIR
+"""
+import re
+from datetime import datetime
+from pathlib import Path
+from warnings import warn
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+PARAM_PATTERN = re.compile(r"^_(?:session_(?P<session>.+)_)?subject_(?P<subject>.+)$")
+
+
+def subject_key_from_path(rel_parts):
+    """
+    sub-X(_ses-Y) of a node dir (path parts below the stage's working dir) from the subject(/session) iterable's
+    parameterization dir, else the per-subject sub-workflow's dir (e.g. anat_preproc_X_Y) or other parameterization
+    (e.g. _query_subject_idx_3)
+    """
+    parts = [p for p in rel_parts[:-1] if not p.startswith("shard-")]
+    for part in parts:
+        m = PARAM_PATTERN.match(part)
+        if m:
+            return f"sub-{m['subject']}" + (f"_ses-{m['session']}" if m["session"] else "")
+    for part in parts:
+        if part.startswith("_") and part != "mapflow":
+            return part
+    return parts[1] if len(parts) > 1 else None
+
+
+def _strings(value):
+    if isinstance(value, str):
+        yield value
+    elif isinstance(value, (list, tuple)):
+        for v in value:
+            yield from _strings(v)
+    elif isinstance(value, dict):
+        for v in value.values():
+            yield from _strings(v)
+
+
+def _load_node(result_file, wd_dir):
+    from nipype.pipeline.engine.utils import load_resultfile
+    try:
+        result = load_resultfile(result_file, resolve=False)
+    except Exception as e:
+        return None, f"{result_file}: {e}"
+    runtime = result.runtime
+    if isinstance(runtime, list) or runtime is None:
+        # MapNode summary, its sub-nodes (mapflow/) have their own result files
+        return None, None
+    node_dir = result_file.parent
+    rel_parts = node_dir.relative_to(wd_dir).parts
+    inputs = result.inputs or {}
+    threads = inputs.get("num_threads") if isinstance(inputs.get("num_threads"), int) else 1
+    prof = getattr(runtime, "prof_dict", None)
+    cpu_mean = np.mean(prof["cpus"]) / 100 if prof and prof.get("cpus") else np.nan
+    interface = result.interface.__name__ if result.interface else None
+    if interface == "Function":
+        # Function nodes by node name (mapflow sub-nodes: _name0, _name1, ...)
+        interface = "Function({})".format(re.sub(r"^_(.+?)[0-9]+$", r"\1", rel_parts[-1]))
+    record = {"node": "/".join(rel_parts),
+              "name": rel_parts[-1],
+              "interface": interface,
+              "subject": subject_key_from_path(rel_parts),
+              "start": getattr(runtime, "startTime", None),
+              "end": getattr(runtime, "endTime", None),
+              "duration_s": getattr(runtime, "duration", np.nan),
+              "peak_rss_gb": getattr(runtime, "mem_peak_gb", None),
+              "cpu_mean": cpu_mean,
+              "threads": max(threads, 1),
+              "host": getattr(runtime, "hostname", None),
+              }
+    record["cpu_efficiency"] = cpu_mean / record["threads"]
+    wd_prefix = str(wd_dir) + "/"
+    record["_inputs"] = sorted({s for s in _strings(inputs) if s.startswith(wd_prefix)})
+    return record, None
+
+
+def load_runtimes(wd_dir, n_threads=16):
+    """one row per node run (MapNode sub-nodes separately) with the runtime info of its result file"""
+    wd_dir = Path(wd_dir).resolve()
+    result_files = sorted(wd_dir.rglob("result_*.pklz"))
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        loaded = list(executor.map(_load_node, result_files, [wd_dir] * len(result_files)))
+    errors = [e for _, e in loaded if e]
+    if errors:
+        warn(f"{len(errors)} result files could not be read, e.g. {errors[0]}")
+    df = pd.DataFrame([r for r, _ in loaded if r is not None])
+    if df.empty:
+        return df
+    for c in ["start", "end"]:
+        # parsed per value, as isoformat() omits zero microseconds (pandas infers one format from the first value)
+        df[c] = pd.to_datetime(df[c].map(lambda t: datetime.fromisoformat(t) if isinstance(t, str) else t), utc=True)
+    for c in ["peak_rss_gb", "duration_s"]:
+        df[c] = pd.to_numeric(df[c], errors="coerce")
+    return df.sort_values("start", ignore_index=True)
+
+
+def critical_path(df, wd_dir):
+    """
+    Longest chain of dependent nodes by runtime. Dependencies are taken from input files that are outputs of other
+    node dirs in the working dir (inputs passed by value, e.g. subject ids, are not edges).
+    :return: rows of df on the path, in order
+    """
+    if df.empty:
+        return df
+    wd_dir = Path(wd_dir).resolve()
+    index_of = {str(wd_dir / node): i for i, node in enumerate(df.node)}
+    finish = np.zeros(len(df))
+    previous = np.full(len(df), -1)
+    # df is sorted by start, so producers come before consumers
+    for i, (inputs, duration) in enumerate(zip(df._inputs, df.duration_s.fillna(0))):
+        for f in inputs:
+            p = Path(f).parent
+            while str(p) not in index_of and p != wd_dir and p != p.parent:
+                p = p.parent
+            j = index_of.get(str(p))
+            if j is None or j == i:
+                continue
+            if previous[i] < 0 or finish[j] > finish[previous[i]]:
+                previous[i] = j
+        finish[i] = duration + (finish[previous[i]] if previous[i] >= 0 else 0)
+    path = [int(np.argmax(finish))]
+    while previous[path[-1]] >= 0:
+        path.append(int(previous[path[-1]]))
+    return df.iloc[path[::-1]].assign(cumulative_s=finish[path[::-1]])
+
+
+def summarize(df):
+    """per interface and per subject summaries of load_runtimes' table"""
+    by_interface = df.groupby("interface").agg(n=("node", "size"), total_h=("duration_s", lambda s: s.sum() / 3600),
+                                               mean_s=("duration_s", "mean"), max_s=("duration_s", "max"),
+                                               peak_rss_gb=("peak_rss_gb", "max"),
+                                               cpu_efficiency=("cpu_efficiency", "mean"))
+    by_interface = by_interface.sort_values("total_h", ascending=False)
+    by_subject = df.dropna(subset=["subject"]).groupby("subject").agg(
+        n=("node", "size"), total_h=("duration_s", lambda s: s.sum() / 3600), start=("start", "min"),
+        end=("end", "max"), peak_rss_gb=("peak_rss_gb", "max"), cpu_efficiency=("cpu_efficiency", "mean"))
+    by_subject.insert(2, "wall_h", (by_subject.end - by_subject.start).dt.total_seconds() / 3600)
+    by_subject = by_subject.sort_values("total_h", ascending=False)
+    return by_interface, by_subject
+
+
+def runtime_report(wd_dir, report_dir=None, n_slowest=20, n_threads=16):
+    """
+    Combines the runtime profiles of all nodes in a stage's working dir (wd_dir, incl. shard dirs) by interface and
+    by subject. Writes report_dir (default wd_dir)/runtime_nodes.csv (one row per node) and runtime_report.html
+    (totals, per interface, slowest subjects, critical path).
+    Peak RSS and CPU efficiency (mean CPU use / threads) need nipype's resource monitor (monitoring enabled, psutil);
+    without it only times are reported.
+    :return: dict of DataFrames nodes, by_interface, by_subject, critical_path
+    """
+    wd_dir = Path(wd_dir)
+    report_dir = Path(report_dir) if report_dir else wd_dir
+    df = load_runtimes(wd_dir, n_threads=n_threads)
+    if df.empty:
+        print(f"no node results in {wd_dir}")
+        return {}
+    by_interface, by_subject = summarize(df)
+    path = critical_path(df, wd_dir)
+
+    report_dir.mkdir(parents=True, exist_ok=True)
+    df.drop(columns="_inputs").to_csv(report_dir / "runtime_nodes.csv", index=False)
+
+    wall_h = (df.end.max() - df.start.min()).total_seconds() / 3600
+    totals = pd.DataFrame([{"nodes": len(df), "subjects": by_subject.shape[0], "wall_h": wall_h,
+                            "node_h": df.duration_s.sum() / 3600, "critical_path_h": path.cumulative_s.max() / 3600,
+                            "peak_rss_gb": df.peak_rss_gb.max(), "cpu_efficiency": df.cpu_efficiency.mean(),
+                            "hosts": df.host.nunique()}])
+    path_cols = ["name", "interface", "subject", "start", "end", "duration_s", "cumulative_s"]
+    sections = [("totals", totals), ("by interface", by_interface),
+                (f"slowest {n_slowest} subjects (node hours)", by_subject.head(n_slowest)),
+                ("critical path (file dependencies)", path[path_cols])]
+    html = [f"<html><head><meta charset='utf-8'><title>runtime {wd_dir}</title></head><body>",
+            f"<h1>runtime report: {wd_dir}</h1>"]
+    for title, table in sections:
+        html += [f"<h2>{title}</h2>", table.to_html(float_format=lambda x: f"{x:.2f}", na_rep="")]
+    html.append("</body></html>")
+    (report_dir / "runtime_report.html").write_text("\n".join(html))
+    print(by_interface.to_string(float_format=lambda x: f"{x:.2f}"))
+    return {"nodes": df, "by_interface": by_interface, "by_subject": by_subject, "critical_path": path}
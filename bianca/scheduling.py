@@ -0,0 +1,62 @@
+from nipype.pipeline.engine import MapNode
+from nipype.pipeline.plugins.multiproc import MultiProcPlugin
+
+
+class PriorityMultiProcPlugin(MultiProcPlugin):
+    """
+    MultiProc that submits ready jobs in order of priority(node) (lower first; ties keep nipype's topological order),
+    e.g. to run the nodes of training subjects before the ones of test subjects when not all ready jobs fit.
+    Usage: wf.run(plugin=PriorityMultiProcPlugin(priority, plugin_args={"n_procs": 8}))
+    """
+
+    def __init__(self, priority=None, plugin_args=None):
+        super().__init__(plugin_args=plugin_args)
+        self.priority = priority
+
+    def _sort_jobs(self, jobids, scheduler="tsort"):
+        jobids = super()._sort_jobs(jobids, scheduler=scheduler)
+        if self.priority is None:
+            return jobids
+        return sorted(jobids, key=lambda jobid: self.priority(self.procs[jobid]))
+
+    def _submit_job(self, node, updatehash=False):
+        # Workflow.run sets use_plugin = (plugin, plugin_args) on MapNodes (unused by nipype); a plugin instance (pool,
+        # callbacks) cannot be pickled to the workers
+        if isinstance(node, MapNode):
+            node.use_plugin = None
+        return super()._submit_job(node, updatehash=updatehash)
+
+
+class ResourceMultiProcPlugin(PriorityMultiProcPlugin):
+    """
+    PriorityMultiProcPlugin that raises the threads (num_threads) of ready jobs of elastic interfaces (e.g.
+    N4BiasFieldCorrection, see bianca.resources.RESOURCE_PROFILES) when fewer jobs are left than processors, so the
+    last subjects of a run do not leave cores idle. Threads are never lowered.
+    admit: function node -> bool, ready jobs are only submitted if admitted (others are asked again in the next poll),
+    e.g. WorkDirManager.admits to start new subjects only within the disk budget
+    """
+
+    def __init__(self, priority=None, elastic=(), admit=None, plugin_args=None):
+        super().__init__(priority, plugin_args=plugin_args)
+        self.elastic = set(elastic)
+        self.admit = admit
+
+    def _is_elastic(self, jobid):
+        node = self.procs[jobid]
+        return (not isinstance(node, MapNode) and
+                any(c.__name__ in self.elastic for c in type(node.interface).__mro__) and
+                hasattr(node.interface.inputs, "num_threads"))
+
+    def _sort_jobs(self, jobids, scheduler="tsort"):
+        jobids = super()._sort_jobs(jobids, scheduler=scheduler)
+        if self.admit is not None:
+            jobids = [jobid for jobid in jobids if self.admit(self.procs[jobid])]
+        n_left = int((~self.proc_done).sum()) + len(self.pending_tasks)
+        elastic = [jobid for jobid in jobids if self._is_elastic(jobid)]
+        if elastic and n_left < self.processors:
+            _, free_processors, _ = self._check_resources(self.pending_tasks)
+            threads = (free_processors - (len(jobids) - len(elastic))) // len(elastic)
+            for jobid in elastic:
+                if threads > self.procs[jobid].n_procs:
+                    self.procs[jobid].n_procs = min(threads, self.processors)
+        return jobids
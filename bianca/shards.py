@@ -0,0 +1,222 @@
+import os
+import json
+import time
+import heapq
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from .workdir import run_workflow
+from .dataset_index import get_dataset_index
+from .manifest import session_key, read_manifest, manifest_files
+from .utils import parse_shard, shard_label, write_text_atomic
+
+
+def make_shards(items, shard_size=None):
+    """consecutive chunks of at most shard_size items (one chunk with all items if shard_size is None)"""
+    items = list(items)
+    if not shard_size:
+        return [items] if items else []
+    return [items[i:i + shard_size] for i in range(0, len(items), shard_size)]
+
+
+def _timed_build(build_wf, items):
+    start = time.time()
+    wf = build_wf(items)
+    return wf, time.time() - start
+
+
+def run_shards(build_wf, items, shard_size=None, n_cpu=1, wd_manager=None, manifest=None, run_wf=True, graph=False,
+               overlap=False, priority=None):
+    """
+    Runs a cohort as a sequence of sub-graphs of at most shard_size subjects(-sessions), so graph construction,
+    expansion and MultiProc bookkeeping scale with the shard and not with the cohort.
+    All shards use the same workflow name, i.e. working dirs (and nipype's cache) do not depend on the shard size.
+    Build (workflow construction) and expand (wf.run until the first node starts) times are reported per shard and
+    saved as wd_dir/<workflow name>_shards.tsv.
+    If nodes of a shard fail, the remaining shards are run before the error is raised.
+    The stage functions pass their shard_size and overlap_shards (as overlap) on to this function.
+    :param build_wf: function items -> Workflow (e.g. a partial of the stage's init_*_wf)
+    :param shard_size: at most this many items per shard (None: all items in one shard)
+    :param overlap: build the next shard's workflow in a thread while the current shard runs
+    :param priority: function node -> sort key of ready jobs (see run_workflow)
+    :return: DataFrame with one row per shard
+    """
+    shards = make_shards(items, shard_size)
+    timing, failed = [], []
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        next_build = executor.submit(_timed_build, build_wf, shards[0]) if shards else None
+        for i, shard in enumerate(shards):
+            wf, build_s = next_build.result()
+            if overlap and i + 1 < len(shards):
+                next_build = executor.submit(_timed_build, build_wf, shards[i + 1])
+            if graph and i == 0:
+                wf.write_graph("workflow_graph.png", graph2use="exec")
+                wf.write_graph("workflow_graph_c.png", graph2use="colored")
+            row = {"shard": i, "n_items": len(shard), "build_s": build_s}
+            if run_wf:
+                try:
+                    row.update(run_workflow(wf, n_cpu, wd_manager, manifest, priority))
+                except RuntimeError as e:
+                    failed.append(i)
+                    print(e)
+            timing.append(row)
+            print(f"{wf.name} shard {i + 1}/{len(shards)} ({len(shard)} items): " +
+                  ", ".join(f"{k} {v:.1f}" for k, v in row.items() if k.endswith("_s")))
+            if not overlap and i + 1 < len(shards):
+                next_build = executor.submit(_timed_build, build_wf, shards[i + 1])
+
+    timing = pd.DataFrame(timing)
+    if shards and wf.base_dir:
+        Path(wf.base_dir).mkdir(exist_ok=True, parents=True)
+        timing.to_csv(Path(wf.base_dir) / f"{wf.name}_shards.tsv", sep="\t", index=False)
+    if failed:
+        raise RuntimeError(f"nodes failed in shards {failed} (see crash files)")
+    return timing
+
+
+def _as_tuple(item):
+    return tuple(item) if isinstance(item, (tuple, list)) else (item,)
+
+
+def input_size_costs(root, items):
+    """estimated cost of subjects or (subject, session)s: size of their files in root (from the dataset index)"""
+    index = get_dataset_index(root, update=False)
+    costs = []
+    for item in items:
+        entities = dict(zip(["subject", "session"], _as_tuple(item)))
+        costs.append(sum(os.stat(f).st_size for f in index.query(**entities) if f.is_file()))
+    return costs
+
+
+def assign_shards(items, n_shards, costs=None):
+    """
+    Deterministic cost-balanced assignment (longest processing time first): items sorted by decreasing cost (ties by
+    item) go to the shard with the lowest total cost so far (ties by shard number).
+    Does not depend on the order of items.
+    :return: list of n_shards lists of items
+    """
+    costs = [1] * len(items) if costs is None else costs
+    order = sorted(range(len(items)), key=lambda j: (-costs[j], str(items[j])))
+    heap = [(0, i) for i in range(n_shards)]
+    shards = [[] for _ in range(n_shards)]
+    for j in order:
+        total, i = heapq.heappop(heap)
+        shards[i].append(items[j])
+        heapq.heappush(heap, (total + costs[j], i))
+    return [sorted(shard, key=str) for shard in shards]
+
+
+def plan_file(out_dir, stage, shard):
+    return Path(out_dir) / "_shards" / stage / f"{shard_label(shard)}.json"
+
+
+def select_shard(out_dir, stage, items, shard, wd_dir, crash_dir, costs=None, keys=None):
+    """
+    Items of shard i/N of a stage (assign_shards over all items) with per-shard working and crash dirs.
+    The assignment (session keys) is saved in out_dir/_shards/{stage}/shard-{i}of{N}.json for merge_shards.
+    The stage functions take shard="i/N" (CLI --shard i/N) to run one shard of a multi-host run: only shard i's items
+    are run, the stage's manifest records them in a shard manifest, and merge_shards(out_dir, stage) checks and
+    combines the shards once all N have run.
+    :param keys: session keys of items (default session_key(*item))
+    :return: shard items, wd_dir / shard-{i}of{N}, crash_dir / shard-{i}of{N}
+    """
+    i, n = parse_shard(shard)
+    keys = [session_key(*_as_tuple(item)) for item in items] if keys is None else keys
+    shard_items = assign_shards(list(items), n, costs)[i - 1]
+    key_of = dict(zip(map(str, items), keys))
+    plan = {"stage": stage, "shard": [i, n], "n_items": len(items),
+            "sessions": [key_of[str(item)] for item in shard_items]}
+    plan_file(out_dir, stage, shard).parent.mkdir(parents=True, exist_ok=True)
+    write_text_atomic(plan_file(out_dir, stage, shard), json.dumps(plan, indent=1))
+    print(f"{stage} {shard_label(shard)}: {len(shard_items)} of {len(items)} items")
+    label = shard_label(shard)
+    return shard_items, Path(wd_dir) / label, Path(crash_dir) / label
+
+
+def merge_tables(out_dir, name, keys=("subject", "session")):
+    """combines out_dir/{name}_shard-*.tsv into out_dir/{name}.tsv (rows of sessions in a shard table replace existing
+    rows) and removes the shard tables"""
+    out_dir = Path(out_dir)
+    shard_files = sorted(out_dir.glob(f"{name}_shard-*.tsv"))
+    if not shard_files:
+        return None
+    dtype = {k: str for k in keys}
+    df = pd.concat([pd.read_csv(f, sep="\t", dtype=dtype) for f in shard_files], ignore_index=True)
+    table_file = out_dir / f"{name}.tsv"
+    if table_file.is_file():
+        previous = pd.read_csv(table_file, sep="\t", dtype=dtype)
+        rerun = previous.set_index(list(keys)).index.isin(df.set_index(list(keys)).index)
+        df = pd.concat([previous[~rerun], df], ignore_index=True)
+    df.to_csv(table_file, sep="\t", index=False)
+    for f in shard_files:
+        f.unlink()
+    return df
+
+
+def merge_shards(out_dir, stage, tables=()):
+    """
+    Checks that every session of a sharded stage run was done exactly once and combines the shard manifests into
+    out_dir/_manifest_{stage}.json (and the shard tables into out_dir/{table}.tsv).
+    A session is done if exactly one shard recorded it, or (skipped as complete) it is in the stage's manifest.
+    Plans and shard manifests are only removed if all sessions are done exactly once.
+    :return: DataFrame session, shard, n_recorded, status (done, previous, missing, duplicate); raises RuntimeError if
+    the plans are inconsistent (different N, missing shards, different numbers of items, sessions assigned twice or
+    to no shard, e.g. if hosts computed the assignment from different inputs or costs)
+    """
+    out_dir = Path(out_dir)
+    plan_files = sorted((out_dir / "_shards" / stage).glob("shard-*.json"))
+    if not plan_files:
+        raise RuntimeError(f"no shard plans for {stage} in {out_dir / '_shards' / stage}")
+    plans = [json.loads(f.read_text()) for f in plan_files]
+    n_shards = {p["shard"][1] for p in plans}
+    if len(n_shards) != 1:
+        raise RuntimeError(f"plans of different shard counts {sorted(n_shards)} in {out_dir / '_shards' / stage}")
+    n = n_shards.pop()
+    missing_shards = sorted(set(range(1, n + 1)) - {p["shard"][0] for p in plans})
+    if missing_shards:
+        raise RuntimeError(f"{stage}: shards {missing_shards} of {n} have not run")
+
+    n_items = {p["n_items"] for p in plans}
+    if len(n_items) != 1:
+        raise RuntimeError(f"{stage}: plans of different numbers of items {sorted(n_items)}, shards were assigned "
+                           f"from different inputs")
+    n_items = n_items.pop()
+
+    shard_of = {}
+    for p in plans:
+        for key in p["sessions"]:
+            if key in shard_of:
+                raise RuntimeError(f"{stage}: {key} assigned to shards {shard_of[key]} and {p['shard'][0]}")
+            shard_of[key] = p["shard"][0]
+    if len(shard_of) != n_items:
+        raise RuntimeError(f"{stage}: plans assign {len(shard_of)} of {n_items} items, {n_items - len(shard_of)} "
+                           f"are in no shard (assignments differ between hosts, e.g. changed costs)")
+
+    main_file = out_dir / f"_manifest_{stage}.json"
+    main = read_manifest(main_file)
+    shard_manifests = [f for f in manifest_files(out_dir, stage) if f != main_file]
+    recorded = {}
+    for f in shard_manifests:
+        for key in read_manifest(f):
+            recorded[key] = recorded.get(key, 0) + 1
+
+    rows = []
+    for key, i in sorted(shard_of.items()):
+        n_recorded = recorded.get(key, 0)
+        status = "done" if n_recorded == 1 else "duplicate" if n_recorded > 1 else \
+            "previous" if key in main else "missing"
+        rows.append(dict(session=key, shard=i, n_recorded=n_recorded, status=status))
+    report = pd.DataFrame(rows)
+    print(report.status.value_counts().to_string())
+
+    if set(report.status) <= {"done", "previous"}:
+        for f in shard_manifests:
+            main.update(read_manifest(f))
+        write_text_atomic(main_file, json.dumps(main, indent=1, sort_keys=True))
+        for table in tables:
+            merge_tables(out_dir, table)
+        for f in shard_manifests + plan_files:
+            f.unlink()
+    return report
@@ -0,0 +1,195 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+import nibabel as nb
+from scipy import ndimage
+
+from .utils import derivative_path
+from .resources import available_cpus
+
+# 26 neighbours, the default of fsl's cluster; not checked against bianca_cluster_stats
+CONNECTIVITY = ndimage.generate_binary_structure(3, 3)
+
+
+# region -> suffix of the bianca_cluster_stats output file the fsl engine sinks
+CLUSTER_STATS_SUFFIXES = {"total": "ClusterStatsTotal", "deepwm": "ClusterStatsdeepwm",
+                          "perventwm": "ClusterStatsperventwm"}
+
+
+def format_t(threshold):
+    return f"thresh{threshold}"
+
+
+def format_cluster_stats(stats):
+    """stats of one region and threshold (see cluster_stats) as printed by bianca_cluster_stats"""
+    return f"Number of clusters = {stats['n_clusters']}\nTotal volume (mm3) = {stats['volume_mm3']}\n"
+
+
+def cluster_stats(bin_map, voxel_volume, min_cluster_size=0):
+    """Number of clusters (>= min_cluster_size voxels) and their total size in a binary map"""
+    labels, n_clusters = ndimage.label(bin_map, structure=CONNECTIVITY)
+    sizes = np.bincount(labels.ravel(), minlength=n_clusters + 1)[1:]
+    sizes = sizes[sizes >= min_cluster_size]
+    return {"n_clusters": len(sizes), "n_voxels": int(sizes.sum()), "volume_mm3": sizes.sum() * voxel_volume}
+
+
+def threshold_lpm(lpm_file, wm_mask_file, region_mask_files, thresholds, min_cluster_size=0):
+    """
+    In-process version of ApplyMask + Threshold(-bin) + cluster stats for all thresholds.
+    LPM and masks are loaded once; thresholds are binarized one at a time, so only one binary map is in memory.
+
+    :param region_mask_files: dict region name -> mask file, e.g. {"deepwm": ..., "perventwm": ...}.
+    Stats for the whole wm mask are reported as region "total".
+    :return: lpm_masked (nibabel image), iterator of (threshold, binary map (nibabel image), stats (list of dicts, one
+    per region))
+    """
+    lpm_img = nb.load(str(lpm_file))
+    lpm = np.asanyarray(lpm_img.dataobj)
+    voxel_volume = float(np.prod(lpm_img.header.get_zooms()[:3]))
+
+    regions = {"total": np.asanyarray(nb.load(str(wm_mask_file)).dataobj) != 0}
+    for region, f in region_mask_files.items():
+        regions[region] = regions["total"] & (np.asanyarray(nb.load(str(f)).dataobj) != 0)
+
+    # fslmaths -mas
+    lpm_masked = np.where(regions["total"], lpm, 0).astype(lpm.dtype)
+    nonzero = lpm_masked != 0
+
+    def bin_maps():
+        for threshold in thresholds:
+            # fslmaths -thr t -bin (-thr zeroes values below t)
+            bin_map = (lpm_masked >= threshold) & nonzero
+            stats = [dict(threshold=threshold, region=region,
+                          **cluster_stats(bin_map & region_mask, voxel_volume, min_cluster_size))
+                     for region, region_mask in regions.items()]
+            yield threshold, nb.Nifti1Image(bin_map.astype(lpm.dtype), lpm_img.affine, lpm_img.header), stats
+
+    return nb.Nifti1Image(lpm_masked, lpm_img.affine, lpm_img.header), bin_maps()
+
+
+def threshold_session(out_dir, subject, session, bianca_lpm, wm_mask, deepwm_mask, pervent_mask, thresholds,
+                      min_cluster_size=0):
+    """
+    Runs threshold_lpm for one session and writes the derivatives bianca_threshold writes: masked LPM, thresholded
+    binary maps and one ClusterStats{Total,deepwm,perventwm}.txt file per threshold in bianca_cluster_stats' output
+    format. The cluster stats are also written as one table per session (_FLAIR_clusterstats.tsv: threshold, region
+    (total, deepwm, perventwm), n_clusters, n_voxels, volume_mm3).
+    :return: stats, out_files
+    """
+    lpm_masked, bin_maps = threshold_lpm(bianca_lpm, wm_mask, {"deepwm": deepwm_mask, "perventwm": pervent_mask},
+                                         thresholds, min_cluster_size)
+    out_file = derivative_path(out_dir, bianca_lpm, bianca_lpm, desc="biancamasked")
+    out_file.parent.mkdir(exist_ok=True, parents=True)
+    lpm_masked.to_filename(str(out_file))
+    out_files = [out_file]
+
+    stats = []
+    for threshold, bin_map, threshold_stats in bin_maps:
+        out_file = derivative_path(out_dir, bianca_lpm, bianca_lpm, desc=format_t(threshold),
+                                   suffix="biancaLPMmaskedThrBin")
+        bin_map.to_filename(str(out_file))
+        out_files.append(out_file)
+        for region_stats in threshold_stats:
+            out_file = derivative_path(out_dir, bianca_lpm, "out.txt", desc=format_t(threshold),
+                                       suffix=CLUSTER_STATS_SUFFIXES[region_stats["region"]])
+            out_file.write_text(format_cluster_stats(region_stats))
+            out_files.append(out_file)
+        stats += threshold_stats
+    stats = pd.DataFrame(stats)
+    out_file = derivative_path(out_dir, bianca_lpm, "out.tsv", suffix="clusterstats")
+    stats.to_csv(out_file, sep="\t", index=False)
+    out_files.append(out_file)
+
+    stats.insert(0, "session", session)
+    stats.insert(0, "subject", subject)
+    return stats, out_files
+
+
+def threshold_sessions(out_dir, session_files, thresholds, n_cpu=1, min_cluster_size=0, manifest=None,
+                       table_name="cluster_stats"):
+    """
+    Runs threshold_session for all sessions in a process pool and saves one cluster stats table in
+    out_dir/{table_name}.tsv.
+    Rows of sessions that are in an existing table but not in session_files (e.g. skipped as complete) are kept.
+    :param session_files: list of dicts with keys subject, session, bianca_lpm, wm_mask, deepwm_mask, pervent_mask
+    :param manifest: CompletionManifest, each session's outputs are recorded when it is done
+    """
+    n_cpu = available_cpus(n_cpu)
+    with ProcessPoolExecutor(max_workers=n_cpu) as executor:
+        futures = [executor.submit(threshold_session, out_dir, thresholds=thresholds,
+                                   min_cluster_size=min_cluster_size, **f) for f in session_files]
+        if manifest is not None:
+            for f in as_completed(futures):
+                manifest.record(f.result()[1])
+        stats = pd.concat([f.result()[0] for f in futures], ignore_index=True)
+
+    stats_file = out_dir / f"{table_name}.tsv"
+    if stats_file.is_file():
+        previous = pd.read_csv(stats_file, sep="\t", dtype={"subject": str, "session": str})
+        rerun = previous.set_index(["subject", "session"]).index.isin(stats.set_index(["subject", "session"]).index)
+        stats = pd.concat([previous[~rerun], stats], ignore_index=True)
+    stats.to_csv(stats_file, sep="\t", index=False)
+    return stats
+
+
+def overlap_sweep(lpm_file, wm_mask_file, manual_mask_file, thresholds):
+    """
+    Overlap measures of the wm-masked LPM vs. the manual mask for many thresholds at once.
+    The masked LPM values are sorted once; voxel counts above each threshold are read off with searchsorted.
+    Lesion-level detection uses the maximum LPM value in each manual lesion (26-connectivity): a lesion is detected at
+    threshold t if any of its voxels is >= t.
+    FPR is relative to the non-lesion voxels in the wm mask.
+    :return: DataFrame with one row per threshold
+    """
+    lpm = np.asanyarray(nb.load(str(lpm_file)).dataobj).astype(float)
+    wm = np.asanyarray(nb.load(str(wm_mask_file)).dataobj) != 0
+    manual = np.asanyarray(nb.load(str(manual_mask_file)).dataobj) != 0
+    thresholds = np.asarray(thresholds, dtype=float)
+
+    lpm_masked = np.where(wm, lpm, 0)
+    pred_vals = np.sort(lpm_masked[lpm_masked != 0])
+    tp_vals = np.sort(lpm_masked[manual & (lpm_masked != 0)])
+    n_pred = len(pred_vals) - np.searchsorted(pred_vals, thresholds, side="left")
+    tp = len(tp_vals) - np.searchsorted(tp_vals, thresholds, side="left")
+    n_manual = int(manual.sum())
+    n_negative = int((wm & ~manual).sum())
+
+    labels, n_lesions = ndimage.label(manual, structure=CONNECTIVITY)
+    lesion_max = np.asarray(ndimage.maximum(lpm_masked, labels, index=np.arange(1, n_lesions + 1)))
+    n_detected = ((lesion_max[np.newaxis] >= thresholds[:, np.newaxis]) & (lesion_max != 0)).sum(1)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        df = pd.DataFrame({"threshold": thresholds,
+                           "dice": 2 * tp / (n_pred + n_manual),
+                           "precision": tp / n_pred,
+                           "recall": tp / n_manual,
+                           "fpr": (n_pred - tp) / n_negative,
+                           "lesion_detection_rate": n_detected / n_lesions,
+                           "n_lesions_detected": n_detected,
+                           "n_lesions_manual": n_lesions,
+                           "n_voxels_pred": n_pred,
+                           "n_voxels_manual": n_manual,
+                           })
+    return df
+
+
+def _overlap_sweep_session(subject, session, bianca_lpm, wm_mask, manual_mask, thresholds):
+    df = overlap_sweep(bianca_lpm, wm_mask, manual_mask, thresholds)
+    df.insert(0, "session", session)
+    df.insert(0, "subject", subject)
+    return df
+
+
+def overlap_sweep_sessions(session_files, thresholds, n_cpu=1, metric="dice"):
+    """
+    Runs overlap_sweep for all sessions in a process pool.
+    :param session_files: list of dicts with keys subject, session, bianca_lpm, wm_mask, manual_mask
+    :return: tidy subject x threshold DataFrame, threshold with the highest mean metric across sessions
+    """
+    n_cpu = available_cpus(n_cpu)
+    with ProcessPoolExecutor(max_workers=n_cpu) as executor:
+        futures = [executor.submit(_overlap_sweep_session, thresholds=thresholds, **f) for f in session_files]
+        df = pd.concat([f.result() for f in futures], ignore_index=True)
+    best_threshold = df.groupby("threshold")[metric].mean().idxmax()
+    return df, best_threshold
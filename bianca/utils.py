@@ -1,7 +1,11 @@
 import pandas as pd
 from pathlib import Path
 import subprocess
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
 from bianca import __version__
+from bianca.dataset_index import get_dataset_index
 
 
 def get_subject_sessions(bids_dir, flair_acq):
@@ -10,8 +14,9 @@ def get_subject_sessions(bids_dir, flair_acq):
         subject = p.parents[2].name.replace("sub-", "")
         return subject, session
 
-    flair_files = list(Path(bids_dir).glob(f"sub-*/ses-*/anat/*_acq-{flair_acq}_*_FLAIR.nii.gz"))
-    t1w_files = list(Path(bids_dir).glob(f"sub-*/ses-*/anat/*_T1w.nii.gz"))
+    index = get_dataset_index(bids_dir)
+    flair_files = index.glob(f"sub-*/ses-*/anat/*_acq-{flair_acq}_*_FLAIR.nii.gz")
+    t1w_files = index.glob(f"sub-*/ses-*/anat/*_T1w.nii.gz")
     flair_suse = set([_get_suse_from_path(p) for p in flair_files])
     t1w_suse = set([_get_suse_from_path(p) for p in t1w_files])
     subject_sessions = list(flair_suse & t1w_suse)
@@ -19,21 +24,62 @@ def get_subject_sessions(bids_dir, flair_acq):
     return subject_sessions
 
 
+def write_text_atomic(path, text):
+    """writes text to a temporary file next to path and renames it, readers never see a partial file"""
+    path = Path(path)
+    tmp_file = path.with_name(f".{path.name}.{os.uname().nodename}.{os.getpid()}")
+    tmp_file.write_text(text)
+    os.replace(tmp_file, path)
+
+
 def export_version(out_dir):
+    """writes pipeline_version.txt (atomically and only if it changed, as shards on several hosts share out_dir)"""
     out_dir.mkdir(parents=True, exist_ok=True)
     try:
         version_label = subprocess.check_output(["git", "describe", "--tags"]).strip()
-        (out_dir / "pipeline_version.txt").write_text(f"git: {version_label.decode()}")
+        version = f"git: {version_label.decode()}"
     except:
-        (out_dir / "pipeline_version.txt").write_text(__version__)
+        version = __version__
+    version_file = out_dir / "pipeline_version.txt"
+    if not version_file.is_file() or version_file.read_text() != version:
+        write_text_atomic(version_file, version)
 
 
-def create_masterfile(prep_dir, training_data_dir, bianca_dir, flair_tmpl, t1w_tmpl, manual_mask_tmpl,
-                      mat_tmpl):
-    bianca_dir.mkdir(exist_ok=True, parents=True)
+def parse_shard(shard):
+    """"i/N" or (i, N) -> (i, N), shards are numbered 1..N"""
+    i, n = map(int, shard.split("/")) if isinstance(shard, str) else shard
+    if not 1 <= i <= n:
+        raise ValueError(f"shard should be i/N with 1 <= i <= N, but is {shard}")
+    return i, n
+
+
+def shard_label(shard):
+    i, n = parse_shard(shard)
+    return f"shard-{i}of{n}"
 
+
+def _format_column(df, tmpl):
+    """vectorized version of df.apply(lambda row: tmpl.format(**row), axis=1)"""
+    col = pd.Series("", index=df.index, dtype=object)
+    for i, piece in enumerate(re.split(r"{(\w+)}", tmpl)):
+        col = col + (df[piece].astype(str) if i % 2 else piece)
+    return col
+
+
+def files_exist(files, n_threads=16):
+    """checks existence of files concurrently, as single stats are slow on NFS"""
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        return list(executor.map(os.path.isfile, files))
+
+
+def masterfile_frame(prep_dir, training_data_dir, bianca_dir, flair_tmpl, t1w_tmpl, manual_mask_tmpl, mat_tmpl,
+                     update=False, n_threads=16):
+    """
+    Rows create_masterfile writes, without checking that the t1w and mat files exist
+    :return: df (all rows), df_new (rows that are not in the existing masterfile)
+    """
     # get flair files
-    flair_globs = list(prep_dir.glob(flair_tmpl.format(subject="*", session="*")))
+    flair_globs = get_dataset_index(prep_dir).glob(flair_tmpl.format(subject="*", session="*"))
     print(f"{len(flair_globs)} flair files found")
 
     # get remaining files
@@ -41,30 +87,91 @@ def create_masterfile(prep_dir, training_data_dir, bianca_dir, flair_tmpl, t1w_t
     df["subject"] = df.flair.str.split("sub-").str[1].str.split("/").str[0]
     df["session"] = df.flair.str.split("ses-").str[1].str.split("/").str[0]
 
-    complete_files = {"t1w": str(prep_dir / t1w_tmpl),
-                      "manual_mask": str(training_data_dir / manual_mask_tmpl),
-                      "mat": str(prep_dir / mat_tmpl)
-                      }
-    for var in complete_files.keys():
-        df[var] = None
-    for i in range(len(df)):
-        for var in complete_files.keys():
-            df[var].iloc[i] = complete_files[var].format(**df.iloc[i])
+    df_existing = None
+    if update and (bianca_dir / "masterfile_wHeader.txt").is_file():
+        df_existing = pd.read_csv(bianca_dir / "masterfile_wHeader.txt", sep=" ", dtype=str, keep_default_na=False)
+        existing = pd.MultiIndex.from_frame(df_existing[["subject", "session"]])
+        df = df[~pd.MultiIndex.from_frame(df[["subject", "session"]]).isin(existing)].reset_index(drop=True)
+        print(f"{len(df_existing)} sessions in existing masterfile, {len(df)} new sessions")
+
+    df["t1w"] = _format_column(df, str(prep_dir / t1w_tmpl))
+    df["manual_mask"] = _format_column(df, str(training_data_dir / manual_mask_tmpl))
+    df["mat"] = _format_column(df, str(prep_dir / mat_tmpl))
 
     df = df[['flair', 't1w', 'manual_mask', 'mat', 'subject', 'session']]
 
     # only include masks from training subjects
-    training_subject_index = df.manual_mask.apply(lambda s: Path(s).is_file())
+    training_subject_index = pd.Series(files_exist(df.manual_mask, n_threads), index=df.index, dtype=bool)
     df.loc[~training_subject_index, "manual_mask"] = "XXX"
-    training_subjects = df[training_subject_index]
 
-    # check if files exist
-    files = df[['flair', 't1w', 'manual_mask', 'mat']].melt()["value"].to_list()
-    for f in files:
-        if f != "XXX":
-            assert Path(f).is_file(), f"{f} is missing"
+    if df_existing is not None:
+        return pd.concat([df_existing, df], ignore_index=True), df
+    return df, df
+
+
+def create_masterfile(prep_dir, training_data_dir, bianca_dir, flair_tmpl, t1w_tmpl, manual_mask_tmpl,
+                      mat_tmpl, update=False, n_threads=16):
+    """
+    update: if True and a masterfile exists in bianca_dir, only sessions missing in masterfile_wHeader.txt are
+    checked and appended; existing rows keep their position (bianca refers to subjects by row number)
+    n_threads: number of threads for file existence checks
+    """
+    bianca_dir.mkdir(exist_ok=True, parents=True)
+    df, df_new = masterfile_frame(prep_dir, training_data_dir, bianca_dir, flair_tmpl, t1w_tmpl, manual_mask_tmpl,
+                                  mat_tmpl, update=update, n_threads=n_threads)
+
+    # check if files exist (flair files come from the index)
+    files = pd.concat([df_new.t1w, df_new.mat]).to_list()
+    missing = [f for f, exists in zip(files, files_exist(files, n_threads)) if not exists]
+    assert not missing, f"{missing} is missing"
+
+    training_subjects = df[df.manual_mask != "XXX"]
 
     # save
     df.to_csv(bianca_dir / "masterfile.txt", index=False, header=False, sep=" ")
     df.to_csv(bianca_dir / "masterfile_wHeader.txt", index=False, sep=" ")
     training_subjects.to_csv(bianca_dir / "masterfile_training_subjects.txt", index=False, sep=" ")
+
+
+def derivative_path(out_dir, source_file, in_file, space=None, desc=None, suffix=None, keep_dtype=False,
+                    **entities):
+    """
+    Returns the path DerivativesDataSink(base_directory=out_dir.parent, out_path_base=out_dir.name) writes in_file
+    to, e.g. for source sub-X_ses-Y_acq-2D_run-1_FLAIR_LPM.nii.gz and desc="biancamasked":
+    {out_dir}/sub-X/ses-Y/anat/sub-X_ses-Y_acq-2D_run-1_FLAIR_desc-biancamasked.nii.gz
+    entities: additional entities (e.g. from/to), added after desc
+    """
+    source_file = Path(source_file)
+    src_fname = source_file.name.split(".")[0]
+    src_fname, dtype = src_fname.rsplit("_", 1)
+    in_fname = Path(in_file).name
+    ext = "." + in_fname.split(".", 1)[1] if "." in in_fname else ""
+
+    subject = re.search(r"sub-([a-zA-Z0-9]+)", src_fname).group(1)
+    session = re.search(r"_ses-([a-zA-Z0-9]+)", src_fname)
+    out_path = Path(out_dir) / f"sub-{subject}"
+    if session:
+        out_path /= f"ses-{session.group(1)}"
+    out_path /= source_file.parent.name
+
+    fname = src_fname
+    for k, v in [("space", space), ("desc", desc)] + list(entities.items()):
+        if v:
+            fname += f"_{k}-{v}"
+    if suffix:
+        fname += f"_{suffix}"
+    if keep_dtype:
+        fname += f"_{dtype}"
+    return out_path / (fname + ext)
+
+
+def set_intermediate_output_type(compress_intermediates=False):
+    """
+    Sets the output type of fsl nodes created afterwards: plain nifti (default) or .nii.gz for
+    compress_intermediates=True. Sinks compress the final outputs.
+    :return: extension for images written by Function nodes
+    """
+    from nipype.interfaces import fsl
+    output_type = "NIFTI_GZ" if compress_intermediates else "NIFTI"
+    fsl.FSLCommand.set_default_output_type(output_type)
+    return fsl.Info.output_type_to_ext(output_type)
@@ -0,0 +1,252 @@
+import os
+import json
+import time
+import shutil
+from pathlib import Path
+from warnings import warn
+
+import pandas as pd
+
+from .cache import file_checksum
+from .dataset_index import parse_entities
+
+MANIFEST_NAME = "_wd_manifest.json"
+# nipype bookkeeping needed to recognize finished nodes (hashfiles, results, inputs)
+KEEP_PATTERNS = ("_0x*.json", "*.pklz")
+LARGE_FILE_BYTES = 1 << 20
+
+
+def dir_size(path):
+    """total size of all files below path in bytes"""
+    size = 0
+    for root, _, files in os.walk(path):
+        for f in files:
+            try:
+                size += os.lstat(os.path.join(root, f)).st_size
+            except FileNotFoundError:
+                pass
+    return size
+
+
+def node_subject_key(node):
+    """
+    Working dir part shared by all nodes of a node's subject(-session): the parameterization of the subject iterable
+    (e.g. _session_tp1_subject_01, first as the subject iterables are upstream of everything) or, for workflows with
+    one sub-workflow per subject (prepare_t1w), the sub-workflow's name.
+    None for nodes outside of the subjects' (sub-)workflows and for MapNode sub-jobs (no hierarchy)
+    """
+    if node.parameterization:
+        return node.parameterization[0]
+    parts = (node._hierarchy or "").split(".")
+    return parts[1] if len(parts) > 1 else None
+
+
+def subject_dirs(wd_dir, node, max_depth=3):
+    """
+    All working dirs of a node's subject: wd_dir / workflow / [sub-workflows /] node_subject_key(node), as nested
+    workflows put their nodes in wd_dir / workflow / sub-workflow / parameterization / node
+    """
+    wf_dir = Path(wd_dir) / node._hierarchy.split(".")[0]
+    key = node_subject_key(node)
+    return [d for depth in range(max_depth) for d in wf_dir.glob("/".join(["*"] * depth + [key])) if d.is_dir()]
+
+
+def disk_usage_report(wd_root, depth=2):
+    """Disk use of all directories depth levels below wd_root (e.g. _wd/{acq}/{stage}), in GB"""
+    wd_root = Path(wd_root)
+    dirs = [p for p in wd_root.glob("/".join(["*"] * depth)) if p.is_dir()]
+    return pd.DataFrame({"stage": [str(p.relative_to(wd_root)) for p in dirs],
+                         "used_gb": [dir_size(p) / 1e9 for p in dirs]}).sort_values("stage", ignore_index=True)
+
+
+class WorkDirManager:
+    """
+    Deletes intermediate files of a subject(-session) from a stage's working dir once its derivatives have been sunk
+    (DerivativesBulkSink finished) and checksummed. Nipype bookkeeping (hashfiles, result files) is kept, and the
+    subject is recorded in a manifest (wd_dir/_wd_manifest.json) with its output checksums, so a rerun skips it as
+    long as the outputs are unchanged (pending).
+    Disk budget (working dir larger than max_gb or less than min_free_gb free on the scratch file system):
+    wait_for_space() blocks before a run, and during a run admits() holds back the nodes of subjects that have not
+    started yet, so subjects are only started within budget.
+    Usage: run_workflow(wf, n_cpu, manager)
+    """
+
+    def __init__(self, wd_dir, max_gb=None, min_free_gb=None, poll_interval=60, max_wait=6 * 3600, check_interval=10):
+        self.wd_dir = Path(wd_dir)
+        self.max_gb = max_gb
+        self.min_free_gb = min_free_gb
+        self.poll_interval = poll_interval
+        self.max_wait = max_wait
+        self.check_interval = check_interval
+        self._started = set()
+        self._budget_check = (0, False)
+        self._held_since = None
+        self.manifest_file = self.wd_dir / MANIFEST_NAME
+        self.manifest = json.loads(self.manifest_file.read_text()) if self.manifest_file.is_file() else {}
+
+    def _save_manifest(self):
+        self.wd_dir.mkdir(exist_ok=True, parents=True)
+        tmp_file = self.manifest_file.with_name(f".{MANIFEST_NAME}.{os.getpid()}")
+        tmp_file.write_text(json.dumps(self.manifest, indent=1, sort_keys=True))
+        tmp_file.rename(self.manifest_file)
+
+    @staticmethod
+    def session_key(out_files):
+        """sub-X_ses-Y (or sub-X) from the derivatives' file names"""
+        d = parse_entities(Path(sorted(out_files)[0]).name)
+        return f"sub-{d['subject']}" + (f"_ses-{d['session']}" if d["session"] else "")
+
+    def is_collected(self, subject, session=None):
+        """True if subject(-session) has been collected and its outputs are unchanged"""
+        key = f"sub-{subject}" + (f"_ses-{session}" if session else "")
+        entry = self.manifest.get(key)
+        if entry is None:
+            return False
+        try:
+            return all(file_checksum(f) == c for f, c in entry["outputs"].items())
+        except FileNotFoundError:
+            return False
+
+    def pending(self, subjects_sessions):
+        """subjects_sessions without the ones that are collected with unchanged outputs"""
+        return [s for s in subjects_sessions if not self.is_collected(*(s if isinstance(s, tuple) else (s,)))]
+
+    def collect(self, subject_dirs, out_files):
+        """
+        Checksums out_files and deletes images and other large files of finished nodes (with a result file) in
+        subject_dirs. Returns freed bytes.
+        """
+        outputs = {str(f): file_checksum(f) for f in out_files}
+        freed = 0
+        for result_file in (r for d in subject_dirs for r in Path(d).rglob("result_*.pklz")):
+            node_dir = result_file.parent
+            for f in node_dir.iterdir():
+                if not f.is_file() or f.is_symlink() or any(f.match(p) for p in KEEP_PATTERNS):
+                    continue
+                size = f.stat().st_size
+                if f.name.endswith((".nii", ".nii.gz")) or size >= LARGE_FILE_BYTES:
+                    f.unlink()
+                    freed += size
+
+        key = self.session_key(out_files)
+        entry = self.manifest.setdefault(key, {"freed_bytes": 0})
+        entry.update(outputs=outputs, subject_dirs=[str(Path(d).relative_to(self.wd_dir)) for d in subject_dirs],
+                     freed_bytes=entry["freed_bytes"] + freed, time=time.strftime("%Y-%m-%d %H:%M:%S"))
+        self._save_manifest()
+        return freed
+
+    def status_callback(self, node, status):
+        """nipype status_callback: collects a subject's working dir when its bulk sink has finished"""
+        from .workflows.interfaces import DerivativesBulkSink
+
+        if status != "end" or not isinstance(node.interface, DerivativesBulkSink):
+            return
+        out_files = list(node.result.outputs.out_files.values())
+        self.collect(subject_dirs(self.wd_dir, node), out_files)
+
+    def usage_gb(self):
+        return dir_size(self.wd_dir) / 1e9
+
+    def _over_budget(self):
+        if self.max_gb is not None and self.usage_gb() > self.max_gb:
+            return True
+        if self.min_free_gb is not None:
+            self.wd_dir.mkdir(exist_ok=True, parents=True)
+            if shutil.disk_usage(self.wd_dir).free / 1e9 < self.min_free_gb:
+                return True
+        return False
+
+    def wait_for_space(self):
+        """Blocks while over budget (other runs on the same scratch may free space), at most max_wait seconds"""
+        start = time.time()
+        while self._over_budget():
+            if time.time() - start > self.max_wait:
+                warn(f"{self.wd_dir} still over disk budget after {self.max_wait}s. Continuing.")
+                return
+            time.sleep(self.poll_interval)
+
+    def admits(self, node):
+        """
+        Per-subject budget check of the scheduler (ResourceMultiProcPlugin admit): nodes of started subjects always run
+        (so they finish and get collected), a new subject starts only within budget (checked at most every
+        check_interval seconds). Subjects are held back at most max_wait seconds at a time.
+        """
+        key = node_subject_key(node)
+        if key is None or key in self._started:
+            return True
+        checked, over_budget = self._budget_check
+        if time.time() - checked > self.check_interval:
+            over_budget = self._over_budget()
+            self._budget_check = (time.time(), over_budget)
+        if over_budget:
+            if self._held_since is None:
+                self._held_since = time.time()
+            if time.time() - self._held_since <= self.max_wait:
+                return False
+            warn(f"{self.wd_dir} still over disk budget after {self.max_wait}s. Starting {key}.")
+        self._held_since = None
+        self._started.add(key)
+        return True
+
+    def report(self):
+        """disk use of the stage's working dir and what was freed, also saved as wd_dir/disk_usage.tsv"""
+        freed = sum(e["freed_bytes"] for e in self.manifest.values())
+        df = pd.DataFrame([{"stage": self.wd_dir.name, "used_gb": self.usage_gb(), "freed_gb": freed / 1e9,
+                            "n_collected": len(self.manifest)}])
+        df.to_csv(self.wd_dir / "disk_usage.tsv", sep="\t", index=False)
+        return df
+
+
+def run_workflow(wf, n_cpu, wd_manager=None, manifest=None, priority=None):
+    """
+    runs wf with MultiProc (bianca.scheduling.ResourceMultiProcPlugin) within the host's or cgroup's CPUs and memory
+    (n_cpu None or < 1: all available CPUs), with node memory estimates from bianca.resources.RESOURCE_PROFILES
+    priority: function node -> sort key of ready jobs (lower first)
+    with a WorkDirManager: waits for disk space before the run and before starting each subject, collects sunk
+    subjects, reports disk use
+    with a CompletionManifest: records subjects whose outputs were sunk without failed nodes (also if nodes of other
+    subjects failed, but not if the run was interrupted)
+    :return: dict with expand_s (wf.run until the first node starts, i.e. graph expansion) and run_s
+    """
+    from .resources import detect_limits, available_cpus, apply_resource_profiles, elastic_interfaces
+    from .scheduling import ResourceMultiProcPlugin
+
+    _, mem_gb = detect_limits()
+    # nodes with larger estimates than the limit run alone instead of failing the run
+    plugin_args = {'n_procs': available_cpus(n_cpu), 'memory_gb': mem_gb * 0.9, 'raise_insufficient': False}
+    apply_resource_profiles(wf)
+    callbacks = [c.status_callback for c in [wd_manager, manifest] if c is not None]
+    if wd_manager is not None:
+        wd_manager.wait_for_space()
+    start = time.time()
+    first_start = []
+
+    def status_callback(node, status):
+        if not first_start and status == "start":
+            first_start.append(time.time())
+        for callback in callbacks:
+            callback(node, status)
+    plugin_args["status_callback"] = status_callback
+
+    admit = wd_manager.admits if wd_manager is not None else None
+    plugin = ResourceMultiProcPlugin(priority, elastic=elastic_interfaces(), admit=admit, plugin_args=plugin_args)
+    # the workflow's monitoring setting alone does not start nipype's resource monitor (read from the global config by
+    # the interfaces); peak memory and cpu use per node are needed for bianca.runtime_report
+    if str((wf.config or {}).get("monitoring", {}).get("enabled", "false")).lower() == "true":
+        from nipype import config
+        config.enable_resource_monitor()
+
+    try:
+        wf.run(plugin=plugin, plugin_args=plugin_args)
+    except RuntimeError:
+        # nipype raises after all runnable nodes are done if some nodes failed
+        if manifest is not None:
+            manifest.commit()
+        raise
+    if manifest is not None:
+        manifest.commit()
+    if wd_manager is not None:
+        print(wd_manager.report().to_string(index=False))
+    end = time.time()
+    expand_end = first_start[0] if first_start else end
+    return {"expand_s": expand_end - start, "run_s": end - expand_end}
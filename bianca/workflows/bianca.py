@@ -1,16 +1,33 @@
+from functools import partial
 from nipype import Node, Workflow
 from nipype.interfaces import utility as niu
 from niworkflows.interfaces.bids import DerivativesDataSink
 from .interfaces import BIANCA
 
-import subprocess, bianca
+import subprocess, bianca, os, shutil
 import pandas as pd
 import numpy as np
 from copy import copy
+from pathlib import Path
+from ..cache import ContentCache, file_checksum, hash_dict
+from ..utils import derivative_path, export_version, masterfile_frame
+from ..knn_engine import run_bianca_native, run_bianca_native_cv, cv_folds
+from ..manifest import CompletionManifest, file_session_key
+from ..shards import run_shards, select_shard
+
+# files bianca --saveclassifierdata writes (and --loadclassifierdata reads) for classifier name "classifier"
+CLASSIFIER_FILES = ["classifier", "classifier_labels"]
+
+# masterfile columns: flair t1w manual_mask mat
+BIANCA_OPTIONS = {"featuresubset": "1,2",
+                  "brainmaskfeaturenum": "2",
+                  "labelfeaturenum": "3",
+                  "matfeaturenum": "4"}
 
 
 def run_bianca_wf(masterfile, out_dir, wd_dir, crash_dir, df, training_subject_idx, query_subject_idx,
-                  name="bianca", n_cpu=4, save_classifier=False, trained_classifier_file=None):
+                  name="bianca", n_cpu=4, save_classifier=False, trained_classifier_file=None, manifest=None,
+                  shard_size=None, overlap_shards=False, exclude_subject_idx=None):
     """
 
     :param masterfile: str
@@ -24,13 +41,20 @@ def run_bianca_wf(masterfile, out_dir, wd_dir, crash_dir, df, training_subject_i
     :param n_cpu:
     :param save_classifier: bool
     :param trained_classifier_file: file previously saved with save_classifier; if given, training subjects
-    are ignored and classifier file is used in prediction
+    are ignored and classifier file is used in prediction. dict query_subject_idx -> file: one classifier per query
+    subject (cross-validation folds)
+    :param manifest: CompletionManifest, records the query subjects' sunk outputs
+    :param shard_size, overlap_shards: sharding of the query subjects, see bianca.shards.run_shards
+    :param exclude_subject_idx: dict query_subject_idx -> list of training subjects left out of the query subject's
+    training set (default: the query subject itself, i.e. leave-one-out)
     :return: None
     """
 
     if save_classifier and trained_classifier_file:
         raise RuntimeError("save_classifier and trained_classifier_file cannot be set at the same time")
-    if trained_classifier_file:
+    if isinstance(trained_classifier_file, dict):
+        trained_classifier_file = {int(q): str(f) for q, f in trained_classifier_file.items()}
+    elif trained_classifier_file:
         trained_classifier_file = str(trained_classifier_file)
     #####
     # masterfile information
@@ -38,13 +62,23 @@ def run_bianca_wf(masterfile, out_dir, wd_dir, crash_dir, df, training_subject_i
     assert df.columns.tolist() == expected_header, f"masterfile columns are off. columns should be \
     {expected_header} but are {df.columns}"
 
-    featuresubset = "1,2"
-    brainmaskfeaturenum = "2"
-    labelfeaturenum = "3"
-    matfeaturenum = "4"
-
     ######
     # workflow
+    build_wf = partial(init_run_bianca_wf, masterfile=masterfile, out_dir=out_dir, wd_dir=wd_dir, crash_dir=crash_dir,
+                       df=df, training_subject_idx=training_subject_idx, name=name, save_classifier=save_classifier,
+                       trained_classifier_file=trained_classifier_file, exclude_subject_idx=exclude_subject_idx)
+
+    run_shards(build_wf, query_subject_idx, shard_size, n_cpu, manifest=manifest, overlap=overlap_shards)
+
+
+def init_run_bianca_wf(query_subject_idx, masterfile, out_dir, wd_dir, crash_dir, df, training_subject_idx,
+                       name="bianca", save_classifier=False, trained_classifier_file=None, exclude_subject_idx=None):
+    """run_bianca_wf's graph of query_subject_idx (one shard, see bianca.shards.run_shards)"""
+    featuresubset = BIANCA_OPTIONS["featuresubset"]
+    brainmaskfeaturenum = BIANCA_OPTIONS["brainmaskfeaturenum"]
+    labelfeaturenum = BIANCA_OPTIONS["labelfeaturenum"]
+    matfeaturenum = BIANCA_OPTIONS["matfeaturenum"]
+
     wf = Workflow(name=name)
 
     ######
@@ -68,9 +102,12 @@ def run_bianca_wf(masterfile, out_dir, wd_dir, crash_dir, df, training_subject_i
     query_info.inputs.df = df
     wf.connect(inputnode, "query_subject_idx", query_info, "query_subject_idx")
 
-    def get_training_info_fnc(df, query_subject_idx, training_subject_idx):
+    def get_training_info_fnc(df, query_subject_idx, training_subject_idx, exclude_subject_idx=None):
         import numpy as np
-        training_subject_idx_clean = training_subject_idx.tolist()
+        training_subject_idx_clean = np.asarray(training_subject_idx).tolist()
+        if exclude_subject_idx:
+            exclude = exclude_subject_idx[query_subject_idx]
+            training_subject_idx_clean = [i for i in training_subject_idx_clean if i not in exclude]
         if query_subject_idx in training_subject_idx_clean:
             training_subject_idx_clean.remove(query_subject_idx)
         training_subjects = df.iloc[training_subject_idx_clean].subject.tolist()
@@ -79,11 +116,13 @@ def run_bianca_wf(masterfile, out_dir, wd_dir, crash_dir, df, training_subject_i
         return training_subject_idx_clean, training_subject_nums_str, training_subjects, training_sessions
 
     training_info = Node(niu.Function(
-        input_names=["df", "query_subject_idx", "training_subject_idx"],
+        input_names=["df", "query_subject_idx", "training_subject_idx", "exclude_subject_idx"],
         output_names=["training_subject_idx", "training_subject_nums_str", "training_subjects", "training_sessions"],
         function=get_training_info_fnc), name="training_info")
     training_info.inputs.df = df
     training_info.inputs.training_subject_idx = training_subject_idx
+    if exclude_subject_idx:
+        training_info.inputs.exclude_subject_idx = {int(q): [int(i) for i in e] for q, e in exclude_subject_idx.items()}
     wf.connect(inputnode, "query_subject_idx", training_info, "query_subject_idx")
 
     bianca = Node(BIANCA(), name="bianca")
@@ -94,7 +133,17 @@ def run_bianca_wf(masterfile, out_dir, wd_dir, crash_dir, df, training_subject_i
     bianca.inputs.save_classifier = save_classifier
     wf.connect(query_info, "query_subject_num", bianca, "querysubjectnum")
 
-    if trained_classifier_file:
+    if isinstance(trained_classifier_file, dict):
+        def select_classifier_fct(classifier_files, query_subject_idx):
+            return classifier_files[query_subject_idx]
+
+        select_classifier = Node(niu.Function(input_names=["classifier_files", "query_subject_idx"],
+                                              output_names=["classifier_file"], function=select_classifier_fct),
+                                 name="select_classifier")
+        select_classifier.inputs.classifier_files = trained_classifier_file
+        wf.connect(inputnode, "query_subject_idx", select_classifier, "query_subject_idx")
+        wf.connect(select_classifier, "classifier_file", bianca, "trained_classifier_file")
+    elif trained_classifier_file:
         bianca.inputs.trained_classifier_file = trained_classifier_file
     else:
         bianca.inputs.labelfeaturenum = labelfeaturenum
@@ -122,7 +171,9 @@ def run_bianca_wf(masterfile, out_dir, wd_dir, crash_dir, df, training_subject_i
     wf.connect(query_info, "query_subject", classifier_info, "query_subject")
     wf.connect(query_info, "query_session", classifier_info, "query_session")
     wf.connect(query_info, "query_flair", classifier_info, "query_flair")
-    if trained_classifier_file:
+    if isinstance(trained_classifier_file, dict):
+        wf.connect(select_classifier, "classifier_file", classifier_info, "classifier_file")
+    elif trained_classifier_file:
         classifier_info.inputs.classifier_file = trained_classifier_file
     else:
         wf.connect(training_info, "training_subjects", classifier_info, "training_subjects")
@@ -153,16 +204,139 @@ def run_bianca_wf(masterfile, out_dir, wd_dir, crash_dir, df, training_subject_i
     wf.config["monitoring"]["enabled"] = "true"
     # wf.write_graph("workflow_graph.png", graph2use="exec")
     # wf.write_graph("workflow_graph_c.png", graph2use="colored")
-    wf.run(plugin='MultiProc', plugin_args={'n_procs': n_cpu})
+    return wf
 
 
-def run_bianca(out_dir, wd_dir, crash_dir, n_cpu=4, save_classifier=False, trained_classifier_file=None,
-               training_subject_idx=None, query_subject_idx=None):
+def _fsl_version():
     try:
-        version_label = subprocess.check_output(["git", "describe", "--tags"]).strip()
-        (out_dir / "pipeline_version.txt").write_text(f"git {version_label.decode()}")
-    except:
-        (out_dir / "pipeline_version.txt").write_text(bianca.__version__)
+        return (Path(os.environ["FSLDIR"]) / "etc" / "fslversion").read_text().strip()
+    except (KeyError, OSError):
+        return None
+
+
+def training_set_hash(df, training_subject_idx):
+    """
+    Hash of everything a trained classifier depends on: training subjects, checksums of their masterfile files,
+    bianca options and fsl version.
+    """
+    training = df.iloc[list(training_subject_idx)]
+    rows = [[subject, session] + [file_checksum(f) for f in files] for subject, session, *files in
+            training[["subject", "session", "flair", "t1w", "manual_mask", "mat"]].values]
+    return hash_dict({"training": rows, "options": BIANCA_OPTIONS, "fsl": _fsl_version()})
+
+
+def run_bianca_cached(masterfile, out_dir, wd_dir, crash_dir, df, training_subject_idx, query_subject_idx,
+                      clf_cache_dir, clf_cache_max_gb=20, n_cpu=4, save_classifier=False, manifest=None,
+                      shard_size=None, overlap_shards=False):
+    """
+    Runs bianca with a classifier from a content-addressed cache (keyed by training_set_hash).
+    On a cache miss, the classifier is trained (and saved) with the first query subject, stored in the cache and
+    then loaded (--loadclassifierdata) for the remaining query subjects.
+    Query subjects that are also training subjects (leave-one-out) have their own training set and are run without
+    the cache.
+    The classifier is copied from the cache to wd_dir before it is used, as other processes may evict it. With
+    save_classifier, a cached classifier is written to the derivatives of the first query subject, as on a cache miss.
+    """
+    cache = ContentCache(clf_cache_dir, clf_cache_max_gb)
+    training_subject_idx = np.asarray(training_subject_idx)
+    loo_idx = [int(q) for q in query_subject_idx if q in training_subject_idx]
+    query_idx = [int(q) for q in query_subject_idx if q not in training_subject_idx]
+
+    if loo_idx:
+        run_bianca_wf(masterfile, out_dir, wd_dir, crash_dir, df, training_subject_idx, loo_idx, name="bianca_loo",
+                      n_cpu=n_cpu, save_classifier=save_classifier, manifest=manifest, shard_size=shard_size,
+                      overlap_shards=overlap_shards)
+    if not query_idx:
+        return
+
+    key = training_set_hash(df, training_subject_idx)
+    clf_dir = Path(wd_dir) / "cached_classifiers" / key
+    query_flair = df.iloc[query_idx[0]].flair
+    clf_files = {f: derivative_path(out_dir, query_flair, f, suffix=f) for f in CLASSIFIER_FILES}
+    if cache.checkout(key, clf_dir, CLASSIFIER_FILES) is None:
+        print(f"classifier {key} not in cache. training.")
+        run_bianca_wf(masterfile, out_dir, wd_dir, crash_dir, df, training_subject_idx, query_idx[:1],
+                      name="bianca_train_clf", n_cpu=n_cpu, save_classifier=True, manifest=manifest)
+        training = df.iloc[training_subject_idx]
+        cache.put(key, clf_files, meta={"masterfile": str(masterfile),
+                                        "training_subjects_sessions": training[["subject", "session"]].values.tolist()})
+        clf_dir.mkdir(parents=True, exist_ok=True)
+        for f, clf_file in clf_files.items():
+            shutil.copyfile(clf_file, clf_dir / f)
+        query_idx = query_idx[1:]
+    else:
+        print(f"using cached classifier {key}")
+        if save_classifier:
+            for f, clf_file in clf_files.items():
+                clf_file.parent.mkdir(parents=True, exist_ok=True)
+                shutil.copyfile(clf_dir / f, clf_file)
+
+    if query_idx:
+        run_bianca_wf(masterfile, out_dir, wd_dir, crash_dir, df, training_subject_idx, query_idx, n_cpu=n_cpu,
+                      trained_classifier_file=clf_dir / "classifier", manifest=manifest, shard_size=shard_size,
+                      overlap_shards=overlap_shards)
+
+
+def train_classifier_cached(prep_dir, training_data_dir, bianca_dir, masterfile_tmpls, clf_cache_dir, work_dir,
+                            clf_cache_max_gb=20):
+    """
+    Trains the classifier run_bianca_cached uses with the masterfile create_masterfile(update=True) will write to
+    bianca_dir, and stores it in the cache (if it is not cached yet). Only the training sessions have to be
+    prepared, i.e. training can run while test sessions are still in preprocessing (see
+    streaming.prepare_streaming).
+    masterfile_tmpls: flair_tmpl, t1w_tmpl, manual_mask_tmpl, mat_tmpl of create_masterfile
+    Returns the cache key (training_set_hash), or None without training sessions.
+    """
+    work_dir = Path(work_dir)
+    rows, _ = masterfile_frame(Path(prep_dir), Path(training_data_dir), Path(bianca_dir), update=True,
+                               **masterfile_tmpls)
+    # read back like run_bianca reads masterfile_wHeader.txt, so that training_set_hash gets the same values
+    rows.to_csv(work_dir / "masterfile_wHeader.txt", index=False, sep=" ")
+    df = pd.read_csv(work_dir / "masterfile_wHeader.txt", sep=" ")
+    training_subject_idx = np.where(~df.manual_mask.isna() & (df.manual_mask != "XXX"))[0]
+    if not len(training_subject_idx):
+        print("no training sessions. no classifier trained.")
+        return None
+
+    key = training_set_hash(df, training_subject_idx)
+    cache = ContentCache(clf_cache_dir, clf_cache_max_gb)
+    if cache.get(key) is not None:
+        print(f"classifier {key} already in cache")
+        return key
+
+    print(f"classifier {key} not in cache. training.")
+    # training subjects 1..n in masterfile order; the first one again as query subject n + 1 (its segmentation is
+    # not used)
+    training = rows.iloc[training_subject_idx]
+    masterfile = work_dir / "masterfile_training.txt"
+    pd.concat([training, training.iloc[:1]]).to_csv(masterfile, index=False, header=False, sep=" ")
+    bianca = BIANCA(masterfile=str(masterfile), querysubjectnum=len(training) + 1,
+                    trainingnums=",".join(str(i) for i in range(1, len(training) + 1)), save_classifier=True,
+                    **BIANCA_OPTIONS)
+    bianca.run(cwd=str(work_dir))
+    cache.put(key, {f: work_dir / f for f in CLASSIFIER_FILES},
+              meta={"masterfile": str(Path(bianca_dir) / "masterfile.txt"),
+                    "training_subjects_sessions": training[["subject", "session"]].values.tolist()})
+    return key
+
+
+def run_bianca(out_dir, wd_dir, crash_dir, n_cpu=4, save_classifier=False, trained_classifier_file=None,
+               training_subject_idx=None, query_subject_idx=None, clf_cache_dir=None, clf_cache_max_gb=20,
+               engine="fsl", skip_completed=True, shard_size=None, overlap_shards=False, shard=None):
+    """
+    clf_cache_dir: if given (and no trained_classifier_file), classifiers are reused from/stored in a cache in this
+    dir (see run_bianca_cached); least recently used classifiers are removed if the cache exceeds clf_cache_max_gb
+    engine: "fsl": fsl's bianca, one call per query subject
+            "native": experimental, not equivalent to fsl's bianca (see bianca.knn_engine); training features are
+                      extracted once and all query subjects are segmented from a process pool (no classifier files,
+                      i.e. save_classifier, trained_classifier_file and clf_cache_dir are not available)
+    skip_completed: drop query subjects that are complete with unchanged outputs according to the stage's
+                    CompletionManifest (out_dir/_manifest_run_bianca.json), which records query subjects after the
+                    run. Completion is tied to the training set (training_set_hash), engine and classifier file.
+    shard_size, overlap_shards: engine "fsl": sharding of the query subjects, see bianca.shards.run_shards
+    shard: "i/N": sharding of the query subjects across hosts, see bianca.shards.select_shard (stage "run_bianca")
+    """
+    export_version(out_dir)
 
     masterfile = out_dir / "masterfile.txt"
     df = pd.read_csv(out_dir / "masterfile_wHeader.txt", sep=" ")
@@ -170,10 +344,79 @@ def run_bianca(out_dir, wd_dir, crash_dir, n_cpu=4, save_classifier=False, train
     ######
     # subject information
     if training_subject_idx is None:
-        training_subject_idx = np.where(~df.manual_mask.isna())[0]
+        # create_masterfile writes XXX as manual mask of sessions without one
+        training_subject_idx = np.where(~df.manual_mask.isna() & (df.manual_mask != "XXX"))[0]
     if query_subject_idx is None:
         query_subject_idx = list(range(len(df)))
 
-    run_bianca_wf(masterfile, out_dir, wd_dir, crash_dir, df, training_subject_idx, query_subject_idx,
-                  n_cpu=n_cpu, save_classifier=save_classifier,
-                  trained_classifier_file=trained_classifier_file)
+    if shard is not None:
+        query_subject_idx, wd_dir, crash_dir = select_shard(
+            out_dir, "run_bianca", list(query_subject_idx), shard, wd_dir, crash_dir,
+            costs=[os.stat(df.flair.iloc[i]).st_size for i in query_subject_idx],
+            keys=[file_session_key(df.flair.iloc[i]) for i in query_subject_idx])
+    manifest = CompletionManifest(
+        out_dir, "run_bianca",
+        params=dict(engine=engine, training=training_set_hash(df, training_subject_idx),
+                    classifier=file_checksum(trained_classifier_file) if trained_classifier_file else None,
+                    save_classifier=save_classifier), shard=shard)
+    if skip_completed:
+        query_subject_idx = [i for i in query_subject_idx if not manifest.is_complete_file(df.flair.iloc[i])]
+        if not query_subject_idx:
+            return
+
+    if engine == "native":
+        if save_classifier or trained_classifier_file or clf_cache_dir:
+            raise ValueError("save_classifier, trained_classifier_file and clf_cache_dir require engine='fsl'")
+        out_files = run_bianca_native(masterfile, out_dir, df, training_subject_idx, query_subject_idx, n_cpu=n_cpu,
+                                      feature_cache_dir=out_dir / "feature_cache")
+        manifest.record(out_files)
+    elif engine != "fsl":
+        raise ValueError(f"engine should be fsl or native, but is {engine}")
+    elif clf_cache_dir and not trained_classifier_file:
+        run_bianca_cached(masterfile, out_dir, wd_dir, crash_dir, df, training_subject_idx, query_subject_idx,
+                          clf_cache_dir, clf_cache_max_gb=clf_cache_max_gb, n_cpu=n_cpu,
+                          save_classifier=save_classifier, manifest=manifest, shard_size=shard_size,
+                          overlap_shards=overlap_shards)
+    else:
+        run_bianca_wf(masterfile, out_dir, wd_dir, crash_dir, df, training_subject_idx, query_subject_idx,
+                      n_cpu=n_cpu, save_classifier=save_classifier,
+                      trained_classifier_file=trained_classifier_file, manifest=manifest, shard_size=shard_size,
+                      overlap_shards=overlap_shards)
+
+
+def run_bianca_cv(out_dir, n_cpu=4, n_folds=None, training_subject_idx=None, seed=0, engine="fsl", wd_dir=None,
+                  crash_dir=None):
+    """
+    Leave-one-out (n_folds=None) or k-fold cross-validated LPMs of the training subjects (folds: see
+    bianca.knn_engine.cv_folds).
+    engine: "fsl": fsl's bianca. Each fold's classifier is trained once (--saveclassifierdata, with the fold's first
+                   subject as query subject and the fold's subjects left out of the training set) and its other
+                   subjects are segmented with it (--loadclassifierdata). Folds run in parallel, in the graphs
+                   bianca_cv_train and bianca_cv_query in wd_dir. Leave-one-out LPMs are the ones of run_bianca with
+                   the training subjects as query subjects.
+            "native": experimental (see run_bianca). In contrast to run_bianca with training subjects as query
+                      subjects (one full bianca training per subject), the sampled training features of every subject
+                      are extracted once and each fold excludes its subjects' rows. Folds run in parallel.
+    """
+    export_version(out_dir)
+    masterfile = out_dir / "masterfile.txt"
+    df = pd.read_csv(out_dir / "masterfile_wHeader.txt", sep=" ")
+    if training_subject_idx is None:
+        training_subject_idx = np.where(~df.manual_mask.isna() & (df.manual_mask != "XXX"))[0]
+    if engine == "native":
+        return run_bianca_native_cv(masterfile, out_dir, df, training_subject_idx, n_folds=n_folds, n_cpu=n_cpu,
+                                    seed=seed, feature_cache_dir=out_dir / "feature_cache")
+    elif engine != "fsl":
+        raise ValueError(f"engine should be fsl or native, but is {engine}")
+    if wd_dir is None or crash_dir is None:
+        raise ValueError("engine='fsl' requires wd_dir and crash_dir")
+
+    folds = cv_folds(training_subject_idx, n_folds, seed)
+    exclude = {q: fold for fold in folds for q in fold}
+    run_bianca_wf(masterfile, out_dir, wd_dir, crash_dir, df, training_subject_idx, [fold[0] for fold in folds],
+                  name="bianca_cv_train", n_cpu=n_cpu, save_classifier=True, exclude_subject_idx=exclude)
+    classifiers = {q: derivative_path(out_dir, df.iloc[fold[0]].flair, "classifier", suffix="classifier")
+                   for fold in folds for q in fold[1:]}
+    if classifiers:
+        run_bianca_wf(masterfile, out_dir, wd_dir, crash_dir, df, training_subject_idx, list(classifiers),
+                      name="bianca_cv_query", n_cpu=n_cpu, trained_classifier_file=classifiers)
@@ -1,13 +1,134 @@
+from functools import partial
 from nipype import Node, Workflow
 from nipype.interfaces import utility as niu, fsl, ants
 from niworkflows.interfaces.bids import DerivativesDataSink
 from bianca.workflows.interfaces import BiancaOverlapMeasures, BiancaClusterStats
+from bianca.dataset_index import get_dataset_index
+from bianca.threshold_engine import threshold_sessions, overlap_sweep_sessions
+from bianca.manifest import CompletionManifest
+from bianca.shards import run_shards, select_shard, input_size_costs
+from bianca.utils import shard_label, parse_shard
+import numpy as np
+
+
+def get_session_files(bianca_dir, mask_dir, flair_prep_dir, subject, session, flair_acq, run_BiancaOverlapMeasures):
+    from bianca.dataset_index import get_dataset_index
+    sub_ses = f"sub-{subject}_ses-{session}"
+    bianca_lpm = get_dataset_index(bianca_dir, update=False).glob(
+        f"sub-{subject}/ses-{session}/anat/{sub_ses}_acq-{flair_acq}_*_FLAIR_LPM.nii.gz")[0]
+
+    if run_BiancaOverlapMeasures:
+        manual_mask = get_dataset_index(mask_dir, update=False).glob(
+            f"sub-{subject}/ses-{session}/{sub_ses}_acq-{flair_acq}_*_FLAIR_mask_goldstandard_new.nii.gz")[0]
+    else:
+        manual_mask = None
+
+    flair_prep_index = get_dataset_index(flair_prep_dir, update=False)
+    wm_mask = flair_prep_index.glob(
+        f"sub-{subject}/ses-{session}/anat/{sub_ses}_space-flair{flair_acq}_desc-wmmask.nii.gz")[0]
+    deepwm_mask = flair_prep_index.glob(
+        f"sub-{subject}/ses-{session}/anat/{sub_ses}_space-flair{flair_acq}_desc-deepWMmask.nii.gz")[0]
+    pervent_mask = flair_prep_index.glob(
+        f"sub-{subject}/ses-{session}/anat/{sub_ses}_space-flair{flair_acq}_desc-periventmask.nii.gz")[0]
+    out_list = [bianca_lpm, manual_mask, wm_mask, deepwm_mask, pervent_mask]
+    return [str(o) for o in out_list]  # as Path is not taken everywhere
+
+
+def bianca_threshold_sweep(bianca_dir, mask_dir, flair_prep_dir, out_dir, subjects_sessions, flair_acq,
+                           thresholds=None, n_cpu=1, metric="dice"):
+    """
+    Threshold sweep for subjects with manual masks, replaces bianca_threshold(run_BiancaOverlapMeasures=True) with
+    a long list of thresholds. Per subject, the masked LPM is sorted once and dice, precision, recall, fpr and
+    lesion-level detection rate are computed for all thresholds.
+    Saves out_dir/overlap_sweep.tsv (one row per subject-session and threshold) and
+    out_dir/overlap_sweep_best_threshold.txt.
+    :param thresholds: default: .005 to .995 in steps of .005
+    :param metric: column of the sweep table that is maximized (mean across subjects) to pick the best threshold
+    :return: sweep DataFrame, best threshold
+    """
+    out_dir.mkdir(exist_ok=True, parents=True)
+    for d in [bianca_dir, flair_prep_dir, mask_dir]:
+        get_dataset_index(d)
+    if thresholds is None:
+        thresholds = np.round(np.arange(.005, 1, .005), 3).tolist()
+
+    session_files = []
+    for subject, session in subjects_sessions:
+        bianca_lpm, manual_mask, wm_mask, _, _ = get_session_files(bianca_dir, mask_dir, flair_prep_dir, subject,
+                                                                   session, flair_acq, True)
+        session_files.append(dict(subject=subject, session=session, bianca_lpm=bianca_lpm, wm_mask=wm_mask,
+                                  manual_mask=manual_mask))
+    df, best_threshold = overlap_sweep_sessions(session_files, thresholds, n_cpu=n_cpu, metric=metric)
+
+    df.to_csv(out_dir / "overlap_sweep.tsv", sep="\t", index=False)
+    (out_dir / "overlap_sweep_best_threshold.txt").write_text(f"{best_threshold}\n")
+    print(f"best threshold ({metric}): {best_threshold}")
+    return df, best_threshold
 
 
 def bianca_threshold(bianca_dir, mask_dir, flair_prep_dir, wd_dir, crash_dir, out_dir, subjects_sessions, flair_acq,
-                     thresholds, n_cpu=1, run_BiancaOverlapMeasures=True):
+                     thresholds, n_cpu=1, run_BiancaOverlapMeasures=True, engine="fsl", skip_completed=True,
+                     shard_size=None, overlap_shards=False, shard=None):
+    """
+    engine: "fsl": one nipype graph with fsl/bianca_cluster_stats nodes per subject and threshold
+            "numpy": in-process engine (bianca.threshold_engine), which loads the LPM and masks once per subject and
+                     handles all thresholds in one pass. Writes the same derivatives (ClusterStats*.txt in
+                     bianca_cluster_stats' output format) plus one _FLAIR_clusterstats.tsv table per session and
+                     out_dir/cluster_stats.tsv.
+                     With run_BiancaOverlapMeasures, overlap measures are written to out_dir/overlap_sweep.tsv
+                     (see bianca_threshold_sweep) instead of one _overlap.txt file per threshold.
+    skip_completed: drop sessions that are complete with unchanged outputs according to the stage's
+                    CompletionManifest (out_dir/_manifest_bianca_threshold.json), which records sessions after the
+                    run. The numpy engine's overlap sweep always uses all sessions.
+    shard_size, overlap_shards: fsl engine: sharding of the sessions, see bianca.shards.run_shards
+    shard: "i/N": sharding of the sessions across hosts, see bianca.shards.select_shard (stage "bianca_threshold",
+           merge with tables=["cluster_stats"]). The numpy engine writes cluster_stats_shard-{i}of{N}.tsv and runs the
+           overlap sweep in shard 1 only.
+    """
     out_dir.mkdir(exist_ok=True, parents=True)
+    all_subjects_sessions = subjects_sessions
+    if shard is not None:
+        subjects_sessions, wd_dir, crash_dir = select_shard(out_dir, "bianca_threshold", subjects_sessions, shard,
+                                                            wd_dir, crash_dir,
+                                                            costs=input_size_costs(bianca_dir, subjects_sessions))
+    manifest = CompletionManifest(out_dir, "bianca_threshold",
+                                  params=dict(thresholds=list(thresholds), engine=engine, flair_acq=flair_acq,
+                                              run_BiancaOverlapMeasures=run_BiancaOverlapMeasures), shard=shard)
+    if skip_completed:
+        subjects_sessions = manifest.pending(subjects_sessions)
+    for d in [bianca_dir, flair_prep_dir] + ([mask_dir] if run_BiancaOverlapMeasures else []):
+        get_dataset_index(d)
+
+    if engine == "numpy":
+        session_files = []
+        for subject, session in subjects_sessions:
+            bianca_lpm, _, wm_mask, deepwm_mask, pervent_mask = get_session_files(
+                bianca_dir, mask_dir, flair_prep_dir, subject, session, flair_acq, False)
+            session_files.append(dict(subject=subject, session=session, bianca_lpm=bianca_lpm, wm_mask=wm_mask,
+                                      deepwm_mask=deepwm_mask, pervent_mask=pervent_mask))
+        if session_files:
+            table_name = "cluster_stats" + (f"_{shard_label(shard)}" if shard else "")
+            threshold_sessions(out_dir, session_files, thresholds, n_cpu=n_cpu, manifest=manifest,
+                               table_name=table_name)
+        if run_BiancaOverlapMeasures and (shard is None or parse_shard(shard)[0] == 1):
+            bianca_threshold_sweep(bianca_dir, mask_dir, flair_prep_dir, out_dir, all_subjects_sessions, flair_acq,
+                                   thresholds=thresholds, n_cpu=n_cpu)
+        return
+    elif engine != "fsl":
+        raise ValueError(f"engine should be fsl or numpy, but is {engine}")
+    if not subjects_sessions:
+        return
+
+    build_wf = partial(init_bianca_threshold_wf, bianca_dir=bianca_dir, mask_dir=mask_dir,
+                       flair_prep_dir=flair_prep_dir, wd_dir=wd_dir, crash_dir=crash_dir, out_dir=out_dir,
+                       flair_acq=flair_acq, thresholds=thresholds, run_BiancaOverlapMeasures=run_BiancaOverlapMeasures)
+
+    run_shards(build_wf, subjects_sessions, shard_size, n_cpu, manifest=manifest, overlap=overlap_shards)
 
+
+def init_bianca_threshold_wf(subjects_sessions, bianca_dir, mask_dir, flair_prep_dir, wd_dir, crash_dir, out_dir,
+                             flair_acq, thresholds, run_BiancaOverlapMeasures=True):
+    """bianca_threshold's graph (fsl engine) of subjects_sessions (one shard, see bianca.shards.run_shards)"""
     wf = Workflow(name="bianca_threshold")
     wf.base_dir = wd_dir
     wf.config.remove_unnecessary_outputs = False
@@ -30,31 +151,10 @@ def bianca_threshold(bianca_dir, mask_dir, flair_prep_dir, wd_dir, crash_dir, ou
     threshsource = Node(niu.IdentityInterface(fields=["threshold"]), name="threshsource")
     threshsource.iterables = [("threshold", thresholds)]
 
-    def subject_info_fnc(bianca_dir, mask_dir, flair_prep_dir, subject, session, flair_acq, run_BiancaOverlapMeasures):
-        from pathlib import Path
-        sub_ses = f"sub-{subject}_ses-{session}"
-        bianca_lpm = list(Path(bianca_dir).glob(
-            f"sub-{subject}/ses-{session}/anat/{sub_ses}_acq-{flair_acq}_*_FLAIR_LPM.nii.gz"))[0]
-
-        if run_BiancaOverlapMeasures:
-            manual_mask = list(Path(mask_dir).glob(
-                f"sub-{subject}/ses-{session}/{sub_ses}_acq-{flair_acq}_*_FLAIR_mask_goldstandard_new.nii.gz"))[0]
-        else:
-            manual_mask = None
-
-        wm_mask = list(Path(flair_prep_dir).glob(
-            f"sub-{subject}/ses-{session}/anat/{sub_ses}_space-flair{flair_acq}_desc-wmmask.nii.gz"))[0]
-        deepwm_mask = list(Path(flair_prep_dir).glob(
-            f"sub-{subject}/ses-{session}/anat/{sub_ses}_space-flair{flair_acq}_desc-deepWMmask.nii.gz"))[0]
-        pervent_mask = list(Path(flair_prep_dir).glob(
-            f"sub-{subject}/ses-{session}/anat/{sub_ses}_space-flair{flair_acq}_desc-periventmask.nii.gz"))[0]
-        out_list = [bianca_lpm, manual_mask, wm_mask, deepwm_mask, pervent_mask]
-        return [str(o) for o in out_list]  # as Path is not taken everywhere
-
     grabber = Node(niu.Function(input_names=["bianca_dir", "mask_dir", "flair_prep_dir", "subject", "session",
                                              "flair_acq", "run_BiancaOverlapMeasures"],
                                 output_names=["bianca_lpm", "manual_mask", "wm_mask", "deepwm_mask", "pervent_mask"],
-                                function=subject_info_fnc),
+                                function=get_session_files),
                    name="grabber"
                    )
     grabber.inputs.bianca_dir = bianca_dir
@@ -165,5 +265,4 @@ def bianca_threshold(bianca_dir, mask_dir, flair_prep_dir, wd_dir, crash_dir, ou
         wf.connect(threshsource, ("threshold", format_t), ds_overlap, "desc")
         wf.connect(overlap, "out_file", ds_overlap, "in_file")
         wf.connect(grabber, "bianca_lpm", ds_overlap, "source_file")
-
-    wf.run(plugin='MultiProc', plugin_args={'n_procs': n_cpu})
+    return wf
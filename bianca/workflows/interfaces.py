@@ -1,6 +1,11 @@
-from nipype.interfaces.base import (TraitedSpec, File, traits)
+from nipype.interfaces.base import (TraitedSpec, File, traits, DynamicTraitedSpec, BaseInterfaceInputSpec,
+                                    SimpleInterface, isdefined)
 from nipype.interfaces.fsl.base import FSLCommand, FSLCommandInputSpec
+from nipype.interfaces.io import add_traits
+from nipype.interfaces import fsl, ants
 import os
+import json
+import shutil
 
 from bianca import workflows
 from pathlib import Path
@@ -132,3 +137,187 @@ class BiancaClusterStats(FSLCommand):
         outputs = self._outputs()
         outputs.out_stat = runtime.stdout
         return outputs
+
+
+class DerivativesBulkSinkInputSpec(DynamicTraitedSpec, BaseInterfaceInputSpec):
+    out_dir = traits.Str(mandatory=True, desc="derivatives dir (as base_directory / out_path_base of "
+                                              "DerivativesDataSink)")
+    specs = traits.Dict(mandatory=True, desc="input name -> dict with source (name of the input holding the source "
+                                             "file, or a path template), space, desc, suffix, keep_dtype, compress, "
+                                             "meta, from, to. String values are formatted with the inputs, e.g. "
+                                             "space='{space}'")
+    n_threads = traits.Int(4, usedefault=True, desc="number of gzip threads")
+    compress_level = traits.Range(low=1, high=9, value=6, usedefault=True, desc="gzip compression level")
+
+
+class DerivativesBulkSinkOutputSpec(TraitedSpec):
+    out_files = traits.Dict(desc="input name -> written file")
+
+
+class DerivativesBulkSink(SimpleInterface):
+    """
+    Writes all derivatives of a subject/session in one node, with the same names as one DerivativesDataSink per file.
+    fields: input names of the in files, source files and entity values referenced in specs
+    """
+    input_spec = DerivativesBulkSinkInputSpec
+    output_spec = DerivativesBulkSinkOutputSpec
+    _always_run = True
+
+    def __init__(self, fields=None, **inputs):
+        super().__init__(**inputs)
+        self._fields = fields or []
+        add_traits(self.inputs, self._fields)
+        self.inputs.trait_set(**{k: v for k, v in inputs.items() if k in self._fields})
+
+    def _run_interface(self, runtime):
+        from bianca.derivatives import sink_derivatives
+
+        values = {k: getattr(self.inputs, k) for k in self._fields if isdefined(getattr(self.inputs, k))}
+        names, items = [], []
+        for name, spec in self.inputs.specs.items():
+            if name not in values:
+                raise ValueError(f"DerivativesBulkSink requires a value for input {name}")
+            source = spec["source"]
+            spec = {k: v.format(**values) if isinstance(v, str) else v for k, v in spec.items()}
+            spec["source_file"] = values[source] if source in values else spec["source"]
+            del spec["source"]
+            names.append(name)
+            items.append(dict(spec, in_file=values[name]))
+
+        out_files = sink_derivatives(self.inputs.out_dir, items, n_threads=self.inputs.n_threads,
+                                     compress_level=self.inputs.compress_level)
+        self._results["out_files"] = {n: str(f) for n, f in zip(names, out_files)}
+        return runtime
+
+
+class NodeCacheInputSpec(BaseInterfaceInputSpec):
+    node_cache_dir = traits.Str(nohash=True, desc="dir of the persistent node cache (bianca.cache.ContentCache); "
+                                                  "not set: no cache")
+    node_cache_max_gb = traits.Float(50, usedefault=True, nohash=True,
+                                     desc="least recently used entries are removed above this size")
+
+
+class NodeCacheMixin:
+    """
+    Restores a command's outputs from a content-addressed cache outside the working dir instead of running it.
+    The key is the command, the tool version, the content checksums of input files (not their paths) and all other
+    hashed inputs, so entries are found after the working dir was wiped, on other hosts and after code changes that
+    do not change the command's inputs.
+    """
+
+    def _node_cache_key(self):
+        from bianca.cache import content_checksum, hash_dict
+
+        def value(v):
+            if isinstance(v, (list, tuple)):
+                return [value(x) for x in v]
+            if isinstance(v, str) and os.path.isfile(v):
+                return content_checksum(v)
+            return v
+
+        inputs = {name: value(v) for name, v in self.inputs.get_traitsfree().items()
+                  if not self.inputs.trait(name).nohash}
+        return hash_dict({"cmd": self._cmd, "version": self.version, "inputs": inputs})
+
+    @staticmethod
+    def _output_files(outputs):
+        """output name -> list of existing files"""
+        files = {}
+        for name, value in outputs.items():
+            values = value if isinstance(value, list) else [value]
+            if values and all(isinstance(v, str) and os.path.isfile(v) for v in values):
+                files[name] = values
+        return files
+
+    def _run_interface(self, runtime):
+        if not isdefined(self.inputs.node_cache_dir):
+            return super()._run_interface(runtime)
+        from bianca.cache import ContentCache
+
+        cache = ContentCache(self.inputs.node_cache_dir, self.inputs.node_cache_max_gb)
+        key = self._node_cache_key()
+        entry = cache.get(key)
+        if entry is not None:
+            cached = json.loads((entry / "meta.json").read_text())["outputs"]
+            # formatting the command line sets up some interfaces' output names (e.g. N4's bias image)
+            runtime.cmdline = self.cmdline
+            outputs = self._list_outputs()
+            if all(name in outputs and (entry / f).is_file() for name, files in cached.items() for f in files):
+                for name, files in cached.items():
+                    targets = outputs[name] if isinstance(outputs[name], list) else [outputs[name]]
+                    for f, target in zip(files, targets):
+                        shutil.copyfile(entry / f, target)
+                runtime.returncode = 0
+                runtime.success_codes = [0]
+                runtime.stdout = runtime.merged = f"outputs restored from node cache entry {entry}"
+                runtime.stderr = ""
+                return runtime
+
+        runtime = super()._run_interface(runtime)
+        output_files = self._output_files(self._list_outputs())
+        entry_files = {name: [f"{name}_{i}_{Path(f).name}" for i, f in enumerate(files)]
+                       for name, files in output_files.items()}
+        cache.put(key, {e: f for name in output_files for e, f in zip(entry_files[name], output_files[name])},
+                  meta={"cmd": self._cmd, "outputs": entry_files})
+        return runtime
+
+
+class CachedFNIRTInputSpec(fsl.preprocess.FNIRTInputSpec, NodeCacheInputSpec):
+    pass
+
+
+class CachedFNIRT(NodeCacheMixin, fsl.FNIRT):
+    input_spec = CachedFNIRTInputSpec
+
+
+class CachedInvWarpInputSpec(fsl.utils.InvWarpInputSpec, NodeCacheInputSpec):
+    pass
+
+
+class CachedInvWarp(NodeCacheMixin, fsl.InvWarp):
+    input_spec = CachedInvWarpInputSpec
+
+
+class CachedN4BiasFieldCorrectionInputSpec(ants.segmentation.N4BiasFieldCorrectionInputSpec, NodeCacheInputSpec):
+    pass
+
+
+class CachedN4BiasFieldCorrection(NodeCacheMixin, ants.N4BiasFieldCorrection):
+    input_spec = CachedN4BiasFieldCorrectionInputSpec
+
+
+def node_cache_inputs(node_cache_dir=None, node_cache_max_gb=50):
+    """inputs of the Cached* interfaces; without node_cache_dir they run like the nipype interfaces"""
+    if node_cache_dir is None:
+        return {}
+    return dict(node_cache_dir=str(node_cache_dir), node_cache_max_gb=node_cache_max_gb)
+
+
+class FallbackFLIRTInputSpec(fsl.preprocess.FLIRTInputSpec):
+    needs_flirt = traits.Bool(True, usedefault=True, desc="False: do not run FLIRT, pass on resampled_file")
+    resampled_file = traits.Either(None, File(exists=True), desc="in_file already resampled to the reference")
+    resampled_matrix_file = traits.Either(None, File(exists=True), desc="matrix in_file -> reference of resampled_file")
+
+
+class FallbackFLIRT(fsl.FLIRT):
+    """
+    FLIRT for inputs without a usable precomputed transform: runs only if needs_flirt, otherwise resampled_file and
+    resampled_matrix_file are passed on as out_file and out_matrix_file
+    """
+    input_spec = FallbackFLIRTInputSpec
+
+    def _run_interface(self, runtime):
+        if self.inputs.needs_flirt:
+            return super()._run_interface(runtime)
+        runtime.returncode = 0
+        runtime.stdout = runtime.merged = f"FLIRT not needed, passing on {self.inputs.resampled_file}"
+        runtime.stderr = ""
+        return runtime
+
+    def _list_outputs(self):
+        if self.inputs.needs_flirt:
+            return super()._list_outputs()
+        outputs = self.output_spec().get()
+        outputs["out_file"] = self.inputs.resampled_file
+        outputs["out_matrix_file"] = self.inputs.resampled_matrix_file
+        return outputs
@@ -1,10 +1,13 @@
 from nipype import Node, Workflow
 from nipype.interfaces import utility as niu, fsl
 from niworkflows.interfaces.bids import DerivativesDataSink
+from ..dataset_index import get_dataset_index
+from ..workdir import run_workflow
 
 
 def post_locate_masking(locate_dir, wd_dir, crash_dir, out_dir, subjects_sessions, n_cpu=1):
     out_dir.mkdir(exist_ok=True, parents=True)
+    get_dataset_index(locate_dir)
 
     wf = Workflow(name="post_locate_masking")
     wf.base_dir = wd_dir
@@ -23,19 +26,20 @@ def post_locate_masking(locate_dir, wd_dir, crash_dir, out_dir, subjects_session
     infosource.synchronize = True
 
     def subject_info_fnc(locate_dir, subject, session):
-        from pathlib import Path
+        from bianca.dataset_index import get_dataset_index
+        index = get_dataset_index(locate_dir, update=False)
         subses = f"sub-{subject}ses-{session}"
 
         # bianca mask
         search_pattern = f"*/{subses}_biancamask.nii.gz"
-        bianca_mask = list(Path(locate_dir).glob(search_pattern))
+        bianca_mask = index.glob(search_pattern)
         if len(bianca_mask) != 1:
             raise Exception(f"Expected one file, but {len(bianca_mask)} found. {search_pattern}")
         bianca_mask = bianca_mask[0]
 
         # locate output
         search_pattern = f"*/*_results_directory/{subses}_BIANCA_LOCATE_binarylesionmap.nii.gz"
-        locate_mask = list(Path(locate_dir).glob(search_pattern))
+        locate_mask = index.glob(search_pattern)
         if len(locate_mask) != 1:
             raise Exception(f"Expected one file, but {len(locate_mask)} found. {search_pattern}")
         locate_mask = locate_mask[0]
@@ -68,4 +72,4 @@ def post_locate_masking(locate_dir, wd_dir, crash_dir, out_dir, subjects_session
     wf.connect(locate_output_masked, "out_file", ds, "in_file")
     wf.connect(grabber, "generic_bids_file", ds, "source_file")
 
-    wf.run(plugin='MultiProc', plugin_args={'n_procs': n_cpu})
+    run_workflow(wf, n_cpu)
@@ -1,17 +1,116 @@
+from functools import partial
 from nipype import Node, Workflow
-from nipype.interfaces import utility as niu, fsl, ants
-from niworkflows.interfaces.bids import DerivativesDataSink
+from nipype.interfaces import utility as niu, fsl
 from pathlib import Path
 from warnings import warn
-from ..utils import export_version
+from .interfaces import DerivativesBulkSink, CachedN4BiasFieldCorrection, node_cache_inputs
+from ..utils import export_version, set_intermediate_output_type
+from ..dataset_index import get_dataset_index
+from ..shards import run_shards, select_shard, input_size_costs
+from ..manifest import CompletionManifest
+
+
+def get_session_files(bids_dir, template_prep_dir, t1w_prep_dir, subject, session, flair_acq):
+    from pathlib import Path
+    from warnings import warn
+    from bianca.dataset_index import get_dataset_index
+
+    sub_ses = f"sub-{subject}_ses-{session}"
+    sub = f"sub-{subject}"
+
+    flair_files = get_dataset_index(bids_dir, update=False).glob(
+        f"sub-{subject}/ses-{session}/anat/{sub_ses}_acq-{flair_acq}_*_FLAIR.nii.gz")
+    assert len(flair_files) > 0, f"Expected at least one file, but found {flair_files}"
+    if len(flair_files) > 1:
+        warn(f"{len(flair_files)} FLAIR files found. Taking first")
+    flair_file = flair_files[0]
+
+    generic_bids_file = Path(bids_dir) / f"sub-{subject}/ses-{session}/anat/{sub_ses}_T1w.nii.gz"
+    flair_space = f"flair{flair_acq}"
+
+    t1w_sub = t1w_prep_dir / f"sub-{subject}/ses-{session}/anat"
+    t1w = t1w_sub / f"{sub_ses}_space-tpl_T1w.nii.gz"
+    t1w_brain = t1w_sub / f"{sub_ses}_space-tpl_desc-brain_T1w.nii.gz"
+
+    template_sub = Path(template_prep_dir) / f"sub-{subject}/anat/"
+    t1w_brainmask = template_sub / f"{sub}_desc-brain_mask.nii.gz"
+    t1w_to_MNI_xfm = template_sub / f"{sub}_from-tpl_to-MNI_xfm.mat"
+    vent_mask = template_sub / f"{sub}_desc-bianca_ventmask.nii.gz"
+    wm_mask = template_sub / f"{sub}_desc-bianca_wmmask.nii.gz"
+    distancemap = template_sub / f"{sub}_desc-bianca_ventdistmap.nii.gz"
+    perivent_mask = template_sub / f"{sub}_desc-periventmask.nii.gz"
+    deepWM_mask = template_sub / f"{sub}_desc-deepWMmask.nii.gz"
+
+    out_list = [flair_file, generic_bids_file, flair_space, t1w, t1w_brain, t1w_brainmask, t1w_to_MNI_xfm,
+                vent_mask, wm_mask, distancemap, perivent_mask, deepWM_mask]
+    for f in [flair_file, t1w, t1w_brain, t1w_brainmask, t1w_to_MNI_xfm, vent_mask, wm_mask, distancemap]:
+        if not f.is_file():
+            raise FileNotFoundError(f)
+    return [str(o) for o in out_list]  # as Path is not taken everywhere
+
+
+def get_grabber(bids_dir, template_prep_dir, t1w_prep_dir, flair_acq, name="grabber"):
+    """Function node subject, session -> FLAIR, prepared T1w and template files (get_session_files)"""
+    grabber = Node(niu.Function(input_names=["bids_dir", "template_prep_dir", "t1w_prep_dir", "subject", "session",
+                                             "flair_acq"],
+                                output_names=["flair_file", "generic_bids_file", "flair_space", "t1w", "t1w_brain",
+                                              "t1w_brainmask", "t1w_to_MNI_xfm", "vent_mask", "wm_mask",
+                                              "distancemap", "perivent_mask", "deepWM_mask"],
+                                function=get_session_files),
+                   name=name
+                   )
+    grabber.inputs.bids_dir = bids_dir
+    grabber.inputs.t1w_prep_dir = t1w_prep_dir
+    grabber.inputs.template_prep_dir = template_prep_dir
+    grabber.inputs.flair_acq = flair_acq
+    return grabber
 
 
 def prepare_bianca_data(bids_dir, template_prep_dir, t1w_prep_dir, out_dir, wd_dir, crash_dir, subjects_sessions,
                         flair_acq, n_cpu=-1,
-                        omp_nthreads=1, run_wf=True, graph=False):
+                        omp_nthreads=1, run_wf=True, graph=False, compress_intermediates=False, compress_level=6,
+                        wd_manager=None, skip_completed=True, shard_size=None, overlap_shards=False,
+                        shard=None, node_cache_dir=None, node_cache_max_gb=50):
+    """
+    :param compress_intermediates: False: intermediate images in wd_dir are written as plain nifti, only outputs are
+    compressed (multi-threaded gzip with compress_level)
+    :param wd_manager: WorkDirManager(wd_dir, ...): deletes intermediates of sunk subjects, skips collected subjects on
+    reruns, waits for disk space before running
+    :param skip_completed: drop sessions that are complete with unchanged outputs according to the stage's
+    CompletionManifest (out_dir/_manifest_prepare_bianca_data.json), which records sessions after the run
+    :param shard_size, overlap_shards, shard: sharding of the sessions, see bianca.shards.run_shards and
+    select_shard (stage "prepare_bianca_data")
+    :param node_cache_dir: persistent cache of the N4 outputs (see prepare_template.prepare_template)
+    """
+    if shard is not None:
+        subjects_sessions, wd_dir, crash_dir = select_shard(out_dir, "prepare_bianca_data", subjects_sessions, shard,
+                                                            wd_dir, crash_dir,
+                                                            costs=input_size_costs(bids_dir, subjects_sessions))
+    manifest = CompletionManifest(out_dir, "prepare_bianca_data", params=dict(flair_acq=flair_acq), shard=shard)
+    if skip_completed:
+        subjects_sessions = manifest.pending(subjects_sessions)
+    if wd_manager is not None:
+        subjects_sessions = wd_manager.pending(subjects_sessions)
+    if not subjects_sessions:
+        return
     out_dir.mkdir(exist_ok=True, parents=True)
     export_version(out_dir)
+    ext = set_intermediate_output_type(compress_intermediates)
+    get_dataset_index(bids_dir)
+
+    build_wf = partial(init_prepare_bianca_data_wf, bids_dir=bids_dir, template_prep_dir=template_prep_dir,
+                       t1w_prep_dir=t1w_prep_dir, out_dir=out_dir, wd_dir=wd_dir, crash_dir=crash_dir,
+                       flair_acq=flair_acq, ext=ext, omp_nthreads=omp_nthreads, compress_level=compress_level,
+                       node_cache_dir=node_cache_dir, node_cache_max_gb=node_cache_max_gb)
 
+    run_shards(build_wf, subjects_sessions, shard_size, n_cpu, wd_manager, manifest, run_wf=run_wf, graph=graph,
+               overlap=overlap_shards)
+
+
+def init_prepare_bianca_data_wf(subjects_sessions, bids_dir, template_prep_dir, t1w_prep_dir, out_dir, wd_dir,
+                                crash_dir, flair_acq, omp_nthreads=1, compress_level=6, node_cache_dir=None,
+                                node_cache_max_gb=50, ext=".nii.gz"):
+    """prepare_bianca_data's graph of subjects_sessions (one shard, see bianca.shards.run_shards)"""
     wf = Workflow(name="meta_prepare")
     wf.base_dir = wd_dir
     wf.config.remove_unnecessary_outputs = False
@@ -25,55 +124,7 @@ def prepare_bianca_data(bids_dir, template_prep_dir, t1w_prep_dir, out_dir, wd_d
                             ]
     infosource.synchronize = True
 
-    def subject_info_fnc(bids_dir, template_prep_dir, t1w_prep_dir, subject, session, flair_acq):
-        from pathlib import Path
-        from warnings import warn
-
-        sub_ses = f"sub-{subject}_ses-{session}"
-        sub = f"sub-{subject}"
-
-        flair_files = list(Path(bids_dir).glob(
-            f"sub-{subject}/ses-{session}/anat/{sub_ses}_acq-{flair_acq}_*_FLAIR.nii.gz"))
-        assert len(flair_files) > 0, f"Expected at least one file, but found {flair_files}"
-        if len(flair_files) > 1:
-            warn(f"{len(flair_files)} FLAIR files found. Taking first")
-        flair_file = flair_files[0]
-
-        generic_bids_file = Path(bids_dir) / f"sub-{subject}/ses-{session}/anat/{sub_ses}_T1w.nii.gz"
-        flair_space = f"flair{flair_acq}"
-
-        t1w_sub = t1w_prep_dir / f"sub-{subject}/ses-{session}/anat"
-        t1w = t1w_sub / f"{sub_ses}_space-tpl_T1w.nii.gz"
-        t1w_brain = t1w_sub / f"{sub_ses}_space-tpl_desc-brain_T1w.nii.gz"
-
-        template_sub = Path(template_prep_dir) / f"sub-{subject}/anat/"
-        t1w_brainmask = template_sub / f"{sub}_desc-brain_mask.nii.gz"
-        t1w_to_MNI_xfm = template_sub / f"{sub}_from-tpl_to-MNI_xfm.mat"
-        vent_mask = template_sub / f"{sub}_desc-bianca_ventmask.nii.gz"
-        wm_mask = template_sub / f"{sub}_desc-bianca_wmmask.nii.gz"
-        distancemap = template_sub / f"{sub}_desc-bianca_ventdistmap.nii.gz"
-        perivent_mask = template_sub / f"{sub}_desc-periventmask.nii.gz"
-        deepWM_mask = template_sub / f"{sub}_desc-deepWMmask.nii.gz"
-
-        out_list = [flair_file, generic_bids_file, flair_space, t1w, t1w_brain, t1w_brainmask, t1w_to_MNI_xfm,
-                    vent_mask, wm_mask, distancemap, perivent_mask, deepWM_mask]
-        for f in [flair_file, t1w, t1w_brain, t1w_brainmask, t1w_to_MNI_xfm, vent_mask, wm_mask, distancemap]:
-            if not f.is_file():
-                raise FileNotFoundError(f)
-        return [str(o) for o in out_list]  # as Path is not taken everywhere
-
-    grabber = Node(niu.Function(input_names=["bids_dir", "template_prep_dir", "t1w_prep_dir", "subject", "session",
-                                             "flair_acq"],
-                                output_names=["flair_file", "generic_bids_file", "flair_space", "t1w", "t1w_brain",
-                                              "t1w_brainmask", "t1w_to_MNI_xfm", "vent_mask", "wm_mask",
-                                              "distancemap", "perivent_mask", "deepWM_mask"],
-                                function=subject_info_fnc),
-                   name="grabber"
-                   )
-    grabber.inputs.bids_dir = bids_dir
-    grabber.inputs.t1w_prep_dir = t1w_prep_dir
-    grabber.inputs.template_prep_dir = template_prep_dir
-    grabber.inputs.flair_acq = flair_acq
+    grabber = get_grabber(bids_dir, template_prep_dir, t1w_prep_dir, flair_acq)
 
     wf.connect([(infosource, grabber, [("subject", "subject"),
                                        ("session", "session"),
@@ -81,7 +132,8 @@ def prepare_bianca_data(bids_dir, template_prep_dir, t1w_prep_dir, out_dir, wd_d
                  )
                 ]
                )
-    prep_flair_wf = get_prep_flair_wf(omp_nthreads=omp_nthreads)
+    prep_flair_wf = get_prep_flair_wf(omp_nthreads=omp_nthreads, ext=ext, node_cache_dir=node_cache_dir,
+                                      node_cache_max_gb=node_cache_max_gb)
     wf.connect([(grabber, prep_flair_wf, [("flair_file", "inputnode.flair_file"),
                                           ("t1w", "inputnode.t1w"),
                                           ("t1w_brain", "inputnode.t1w_brain"),
@@ -97,7 +149,7 @@ def prepare_bianca_data(bids_dir, template_prep_dir, t1w_prep_dir, out_dir, wd_d
                 ]
                )
 
-    ds_wf = get_ds_wf(out_dir)
+    ds_wf = get_ds_wf(out_dir, compress_level=compress_level, n_threads=omp_nthreads)
     wf.connect([(prep_flair_wf, ds_wf, [("outputnode.flair_biascorr", "inputnode.flair_biascorr"),
                                         ("outputnode.t1w_brain", "inputnode.t1w_brain"),
                                         ("outputnode.brainmask", "inputnode.brainmask"),
@@ -118,15 +170,10 @@ def prepare_bianca_data(bids_dir, template_prep_dir, t1w_prep_dir, out_dir, wd_d
                  )
                 ]
                )
-
-    if graph:
-        wf.write_graph("workflow_graph.png", graph2use="exec")
-        wf.write_graph("workflow_graph_c.png", graph2use="colored")
-    if run_wf:
-        wf.run(plugin='MultiProc', plugin_args={'n_procs': n_cpu})
+    return wf
 
 
-def get_prep_flair_wf(name="prep_flair", omp_nthreads=1):
+def get_prep_flair_wf(name="prep_flair", omp_nthreads=1, ext=".nii.gz", node_cache_dir=None, node_cache_max_gb=50):
     wf = Workflow(name=name)
 
     inputnode = Node(niu.IdentityInterface(
@@ -138,55 +185,52 @@ def get_prep_flair_wf(name="prep_flair", omp_nthreads=1):
     flair = Node(fsl.Reorient2Std(), name="flair")
     wf.connect(inputnode, "flair_file", flair, "in_file")
 
-    flair_biascorr = Node(ants.N4BiasFieldCorrection(save_bias=False, num_threads=omp_nthreads), name="flair_biascorr")
+    flair_biascorr = Node(CachedN4BiasFieldCorrection(save_bias=False, num_threads=omp_nthreads,
+                                                      **node_cache_inputs(node_cache_dir, node_cache_max_gb)),
+                          name="flair_biascorr")
     wf.connect(flair, "out_file", flair_biascorr, "input_image")
 
     flirt_t1w_to_flair = Node(fsl.FLIRT(dof=6), name="flirt_t1w_to_flair")
     wf.connect(inputnode, "t1w", flirt_t1w_to_flair, "in_file")
     wf.connect(flair_biascorr, "output_image", flirt_t1w_to_flair, "reference")
 
-    # bring t1w data to flair space
-    t1w_brain_flairSp = Node(fsl.ApplyXFM(), name="t1w_brain_flairSp")
-    wf.connect(inputnode, "t1w_brain", t1w_brain_flairSp, "in_file")
-    wf.connect(flirt_t1w_to_flair, "out_matrix_file", t1w_brain_flairSp, "in_matrix_file")
-    wf.connect(flair_biascorr, "output_image", t1w_brain_flairSp, "reference")
-
-    brainmask_flairSp = Node(fsl.ApplyXFM(interp="nearestneighbour"), name="brainmask_flairSp")
-    wf.connect(inputnode, "t1w_brainmask", brainmask_flairSp, "in_file")
-    wf.connect(flirt_t1w_to_flair, "out_matrix_file", brainmask_flairSp, "in_matrix_file")
-    wf.connect(flair_biascorr, "output_image", brainmask_flairSp, "reference")
-
-    wm_mask_flairSp = Node(fsl.ApplyXFM(interp="nearestneighbour"), name="wm_mask_flairSp")
-    wf.connect(inputnode, "wm_mask", wm_mask_flairSp, "in_file")
-    wf.connect(flirt_t1w_to_flair, "out_matrix_file", wm_mask_flairSp, "in_matrix_file")
-    wf.connect(flair_biascorr, "output_image", wm_mask_flairSp, "reference")
-
-    vent_mask_flairSp = Node(fsl.ApplyXFM(interp="nearestneighbour"), name="vent_mask_flairSp")
-    wf.connect(inputnode, "vent_mask", vent_mask_flairSp, "in_file")
-    wf.connect(flirt_t1w_to_flair, "out_matrix_file", vent_mask_flairSp, "in_matrix_file")
-    wf.connect(flair_biascorr, "output_image", vent_mask_flairSp, "reference")
-
+    # bring t1w data to flair space: one node computes the flair -> t1w voxel mapping once and resamples all images
     # since there might be some missalignment between the (nn resampled) brain mask and the distancemap, there might
     # be some distance values outside the flair space brain mask --> re-threshold to get rid of them
     # also, the distancemap was created with a dilated brainmaks
-    distancemap_flairSp_init = Node(fsl.ApplyXFM(), name="distancemap_flairSp_init")
-    wf.connect(inputnode, "distancemap", distancemap_flairSp_init, "in_file")
-    wf.connect(flirt_t1w_to_flair, "out_matrix_file", distancemap_flairSp_init, "in_matrix_file")
-    wf.connect(flair_biascorr, "output_image", distancemap_flairSp_init, "reference")
-
-    distancemap_flairSp = Node(fsl.ApplyMask(), name="distancemap_flairSp")
-    wf.connect(distancemap_flairSp_init, "out_file", distancemap_flairSp, "in_file")
-    wf.connect(brainmask_flairSp, "out_file", distancemap_flairSp, "mask_file")
-
-    perivent_mask_flairSp = Node(fsl.ApplyXFM(interp="nearestneighbour"), name="perivent_mask_flairSp")
-    wf.connect(inputnode, "perivent_mask", perivent_mask_flairSp, "in_file")
-    wf.connect(flirt_t1w_to_flair, "out_matrix_file", perivent_mask_flairSp, "in_matrix_file")
-    wf.connect(flair_biascorr, "output_image", perivent_mask_flairSp, "reference")
-
-    deepWM_mask_flairSp = Node(fsl.ApplyXFM(interp="nearestneighbour"), name="deepWM_mask_flairSp")
-    wf.connect(inputnode, "deepWM_mask", deepWM_mask_flairSp, "in_file")
-    wf.connect(flirt_t1w_to_flair, "out_matrix_file", deepWM_mask_flairSp, "in_matrix_file")
-    wf.connect(flair_biascorr, "output_image", deepWM_mask_flairSp, "reference")
+    def resample_fnc(reference, matrix_file, t1w_brain, brainmask, wm_mask, vent_mask, distancemap, perivent_mask,
+                     deepWM_mask, ext):
+        import os
+        from bianca.resample import apply_xfm
+        in_files = dict(t1w_brain=t1w_brain, brainmask=brainmask, wm_mask=wm_mask, vent_mask=vent_mask,
+                        distancemap=distancemap, perivent_mask=perivent_mask, deepWM_mask=deepWM_mask)
+        interps = {k: "nearestneighbour" for k in in_files}
+        interps.update(t1w_brain="trilinear", distancemap="trilinear")
+        out_files = {k: os.path.join(os.getcwd(), f"{k}_flairSp{ext}") for k in in_files}
+        apply_xfm(in_files, reference, matrix_file, interps, out_files, mask_file="brainmask", masked=["distancemap"])
+        return [out_files[k] for k in in_files]
+
+    resample_flairSp = Node(niu.Function(input_names=["reference", "matrix_file", "t1w_brain", "brainmask", "wm_mask",
+                                                      "vent_mask", "distancemap", "perivent_mask", "deepWM_mask",
+                                                      "ext"],
+                                         output_names=["t1w_brain", "brainmask", "wm_mask", "vent_mask", "distancemap",
+                                                       "perivent_mask", "deepWM_mask"],
+                                         function=resample_fnc),
+                            name="resample_flairSp")
+    resample_flairSp.inputs.ext = ext
+    wf.connect(flair_biascorr, "output_image", resample_flairSp, "reference")
+    wf.connect(flirt_t1w_to_flair, "out_matrix_file", resample_flairSp, "matrix_file")
+    wf.connect([(inputnode, resample_flairSp, [("t1w_brain", "t1w_brain"),
+                                               ("t1w_brainmask", "brainmask"),
+                                               ("wm_mask", "wm_mask"),
+                                               ("vent_mask", "vent_mask"),
+                                               ("distancemap", "distancemap"),
+                                               ("perivent_mask", "perivent_mask"),
+                                               ("deepWM_mask", "deepWM_mask"),
+                                               ]
+                 )
+                ]
+               )
 
     # MNI
     flair_to_t1w = Node(fsl.ConvertXFM(invert_xfm=True), name="flair_to_t1w")
@@ -210,14 +254,8 @@ def get_prep_flair_wf(name="prep_flair", omp_nthreads=1):
 
     wf.connect(flair_biascorr, "output_image", outputnode, "flair_biascorr")
 
-    wf.connect(t1w_brain_flairSp, "out_file", outputnode, "t1w_brain")
-    wf.connect(brainmask_flairSp, "out_file", outputnode, "brainmask")
-    wf.connect(wm_mask_flairSp, "out_file", outputnode, "wm_mask")
-    wf.connect(vent_mask_flairSp, "out_file", outputnode, "vent_mask")
-
-    wf.connect(distancemap_flairSp, "out_file", outputnode, "distancemap")
-    wf.connect(perivent_mask_flairSp, "out_file", outputnode, "perivent_mask")
-    wf.connect(deepWM_mask_flairSp, "out_file", outputnode, "deepWM_mask")
+    for field in ["t1w_brain", "brainmask", "wm_mask", "vent_mask", "distancemap", "perivent_mask", "deepWM_mask"]:
+        wf.connect(resample_flairSp, field, outputnode, field)
 
     wf.connect(flirt_t1w_to_flair, "out_matrix_file", outputnode, "t1w_to_flair")
 
@@ -227,95 +265,31 @@ def get_prep_flair_wf(name="prep_flair", omp_nthreads=1):
     return wf
 
 
-def get_ds_wf(out_dir, name="get_ds_wf"):
+def get_ds_wf(out_dir, name="get_ds_wf", compress_level=6, n_threads=1):
     out_dir = Path(out_dir)
     wf = Workflow(name=name)
 
-    base_directory = str(out_dir.parent)
-    out_path_base = str(out_dir.name)
-
-    inputnode = Node(niu.IdentityInterface(
-        fields=['flair_biascorr', 't1w_brain', 'brainmask', 'wm_mask', 'vent_mask', 'distancemap', 'perivent_mask',
-                'deepWM_mask', 'bids_flair_file', "generic_bids_file", "space", "t1w_to_flair", "flair_mniSp",
-                "flair_to_mni"]),
-        name='inputnode')
-
-    ds_flair_biascorr = Node(DerivativesDataSink(base_directory=base_directory, out_path_base=out_path_base),
-                             name="ds_flair_biascorr")
-    ds_flair_biascorr.inputs.suffix = "FLAIR_biascorr"
-    wf.connect(inputnode, "flair_biascorr", ds_flair_biascorr, "in_file")
-    wf.connect(inputnode, "bids_flair_file", ds_flair_biascorr, "source_file")
-
-    ds_wmmask = Node(DerivativesDataSink(base_directory=base_directory, out_path_base=out_path_base), name="ds_wmmask")
-    ds_wmmask.inputs.desc = "wmmask"
-    wf.connect(inputnode, "wm_mask", ds_wmmask, "in_file")
-    wf.connect(inputnode, "generic_bids_file", ds_wmmask, "source_file")
-    wf.connect(inputnode, "space", ds_wmmask, "space")
-
-    ds_ventmask = Node(DerivativesDataSink(base_directory=base_directory, out_path_base=out_path_base),
-                       name="ds_ventmask")
-    ds_ventmask.inputs.desc = "ventmask"
-    wf.connect(inputnode, "vent_mask", ds_ventmask, "in_file")
-    wf.connect(inputnode, "generic_bids_file", ds_ventmask, "source_file")
-    wf.connect(inputnode, "space", ds_ventmask, "space")
-
-    ds_distancemap = Node(DerivativesDataSink(base_directory=base_directory, out_path_base=out_path_base),
-                          name="ds_distancemap")
-    ds_distancemap.inputs.desc = "distanceVent"
-    wf.connect(inputnode, "distancemap", ds_distancemap, "in_file")
-    wf.connect(inputnode, "generic_bids_file", ds_distancemap, "source_file")
-    wf.connect(inputnode, "space", ds_distancemap, "space")
-
-    ds_perivent_mask = Node(DerivativesDataSink(base_directory=base_directory, out_path_base=out_path_base),
-                            name="ds_perivent_mask")
-    ds_perivent_mask.inputs.desc = "periventmask"
-    wf.connect(inputnode, "perivent_mask", ds_perivent_mask, "in_file")
-    wf.connect(inputnode, "generic_bids_file", ds_perivent_mask, "source_file")
-    wf.connect(inputnode, "space", ds_perivent_mask, "space")
-
-    ds_deepWM_mask = Node(DerivativesDataSink(base_directory=base_directory, out_path_base=out_path_base),
-                          name="ds_deepWM_mask")
-    ds_deepWM_mask.inputs.desc = "deepWMmask"
-    wf.connect(inputnode, "deepWM_mask", ds_deepWM_mask, "in_file")
-    wf.connect(inputnode, "generic_bids_file", ds_deepWM_mask, "source_file")
-    wf.connect(inputnode, "space", ds_deepWM_mask, "space")
-
-    ds_t1w_brain = Node(DerivativesDataSink(base_directory=base_directory, out_path_base=out_path_base),
-                        name="ds_t1w_brain")
-    ds_t1w_brain.inputs.desc = "t1w_brain"
-    wf.connect(inputnode, "t1w_brain", ds_t1w_brain, "in_file")
-    wf.connect(inputnode, "generic_bids_file", ds_t1w_brain, "source_file")
-    wf.connect(inputnode, "space", ds_t1w_brain, "space")
-
-    ds_brainmask = Node(DerivativesDataSink(base_directory=base_directory, out_path_base=out_path_base),
-                        name="ds_brainmask")
-    ds_brainmask.inputs.desc = "brainmask"
-    wf.connect(inputnode, "brainmask", ds_brainmask, "in_file")
-    wf.connect(inputnode, "generic_bids_file", ds_brainmask, "source_file")
-    wf.connect(inputnode, "space", ds_brainmask, "space")
-
-    ds_t1w_to_flair = Node(DerivativesDataSink(base_directory=base_directory, out_path_base=out_path_base,
-                                               allowed_entities=['from', 'to'], **{'from': 't1w'}),
-                           name="ds_t1w_to_flair")
-
-    wf.connect(inputnode, "t1w_to_flair", ds_t1w_to_flair, "in_file")
-    wf.connect(inputnode, "generic_bids_file", ds_t1w_to_flair, "source_file")
-    wf.connect(inputnode, "space", ds_t1w_to_flair, "to")
-
-    # MNI outputs
-    ds_flair_mniSp = Node(DerivativesDataSink(base_directory=base_directory, out_path_base=out_path_base),
-                          name="ds_flair_mniSp")
-    ds_flair_mniSp.inputs.suffix = "FLAIR"
-    ds_flair_mniSp.inputs.space = "MNI"
-    ds_flair_mniSp.inputs.desc = "12dof"
-    wf.connect(inputnode, "flair_mniSp", ds_flair_mniSp, "in_file")
-    wf.connect(inputnode, "bids_flair_file", ds_flair_mniSp, "source_file")
-
-    ds_flair_to_mni = Node(DerivativesDataSink(base_directory=base_directory, out_path_base=out_path_base,
-                                               allowed_entities=['from', 'to'], **{'to': 'MNI'}),
-                           name="ds_flair_to_mni")
-    ds_flair_to_mni.inputs.desc = "12dof"
-    wf.connect(inputnode, "flair_to_mni", ds_flair_to_mni, "in_file")
-    wf.connect(inputnode, "generic_bids_file", ds_flair_to_mni, "source_file")
-    wf.connect(inputnode, "space", ds_flair_to_mni, "from")
+    fields = ['flair_biascorr', 't1w_brain', 'brainmask', 'wm_mask', 'vent_mask', 'distancemap', 'perivent_mask',
+              'deepWM_mask', 'bids_flair_file', "generic_bids_file", "space", "t1w_to_flair", "flair_mniSp",
+              "flair_to_mni"]
+    inputnode = Node(niu.IdentityInterface(fields=fields), name='inputnode')
+
+    flair_space = dict(source="generic_bids_file", space="{space}")
+    specs = {"flair_biascorr": dict(source="bids_flair_file", suffix="FLAIR_biascorr"),
+             "wm_mask": dict(flair_space, desc="wmmask"),
+             "vent_mask": dict(flair_space, desc="ventmask"),
+             "distancemap": dict(flair_space, desc="distanceVent"),
+             "perivent_mask": dict(flair_space, desc="periventmask"),
+             "deepWM_mask": dict(flair_space, desc="deepWMmask"),
+             "t1w_brain": dict(flair_space, desc="t1w_brain"),
+             "brainmask": dict(flair_space, desc="brainmask"),
+             "t1w_to_flair": {"source": "generic_bids_file", "from": "t1w", "to": "{space}"},
+             # MNI outputs
+             "flair_mniSp": dict(source="bids_flair_file", space="MNI", desc="12dof", suffix="FLAIR"),
+             "flair_to_mni": {"source": "generic_bids_file", "desc": "12dof", "from": "{space}", "to": "MNI"},
+             }
+    ds = Node(DerivativesBulkSink(fields=fields, out_dir=str(out_dir), specs=specs, compress_level=compress_level,
+                                  n_threads=n_threads), name="ds", run_without_submitting=True)
+    for field in fields:
+        wf.connect(inputnode, field, ds, field)
     return wf
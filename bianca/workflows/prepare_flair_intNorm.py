@@ -1,15 +1,117 @@
+from functools import partial
 from nipype import Node, Workflow
-from nipype.interfaces import utility as niu, fsl, ants
-from niworkflows.interfaces.bids import DerivativesDataSink
+from nipype.interfaces import utility as niu
 from pathlib import Path
 from warnings import warn
-from ..utils import export_version
-
-
-def prepare_flair_intNorm(flair_prep_dir, out_dir, wd_dir, crash_dir, subjects_sessions, flair_acq, n_cpu=-1):
+from .interfaces import DerivativesBulkSink
+from ..utils import export_version, set_intermediate_output_type
+from ..dataset_index import get_dataset_index
+from ..shards import run_shards, select_shard, input_size_costs
+from ..manifest import CompletionManifest
+from ..intnorm import normalize_sessions
+
+
+def get_session_files(flair_prep_dir, subject, session, flair_acq):
+    from bianca.dataset_index import get_dataset_index
+
+    index = get_dataset_index(flair_prep_dir, update=False)
+    sub_ses = f"sub-{subject}_ses-{session}"
+    flair_files = index.glob(
+        f"sub-{subject}/ses-{session}/anat/{sub_ses}_acq-{flair_acq}_*_FLAIR_biascorr.nii.gz")
+    assert len(flair_files) == 1, f"Expected one file, but found {flair_files}"
+    flair_file = flair_files[0]
+
+    brain_masks = index.glob(
+        f"sub-{subject}/ses-{session}/anat/{sub_ses}_space-flair{flair_acq}_desc-brainmask.nii.gz")
+    assert len(brain_masks) > 0, f"Expected one file, but found {brain_masks}"
+    brain_mask = brain_masks[0]
+
+    out_list = [flair_file, brain_mask]
+    return [str(o) for o in out_list]  # as Path is not taken everywhere
+
+
+# Intensity normalization - subtract minimum, then divide by difference of maximum and minimum (within brain mask)
+def normalize_fnc(flair_file, brain_mask, percentiles, ext):
+    import os
+    from pathlib import Path
+    from bianca.intnorm import normalize_flair
+    out_file = Path(os.getcwd()) / Path(flair_file).name.replace(".nii.gz", f"_intNorm{ext}")
+    return str(normalize_flair(flair_file, brain_mask, out_file, percentiles))
+
+
+def get_normalize_node(percentiles=None, ext=".nii.gz", name="flair_normalized"):
+    flair_normalized = Node(interface=niu.Function(input_names=["flair_file", "brain_mask", "percentiles", "ext"],
+                                                   output_names=["out_file"],
+                                                   function=normalize_fnc),
+                            name=name)
+    flair_normalized.inputs.percentiles = percentiles
+    flair_normalized.inputs.ext = ext
+    return flair_normalized
+
+
+def get_ds_node(out_dir, compress_level=6, name="ds_flair_biascorr_intNorm"):
+    """sink of the normalized FLAIR (named after the biascorr FLAIR, input flair_file)"""
+    fields = ["flair_file", "flair_biascorr_intNorm"]
+    specs = {"flair_biascorr_intNorm": dict(source="flair_file", suffix="FLAIR_biascorrIntNorm")}
+    return Node(DerivativesBulkSink(fields=fields, out_dir=str(out_dir), specs=specs, compress_level=compress_level),
+                name=name, run_without_submitting=True)
+
+
+def prepare_flair_intNorm_batch(flair_prep_dir, out_dir, subjects_sessions, flair_acq, n_cpu=-1, percentiles=None):
+    """
+    Normalizes all subjects_sessions in a process pool, without building a nipype graph. Outputs are the same as
+    prepare_flair_intNorm's.
+    """
+    out_dir.mkdir(exist_ok=True, parents=True)
+    export_version(out_dir)
+    get_dataset_index(flair_prep_dir)
+    session_files = [get_session_files(flair_prep_dir, subject, session, flair_acq)
+                     for subject, session in subjects_sessions]
+    return normalize_sessions(out_dir, session_files, n_cpu=n_cpu, percentiles=percentiles)
+
+
+def prepare_flair_intNorm(flair_prep_dir, out_dir, wd_dir, crash_dir, subjects_sessions, flair_acq, n_cpu=-1,
+                          percentiles=None, compress_intermediates=False, compress_level=6, wd_manager=None,
+                          skip_completed=True, shard_size=None, overlap_shards=False, shard=None):
+    """
+    :param percentiles: None: normalize with the min/max within the brain mask, (low, high): with the percentile range,
+    e.g. (1, 99), which is less sensitive to outliers
+    :param compress_intermediates: False: intermediate images in wd_dir are written as plain nifti, only outputs are
+    compressed (multi-threaded gzip with compress_level)
+    :param wd_manager: WorkDirManager(wd_dir, ...): deletes intermediates of sunk subjects, skips collected subjects on
+    reruns, waits for disk space before running
+    :param skip_completed: drop sessions that are complete with unchanged outputs according to the stage's
+    CompletionManifest (out_dir/_manifest_prepare_flair_intNorm.json), which records sessions after the run
+    :param shard_size, overlap_shards, shard: sharding of the sessions, see bianca.shards.run_shards and
+    select_shard (stage "prepare_flair_intNorm")
+    """
+    if shard is not None:
+        subjects_sessions, wd_dir, crash_dir = select_shard(out_dir, "prepare_flair_intNorm", subjects_sessions, shard,
+                                                            wd_dir, crash_dir,
+                                                            costs=input_size_costs(flair_prep_dir, subjects_sessions))
+    manifest = CompletionManifest(out_dir, "prepare_flair_intNorm",
+                                  params=dict(flair_acq=flair_acq, percentiles=percentiles), shard=shard)
+    if skip_completed:
+        subjects_sessions = manifest.pending(subjects_sessions)
+    if wd_manager is not None:
+        subjects_sessions = wd_manager.pending(subjects_sessions)
+    if not subjects_sessions:
+        return
     out_dir.mkdir(exist_ok=True, parents=True)
     export_version(out_dir)
+    ext = set_intermediate_output_type(compress_intermediates)
+    get_dataset_index(flair_prep_dir)
+
+    build_wf = partial(init_prepare_flair_intNorm_wf, flair_prep_dir=flair_prep_dir, out_dir=out_dir, wd_dir=wd_dir,
+                       crash_dir=crash_dir, flair_acq=flair_acq, ext=ext, percentiles=percentiles,
+                       compress_level=compress_level)
+
+    run_shards(build_wf, subjects_sessions, shard_size, n_cpu, wd_manager, manifest, overlap=overlap_shards)
 
+
+def init_prepare_flair_intNorm_wf(subjects_sessions, flair_prep_dir, out_dir, wd_dir, crash_dir, flair_acq,
+                                  percentiles=None, compress_level=6, ext=".nii.gz"):
+    """prepare_flair_intNorm's graph of subjects_sessions (one shard, see bianca.shards.run_shards)"""
     wf = Workflow(name="prepare_flair_intNorm")
     wf.base_dir = wd_dir
     wf.config.remove_unnecessary_outputs = False
@@ -23,26 +125,9 @@ def prepare_flair_intNorm(flair_prep_dir, out_dir, wd_dir, crash_dir, subjects_s
                             ]
     infosource.synchronize = True
 
-    def subject_info_fnc(flair_prep_dir, subject, session, flair_acq):
-        from pathlib import Path
-
-        sub_ses = f"sub-{subject}_ses-{session}"
-        flair_files = list(Path(flair_prep_dir).glob(
-            f"sub-{subject}/ses-{session}/anat/{sub_ses}_acq-{flair_acq}_*_FLAIR_biascorr.nii.gz"))
-        assert len(flair_files) == 1, f"Expected one file, but found {flair_files}"
-        flair_file = flair_files[0]
-
-        brain_masks = list(Path(flair_prep_dir).glob(
-            f"sub-{subject}/ses-{session}/anat/{sub_ses}_space-flair{flair_acq}_desc-brainmask.nii.gz"))
-        assert len(brain_masks) > 0, f"Expected one file, but found {brain_masks}"
-        brain_mask = brain_masks[0]
-
-        out_list = [flair_file, brain_mask]
-        return [str(o) for o in out_list]  # as Path is not taken everywhere
-
     grabber = Node(niu.Function(input_names=["flair_prep_dir", "subject", "session", "flair_acq"],
                                 output_names=["flair_file", "brain_mask"],
-                                function=subject_info_fnc),
+                                function=get_session_files),
                    name="grabber"
                    )
     grabber.inputs.flair_prep_dir = flair_prep_dir
@@ -55,32 +140,11 @@ def prepare_flair_intNorm(flair_prep_dir, out_dir, wd_dir, crash_dir, subjects_s
                 ]
                )
 
-    # adapted from https://gist.github.com/lebedov/94f1caf8a792d80cd91e7b99c1a0c1d7
-    # Intensity normalization - subtract minimum, then divide by difference of maximum and minimum:
-    img_range = Node(interface=fsl.ImageStats(op_string='-k %s -R'), name='img_range')
-    wf.connect(grabber, "flair_file", img_range, "in_file")
-    wf.connect(grabber, "brain_mask", img_range, "mask_file")
-
-    def func(in_stat):
-        min_val, max_val = in_stat
-        return '-sub %s -div %s' % (min_val, (max_val - min_val))
-
-    stat_to_op_string = Node(interface=niu.Function(input_names=['in_stat'],
-                                                    output_names=['op_string'],
-                                                    function=func),
-                             name='stat_to_op_string', iterfield=['in_stat'])
-    wf.connect(img_range, "out_stat", stat_to_op_string, "in_stat")
-
-    flair_normalized = Node(interface=fsl.ImageMaths(), name='flair_normalized')
-    wf.connect(stat_to_op_string, "op_string", flair_normalized, "op_string")
-    wf.connect(grabber, "flair_file", flair_normalized, "in_file")
-
-    base_directory = str(out_dir.parent)
-    out_path_base = str(out_dir.name)
-    ds_flair_biascorr_intNorm = Node(DerivativesDataSink(base_directory=base_directory, out_path_base=out_path_base),
-                                     name="ds_flair_biascorr_intNorm")
-    ds_flair_biascorr_intNorm.inputs.suffix = "FLAIR_biascorrIntNorm"
-    wf.connect(flair_normalized, "out_file", ds_flair_biascorr_intNorm, "in_file")
-    wf.connect(grabber, "flair_file", ds_flair_biascorr_intNorm, "source_file")
-
-    wf.run(plugin='MultiProc', plugin_args={'n_procs': n_cpu})
+    flair_normalized = get_normalize_node(percentiles, ext)
+    wf.connect(grabber, "flair_file", flair_normalized, "flair_file")
+    wf.connect(grabber, "brain_mask", flair_normalized, "brain_mask")
+
+    ds_flair_biascorr_intNorm = get_ds_node(out_dir, compress_level)
+    wf.connect(flair_normalized, "out_file", ds_flair_biascorr_intNorm, "flair_biascorr_intNorm")
+    wf.connect(grabber, "flair_file", ds_flair_biascorr_intNorm, "flair_file")
+    return wf
@@ -1,26 +1,93 @@
+from functools import partial
 from nipype.pipeline import engine as pe
 from nipype import Workflow
-from nipype.interfaces import utility as niu, fsl, ants
+from nipype.interfaces import utility as niu, fsl
 
 import niworkflows
-from niworkflows.interfaces.bids import DerivativesDataSink
 
-from ..utils import export_version
+from .interfaces import DerivativesBulkSink, CachedN4BiasFieldCorrection, FallbackFLIRT, node_cache_inputs
+from ..utils import export_version, set_intermediate_output_type
+from ..dataset_index import get_dataset_index
+from ..shards import run_shards, select_shard, input_size_costs
+from ..manifest import CompletionManifest
 from warnings import warn
 
 
+# smriprep's orig -> template affines of the T1w runs (< 0.6, >= 0.6)
+SMRIPREP_AFFINE_GLOBS = ["*_run-*_T1w_space-orig_target-T1w_affine.txt",
+                         "*_run-*_from-orig_to-T1w_mode-image_xfm.txt"]
+
+
+def smriprep_affine_names(t1w):
+    """file names of smriprep's orig -> template affine of the T1w run t1w (< 0.6, >= 0.6)"""
+    run = t1w.name.split(".")[0]
+    return [f"{run}_space-orig_target-T1w_affine.txt", f"{run[:-len('_T1w')]}_from-orig_to-T1w_mode-image_xfm.txt"]
+
+
+def find_smriprep_affines(smriprep_dir, subject, session):
+    """smriprep's orig -> template affines of a session's T1w runs, with the file names of either smriprep version"""
+    index = get_dataset_index(smriprep_dir, update=False)
+    return [f for pattern in SMRIPREP_AFFINE_GLOBS for f in index.glob(f"sub-{subject}/ses-{session}/anat/{pattern}")]
+
+
 def _check_versions():
     if niworkflows.__version__ != '1.1.12':
         warn(f"tested with niworkflows version 0.5.2. but {niworkflows.__version__} is installed")
 
 
 def prepare_t1w(bids_dir, smriprep_dir, out_dir, wd_dir, crash_dir, subjects_sessions, n_cpu=1, omp_nthreads=1,
-                run_wf=True, graph=False, smriprep06=False):
+                run_wf=True, graph=False, smriprep06=False, compress_intermediates=False, compress_level=6,
+                wd_manager=None, skip_completed=True, shard_size=None, overlap_shards=False, shard=None,
+                node_cache_dir=None, node_cache_max_gb=50, smriprep_affines=False, affine_min_corr=0.9):
+    """
+    :param compress_intermediates: False: intermediate images in wd_dir are written as plain nifti, only outputs are
+    compressed (multi-threaded gzip with compress_level)
+    :param wd_manager: WorkDirManager(wd_dir, ...): deletes intermediates of sunk subjects, skips collected subjects on
+    reruns, waits for disk space before running
+    :param skip_completed: drop sessions that are complete with unchanged outputs according to the stage's
+    CompletionManifest (out_dir/_manifest_prepare_t1w.json), which records sessions after the run
+    :param shard_size, overlap_shards, shard: sharding of the sessions, see bianca.shards.run_shards and
+    select_shard (stage "prepare_t1w")
+    :param node_cache_dir: persistent cache of the N4 outputs (see prepare_template.prepare_template)
+    :param smriprep_affines: bring the T1w runs to template space with smriprep's orig -> template affines
+    (*_T1w_space-orig_target-T1w_affine.txt, or *_from-orig_to-T1w_mode-image_xfm.txt of smriprep >= 0.6) instead of
+    FLIRT. FLIRT is only run for runs without an affine or whose correlation with the template within its brain mask
+    is below affine_min_corr (see init_t1w_tpl_space_wf)
+    """
+    if shard is not None:
+        subjects_sessions, wd_dir, crash_dir = select_shard(out_dir, "prepare_t1w", subjects_sessions, shard,
+                                                            wd_dir, crash_dir,
+                                                            costs=input_size_costs(bids_dir, subjects_sessions))
+    manifest = CompletionManifest(out_dir, "prepare_t1w", params=t1w_params(smriprep06, smriprep_affines,
+                                                                            affine_min_corr), shard=shard)
+    if skip_completed:
+        subjects_sessions = manifest.pending(subjects_sessions)
+    if wd_manager is not None:
+        subjects_sessions = wd_manager.pending(subjects_sessions)
+    if not subjects_sessions:
+        return
     _check_versions()
     export_version(out_dir)
+    ext = set_intermediate_output_type(compress_intermediates)
 
     out_dir.mkdir(exist_ok=True, parents=True)
+    get_dataset_index(bids_dir)
+    get_dataset_index(smriprep_dir)
+
+    build_wf = partial(init_prepare_t1w_wf, bids_dir=bids_dir, smriprep_dir=smriprep_dir, out_dir=out_dir,
+                       wd_dir=wd_dir, crash_dir=crash_dir, ext=ext, omp_nthreads=omp_nthreads, smriprep06=smriprep06,
+                       compress_level=compress_level, node_cache_dir=node_cache_dir,
+                       node_cache_max_gb=node_cache_max_gb, smriprep_affines=smriprep_affines,
+                       affine_min_corr=affine_min_corr)
+
+    run_shards(build_wf, subjects_sessions, shard_size, n_cpu, wd_manager, manifest, run_wf=run_wf, graph=graph,
+               overlap=overlap_shards)
+
 
+def init_prepare_t1w_wf(subjects_sessions, bids_dir, smriprep_dir, out_dir, wd_dir, crash_dir, omp_nthreads=1,
+                        smriprep06=False, compress_level=6, node_cache_dir=None, node_cache_max_gb=50,
+                        smriprep_affines=False, affine_min_corr=0.9, ext=".nii.gz"):
+    """prepare_t1w's graph of subjects_sessions (one shard, see bianca.shards.run_shards)"""
     wf = Workflow(name="meta_prepare_t1")
     wf.base_dir = wd_dir
     wf.config.remove_unnecessary_outputs = False
@@ -36,13 +103,23 @@ def prepare_t1w(bids_dir, smriprep_dir, out_dir, wd_dir, crash_dir, subjects_ses
                                                         out_dir=out_dir,
                                                         name=name,
                                                         omp_nthreads=omp_nthreads,
-                                                        smriprep06=smriprep06)
+                                                        smriprep06=smriprep06,
+                                                        compress_level=compress_level,
+                                                        node_cache_dir=node_cache_dir,
+                                                        node_cache_max_gb=node_cache_max_gb,
+                                                        smriprep_affines=smriprep_affines,
+                                                        affine_min_corr=affine_min_corr,
+                                                        ext=ext)
         wf.add_nodes([single_ses_wf])
-    if graph:
-        wf.write_graph("workflow_graph.png", graph2use="exec")
-        wf.write_graph("workflow_graph_c.png", graph2use="colored")
-    if run_wf:
-        wf.run(plugin='MultiProc', plugin_args={'n_procs': n_cpu})
+    return wf
+
+
+def t1w_params(smriprep06=False, smriprep_affines=False, affine_min_corr=0.9):
+    """parameters of prepare_t1w's CompletionManifest"""
+    params = dict(smriprep06=smriprep06)
+    if smriprep_affines:
+        params.update(smriprep_affines=True, affine_min_corr=affine_min_corr)
+    return params
 
 
 def _pop(inlist):
@@ -58,22 +135,27 @@ def init_single_ses_anat_preproc_wf(subject,
                                     out_dir,
                                     omp_nthreads=1,
                                     name='anat_preproc_wf',
-                                    smriprep06=False):
+                                    smriprep06=False,
+                                    compress_level=6,
+                                    node_cache_dir=None,
+                                    node_cache_max_gb=50,
+                                    smriprep_affines=False,
+                                    affine_min_corr=0.9,
+                                    ext=".nii.gz"):
     wf = Workflow(name=name)
 
     if smriprep06:
         def subject_info_fnc(bids_dir, smriprep_dir, subject, session):
             from pathlib import Path
+            from bianca.dataset_index import get_dataset_index
+            from bianca.workflows.prepare_t1w import find_smriprep_affines
             tpl_t1w = str(Path(smriprep_dir, f"sub-{subject}/anat/sub-{subject}_desc-preproc_T1w.nii.gz"))
             tpl_brainmask = str(Path(smriprep_dir, f"sub-{subject}/anat/sub-{subject}_desc-brain_mask.nii.gz"))
 
-            t1ws = list(Path(bids_dir).glob(f"sub-{subject}/ses-{session}/anat/*_T1w.nii.gz"))
+            t1ws = get_dataset_index(bids_dir, update=False).glob(f"sub-{subject}/ses-{session}/anat/*_T1w.nii.gz")
             assert len(t1ws) > 0, f"Expected at least one file, but found {t1ws}"
-            t1ws.sort()
 
-            xfms = list(Path(smriprep_dir).glob(
-                f"sub-{subject}/ses-{session}/anat/*_run-*_T1w_space-orig_target-T1w_affine.txt"))
-            xfms.sort()
+            xfms = find_smriprep_affines(smriprep_dir, subject, session)
 
             for f in t1ws:
                 if not f.is_file():
@@ -85,23 +167,23 @@ def init_single_ses_anat_preproc_wf(subject,
     else:
         def subject_info_fnc(bids_dir, smriprep_dir, subject, session):
             from pathlib import Path
+            from bianca.dataset_index import get_dataset_index
+            from bianca.workflows.prepare_t1w import find_smriprep_affines
+            smriprep_index = get_dataset_index(smriprep_dir, update=False)
             tpl_t1w = str(Path(smriprep_dir, f"sub-{subject}/anat/sub-{subject}_T1w_preproc.nii.gz"))
             tpl_brainmask = str(Path(smriprep_dir, f"sub-{subject}/anat/sub-{subject}_T1w_brainmask.nii.gz"))
             if not Path(tpl_t1w).is_file():
                 tpl_t1w = str(
-                    list(Path(smriprep_dir).glob(f"sub-{subject}/ses*/anat/sub-{subject}*_T1w_preproc.nii.gz"))[0])
-                tpl_brainmask = str(list(
-                    Path(smriprep_dir).glob(f"sub-{subject}/ses*/anat/sub-{subject}*_T1w_brainmask.nii.gz"))[0])
+                    smriprep_index.glob(f"sub-{subject}/ses*/anat/sub-{subject}*_T1w_preproc.nii.gz")[0])
+                tpl_brainmask = str(
+                    smriprep_index.glob(f"sub-{subject}/ses*/anat/sub-{subject}*_T1w_brainmask.nii.gz")[0])
                 if not Path(tpl_t1w).is_file():
                     raise FileNotFoundError(tpl_t1w)
 
-            t1ws = list(Path(bids_dir).glob(f"sub-{subject}/ses-{session}/anat/*_T1w.nii.gz"))
+            t1ws = get_dataset_index(bids_dir, update=False).glob(f"sub-{subject}/ses-{session}/anat/*_T1w.nii.gz")
             assert len(t1ws) > 0, f"Expected at least one file, but found {t1ws}"
-            t1ws.sort()
 
-            xfms = list(Path(smriprep_dir).glob(
-                f"sub-{subject}/ses-{session}/anat/*_run-*_T1w_space-orig_target-T1w_affine.txt"))
-            xfms.sort()
+            xfms = find_smriprep_affines(smriprep_dir, subject, session)
 
             for f in t1ws + xfms:
                 if not f.is_file():
@@ -120,17 +202,25 @@ def init_single_ses_anat_preproc_wf(subject,
     grabber.inputs.subject = subject
     grabber.inputs.session = session
 
-    t1w_biascorr = pe.MapNode(ants.N4BiasFieldCorrection(save_bias=False, num_threads=omp_nthreads),
+    t1w_biascorr = pe.MapNode(CachedN4BiasFieldCorrection(save_bias=False, num_threads=omp_nthreads,
+                                                          **node_cache_inputs(node_cache_dir, node_cache_max_gb)),
                               iterfield=["input_image"],
                               name="t1w_biascorr")
     wf.connect(grabber, "t1ws", t1w_biascorr, "input_image")
 
-    t1w_tpl_space = pe.MapNode(fsl.FLIRT(dof=6), iterfield=["in_file"], name="t1w_tpl_space")
-    wf.connect(grabber, "tpl_t1w", t1w_tpl_space, "reference")
-    wf.connect(t1w_biascorr, "output_image", t1w_tpl_space, "in_file")
-
     merge_t1w = pe.Node(fsl.Merge(dimension="t"), name='merge_t1w')
-    wf.connect(t1w_tpl_space, "out_file", merge_t1w, "in_files")
+    if smriprep_affines:
+        t1w_tpl_space = init_t1w_tpl_space_wf(affine_min_corr, ext)
+        wf.connect([(grabber, t1w_tpl_space, [("t1ws", "inputnode.t1w"), ("xfms", "inputnode.xfms"),
+                                              ("tpl_brainmask", "inputnode.brainmask"),
+                                              ("tpl_t1w", "inputnode.reference")]),
+                    (t1w_biascorr, t1w_tpl_space, [("output_image", "inputnode.in_file")]),
+                    (t1w_tpl_space, merge_t1w, [("outputnode.out_file", "in_files")])])
+    else:
+        t1w_tpl_space = pe.MapNode(fsl.FLIRT(dof=6), iterfield=["in_file"], name="t1w_tpl_space")
+        wf.connect(grabber, "tpl_t1w", t1w_tpl_space, "reference")
+        wf.connect(t1w_biascorr, "output_image", t1w_tpl_space, "in_file")
+        wf.connect(t1w_tpl_space, "out_file", merge_t1w, "in_files")
 
     mean_t1w = pe.Node(fsl.MeanImage(), name='mean_t1w')
     wf.connect(merge_t1w, "merged_file", mean_t1w, "in_file")
@@ -139,7 +229,7 @@ def init_single_ses_anat_preproc_wf(subject,
     wf.connect(mean_t1w, "out_file", t1w_brain_tpl_space, "in_file")
     wf.connect(grabber, "tpl_brainmask", t1w_brain_tpl_space, "mask_file")
 
-    ds = init_t1w_derivatives_wf(bids_dir, out_dir)
+    ds = init_t1w_derivatives_wf(bids_dir, out_dir, compress_level=compress_level, n_threads=omp_nthreads)
     ds.inputs.inputnode.subject = subject
     ds.inputs.inputnode.session = session
     wf.connect(mean_t1w, "out_file", ds, "inputnode.t1w_template_space")
@@ -148,41 +238,82 @@ def init_single_ses_anat_preproc_wf(subject,
     return wf
 
 
-def init_t1w_derivatives_wf(bids_root, output_dir, name='t1w_derivatives_wf'):
-    """Set up a battery of datasinks to store derivatives in the right location."""
-    base_directory = str(output_dir.parent)
-    out_path_base = str(output_dir.name)
+def init_t1w_tpl_space_wf(affine_min_corr=0.9, ext=".nii.gz", name="t1w_tpl_space"):
+    """
+    Bias corrected T1w runs (in_file, with the raw runs t1w to find their affines among xfms) to template space:
+    check resamples a run with smriprep's orig -> template affine (in-process, see bianca.resample.apply_xfm) and
+    tests the alignment by its correlation with the template within the brain mask. flirt (dof 6) only runs for runs
+    without an affine or with a correlation below affine_min_corr and passes on the others.
+    outputnode: out_file, out_matrix_file as FLIRT's, needs_flirt, corr (None without an affine)
+    """
+    def check_fnc(in_file, t1w, xfms, reference, brainmask, affine_min_corr, ext):
+        import os
+        from pathlib import Path
+        from nipype import logging
+        from bianca.resample import itk_affine_to_flirt_matrix, apply_xfm, masked_correlation
+        from bianca.workflows.prepare_t1w import smriprep_affine_names
+        logger = logging.getLogger("nipype.workflow")
+        run = Path(t1w).name.split(".")[0]
+        xfms = [x for x in xfms if Path(x).name in smriprep_affine_names(Path(t1w))]
+        if not xfms:
+            logger.warning(f"no smriprep affine for {t1w}, running FLIRT")
+            return None, None, True, None
+        out_file = os.path.abspath(f"{run}_tpl{ext}")
+        out_matrix_file = os.path.abspath(f"{run}_tpl.mat")
+        try:
+            itk_affine_to_flirt_matrix(xfms[0], in_file, reference, out_matrix_file)
+        except ValueError as e:
+            logger.warning(f"{e}, running FLIRT")
+            return None, None, True, None
+        apply_xfm({"t1w": in_file}, reference, out_matrix_file, {"t1w": "trilinear"}, {"t1w": out_file})
+        corr = masked_correlation(out_file, reference, brainmask)
+        if corr < affine_min_corr:
+            logger.warning(f"{xfms[0]}: correlation with the template {corr:.3f} < {affine_min_corr}, running FLIRT")
+            return None, None, True, corr
+        return out_file, out_matrix_file, False, corr
 
     wf = Workflow(name=name)
+    inputnode = pe.Node(niu.IdentityInterface(fields=["in_file", "t1w", "xfms", "reference", "brainmask"]),
+                        name="inputnode")
+    outputnode = pe.Node(niu.IdentityInterface(fields=["out_file", "out_matrix_file", "needs_flirt", "corr"]),
+                         name="outputnode")
+
+    check = pe.MapNode(niu.Function(input_names=["in_file", "t1w", "xfms", "reference", "brainmask",
+                                                 "affine_min_corr", "ext"],
+                                    output_names=["out_file", "out_matrix_file", "needs_flirt", "corr"],
+                                    function=check_fnc),
+                       iterfield=["in_file", "t1w"],
+                       name="check")
+    check.inputs.affine_min_corr = affine_min_corr
+    check.inputs.ext = ext
+
+    flirt = pe.MapNode(FallbackFLIRT(dof=6),
+                       iterfield=["in_file", "needs_flirt", "resampled_file", "resampled_matrix_file"],
+                       name="flirt")
+
+    wf.connect([(inputnode, check, [("in_file", "in_file"), ("t1w", "t1w"), ("xfms", "xfms"),
+                                    ("reference", "reference"), ("brainmask", "brainmask")]),
+                (inputnode, flirt, [("in_file", "in_file"), ("reference", "reference")]),
+                (check, flirt, [("needs_flirt", "needs_flirt"), ("out_file", "resampled_file"),
+                                ("out_matrix_file", "resampled_matrix_file")]),
+                (flirt, outputnode, [("out_file", "out_file"), ("out_matrix_file", "out_matrix_file")]),
+                (check, outputnode, [("needs_flirt", "needs_flirt"), ("corr", "corr")])])
+    return wf
 
-    inputnode = pe.Node(
-        niu.IdentityInterface(fields=['subject', 'session', 't1w_template_space', 't1w_brain_template_space']),
-        name='inputnode')
 
-    def generic_bids_file_fct(bids_root, subject, session):
-        from pathlib import Path
-        return Path(bids_root) / f"sub-{subject}/ses-{session}/anat/sub-{subject}_ses-{session}_T1w.nii.gz"
-
-    generic_bids_file = pe.Node(niu.Function(
-        input_names=["bids_root", "subject", "session"],
-        output_names=["out_file"],
-        function=generic_bids_file_fct), name='generic_bids_file')
-    generic_bids_file.inputs.bids_root = bids_root
-    wf.connect(inputnode, "subject", generic_bids_file, "subject")
-    wf.connect(inputnode, "session", generic_bids_file, "session")
-
-    ds_t1w_preproc = pe.Node(
-        DerivativesDataSink(base_directory=base_directory, out_path_base=out_path_base, keep_dtype=True, compress=True,
-                            space="tpl"),
-        name='ds_t1w_preproc', run_without_submitting=True)
-    wf.connect(generic_bids_file, "out_file", ds_t1w_preproc, "source_file")
-    wf.connect(inputnode, "t1w_template_space", ds_t1w_preproc, "in_file")
-
-    ds_t1w_brain = pe.Node(
-        DerivativesDataSink(base_directory=base_directory, out_path_base=out_path_base, keep_dtype=True, compress=True,
-                            space="tpl", desc="brain"),
-        name='ds_t1w_brain', run_without_submitting=True)
-    wf.connect(generic_bids_file, "out_file", ds_t1w_brain, "source_file")
-    wf.connect(inputnode, "t1w_brain_template_space", ds_t1w_brain, "in_file")
+def init_t1w_derivatives_wf(bids_root, output_dir, name='t1w_derivatives_wf', compress_level=6, n_threads=1):
+    """Set up a bulk datasink to store derivatives in the right location."""
+    wf = Workflow(name=name)
 
+    fields = ['subject', 'session', 't1w_template_space', 't1w_brain_template_space']
+    inputnode = pe.Node(niu.IdentityInterface(fields=fields), name='inputnode')
+
+    generic_bids_file = str(bids_root) + "/sub-{subject}/ses-{session}/anat/sub-{subject}_ses-{session}_T1w.nii.gz"
+    specs = {"t1w_template_space": dict(source=generic_bids_file, keep_dtype=True, space="tpl"),
+             "t1w_brain_template_space": dict(source=generic_bids_file, keep_dtype=True, space="tpl", desc="brain"),
+             }
+    ds = pe.Node(DerivativesBulkSink(fields=fields, out_dir=str(output_dir), specs=specs, compress_level=compress_level,
+                                     n_threads=n_threads), name="ds", run_without_submitting=True)
+    for field in fields:
+        wf.connect(inputnode, field, ds, field)
     return wf
@@ -1,17 +1,68 @@
+from functools import partial
 from nipype.pipeline import engine as pe
 from nipype import Workflow
-from nipype.interfaces import utility as niu, fsl
-from niworkflows.interfaces.bids import DerivativesDataSink
-from .interfaces import MakeBiancaMask
-from ..utils import export_version
+from nipype.interfaces import utility as niu, fsl, ants
+from .interfaces import MakeBiancaMask, DerivativesBulkSink, CachedFNIRT, CachedInvWarp, node_cache_inputs
+from ..utils import export_version, set_intermediate_output_type
+from ..dataset_index import get_dataset_index
+from ..shards import run_shards, select_shard, input_size_costs
+from ..manifest import CompletionManifest
 
 
 def prepare_template(bids_dir, smriprep_dir, out_dir, wd_dir, crash_dir, subjects, n_cpu=1, omp_nthreads=1,
-                     run_wf=True, graph=False, smriprep06=False):
+                     run_wf=True, graph=False, smriprep06=False, distance_cutoffs=(10,), perivent_cutoff=10,
+                     compress_intermediates=False, compress_level=6, wd_manager=None, skip_completed=True,
+                     shard_size=None, overlap_shards=False, shard=None, node_cache_dir=None, node_cache_max_gb=50,
+                     smriprep_mni_space=None):
+    """
+    :param compress_intermediates: False: intermediate images in wd_dir are written as plain nifti, only outputs are
+    compressed (multi-threaded gzip with compress_level)
+    :param wd_manager: WorkDirManager(wd_dir, ...): deletes intermediates of sunk subjects, skips collected subjects on
+    reruns, waits for disk space before running
+    :param skip_completed: drop subjects that are complete with unchanged outputs according to the stage's
+    CompletionManifest (out_dir/_manifest_prepare_template.json), which records subjects after the run
+    :param shard_size, overlap_shards, shard: sharding of the subjects, see bianca.shards.run_shards and
+    select_shard (stage "prepare_template")
+    :param node_cache_dir: persistent cache of the FNIRT and InvWarp outputs (keyed by input contents and parameters,
+    see interfaces.NodeCacheMixin), e.g. outside a wd_dir in /tmp; least recently used entries are removed above
+    node_cache_max_gb
+    :param smriprep_mni_space: reuse smriprep's transforms between the subject template and this space instead of
+    registering with FLIRT+FNIRT+InvWarp (see get_smriprep_norm_wf). fsl's MNI152 (bianca's masks, flair_to_mni) is
+    MNI152NLin6Asym; other spaces (e.g. MNI152NLin2009cAsym) only approximate it
+    """
+    if shard is not None:
+        subjects, wd_dir, crash_dir = select_shard(out_dir, "prepare_template", subjects, shard, wd_dir, crash_dir,
+                                                costs=input_size_costs(bids_dir, subjects))
+    manifest = CompletionManifest(out_dir, "prepare_template",
+                                  params=template_params(smriprep06, distance_cutoffs, perivent_cutoff,
+                                                         smriprep_mni_space), shard=shard)
+    if skip_completed:
+        subjects = manifest.pending(subjects)
+    if wd_manager is not None:
+        subjects = wd_manager.pending(subjects)
+    if not subjects:
+        return
     export_version(out_dir)
+    ext = set_intermediate_output_type(compress_intermediates)
 
     out_dir.mkdir(exist_ok=True, parents=True)
+    if not smriprep06 or smriprep_mni_space is not None:
+        get_dataset_index(smriprep_dir)
 
+    build_wf = partial(init_prepare_template_wf, bids_dir=bids_dir, smriprep_dir=smriprep_dir, out_dir=out_dir,
+                       wd_dir=wd_dir, crash_dir=crash_dir, ext=ext, omp_nthreads=omp_nthreads, smriprep06=smriprep06,
+                       distance_cutoffs=distance_cutoffs, perivent_cutoff=perivent_cutoff,
+                       compress_level=compress_level, node_cache_dir=node_cache_dir,
+                       node_cache_max_gb=node_cache_max_gb, smriprep_mni_space=smriprep_mni_space)
+
+    run_shards(build_wf, subjects, shard_size, n_cpu, wd_manager, manifest, run_wf=run_wf, graph=graph,
+               overlap=overlap_shards)
+
+
+def init_prepare_template_wf(subjects, bids_dir, smriprep_dir, out_dir, wd_dir, crash_dir, omp_nthreads=1,
+                             smriprep06=False, distance_cutoffs=(10,), perivent_cutoff=10, compress_level=6,
+                             node_cache_dir=None, node_cache_max_gb=50, smriprep_mni_space=None, ext=".nii.gz"):
+    """prepare_template's graph of subjects (one shard, see bianca.shards.run_shards)"""
     wf = Workflow(name="meta_prepare_template")
     wf.base_dir = wd_dir
     wf.config.remove_unnecessary_outputs = False
@@ -22,6 +73,89 @@ def prepare_template(bids_dir, smriprep_dir, out_dir, wd_dir, crash_dir, subject
     infosource.iterables = [("subject", subjects)
                             ]
 
+    grabber = get_template_grabber(smriprep_dir, smriprep06)
+    wf.connect(infosource, "subject", grabber, "subject")
+
+    prepare_template = prepare_template_wf(distance_cutoffs=distance_cutoffs, perivent_cutoff=perivent_cutoff,
+                                           ext=ext, node_cache_dir=node_cache_dir,
+                                           node_cache_max_gb=node_cache_max_gb,
+                                           smriprep_xfms=smriprep_mni_space is not None)
+    wf.connect(grabber, "tpl_t1w", prepare_template, "inputnode.tpl_t1w")
+    wf.connect(grabber, "tpl_t1w_brainmask", prepare_template, "inputnode.tpl_t1w_brainmask")
+    wf.connect(grabber, "CSF_pve", prepare_template, "inputnode.CSF_pve")
+    if smriprep_mni_space is not None:
+        xfm_grabber = get_mni_xfm_grabber(smriprep_dir, smriprep_mni_space, smriprep06)
+        wf.connect(infosource, "subject", xfm_grabber, "subject")
+        wf.connect(xfm_grabber, "tpl_2_MNI_xfm", prepare_template, "inputnode.tpl_2_MNI_xfm")
+        wf.connect(xfm_grabber, "MNI_2_tpl_xfm", prepare_template, "inputnode.MNI_2_tpl_xfm")
+
+    ds = init_template_derivatives_wf(bids_dir, out_dir, compress_level=compress_level, n_threads=omp_nthreads)
+
+    wf.connect([
+        (infosource, ds, [("subject", "inputnode.subject")]),
+        (grabber, ds, [
+            ("tpl_t1w", "inputnode.t1w_preproc"),
+            ("tpl_t1w_brainmask", "inputnode.t1w_mask"),
+        ]),
+        (prepare_template, ds, [
+            ("outputnode.t1w_MNIspace", "inputnode.t1w_MNIspace"),
+            ("outputnode.t1w_2_MNI_mat", "inputnode.t1w_2_MNI_xfm"),
+            ("outputnode.t1w_2_MNI_warp", "inputnode.t1w_2_MNI_warp"),
+            ("outputnode.bianca_wm_mask_file", "inputnode.bianca_wm_mask_file"),
+            ("outputnode.vent_file", "inputnode.bianca_vent_mask_file"),
+            ("outputnode.distance_map", "inputnode.distance_map"),
+            ("outputnode.perivent_mask", "inputnode.perivent_mask"),
+            ("outputnode.deepWM_mask", "inputnode.deepWM_mask"),
+            ("outputnode.distance_bands", "inputnode.distance_bands"),
+        ]
+         )
+    ]
+    )
+    return wf
+
+
+def template_params(smriprep06=False, distance_cutoffs=(10,), perivent_cutoff=10, smriprep_mni_space=None):
+    """parameters of prepare_template's CompletionManifest"""
+    params = dict(smriprep06=smriprep06, distance_cutoffs=list(distance_cutoffs), perivent_cutoff=perivent_cutoff)
+    if smriprep_mni_space is not None:
+        params["smriprep_mni_space"] = smriprep_mni_space
+    return params
+
+
+def get_mni_xfm_grabber(smriprep_dir, mni_space, smriprep06=False, name="xfm_grabber"):
+    """Function node subject -> smriprep's ITK (h5) transforms template -> mni_space and mni_space -> template"""
+    def xfm_info_fnc(smriprep_dir, mni_space, smriprep06, subject):
+        from pathlib import Path
+        from bianca.dataset_index import get_dataset_index
+        if smriprep06:
+            suffixes = [f"from-T1w_to-{mni_space}_mode-image_xfm.h5", f"from-{mni_space}_to-T1w_mode-image_xfm.h5"]
+        else:
+            suffixes = [f"T1w_target-{mni_space}_warp.h5", f"T1w_space-{mni_space}_target-T1w_warp.h5"]
+        out_list = []
+        for suffix in suffixes:
+            f = Path(smriprep_dir, f"sub-{subject}/anat/sub-{subject}_{suffix}")
+            if not f.is_file():
+                found = get_dataset_index(smriprep_dir, update=False).glob(
+                    f"sub-{subject}/ses*/anat/sub-{subject}*_{suffix}")
+                if not found:
+                    raise FileNotFoundError(f)
+                f = found[0]
+            out_list.append(str(f))
+        return out_list
+
+    grabber = pe.Node(niu.Function(input_names=["smriprep_dir", "mni_space", "smriprep06", "subject"],
+                                   output_names=["tpl_2_MNI_xfm", "MNI_2_tpl_xfm"],
+                                   function=xfm_info_fnc),
+                      name=name
+                      )
+    grabber.inputs.smriprep_dir = smriprep_dir
+    grabber.inputs.mni_space = mni_space
+    grabber.inputs.smriprep06 = smriprep06
+    return grabber
+
+
+def get_template_grabber(smriprep_dir, smriprep06=False, name="grabber"):
+    """Function node subject -> smriprep template T1w, brain mask and CSF pve"""
     if smriprep06:
         def subject_info_fnc(smriprep_dir, subject):
             from pathlib import Path
@@ -48,12 +182,13 @@ def prepare_template(bids_dir, smriprep_dir, out_dir, wd_dir, crash_dir, subject
                     in_ses_folder = True
 
             if in_ses_folder:
-                tpl_t1w = list(Path(smriprep_dir).glob(f"sub-{subject}/ses*/anat/sub-{subject}*_T1w_preproc.nii.gz"))[
-                    0]
-                tpl_t1w_brainmask = list(Path(
-                    smriprep_dir).glob(f"sub-{subject}/ses*/anat/sub-{subject}*_T1w_brainmask.nii.gz"))[0]
-                CSF_pve = list(Path(
-                    smriprep_dir).glob(f"sub-{subject}/ses*/anat/sub-{subject}*_T1w_class-CSF_probtissue.nii.gz"))[0]
+                from bianca.dataset_index import get_dataset_index
+                smriprep_index = get_dataset_index(smriprep_dir, update=False)
+                tpl_t1w = smriprep_index.glob(f"sub-{subject}/ses*/anat/sub-{subject}*_T1w_preproc.nii.gz")[0]
+                tpl_t1w_brainmask = smriprep_index.glob(
+                    f"sub-{subject}/ses*/anat/sub-{subject}*_T1w_brainmask.nii.gz")[0]
+                CSF_pve = smriprep_index.glob(
+                    f"sub-{subject}/ses*/anat/sub-{subject}*_T1w_class-CSF_probtissue.nii.gz")[0]
 
                 out_list = [tpl_t1w, tpl_t1w_brainmask, CSF_pve]
                 for f in out_list:
@@ -65,20 +200,38 @@ def prepare_template(bids_dir, smriprep_dir, out_dir, wd_dir, crash_dir, subject
     grabber = pe.Node(niu.Function(input_names=["smriprep_dir", "subject"],
                                    output_names=["tpl_t1w", "tpl_t1w_brainmask", "CSF_pve"],
                                    function=subject_info_fnc),
-                      name="grabber"
+                      name=name
                       )
     grabber.inputs.smriprep_dir = smriprep_dir
-    wf.connect(infosource, "subject", grabber, "subject")
+    return grabber
 
-    prepare_template = prepare_template_wf()
+
+def init_single_subject_template_wf(subject, bids_dir, smriprep_dir, out_dir, name="template_wf", omp_nthreads=1,
+                                    smriprep06=False, distance_cutoffs=(10,), perivent_cutoff=10, ext=".nii.gz",
+                                    compress_level=6, node_cache_dir=None, node_cache_max_gb=50,
+                                    smriprep_mni_space=None):
+    """prepare_template's graph for one subject (without iterables), e.g. to be combined with other stages'
+    per-session workflows (see bianca.workflows.streaming)"""
+    wf = Workflow(name=name)
+
+    grabber = get_template_grabber(smriprep_dir, smriprep06)
+    grabber.inputs.subject = subject
+
+    prepare_template = prepare_template_wf(distance_cutoffs=distance_cutoffs, perivent_cutoff=perivent_cutoff, ext=ext,
+                                           node_cache_dir=node_cache_dir, node_cache_max_gb=node_cache_max_gb,
+                                           smriprep_xfms=smriprep_mni_space is not None)
     wf.connect(grabber, "tpl_t1w", prepare_template, "inputnode.tpl_t1w")
     wf.connect(grabber, "tpl_t1w_brainmask", prepare_template, "inputnode.tpl_t1w_brainmask")
     wf.connect(grabber, "CSF_pve", prepare_template, "inputnode.CSF_pve")
-
-    ds = init_template_derivatives_wf(bids_dir, out_dir)
-
+    if smriprep_mni_space is not None:
+        xfm_grabber = get_mni_xfm_grabber(smriprep_dir, smriprep_mni_space, smriprep06)
+        xfm_grabber.inputs.subject = subject
+        wf.connect(xfm_grabber, "tpl_2_MNI_xfm", prepare_template, "inputnode.tpl_2_MNI_xfm")
+        wf.connect(xfm_grabber, "MNI_2_tpl_xfm", prepare_template, "inputnode.MNI_2_tpl_xfm")
+
+    ds = init_template_derivatives_wf(bids_dir, out_dir, compress_level=compress_level, n_threads=omp_nthreads)
+    ds.inputs.inputnode.subject = subject
     wf.connect([
-        (infosource, ds, [("subject", "inputnode.subject")]),
         (grabber, ds, [
             ("tpl_t1w", "inputnode.t1w_preproc"),
             ("tpl_t1w_brainmask", "inputnode.t1w_mask"),
@@ -91,139 +244,94 @@ def prepare_template(bids_dir, smriprep_dir, out_dir, wd_dir, crash_dir, subject
             ("outputnode.vent_file", "inputnode.bianca_vent_mask_file"),
             ("outputnode.distance_map", "inputnode.distance_map"),
             ("outputnode.perivent_mask", "inputnode.perivent_mask"),
-            ("outputnode.deepWM_mask", "inputnode.deepWM_mask")
+            ("outputnode.deepWM_mask", "inputnode.deepWM_mask"),
+            ("outputnode.distance_bands", "inputnode.distance_bands"),
         ]
          )
     ]
     )
+    return wf
 
-    if graph:
-        wf.write_graph("workflow_graph.png", graph2use="exec")
-        wf.write_graph("workflow_graph_c.png", graph2use="colored")
-    if run_wf:
-        wf.run(plugin='MultiProc', plugin_args={'n_procs': n_cpu})
-
-
-def init_template_derivatives_wf(bids_root, output_dir, name='template_derivatives_wf'):
-    """Set up a battery of datasinks to store derivatives in the right location."""
-    base_directory = str(output_dir.parent)
-    out_path_base = str(output_dir.name)
 
+def init_template_derivatives_wf(bids_root, output_dir, name='template_derivatives_wf', compress_level=6, n_threads=1):
+    """Set up a bulk datasink to store derivatives in the right location."""
     wf = Workflow(name=name)
 
-    inputnode = pe.Node(
-        niu.IdentityInterface(
-            fields=['subject', 't1w_preproc', 't1w_mask', 't1w_2_MNI_xfm', 't1w_2_MNI_warp',
-                    't1w_MNIspace', 'bianca_wm_mask_file', 'bianca_vent_mask_file', "distance_map", "perivent_mask",
-                    "deepWM_mask"
-                    ]),
-        name='inputnode')
-
-    def generic_bids_file_fct(bids_root, subject):
-        from pathlib import Path
-        return Path(bids_root) / f"sub-{subject}/anat/sub-{subject}_T1w.nii.gz"
-
-    generic_bids_file = pe.Node(niu.Function(
-        input_names=["bids_root", "subject"],
-        output_names=["out_file"],
-        function=generic_bids_file_fct), name='generic_bids_file')
-    generic_bids_file.inputs.bids_root = bids_root
-    wf.connect(inputnode, "subject", generic_bids_file, "subject")
-
-    ds_t1w_preproc = pe.Node(
-        DerivativesDataSink(base_directory=base_directory, out_path_base=out_path_base, desc='preproc',
-                            keep_dtype=True, compress=True),
-        name='ds_t1w_preproc', run_without_submitting=True)
-    ds_t1w_preproc.inputs.SkullStripped = False
-    wf.connect(generic_bids_file, "out_file", ds_t1w_preproc, "source_file")
-    wf.connect(inputnode, "t1w_preproc", ds_t1w_preproc, "in_file")
-
-    ds_t1w_mask = pe.Node(
-        DerivativesDataSink(base_directory=base_directory, out_path_base=out_path_base, desc='brain', suffix='mask',
-                            compress=True), name='ds_t1w_mask', run_without_submitting=True)
-    ds_t1w_mask.inputs.Type = 'Brain'
-    wf.connect(generic_bids_file, "out_file", ds_t1w_mask, "source_file")
-    wf.connect(inputnode, "t1w_mask", ds_t1w_mask, "in_file")
-
-    # Bianca masks
-    ds_bianca_wm_mask = pe.Node(
-        DerivativesDataSink(base_directory=base_directory, out_path_base=out_path_base, desc='bianca', suffix='wmmask',
-                            compress=True), name='ds_bianca_wm_mask', run_without_submitting=True)
-    wf.connect(generic_bids_file, "out_file", ds_bianca_wm_mask, "source_file")
-    wf.connect(inputnode, "bianca_wm_mask_file", ds_bianca_wm_mask, "in_file")
-
-    ds_bianca_vent_mask = pe.Node(
-        DerivativesDataSink(base_directory=base_directory, out_path_base=out_path_base, desc='bianca',
-                            suffix='ventmask', compress=True), name='ds_bianca_vent_mask', run_without_submitting=True)
-    wf.connect(generic_bids_file, "out_file", ds_bianca_vent_mask, "source_file")
-    wf.connect(inputnode, "bianca_vent_mask_file", ds_bianca_vent_mask, "in_file")
-
-    ds_distance_map = pe.Node(
-        DerivativesDataSink(base_directory=base_directory, out_path_base=out_path_base, desc='bianca',
-                            suffix='ventdistmap', compress=True), name='ds_distance_map', run_without_submitting=True)
-    wf.connect(generic_bids_file, "out_file", ds_distance_map, "source_file")
-    wf.connect(inputnode, "distance_map", ds_distance_map, "in_file")
-
-    ds_perivent_mask = pe.Node(DerivativesDataSink(base_directory=base_directory, out_path_base=out_path_base),
-                               name="ds_perivent_mask")
-    ds_perivent_mask.inputs.desc = "periventmask"
-    wf.connect(generic_bids_file, "out_file", ds_perivent_mask, "source_file")
-    wf.connect(inputnode, "perivent_mask", ds_perivent_mask, "in_file")
-
-    ds_deepWM_mask = pe.Node(DerivativesDataSink(base_directory=base_directory, out_path_base=out_path_base),
-                             name="ds_deepWM_mask")
-    ds_deepWM_mask.inputs.desc = "deepWMmask"
-    wf.connect(generic_bids_file, "out_file", ds_deepWM_mask, "source_file")
-    wf.connect(inputnode, "deepWM_mask", ds_deepWM_mask, "in_file")
-
-    # MNI
-    ds_t1w_to_MNI_warp = pe.Node(
-        DerivativesDataSink(base_directory=base_directory, out_path_base=out_path_base,
-                            allowed_entities=['from', 'to'], suffix='warpfield', **{'from': 'tpl', 'to': 'MNI'}),
-        name='ds_t1w_to_MNI_warp', run_without_submitting=True)
-    wf.connect(generic_bids_file, "out_file", ds_t1w_to_MNI_warp, "source_file")
-    wf.connect(inputnode, "t1w_2_MNI_warp", ds_t1w_to_MNI_warp, "in_file")
-
-    df_t1w_MNIspace = pe.Node(DerivativesDataSink(base_directory=base_directory, out_path_base=out_path_base,
-                                                  space="MNI", desc="warped2mm"),
-                              name="df_t1w_MNIspace")
-    wf.connect(generic_bids_file, "out_file", df_t1w_MNIspace, "source_file")
-    wf.connect(inputnode, "t1w_MNIspace", df_t1w_MNIspace, "in_file")
-
-    ds_t1w_to_MNI_xfm = pe.Node(
-        DerivativesDataSink(base_directory=base_directory, out_path_base=out_path_base,
-                            allowed_entities=['from', 'to'], suffix='xfm', **{'from': 'tpl', 'to': 'MNI'}),
-        name='ds_t1w_to_MNI_xfm', run_without_submitting=True)
-    wf.connect(generic_bids_file, "out_file", ds_t1w_to_MNI_xfm, "source_file")
-    wf.connect(inputnode, "t1w_2_MNI_xfm", ds_t1w_to_MNI_xfm, "in_file")
-
+    fields = ['subject', 't1w_preproc', 't1w_mask', 't1w_2_MNI_xfm', 't1w_2_MNI_warp',
+              't1w_MNIspace', 'bianca_wm_mask_file', 'bianca_vent_mask_file', "distance_map", "perivent_mask",
+              "deepWM_mask", "distance_bands"
+              ]
+    inputnode = pe.Node(niu.IdentityInterface(fields=fields), name='inputnode')
+
+    generic_bids_file = str(bids_root) + "/sub-{subject}/anat/sub-{subject}_T1w.nii.gz"
+    specs = {"t1w_preproc": dict(source=generic_bids_file, desc="preproc", keep_dtype=True, compress=True,
+                                 meta={"SkullStripped": False}),
+             "t1w_mask": dict(source=generic_bids_file, desc="brain", suffix="mask", compress=True,
+                              meta={"Type": "Brain"}),
+             # Bianca masks
+             "bianca_wm_mask_file": dict(source=generic_bids_file, desc="bianca", suffix="wmmask", compress=True),
+             "bianca_vent_mask_file": dict(source=generic_bids_file, desc="bianca", suffix="ventmask", compress=True),
+             "distance_map": dict(source=generic_bids_file, desc="bianca", suffix="ventdistmap", compress=True),
+             "distance_bands": dict(source=generic_bids_file, desc="bianca", suffix="ventdistbands", compress=True),
+             "perivent_mask": dict(source=generic_bids_file, desc="periventmask"),
+             "deepWM_mask": dict(source=generic_bids_file, desc="deepWMmask"),
+             # MNI
+             "t1w_2_MNI_warp": {"source": generic_bids_file, "from": "tpl", "to": "MNI", "suffix": "warpfield"},
+             "t1w_MNIspace": dict(source=generic_bids_file, space="MNI", desc="warped2mm"),
+             "t1w_2_MNI_xfm": {"source": generic_bids_file, "from": "tpl", "to": "MNI", "suffix": "xfm"},
+             }
+    ds = pe.Node(DerivativesBulkSink(fields=fields, out_dir=str(output_dir), specs=specs, compress_level=compress_level,
+                                     n_threads=n_threads), name="ds", run_without_submitting=True)
+    for field in fields:
+        wf.connect(inputnode, field, ds, field)
     return wf
 
 
-def prepare_template_wf(name="prepare_template"):
+def prepare_template_wf(name="prepare_template", distance_cutoffs=(10,), perivent_cutoff=10, ext=".nii.gz",
+                        node_cache_dir=None, node_cache_max_gb=50, smriprep_xfms=False):
+    """
+    :param ext: extension of images written by Function nodes
+    :param node_cache_dir: persistent cache of the FNIRT and InvWarp outputs (see prepare_template)
+    :param smriprep_xfms: transforms to and from MNI from smriprep's h5 transforms (inputnode.tpl_2_MNI_xfm,
+    MNI_2_tpl_xfm; see get_smriprep_norm_wf) instead of FLIRT+FNIRT+InvWarp
+    :param distance_cutoffs: ventricle distance cut-offs (mm) of the labeled band image (bianca.regions.distance_bands)
+    :param perivent_cutoff: cut-off (mm) of the binary periventricular/deepWM masks
+    """
     wf = Workflow(name=name)
 
-    inputnode = pe.Node(niu.IdentityInterface(fields=['tpl_t1w', 'tpl_t1w_brainmask', 'CSF_pve']),
+    inputnode = pe.Node(niu.IdentityInterface(fields=['tpl_t1w', 'tpl_t1w_brainmask', 'CSF_pve', 'tpl_2_MNI_xfm',
+                                                      'MNI_2_tpl_xfm']),
                         name='inputnode')
 
     tpl_t1w_brain = pe.Node(fsl.ApplyMask(), name='tpl_t1w_brain')
     wf.connect(inputnode, "tpl_t1w", tpl_t1w_brain, "in_file")
     wf.connect(inputnode, "tpl_t1w_brainmask", tpl_t1w_brain, "mask_file")
 
-    norm_wf = get_norm_wf()
-    wf.connect(inputnode, 'tpl_t1w', norm_wf, "inputnode.t1w")
-    wf.connect(tpl_t1w_brain, 'out_file', norm_wf, "inputnode.t1w_brain")
-
-    MNI_2_t1w_warp = pe.Node(fsl.InvWarp(), name='MNI_2_t1w_warp')
-    wf.connect(inputnode, 'tpl_t1w', MNI_2_t1w_warp, 'reference')
-    wf.connect(norm_wf, 'outputnode.t1w_2_MNI_warp', MNI_2_t1w_warp, 'warp')
-
-    bianca_mask = pe.Node(MakeBiancaMask(), name='bianca_mask')
+    if smriprep_xfms:
+        norm_wf = get_smriprep_norm_wf(ext=ext)
+        wf.connect(inputnode, 'tpl_t1w', norm_wf, "inputnode.t1w")
+        wf.connect(inputnode, 'tpl_t1w_brainmask', norm_wf, "inputnode.t1w_brainmask")
+        wf.connect(inputnode, 'tpl_2_MNI_xfm', norm_wf, "inputnode.t1w_2_MNI_xfm")
+        wf.connect(inputnode, 'MNI_2_tpl_xfm', norm_wf, "inputnode.MNI_2_t1w_xfm")
+        MNI_2_t1w_warp, MNI_2_t1w_warp_field = norm_wf, 'outputnode.MNI_2_t1w_warp'
+    else:
+        norm_wf = get_norm_wf(node_cache_dir=node_cache_dir, node_cache_max_gb=node_cache_max_gb)
+        wf.connect(inputnode, 'tpl_t1w', norm_wf, "inputnode.t1w")
+        wf.connect(tpl_t1w_brain, 'out_file', norm_wf, "inputnode.t1w_brain")
+
+        MNI_2_t1w_warp = pe.Node(CachedInvWarp(**node_cache_inputs(node_cache_dir, node_cache_max_gb)),
+                                 name='MNI_2_t1w_warp')
+        wf.connect(inputnode, 'tpl_t1w', MNI_2_t1w_warp, 'reference')
+        wf.connect(norm_wf, 'outputnode.t1w_2_MNI_warp', MNI_2_t1w_warp, 'warp')
+        MNI_2_t1w_warp_field = 'inverse_warp'
+
+    # make_bianca_mask expects .nii.gz internally
+    bianca_mask = pe.Node(MakeBiancaMask(output_type="NIFTI_GZ"), name='bianca_mask')
     bianca_mask.inputs.keep_intermediate_files = 0
 
     wf.connect(inputnode, 'tpl_t1w', bianca_mask, 'structural_image')
     wf.connect(inputnode, 'CSF_pve', bianca_mask, 'CSF_pve')
-    wf.connect(MNI_2_t1w_warp, 'inverse_warp', bianca_mask, 'warp_file_MNI2structural')
+    wf.connect(MNI_2_t1w_warp, MNI_2_t1w_warp_field, bianca_mask, 'warp_file_MNI2structural')
     wf.connect(tpl_t1w_brain, 'out_file', bianca_mask, 'structural_image_brainextracted')
     wf.connect(inputnode, 'tpl_t1w_brainmask', bianca_mask, 'brainmask')
 
@@ -236,26 +344,26 @@ def prepare_template_wf(name="prepare_template"):
     wf.connect(bianca_mask, 'vent_file', distancemap, "in_file")
     wf.connect(brainmask_dil, 'out_file', distancemap, "mask_file")
 
-    perivent_mask_init = pe.Node(fsl.maths.MathsCommand(), name="perivent_mask_init")
-    perivent_mask_init.inputs.args = "-uthr 10 -bin"
-    wf.connect(distancemap, "distance_map", perivent_mask_init, "in_file")
-
-    perivent_mask = pe.Node(fsl.ApplyMask(), name="perivent_mask")
-    wf.connect(perivent_mask_init, "out_file", perivent_mask, "in_file")
-    wf.connect(inputnode, "tpl_t1w_brainmask", perivent_mask, "mask_file")
-
-    deepWM_mask_init = pe.Node(fsl.maths.MathsCommand(), name="deepWM_mask_init")
-    deepWM_mask_init.inputs.args = "-thr 10 -bin"
-    wf.connect(distancemap, "distance_map", deepWM_mask_init, "in_file")
-
-    deepWM_mask = pe.Node(fsl.ApplyMask(), name="deepWM_mask")
-    wf.connect(deepWM_mask_init, "out_file", deepWM_mask, "in_file")
-    wf.connect(inputnode, "tpl_t1w_brainmask", deepWM_mask, "mask_file")
+    # ventricle distance bands (for distance_cutoffs) and perivent/deepWM masks (perivent_cutoff) in one node
+    def regions_fnc(distance_map, brainmask, cutoffs, perivent_cutoff, ext):
+        import os
+        from bianca.regions import ventricle_distance_regions
+        return ventricle_distance_regions(distance_map, brainmask, os.getcwd(), cutoffs, perivent_cutoff, ext)
+
+    distance_regions = pe.Node(niu.Function(input_names=["distance_map", "brainmask", "cutoffs", "perivent_cutoff",
+                                                         "ext"],
+                                            output_names=["distance_bands", "perivent_mask", "deepWM_mask"],
+                                            function=regions_fnc),
+                               name="distance_regions")
+    distance_regions.inputs.cutoffs = list(distance_cutoffs)
+    distance_regions.inputs.perivent_cutoff = perivent_cutoff
+    distance_regions.inputs.ext = ext
+    wf.connect(distancemap, "distance_map", distance_regions, "distance_map")
+    wf.connect(inputnode, "tpl_t1w_brainmask", distance_regions, "brainmask")
 
     outputnode = pe.Node(niu.IdentityInterface(fields=["t1w_2_MNI_mat", "t1w_MNIspace", "t1w_2_MNI_warp",
                                                        "bianca_wm_mask_file", "vent_file", "distance_map",
-                                                       "perivent_mask",
-                                                       "deepWM_mask"]),
+                                                       "perivent_mask", "deepWM_mask", "distance_bands"]),
                          name='outputnode')
 
     wf.connect(norm_wf, 'outputnode.t1w_2_MNI_mat', outputnode, "t1w_2_MNI_mat")
@@ -264,12 +372,13 @@ def prepare_template_wf(name="prepare_template"):
     wf.connect(bianca_mask, 'mask_file', outputnode, "bianca_wm_mask_file")
     wf.connect(bianca_mask, 'vent_file', outputnode, "vent_file")
     wf.connect(distancemap, "distance_map", outputnode, "distance_map")
-    wf.connect(perivent_mask, "out_file", outputnode, "perivent_mask")
-    wf.connect(deepWM_mask, "out_file", outputnode, "deepWM_mask")
+    wf.connect(distance_regions, "perivent_mask", outputnode, "perivent_mask")
+    wf.connect(distance_regions, "deepWM_mask", outputnode, "deepWM_mask")
+    wf.connect(distance_regions, "distance_bands", outputnode, "distance_bands")
     return wf
 
 
-def get_norm_wf(name="norm_wf"):
+def get_norm_wf(name="norm_wf", node_cache_dir=None, node_cache_max_gb=50):
     wf = Workflow(name=name)
 
     inputnode = pe.Node(niu.IdentityInterface(fields=['t1w', 't1w_brain']), name='inputnode')
@@ -287,7 +396,8 @@ def get_norm_wf(name="norm_wf"):
     # 2. CALC. WARP STRUCT -> MNI with FNIRT
     # cf. wrt. 2mm
     # https://www.jiscmail.ac.uk/cgi-bin/webadmin?A2=ind1311&L=FSL&P=R86108&1=FSL&9=A&J=on&d=No+Match%3BMatch%3BMatches&z=4
-    t1w_2_MNI_fnirt = pe.Node(fsl.FNIRT(), name='t1w_2_MNI_fnirt')
+    t1w_2_MNI_fnirt = pe.Node(CachedFNIRT(**node_cache_inputs(node_cache_dir, node_cache_max_gb)),
+                              name='t1w_2_MNI_fnirt')
     t1w_2_MNI_fnirt.inputs.config_file = 'T1_2_MNI152_2mm'
     t1w_2_MNI_fnirt.inputs.ref_file = fsl.Info.standard_image('MNI152_T1_2mm.nii.gz')
     t1w_2_MNI_fnirt.inputs.field_file = True
@@ -298,3 +408,65 @@ def get_norm_wf(name="norm_wf"):
     wf.connect(t1w_2_MNI_fnirt, 'field_file', outputnode, 't1w_2_MNI_warp')
     wf.connect(t1w_2_MNI_fnirt, 'warped_file', outputnode, 't1w_MNIspace')
     return wf
+
+
+def get_smriprep_norm_wf(name="norm_wf", ext=".nii.gz"):
+    """
+    get_norm_wf's outputs, and the MNI -> t1w warp of InvWarp, from smriprep's transforms (ITK h5 with affine and
+    displacement field) instead of FLIRT+FNIRT: antsApplyTransforms composes each transform into one displacement field
+    on the grid FNIRT/InvWarp would use (MNI 2mm, t1w), which is converted to an fsl warp. The t1w -> MNI flirt matrix
+    is a least-squares fit of the transform within the brain mask.
+    """
+    wf = Workflow(name=name)
+
+    inputnode = pe.Node(niu.IdentityInterface(fields=['t1w', 't1w_brainmask', 't1w_2_MNI_xfm', 'MNI_2_t1w_xfm']),
+                        name='inputnode')
+    outputnode = pe.Node(niu.IdentityInterface(fields=['t1w_2_MNI_mat', 't1w_2_MNI_warp', 't1w_MNIspace',
+                                                       'MNI_2_t1w_warp']),
+                         name='outputnode')
+    mni = fsl.Info.standard_image('MNI152_T1_1mm.nii.gz')
+    mni_2mm = fsl.Info.standard_image('MNI152_T1_2mm.nii.gz')
+
+    # displacement fields ([out, 1]: composite warp instead of the warped image)
+    t1w_2_MNI_field = pe.Node(ants.ApplyTransforms(dimension=3, print_out_composite_warp_file=True,
+                                                   output_image="t1w_2_MNI_field.nii.gz", reference_image=mni_2mm),
+                              name="t1w_2_MNI_field")
+    wf.connect(inputnode, "t1w", t1w_2_MNI_field, "input_image")
+    wf.connect(inputnode, "t1w_2_MNI_xfm", t1w_2_MNI_field, "transforms")
+
+    MNI_2_t1w_field = pe.Node(ants.ApplyTransforms(dimension=3, print_out_composite_warp_file=True,
+                                                   output_image="MNI_2_t1w_field.nii.gz", input_image=mni),
+                              name="MNI_2_t1w_field")
+    wf.connect(inputnode, "t1w", MNI_2_t1w_field, "reference_image")
+    wf.connect(inputnode, "MNI_2_t1w_xfm", MNI_2_t1w_field, "transforms")
+
+    def to_fsl_fnc(t1w_2_MNI_field, MNI_2_t1w_field, t1w, t1w_brainmask, mni, ext):
+        import os
+        from bianca.resample import itk_field_to_fsl_warp, itk_field_to_flirt_matrix
+        t1w_2_MNI_warp = itk_field_to_fsl_warp(t1w_2_MNI_field, t1w, os.path.abspath("t1w_2_MNI_warp" + ext))
+        MNI_2_t1w_warp = itk_field_to_fsl_warp(MNI_2_t1w_field, mni, os.path.abspath("MNI_2_t1w_warp" + ext))
+        t1w_2_MNI_mat = itk_field_to_flirt_matrix(MNI_2_t1w_field, mni, t1w_brainmask,
+                                                  os.path.abspath("t1w_2_MNI.mat"))
+        return t1w_2_MNI_warp, MNI_2_t1w_warp, t1w_2_MNI_mat
+
+    to_fsl = pe.Node(niu.Function(input_names=["t1w_2_MNI_field", "MNI_2_t1w_field", "t1w", "t1w_brainmask", "mni",
+                                               "ext"],
+                                  output_names=["t1w_2_MNI_warp", "MNI_2_t1w_warp", "t1w_2_MNI_mat"],
+                                  function=to_fsl_fnc),
+                     name="to_fsl")
+    to_fsl.inputs.mni = mni
+    to_fsl.inputs.ext = ext
+    wf.connect(t1w_2_MNI_field, "output_image", to_fsl, "t1w_2_MNI_field")
+    wf.connect(MNI_2_t1w_field, "output_image", to_fsl, "MNI_2_t1w_field")
+    wf.connect(inputnode, "t1w", to_fsl, "t1w")
+    wf.connect(inputnode, "t1w_brainmask", to_fsl, "t1w_brainmask")
+
+    t1w_MNIspace = pe.Node(fsl.ApplyWarp(ref_file=mni_2mm, relwarp=True), name="t1w_MNIspace")
+    wf.connect(inputnode, "t1w", t1w_MNIspace, "in_file")
+    wf.connect(to_fsl, "t1w_2_MNI_warp", t1w_MNIspace, "field_file")
+
+    wf.connect(to_fsl, "t1w_2_MNI_mat", outputnode, "t1w_2_MNI_mat")
+    wf.connect(to_fsl, "t1w_2_MNI_warp", outputnode, "t1w_2_MNI_warp")
+    wf.connect(to_fsl, "MNI_2_t1w_warp", outputnode, "MNI_2_t1w_warp")
+    wf.connect(t1w_MNIspace, "out_file", outputnode, "t1w_MNIspace")
+    return wf
@@ -0,0 +1,333 @@
+from functools import partial
+from pathlib import Path
+from nipype import Node, Workflow
+from nipype.interfaces import utility as niu
+
+from .prepare_template import init_single_subject_template_wf, template_params
+from .prepare_t1w import init_single_ses_anat_preproc_wf, _check_versions, t1w_params
+from .prepare_flair import get_grabber, get_prep_flair_wf, get_ds_wf
+from .prepare_flair_intNorm import get_normalize_node, get_ds_node, get_session_files as get_intnorm_files
+from ..utils import export_version, set_intermediate_output_type
+from ..dataset_index import get_dataset_index
+from ..manifest import CompletionManifest
+from ..shards import run_shards
+from ..workdir import node_subject_key
+
+
+class StageManifests:
+    """
+    CompletionManifests of several stages in one graph: routes nipype status callbacks to the manifest of the node's
+    stage, given by the prefix of its per-subject(-session) sub-workflow name (node_subject_key)
+    """
+
+    def __init__(self, manifests):
+        self.manifests = manifests
+
+    def status_callback(self, node, status):
+        key = node_subject_key(node)
+        for prefix, manifest in self.manifests.items():
+            if key is not None and key.startswith(prefix):
+                manifest.status_callback(node, status)
+
+    def commit(self):
+        for manifest in self.manifests.values():
+            manifest.commit()
+
+
+def _wait_fnc(template_prep_dir, t1w_prep_dir, template_files=None, t1w_files=None):
+    # template_files, t1w_files: sink outputs of the subject's template and the session's t1w, only connected so the
+    # FLAIR grabber (which reads them from disk) waits for them
+    return template_prep_dir, t1w_prep_dir
+
+
+def _flair_files_fnc(out_files):
+    return out_files["flair_biascorr"], out_files["brainmask"]
+
+
+def _training_features_fnc(out_files, manual_mask, subject, session, cache_dir):
+    from bianca.knn_engine import cached_training_features
+    row = dict(flair=out_files["flair_biascorr"], t1w=out_files["t1w_brain"], manual_mask=manual_mask,
+               mat=out_files["flair_to_mni"], subject=subject, session=session)
+    cached_training_features(row, cache_dir)
+    return cache_dir
+
+
+def _train_classifier_fnc(prep_dir, training_data_dir, bianca_dir, masterfile_tmpls, clf_cache_dir,
+                          clf_cache_max_gb, sinks=None):
+    # sinks: sink outputs of the training sessions, only connected so that training waits for them
+    import os
+    from bianca.workflows.bianca import train_classifier_cached
+    return train_classifier_cached(prep_dir, training_data_dir, bianca_dir, masterfile_tmpls, clf_cache_dir,
+                                   os.getcwd(), clf_cache_max_gb=clf_cache_max_gb)
+
+
+def prepare_streaming(bids_dir, smriprep_dir, template_prep_dir, t1w_prep_dir, flair_prep_dir, intnorm_dir, wd_dir,
+                      crash_dir, subjects_sessions, flair_acq, training_data_dir=None, masterfile_tmpls=None,
+                      engine=None, feature_cache_dir=None, bianca_dir=None, clf_cache_dir=None, clf_cache_max_gb=20,
+                      n_cpu=1, omp_nthreads=1, run_wf=True, graph=False,
+                      smriprep06=False, distance_cutoffs=(10,), perivent_cutoff=10, percentiles=None,
+                      compress_intermediates=False, compress_level=6, skip_completed=True, shard_size=None,
+                      overlap_shards=False, node_cache_dir=None, node_cache_max_gb=50, smriprep_mni_space=None,
+                      smriprep_affines=False, affine_min_corr=0.9):
+    """
+    prepare_template, prepare_t1w, prepare_bianca_data and prepare_flair_intNorm in one graph, with one sub-workflow
+    per subject (template) and per session (t1w, FLAIR, intensity normalization). A session's FLAIR preparation only
+    waits for its own subject's template and its own t1w (not for the whole cohort's stages), so the first sessions
+    are ready for bianca while others are still in preprocessing. Outputs, manifests and parameters are the ones of
+    the single stages, i.e. stages can be run separately before or afterwards.
+    Training sessions (with a manual mask in training_data_dir) are put first and their nodes are submitted before
+    the ones of test sessions whenever not all ready jobs fit (PriorityMultiProcPlugin).
+    :param engine: bianca engine to train for while preprocessing. "fsl": once the FLAIRs of all training sessions
+    are sunk, the classifier is trained and stored in the classifier cache clf_cache_dir (see
+    bianca.train_classifier_cached), so run_bianca(clf_cache_dir=clf_cache_dir) after create_masterfile(update=True)
+    into bianca_dir only segments the query sessions. "native": the training features of a training session are
+    extracted into feature_cache_dir (run_bianca's out_dir / "feature_cache") as soon as its FLAIR is prepared, so
+    run_bianca(engine="native") starts with a complete cache. None: preprocessing only.
+    :param training_data_dir, masterfile_tmpls: manual masks and create_masterfile's templates (default:
+    masterfile_templates(flair_acq)), manual_mask_tmpl with {subject} and {session} relative to training_data_dir
+    :param skip_completed: per stage, drop subjects/sessions that are complete according to the stage's
+    CompletionManifest
+    :param shard_size, overlap_shards: sharding of the subjects (with all their sessions, training subjects first), see
+    bianca.shards.run_shards
+    :param node_cache_dir: persistent cache of the FNIRT, InvWarp and N4 outputs (see
+    prepare_template.prepare_template)
+    :param smriprep_mni_space: template <-> MNI transforms from smriprep (see prepare_template.prepare_template)
+    :param smriprep_affines, affine_min_corr: T1w runs to template space with smriprep's affines (see
+    prepare_t1w.prepare_t1w)
+    """
+    from ..pipeline import masterfile_templates
+    if engine not in (None, "fsl", "native"):
+        raise ValueError(f"engine should be None, fsl or native, but is {engine}")
+    if engine == "native" and feature_cache_dir is None:
+        raise ValueError("engine='native' requires feature_cache_dir")
+    if engine == "fsl" and None in (training_data_dir, bianca_dir, clf_cache_dir):
+        raise ValueError("engine='fsl' requires training_data_dir, bianca_dir and clf_cache_dir")
+    masterfile_tmpls = dict(masterfile_templates(flair_acq), **(masterfile_tmpls or {}))
+    template_prep_dir, t1w_prep_dir, flair_prep_dir, intnorm_dir = map(Path, [template_prep_dir, t1w_prep_dir,
+                                                                              flair_prep_dir, intnorm_dir])
+    subjects_sessions = [tuple(s) for s in subjects_sessions]
+    subjects = sorted({s for s, _ in subjects_sessions})
+    manifests = {
+        "template_": CompletionManifest(template_prep_dir, "prepare_template",
+                                        params=template_params(smriprep06, distance_cutoffs, perivent_cutoff,
+                                                               smriprep_mni_space)),
+        "anat_preproc_": CompletionManifest(t1w_prep_dir, "prepare_t1w",
+                                            params=t1w_params(smriprep06, smriprep_affines, affine_min_corr)),
+        "flair_": CompletionManifest(flair_prep_dir, "prepare_bianca_data", params=dict(flair_acq=flair_acq)),
+        "intnorm_": CompletionManifest(intnorm_dir, "prepare_flair_intNorm",
+                                       params=dict(flair_acq=flair_acq, percentiles=percentiles)),
+    }
+    pending = {"template_": set(subjects), "anat_preproc_": set(subjects_sessions), "flair_": set(subjects_sessions),
+               "intnorm_": set(subjects_sessions)}
+    if skip_completed:
+        pending = {prefix: set(manifests[prefix].pending(sorted(items))) for prefix, items in pending.items()}
+    # template and t1w are only needed for sessions whose FLAIR is prepared
+    pending["template_"] &= {s for s, _ in pending["flair_"]}
+    pending["anat_preproc_"] &= pending["flair_"]
+    sessions = [s for s in subjects_sessions if s in pending["flair_"] or s in pending["intnorm_"]]
+    if not sessions:
+        return
+
+    training, manual_masks = set(), {}
+    if training_data_dir is not None:
+        manual_masks = {(s, ses): Path(training_data_dir) / masterfile_tmpls["manual_mask_tmpl"].format(subject=s,
+                                                                                                        session=ses)
+                        for s, ses in sessions}
+        training = {s for s, f in manual_masks.items() if f.is_file()}
+    training_subjects = {s for s, _ in training}
+    # subjects with all their sessions, training subjects first
+    items = [(s, [ses for sub, ses in sessions if sub == s]) for s in sorted({s for s, _ in sessions},
+                                                                            key=lambda s: s not in training_subjects)]
+    # the classifier is trained in the shard of the last subject with a training session to prepare (the ones of
+    # earlier shards are sunk before), or in the first shard if all training sessions are prepared
+    flair_training_subjects = [s for s, _ in items if any(t in pending["flair_"] for t in training if t[0] == s)]
+    classifier_subject = (flair_training_subjects or [items[0][0]])[-1] if engine == "fsl" else None
+    print(f"streaming: {len(sessions)} sessions of {len(items)} subjects ({len(training)} training sessions); "
+          f"to run: template {len(pending['template_'])}, t1w {len(pending['anat_preproc_'])}, "
+          f"FLAIR {len(pending['flair_'])}, intNorm {len(pending['intnorm_'])}")
+
+    for out_dir in [template_prep_dir, t1w_prep_dir, flair_prep_dir, intnorm_dir]:
+        out_dir.mkdir(exist_ok=True, parents=True)
+        export_version(out_dir)
+    ext = set_intermediate_output_type(compress_intermediates)
+    get_dataset_index(bids_dir)
+    if pending["anat_preproc_"]:
+        _check_versions()
+        get_dataset_index(smriprep_dir)
+    elif pending["template_"] and (not smriprep06 or smriprep_mni_space is not None):
+        get_dataset_index(smriprep_dir)
+    if pending["intnorm_"] - pending["flair_"]:
+        get_dataset_index(flair_prep_dir)
+
+    priorities = {}
+
+    build_wf = partial(init_streaming_wf, bids_dir=bids_dir, smriprep_dir=smriprep_dir,
+                       template_prep_dir=template_prep_dir, t1w_prep_dir=t1w_prep_dir, flair_prep_dir=flair_prep_dir,
+                       intnorm_dir=intnorm_dir, wd_dir=wd_dir, crash_dir=crash_dir, flair_acq=flair_acq, ext=ext,
+                       pending=pending, training=training, manual_masks=manual_masks, priorities=priorities,
+                       engine=engine, feature_cache_dir=feature_cache_dir, classifier_subject=classifier_subject,
+                       training_data_dir=training_data_dir, bianca_dir=bianca_dir, masterfile_tmpls=masterfile_tmpls,
+                       clf_cache_dir=clf_cache_dir, clf_cache_max_gb=clf_cache_max_gb, omp_nthreads=omp_nthreads,
+                       smriprep06=smriprep06, distance_cutoffs=distance_cutoffs, perivent_cutoff=perivent_cutoff,
+                       percentiles=percentiles, compress_level=compress_level, node_cache_dir=node_cache_dir,
+                       node_cache_max_gb=node_cache_max_gb, smriprep_mni_space=smriprep_mni_space,
+                       smriprep_affines=smriprep_affines, affine_min_corr=affine_min_corr)
+
+    def priority(node):
+        return priorities.get(node_subject_key(node), 1)
+
+    run_shards(build_wf, items, shard_size, n_cpu, manifest=StageManifests(manifests), run_wf=run_wf, graph=graph,
+               overlap=overlap_shards, priority=priority)
+
+
+def init_streaming_wf(items, bids_dir, smriprep_dir, template_prep_dir, t1w_prep_dir, flair_prep_dir, intnorm_dir,
+                      wd_dir, crash_dir, flair_acq, pending, training, manual_masks, priorities, engine=None,
+                      feature_cache_dir=None, classifier_subject=None, training_data_dir=None, bianca_dir=None,
+                      masterfile_tmpls=None, clf_cache_dir=None, clf_cache_max_gb=20, omp_nthreads=1, smriprep06=False, distance_cutoffs=(10,),
+                      perivent_cutoff=10, percentiles=None, compress_level=6, node_cache_dir=None, node_cache_max_gb=50,
+                      smriprep_mni_space=None, smriprep_affines=False, affine_min_corr=0.9, ext=".nii.gz"):
+    """prepare_streaming's graph of items (one shard, see bianca.shards.run_shards)"""
+    wf = Workflow(name="meta_prepare_streaming")
+    wf.base_dir = wd_dir
+    wf.config.remove_unnecessary_outputs = False
+    wf.config["execution"]["crashdump_dir"] = crash_dir
+    wf.config["monitoring"]["enabled"] = "true"
+
+    training_subjects = {s for s, _ in training}
+    training_sinks = []
+    for subject, subject_sessions in items:
+        priority = 0 if subject in training_subjects else 1
+        template_wf = None
+        if subject in pending["template_"]:
+            template_wf = init_single_subject_template_wf(subject, bids_dir, smriprep_dir, template_prep_dir,
+                                                          name=f"template_{subject}", omp_nthreads=omp_nthreads,
+                                                          smriprep06=smriprep06,
+                                                          distance_cutoffs=distance_cutoffs,
+                                                          perivent_cutoff=perivent_cutoff, ext=ext,
+                                                          compress_level=compress_level,
+                                                          node_cache_dir=node_cache_dir,
+                                                          node_cache_max_gb=node_cache_max_gb,
+                                                          smriprep_mni_space=smriprep_mni_space)
+            wf.add_nodes([template_wf])
+            priorities[template_wf.name] = priority
+
+        for session in subject_sessions:
+            priority = 0 if (subject, session) in training else 1
+            ds_flair = None
+            if (subject, session) in pending["flair_"]:
+                flair_wf = Workflow(name=f"flair_{subject}_{session}")
+                wait = Node(niu.Function(input_names=["template_prep_dir", "t1w_prep_dir", "template_files",
+                                                      "t1w_files"],
+                                         output_names=["template_prep_dir", "t1w_prep_dir"],
+                                         function=_wait_fnc),
+                            name="wait")
+                wait.inputs.template_prep_dir = template_prep_dir
+                wait.inputs.t1w_prep_dir = t1w_prep_dir
+                grabber = get_grabber(bids_dir, template_prep_dir, t1w_prep_dir, flair_acq)
+                grabber.inputs.subject = subject
+                grabber.inputs.session = session
+                flair_wf.connect([(wait, grabber, [("template_prep_dir", "template_prep_dir"),
+                                                   ("t1w_prep_dir", "t1w_prep_dir")])])
+
+                prep_flair_wf = get_prep_flair_wf(omp_nthreads=omp_nthreads, ext=ext, node_cache_dir=node_cache_dir,
+                                                  node_cache_max_gb=node_cache_max_gb)
+                flair_wf.connect([(grabber, prep_flair_wf, [(f, f"inputnode.{f}") for f in
+                                                            ["flair_file", "t1w", "t1w_brain", "t1w_brainmask",
+                                                             "t1w_to_MNI_xfm", "vent_mask", "wm_mask",
+                                                             "distancemap", "perivent_mask", "deepWM_mask"]])])
+                ds_wf = get_ds_wf(flair_prep_dir, compress_level=compress_level, n_threads=omp_nthreads)
+                flair_wf.connect([(prep_flair_wf, ds_wf, [(f"outputnode.{f}", f"inputnode.{f}") for f in
+                                                          ["flair_biascorr", "t1w_brain", "brainmask", "wm_mask",
+                                                           "vent_mask", "distancemap", "perivent_mask",
+                                                           "deepWM_mask", "t1w_to_flair", "flair_mniSp",
+                                                           "flair_to_mni"]]),
+                                  (grabber, ds_wf, [("flair_file", "inputnode.bids_flair_file"),
+                                                    ("flair_space", "inputnode.space"),
+                                                    ("generic_bids_file", "inputnode.generic_bids_file")])
+                                  ])
+                wf.add_nodes([flair_wf])
+                priorities[flair_wf.name] = priority
+                ds_flair = (flair_wf, "get_ds_wf.ds.out_files")
+                if (subject, session) in training:
+                    training_sinks.append(ds_flair)
+
+                if template_wf is not None:
+                    wf.connect(template_wf, "template_derivatives_wf.ds.out_files", flair_wf, "wait.template_files")
+                if (subject, session) in pending["anat_preproc_"]:
+                    t1w_wf = init_single_ses_anat_preproc_wf(subject=subject, session=session, bids_dir=bids_dir,
+                                                             smriprep_dir=smriprep_dir, out_dir=t1w_prep_dir,
+                                                             name=f"anat_preproc_{subject}_{session}",
+                                                             omp_nthreads=omp_nthreads, smriprep06=smriprep06,
+                                                             compress_level=compress_level,
+                                                             node_cache_dir=node_cache_dir,
+                                                             node_cache_max_gb=node_cache_max_gb,
+                                                             smriprep_affines=smriprep_affines,
+                                                             affine_min_corr=affine_min_corr, ext=ext)
+                    wf.add_nodes([t1w_wf])
+                    priorities[t1w_wf.name] = priority
+                    wf.connect(t1w_wf, "t1w_derivatives_wf.ds.out_files", flair_wf, "wait.t1w_files")
+
+                if (subject, session) in training and engine == "native":
+                    features_wf = Workflow(name=f"features_{subject}_{session}")
+                    features = Node(niu.Function(input_names=["out_files", "manual_mask", "subject", "session",
+                                                              "cache_dir"],
+                                                 output_names=["cache_dir"],
+                                                 function=_training_features_fnc),
+                                    name="training_features")
+                    features.inputs.manual_mask = str(manual_masks[(subject, session)])
+                    features.inputs.subject = subject
+                    features.inputs.session = session
+                    features.inputs.cache_dir = str(feature_cache_dir)
+                    features_wf.add_nodes([features])
+                    wf.connect(flair_wf, "get_ds_wf.ds.out_files", features_wf, "training_features.out_files")
+                    priorities[features_wf.name] = priority
+
+            if (subject, session) in pending["intnorm_"]:
+                intnorm_wf = Workflow(name=f"intnorm_{subject}_{session}")
+                if ds_flair is not None:
+                    grabber = Node(niu.Function(input_names=["out_files"],
+                                                output_names=["flair_file", "brain_mask"],
+                                                function=_flair_files_fnc),
+                                   name="grabber")
+                else:
+                    grabber = Node(niu.Function(input_names=["flair_prep_dir", "subject", "session", "flair_acq"],
+                                                output_names=["flair_file", "brain_mask"],
+                                                function=get_intnorm_files),
+                                   name="grabber")
+                    grabber.inputs.flair_prep_dir = flair_prep_dir
+                    grabber.inputs.subject = subject
+                    grabber.inputs.session = session
+                    grabber.inputs.flair_acq = flair_acq
+                flair_normalized = get_normalize_node(percentiles, ext)
+                ds_intnorm = get_ds_node(intnorm_dir, compress_level)
+                intnorm_wf.connect([(grabber, flair_normalized, [("flair_file", "flair_file"),
+                                                                 ("brain_mask", "brain_mask")]),
+                                    (grabber, ds_intnorm, [("flair_file", "flair_file")]),
+                                    (flair_normalized, ds_intnorm, [("out_file", "flair_biascorr_intNorm")])])
+                wf.add_nodes([intnorm_wf])
+                if ds_flair is not None:
+                    wf.connect(*ds_flair, intnorm_wf, "grabber.out_files")
+                priorities[intnorm_wf.name] = priority
+
+    if classifier_subject in {s for s, _ in items}:
+        classifier_wf = Workflow(name="classifier")
+        train = Node(niu.Function(input_names=["prep_dir", "training_data_dir", "bianca_dir", "masterfile_tmpls",
+                                               "clf_cache_dir", "clf_cache_max_gb", "sinks"],
+                                  output_names=["key"],
+                                  function=_train_classifier_fnc),
+                     name="train_classifier")
+        train.inputs.prep_dir = str(flair_prep_dir)
+        train.inputs.training_data_dir = str(training_data_dir)
+        train.inputs.bianca_dir = str(bianca_dir)
+        train.inputs.masterfile_tmpls = masterfile_tmpls
+        train.inputs.clf_cache_dir = str(clf_cache_dir)
+        train.inputs.clf_cache_max_gb = clf_cache_max_gb
+        classifier_wf.add_nodes([train])
+        if training_sinks:
+            sinks = Node(niu.Merge(len(training_sinks)), name="training_sinks")
+            classifier_wf.connect(sinks, "out", train, "sinks")
+        wf.add_nodes([classifier_wf])
+        for i, ds in enumerate(training_sinks):
+            wf.connect(*ds, classifier_wf, f"training_sinks.in{i + 1}")
+        priorities[classifier_wf.name] = 0
+    return wf
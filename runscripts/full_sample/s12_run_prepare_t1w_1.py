@@ -33,11 +33,7 @@ smriprep_subj = {('lhabX0196', 'tp1'), ('lhabX0196', 'tp2'), ('lhabX0196', 'tp3'
 subjects_sessions = list(set(subjects_sessions) - smriprep_subj)
 subjects_sessions.sort()
 
-subjects_sessions = subjects_sessions[:250]
-# subjects_sessions = subjects_sessions[250:500]
-# subjects_sessions = subjects_sessions[500:750]
-# subjects_sessions = subjects_sessions[750:]
-
 print(f"\n{len(subjects_sessions)} subjects-sessions\n")
 
-prepare_t1w(bids_dir, smriprep_dir, out_dir, wd_dir, crash_dir, subjects_sessions, n_cpu=32, omp_nthreads=1)
+prepare_t1w(bids_dir, smriprep_dir, out_dir, wd_dir, crash_dir, subjects_sessions, n_cpu=32, omp_nthreads=1,
+            shard_size=250)
@@ -0,0 +1,30 @@
+import shutil
+
+from bianca.cache import ContentCache
+
+
+def test_checkout(tmp_path):
+    cache = ContentCache(tmp_path / "cache")
+    for name in ["classifier", "classifier_labels"]:
+        (tmp_path / name).write_text(name)
+    cache.put("abc", {name: tmp_path / name for name in ["classifier", "classifier_labels"]})
+
+    out = cache.checkout("abc", tmp_path / "wd" / "abc", ["classifier", "classifier_labels"])
+    assert out == tmp_path / "wd" / "abc"
+    assert (out / "classifier").read_text() == "classifier"
+    assert (out / "classifier_labels").read_text() == "classifier_labels"
+    # the copies stay usable when the entry is evicted
+    shutil.rmtree(tmp_path / "cache" / "abc")
+    assert (out / "classifier").read_text() == "classifier"
+
+    assert cache.checkout("abc", tmp_path / "wd" / "abc2", ["classifier"]) is None
+    assert cache.checkout("xyz", tmp_path / "wd" / "xyz", ["classifier"]) is None
+
+
+def test_checkout_entry_evicted_while_copying(tmp_path):
+    cache = ContentCache(tmp_path / "cache")
+    (tmp_path / "classifier").write_text("classifier")
+    entry = cache.put("abc", {"classifier": tmp_path / "classifier"})
+    # another process's rmtree removed the entry's files, but not yet meta.json
+    (entry / "classifier").unlink()
+    assert cache.checkout("abc", tmp_path / "wd" / "abc", ["classifier"]) is None
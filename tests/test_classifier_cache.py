@@ -0,0 +1,67 @@
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip("niworkflows")
+from bianca.cache import ContentCache
+from bianca.pipeline import masterfile_templates
+from bianca.utils import create_masterfile
+from bianca.workflows import bianca as bianca_wf
+from bianca.workflows.bianca import train_classifier_cached, training_set_hash
+
+
+class FakeBIANCA:
+    """records the inputs and writes the classifier files bianca --saveclassifierdata writes"""
+    calls = []
+
+    def __init__(self, **inputs):
+        self.inputs = inputs
+
+    def run(self, cwd):
+        FakeBIANCA.calls.append(dict(self.inputs, rows=Path(self.inputs["masterfile"]).read_text().splitlines()))
+        for f in ["classifier", "classifier_labels"]:
+            (Path(cwd) / f).write_text(f)
+
+
+def write(path, content="0"):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(content)
+
+
+def test_train_classifier_cached(tmp_path, monkeypatch):
+    monkeypatch.setattr(bianca_wf, "BIANCA", FakeBIANCA)
+    prep_dir, training_data_dir, bianca_dir = tmp_path / "prep", tmp_path / "masks", tmp_path / "bianca"
+    tmpls = masterfile_templates("2D")
+
+    def prepare(subject, session, complete=True):
+        write(prep_dir / tmpls["flair_tmpl"].replace("*", "run-1").format(subject=subject, session=session))
+        if complete:
+            for tmpl in [tmpls["t1w_tmpl"], tmpls["mat_tmpl"]]:
+                write(prep_dir / tmpl.format(subject=subject, session=session), subject + session)
+
+    # test session 03 is still in preprocessing, 02 has no manual mask
+    for subject in ["01", "02", "04"]:
+        prepare(subject, "tp1")
+    prepare("03", "tp1", complete=False)
+    for subject in ["01", "04"]:
+        write(training_data_dir / tmpls["manual_mask_tmpl"].format(subject=subject, session="tp1"), subject)
+
+    cache_dir, work_dir = tmp_path / "cache", tmp_path / "wd"
+    work_dir.mkdir()
+    key = train_classifier_cached(prep_dir, training_data_dir, bianca_dir, tmpls, cache_dir, work_dir)
+    call, = FakeBIANCA.calls
+    assert call["trainingnums"] == "1,2" and call["querysubjectnum"] == 3 and call["save_classifier"]
+    assert [row.split(" ")[-2] for row in call["rows"]] == ["01", "04", "01"]
+    assert (ContentCache(cache_dir).get(key) / "classifier").read_text() == "classifier"
+
+    # run_bianca's training set of the masterfile written after preprocessing has the same hash
+    prepare("03", "tp1")
+    create_masterfile(prep_dir, training_data_dir, bianca_dir, update=True, **tmpls)
+    df = pd.read_csv(bianca_dir / "masterfile_wHeader.txt", sep=" ")
+    assert training_set_hash(df, np.where(df.manual_mask != "XXX")[0]) == key
+
+    # cached: no training
+    assert train_classifier_cached(prep_dir, training_data_dir, bianca_dir, tmpls, cache_dir, work_dir) == key
+    assert len(FakeBIANCA.calls) == 1
@@ -0,0 +1,103 @@
+import os
+import sqlite3
+
+import pytest
+
+from bianca import dataset_index
+from bianca.dataset_index import DatasetIndex, get_dataset_index, parse_entities
+
+FILES = ["sub-01/ses-tp1/anat/sub-01_ses-tp1_T1w.nii.gz",
+         "sub-01/ses-tp1/anat/sub-01_ses-tp1_acq-2D_run-1_FLAIR.nii.gz",
+         "sub-01/ses-tp2/anat/sub-01_ses-tp2_T1w.nii.gz",
+         "sub-02/ses-tp1/anat/sub-02_ses-tp1_run-1_T1w.nii.gz",
+         "sub-02/ses-tp1/anat/sub-02_ses-tp1_run-2_T1w.nii.gz",
+         "dataset_description.json"]
+PATTERNS = ["sub-*/ses-*/anat/*_T1w.nii.gz", "sub-01/ses-tp1/anat/*", "sub-0[2-3]/ses-tp1/anat/*_run-*_T1w.nii.gz",
+            "*.json", "sub-*/ses-tp?/anat/*FLAIR*", "sub-03/*/anat/*.nii.gz"]
+
+
+@pytest.fixture
+def bids_dir(tmp_path):
+    root = tmp_path / "bids"
+    for f in FILES:
+        (root / f).parent.mkdir(parents=True, exist_ok=True)
+        (root / f).touch()
+    # symlinked subject (e.g. datalad or a tree assembled from several sites) and a link cycle
+    real = tmp_path / "real" / "sub-03" / "ses-tp1" / "anat"
+    real.mkdir(parents=True)
+    (real / "sub-03_ses-tp1_T1w.nii.gz").touch()
+    (root / "sub-03").symlink_to(tmp_path / "real" / "sub-03")
+    (root / "sub-01" / "ses-tp1" / "anat" / "loop").symlink_to(root / "sub-01")
+    return root
+
+
+def index_of(root, tmp_path):
+    return get_dataset_index(root, index_file=tmp_path / "index.sqlite")
+
+
+@pytest.mark.parametrize("pattern", PATTERNS)
+def test_glob_matches_path_glob(bids_dir, tmp_path, pattern):
+    index = index_of(bids_dir, tmp_path)
+    expected = sorted(p for p in bids_dir.glob(pattern) if p.is_file())
+    assert index.glob(pattern) == expected
+
+
+def test_symlinked_subject_indexed(bids_dir, tmp_path):
+    index = index_of(bids_dir, tmp_path)
+    expected = [bids_dir / "sub-03" / "ses-tp1" / "anat" / "sub-03_ses-tp1_T1w.nii.gz"]
+    assert index.glob("sub-03/ses-tp1/anat/*_T1w.nii.gz") == expected
+
+
+def test_incremental_update(bids_dir, tmp_path):
+    index = index_of(bids_dir, tmp_path)
+    new = bids_dir / "sub-02" / "ses-tp1" / "anat" / "sub-02_ses-tp1_acq-3D_run-1_FLAIR.nii.gz"
+    new.touch()
+    (bids_dir / FILES[2]).unlink()
+    os.rmdir(bids_dir / "sub-01" / "ses-tp2" / "anat")
+    index.update()
+    for pattern in PATTERNS:
+        assert index.glob(pattern) == sorted(p for p in bids_dir.glob(pattern) if p.is_file())
+
+
+def test_update_false_syncs_once_per_process(bids_dir, tmp_path, monkeypatch):
+    monkeypatch.setattr(dataset_index, "_SYNCED", set())
+    index_file = tmp_path / "index.sqlite"
+    DatasetIndex(bids_dir, index_file=index_file).update()
+    new = bids_dir / "sub-02" / "ses-tp1" / "anat" / "sub-02_ses-tp1_run-3_T1w.nii.gz"
+    new.touch()
+    # an index built by another process is synced on first use in this one
+    assert new in get_dataset_index(bids_dir, index_file=index_file, update=False).glob("sub-02/ses-tp1/anat/*")
+    new.unlink()
+    assert new in get_dataset_index(bids_dir, index_file=index_file, update=False).glob("sub-02/ses-tp1/anat/*")
+    assert new not in get_dataset_index(bids_dir, index_file=index_file).glob("sub-02/ses-tp1/anat/*")
+
+
+def test_connections_closed(bids_dir, tmp_path, monkeypatch):
+    connections = []
+    connect = sqlite3.connect
+
+    def recording_connect(*args, **kwargs):
+        connections.append(connect(*args, **kwargs))
+        return connections[-1]
+
+    monkeypatch.setattr(sqlite3, "connect", recording_connect)
+    index = index_of(bids_dir, tmp_path)
+    index.glob("*.json")
+    index.query(subject="01")
+    assert len(connections) == 3
+    for con in connections:
+        with pytest.raises(sqlite3.ProgrammingError):
+            con.execute("SELECT 1")
+
+
+def test_query(bids_dir, tmp_path):
+    index = index_of(bids_dir, tmp_path)
+    assert index.query(subject="02", suffix="T1w") == sorted((bids_dir / "sub-02/ses-tp1/anat").glob("*_T1w.nii.gz"))
+    with pytest.raises(ValueError):
+        index.query(task="rest")
+
+
+def test_parse_entities():
+    d = parse_entities("sub-01_ses-tp1_acq-2D_run-1_FLAIR.nii.gz")
+    assert (d["subject"], d["session"], d["acq"], d["run"]) == ("01", "tp1", "2D", "1")
+    assert (d["suffix"], d["extension"]) == ("FLAIR", ".nii.gz")
@@ -0,0 +1,19 @@
+import numpy as np
+import nibabel as nb
+
+from bianca.workflows.interfaces import FallbackFLIRT
+
+
+def test_fallback_flirt_passes_on_resampled_file(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for name in ["in", "ref", "resampled"]:
+        nb.Nifti1Image(np.zeros((4, 4, 4), np.float32), np.eye(4)).to_filename(str(tmp_path / f"{name}.nii.gz"))
+    np.savetxt(str(tmp_path / "resampled.mat"), np.eye(4))
+    flirt = FallbackFLIRT(dof=6, in_file=str(tmp_path / "in.nii.gz"), reference=str(tmp_path / "ref.nii.gz"),
+                          needs_flirt=False, resampled_file=str(tmp_path / "resampled.nii.gz"),
+                          resampled_matrix_file=str(tmp_path / "resampled.mat"))
+    # runs without fsl, as flirt is not called
+    result = flirt.run()
+    assert result.outputs.out_file == str(tmp_path / "resampled.nii.gz")
+    assert result.outputs.out_matrix_file == str(tmp_path / "resampled.mat")
+    assert "flirt" in flirt.cmdline
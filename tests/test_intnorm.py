@@ -0,0 +1,36 @@
+import numpy as np
+import nibabel as nb
+import pytest
+
+from bianca.intnorm import normalize_flair
+
+
+def save(data, path):
+    nb.Nifti1Image(np.asarray(data), np.eye(4)).to_filename(str(path))
+    return path
+
+
+@pytest.fixture
+def flair(tmp_path):
+    d = np.arange(4 * 5 * 6, dtype=np.float32).reshape((4, 5, 6))
+    return d, save(d, tmp_path / "flair.nii.gz")
+
+
+def test_normalize_flair(tmp_path, flair):
+    d, flair_file = flair
+    mask = np.zeros(d.shape, np.uint8)
+    mask[1:3, 1:4, 1:5] = 1
+    out_file = normalize_flair(flair_file, save(mask, tmp_path / "mask.nii.gz"), tmp_path / "out" / "norm.nii.gz")
+    lo, hi = d[mask != 0].min(), d[mask != 0].max()
+    np.testing.assert_allclose(nb.load(str(out_file)).get_fdata(), (d - lo) / (hi - lo), rtol=1e-6)
+
+
+@pytest.mark.parametrize("mask_value", ["empty", "constant"])
+def test_normalize_flair_no_range(tmp_path, flair, mask_value):
+    d, flair_file = flair
+    mask = np.zeros(d.shape, np.uint8)
+    if mask_value == "constant":
+        mask[1, 1, 1] = 1
+    with pytest.raises(ValueError, match="empty brain mask" if mask_value == "empty" else "is constant"):
+        normalize_flair(flair_file, save(mask, tmp_path / "mask.nii.gz"), tmp_path / "norm.nii.gz")
+    assert not (tmp_path / "norm.nii.gz").exists()
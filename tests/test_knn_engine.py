@@ -0,0 +1,167 @@
+import json
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import nibabel as nb
+import pytest
+
+from bianca import knn_engine
+from bianca.knn_engine import (training_features, predict_lpm, run_bianca_native, run_bianca_native_cv, compare_lpms,
+                               cv_folds, _share, _init_worker, _get_tree)
+
+SHAPE = (16, 16, 12)
+
+
+def synthetic_subject(out_dir, subject, rng, lesions=((5, 5, 5),), radius=2):
+    """t1w (brain = nonzero), flair with bright spherical lesions, manual mask and an identity flair->MNI matrix"""
+    out_dir = Path(out_dir) / f"sub-{subject}" / "ses-tp1" / "anat"
+    out_dir.mkdir(parents=True)
+    ijk = np.indices(SHAPE)
+    brain = np.zeros(SHAPE, bool)
+    brain[2:-2, 2:-2, 2:-2] = True
+    manual = np.zeros(SHAPE, bool)
+    for centre in lesions:
+        manual |= sum((c - m) ** 2 for c, m in zip(ijk, centre)) <= radius ** 2
+    manual &= brain
+    flair = np.where(manual, 300., 100.) + rng.normal(0, 5, SHAPE)
+    t1w = np.where(manual, 60., 100.) + rng.normal(0, 5, SHAPE)
+    row = {}
+    prefix = out_dir / f"sub-{subject}_ses-tp1"
+    for name, d in [("FLAIR", flair * brain), ("T1w", t1w * brain), ("mask", manual)]:
+        f = f"{prefix}_{name}.nii.gz"
+        nb.Nifti1Image(d.astype(np.float32), np.eye(4)).to_filename(f)
+        row[name] = f
+    mat = f"{prefix}_flair2mni.mat"
+    np.savetxt(mat, np.eye(4))
+    return {"flair": row["FLAIR"], "t1w": row["T1w"], "manual_mask": row["mask"], "mat": mat, "subject": subject,
+            "session": "tp1"}
+
+
+@pytest.fixture
+def cohort(tmp_path):
+    rng = np.random.default_rng(0)
+    lesions = [((5, 5, 5),), ((10, 9, 6), (5, 10, 5)), ((6, 6, 7),), ((9, 5, 6),)]
+    df = pd.DataFrame([synthetic_subject(tmp_path / "data", f"{i:02d}", rng, l) for i, l in enumerate(lesions)])
+    out_dir = tmp_path / "bianca"
+    out_dir.mkdir()
+    df.to_csv(out_dir / "masterfile_wHeader.txt", sep=" ", index=False)
+    df.drop(columns=["subject", "session"]).to_csv(out_dir / "masterfile.txt", sep=" ", index=False, header=False)
+    return out_dir, df
+
+
+@pytest.fixture
+def worker():
+    shms = []
+
+    def init(df, training_subject_idx, k=5, seed=0):
+        training = [training_features(df.iloc[i], seed=seed) for i in training_subject_idx]
+        features = np.vstack([f for f, _ in training]).astype(np.float32)
+        labels = np.concatenate([l for _, l in training]).astype(np.float32)
+        subject = np.concatenate([np.full(len(l), i) for i, (_, l) in zip(training_subject_idx, training)])
+        shared = [_share(a) for a in [features, labels, subject]]
+        shms.extend(shm for shm, _ in shared)
+        _init_worker(*[spec for _, spec in shared], (1 / features.std(axis=0)).astype(np.float32), k)
+        return subject
+
+    yield init
+    for shm in knn_engine._worker.get("shm", []):
+        shm.close()
+    for shm in shms:
+        shm.close()
+        shm.unlink()
+    knn_engine._worker.clear()
+
+
+def test_predict_lpm_synthetic(cohort, worker):
+    _, df = cohort
+    worker(df, [0, 1, 2])
+    lpm = predict_lpm(df.iloc[3]).get_fdata()
+    manual = nb.load(df.manual_mask[3]).get_fdata() > 0
+    brain = nb.load(df.t1w[3]).get_fdata() != 0
+    assert lpm.min() >= 0 and lpm.max() <= 1
+    assert (lpm[~brain] == 0).all()
+    assert lpm[manual].mean() > 0.8
+    assert lpm[brain & ~manual].mean() < 0.05
+
+
+def test_training_features_sampling(cohort):
+    _, df = cohort
+    features, labels = training_features(df.iloc[1], training_pts=20, seed=1)
+    assert features.shape == (len(labels), 5)
+    assert labels.sum() == 20 and (~labels).sum() == 200
+    empty = dict(df.iloc[0])
+    nb.Nifti1Image(np.zeros(SHAPE, np.float32), np.eye(4)).to_filename(empty["manual_mask"])
+    with pytest.warns(UserWarning, match="Empty manual mask"):
+        features, labels = training_features(empty)
+    assert len(labels) == 0
+
+
+def test_leave_one_out_tree_excludes_subject(cohort, worker):
+    _, df = cohort
+    subject = worker(df, [0, 1, 2])
+    tree, labels = _get_tree((1,))
+    assert tree.n == (subject != 1).sum() == len(labels)
+    tree, _ = _get_tree(())
+    assert tree.n == len(subject)
+
+
+def test_run_bianca_native_leave_one_out(cohort):
+    out_dir, df = cohort
+    out_files = run_bianca_native(out_dir / "masterfile.txt", out_dir, df, [0, 1, 2], [0, 1, 2, 3], n_cpu=1, k=5)
+    assert len(out_files) == 4
+    for i, f in enumerate(out_files):
+        meta = json.loads(Path(f.replace(".nii.gz", ".json")).read_text())
+        query = meta["query_subject_session"]
+        assert query not in meta["training_subjects_sessions"]
+        expected = [[df.subject[j], "tp1"] for j in [0, 1, 2] if df.subject[j] != query[0]]
+        assert meta["training_subjects_sessions"] == expected
+
+
+def test_run_bianca_native_cv_folds(cohort):
+    out_dir, df = cohort
+    out_files = run_bianca_native_cv(out_dir / "masterfile.txt", out_dir, df, [0, 1, 2, 3], n_folds=2, n_cpu=1, k=5)
+    assert len(out_files) == 4
+    for f in out_files:
+        meta = json.loads(Path(f.replace(".nii.gz", ".json")).read_text())
+        assert meta["query_subject_session"] not in meta["training_subjects_sessions"]
+        assert len(meta["training_subjects_sessions"]) == 2
+
+
+def test_cv_folds():
+    assert cv_folds([3, 1, 2]) == [[3], [1], [2]]
+    folds = cv_folds(range(10), n_folds=3, seed=1)
+    assert sorted(len(f) for f in folds) == [3, 3, 4]
+    assert sorted(i for f in folds for i in f) == list(range(10))
+    assert all(f == sorted(f) for f in folds)
+    assert folds == cv_folds(range(10), n_folds=3, seed=1)
+    assert len(cv_folds(range(2), n_folds=3)) == 2
+
+
+def test_compare_lpms(tmp_path):
+    a = np.zeros(SHAPE, np.float32)
+    a[4:8, 4:8, 4:8] = np.linspace(0.92, 1, 4)
+    for name, d in [("a", a), ("b", np.where(a > 0, a - 0.03, 0))]:
+        nb.Nifti1Image(d, np.eye(4)).to_filename(str(tmp_path / f"{name}.nii.gz"))
+    s = compare_lpms(tmp_path / "a.nii.gz", tmp_path / "b.nii.gz")
+    assert s.r == pytest.approx(1)
+    assert s.dice == pytest.approx(2 * 48 / (64 + 48))
+
+
+def test_feature_cache_keeps_other_keys(cohort, tmp_path, monkeypatch):
+    from bianca.knn_engine import cached_training_features
+    _, df = cohort
+    row = df.iloc[1]
+    cache_dir = tmp_path / "feature_cache"
+    a = cached_training_features(row, cache_dir, training_pts=10, seed=0)
+    b = cached_training_features(row, cache_dir, training_pts=10, seed=1)
+    assert len([e for e in cache_dir.iterdir() if not e.name.startswith(".")]) == 2
+
+    def fail(*args, **kwargs):
+        raise AssertionError("features were extracted again")
+
+    monkeypatch.setattr(knn_engine, "training_features", fail)
+    for expected, seed in [(a, 0), (b, 1)]:
+        features, labels = cached_training_features(row, cache_dir, training_pts=10, seed=seed)
+        np.testing.assert_array_equal(features, expected[0])
+        np.testing.assert_array_equal(labels, expected[1])
@@ -0,0 +1,99 @@
+import os
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from bianca.manifest import CompletionManifest
+
+
+def write(path, content=b"0" * 10):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(content)
+    return path
+
+
+@pytest.fixture
+def outputs(tmp_path):
+    anat = tmp_path / "out" / "sub-01" / "ses-tp1" / "anat"
+    return [write(anat / "sub-01_ses-tp1_FLAIR_LPM.nii.gz"), write(anat / "sub-01_ses-tp1_FLAIR_LPM.json")]
+
+
+def test_is_complete(tmp_path, outputs):
+    manifest = CompletionManifest(tmp_path / "out", "run_bianca", params={"engine": "fsl"})
+    assert not manifest.is_complete("01", "tp1")
+    manifest.record(outputs)
+    assert manifest.is_complete("01", "tp1")
+    assert not manifest.is_complete("01", "tp2")
+    assert manifest.pending([("01", "tp1"), ("02", "tp1")]) == [("02", "tp1")]
+    # read by later runs, but only with the same parameters
+    assert CompletionManifest(tmp_path / "out", "run_bianca", params={"engine": "fsl"}).is_complete("01", "tp1")
+    assert not CompletionManifest(tmp_path / "out", "run_bianca", params={"engine": "native"}).is_complete("01", "tp1")
+
+
+def test_is_complete_output_changes(tmp_path, outputs):
+    manifest = CompletionManifest(tmp_path / "out", "run_bianca")
+    manifest.record(outputs)
+    # new mtime, same content (e.g. copied or touched): sha1 is unchanged
+    st = os.stat(outputs[0])
+    os.utime(outputs[0], ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+    assert manifest.is_complete("01", "tp1")
+    # same size, different content
+    write(outputs[0], b"1" * 10)
+    os.utime(outputs[0], ns=(st.st_atime_ns, st.st_mtime_ns + 2 * 10 ** 9))
+    assert not manifest.is_complete("01", "tp1")
+    manifest.record(outputs)
+    assert manifest.is_complete("01", "tp1")
+    outputs[1].unlink()
+    assert not manifest.is_complete("01", "tp1")
+
+
+class DerivativesDataSink:
+    pass
+
+
+class BET:
+    pass
+
+
+def sink_node(subject, out_file):
+    return SimpleNamespace(parameterization=[f"_session_tp1_subject_{subject}"], _hierarchy="wf",
+                           interface=DerivativesDataSink(),
+                           result=SimpleNamespace(outputs=SimpleNamespace(out_file=str(out_file))))
+
+
+def test_status_callback_commit_skips_failed_subjects(tmp_path):
+    out_dir = tmp_path / "out"
+    out_files = {s: write(out_dir / f"sub-{s}" / "ses-tp1" / "anat" / f"sub-{s}_ses-tp1_FLAIR.nii.gz")
+                 for s in ["01", "02"]}
+    manifest = CompletionManifest(out_dir, "prepare_flair")
+    for subject, out_file in out_files.items():
+        manifest.status_callback(sink_node(subject, out_file), "end")
+    # a failed node of subject 02 after its sink ran, and an unrelated finished node
+    failed = SimpleNamespace(parameterization=["_session_tp1_subject_02"], _hierarchy="wf", interface=BET())
+    manifest.status_callback(failed, "exception")
+    manifest.status_callback(SimpleNamespace(parameterization=[], _hierarchy="wf", interface=BET()), "end")
+    assert not (out_dir / "_manifest_prepare_flair.json").exists()
+
+    manifest.commit()
+    assert manifest.is_complete("01", "tp1")
+    assert not manifest.is_complete("02", "tp1")
+    assert list(json.loads((out_dir / "_manifest_prepare_flair.json").read_text())) == ["sub-01_ses-tp1"]
+    # commit starts over
+    manifest.commit()
+    assert list(json.loads((out_dir / "_manifest_prepare_flair.json").read_text())) == ["sub-01_ses-tp1"]
+
+
+def test_shards_read_other_shards_manifests(tmp_path):
+    out_dir = tmp_path / "out"
+    out_files = {s: write(out_dir / f"sub-{s}" / "ses-tp1" / "anat" / f"sub-{s}_ses-tp1_FLAIR.nii.gz")
+                 for s in ["01", "02"]}
+    CompletionManifest(out_dir, "prepare_flair", shard="1/2").record([out_files["01"]])
+    shard_2 = CompletionManifest(out_dir, "prepare_flair", shard="2/2")
+    assert shard_2.is_complete("01", "tp1")
+    shard_2.record([out_files["02"]])
+    # each shard writes only its own records
+    assert list(json.loads((out_dir / "_manifest_prepare_flair_shard-1of2.json").read_text())) == ["sub-01_ses-tp1"]
+    assert list(json.loads((out_dir / "_manifest_prepare_flair_shard-2of2.json").read_text())) == ["sub-02_ses-tp1"]
+    # unsharded runs see the shards' records
+    assert CompletionManifest(out_dir, "prepare_flair").pending([("01", "tp1"), ("02", "tp1")]) == []
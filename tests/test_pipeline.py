@@ -0,0 +1,53 @@
+import sys
+
+import pytest
+
+from bianca import utils
+from bianca.pipeline import Pipeline, load_config
+
+CONFIG = {"bids_dir": "/data/sourcedata", "base_dir": "/data/out", "n_cpu": 2,
+          "stages": {"t1w": {"shard_size": 2, "exclude_sessions": [["01", "tp2"], "03"]}}}
+SESSIONS = [("01", "tp1"), ("01", "tp2"), ("02", "tp1"), ("03", "tp1"), ("03", "tp2")]
+
+
+@pytest.fixture
+def pipeline(monkeypatch):
+    monkeypatch.setattr(utils, "get_subject_sessions", lambda bids_dir, acq: list(SESSIONS))
+    return Pipeline(CONFIG)
+
+
+def test_exclude_sessions(pipeline):
+    assert pipeline.subjects_sessions(stage="t1w") == [("01", "tp1"), ("02", "tp1")]
+    assert pipeline.subjects_sessions(stage="flair") == SESSIONS
+    assert pipeline.subjects_sessions() == SESSIONS
+    assert pipeline.options("t1w") == {"n_cpu": 2, "shard_size": 2}
+
+
+TOML = """
+bids_dir = "/data/sourcedata"
+base_dir = "/data/out"
+n_cpu = 2
+
+[stages.t1w]
+shard_size = 2
+exclude_sessions = [["01", "tp2"], "03"]
+"""
+
+
+def test_load_toml_config(tmp_path):
+    if sys.version_info < (3, 11):
+        pytest.importorskip("tomli")
+    (tmp_path / "config.toml").write_text(TOML)
+    assert load_config(tmp_path / "config.toml") == CONFIG
+
+
+def test_load_toml_config_tomli(tmp_path, monkeypatch):
+    # python < 3.11: tomli has the same interface
+    tomllib = pytest.importorskip("tomllib")
+    monkeypatch.setitem(sys.modules, "tomllib", None)
+    monkeypatch.setitem(sys.modules, "tomli", tomllib)
+    (tmp_path / "config.toml").write_text(TOML)
+    assert load_config(tmp_path / "config.toml") == CONFIG
+    monkeypatch.setitem(sys.modules, "tomli", None)
+    with pytest.raises(ImportError, match="tomli"):
+        load_config(tmp_path / "config.toml")
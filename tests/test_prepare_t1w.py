@@ -0,0 +1,57 @@
+from pathlib import Path
+
+import numpy as np
+import nibabel as nb
+import pytest
+
+pytest.importorskip("niworkflows")
+from nipype.utils.functions import create_function_from_source
+from bianca.workflows.prepare_t1w import find_smriprep_affines, init_t1w_tpl_space_wf
+
+ITK_IDENTITY = """#Insight Transform File V1.0
+#Transform 0
+Transform: MatrixOffsetTransformBase_double_3_3
+Parameters: 1 0 0 0 1 0 0 0 1 0 0 0
+FixedParameters: 0 0 0
+"""
+
+# smriprep < 0.6, >= 0.6
+AFFINE_NAMES = {"space-orig": "sub-01_ses-tp1_{run}_T1w_space-orig_target-T1w_affine.txt",
+                "from-orig": "sub-01_ses-tp1_{run}_from-orig_to-T1w_mode-image_xfm.txt"}
+
+
+def test_find_smriprep_affines(tmp_path):
+    anat = tmp_path / "sub-01" / "ses-tp1" / "anat"
+    anat.mkdir(parents=True)
+    for f in [AFFINE_NAMES["space-orig"].format(run="run-1"), AFFINE_NAMES["from-orig"].format(run="run-2"),
+              "sub-01_ses-tp1_from-T1w_to-MNI152NLin6Asym_mode-image_xfm.h5"]:
+        (anat / f).write_text(ITK_IDENTITY)
+    assert sorted(Path(f).name for f in find_smriprep_affines(tmp_path, "01", "tp1")) == [
+        AFFINE_NAMES["space-orig"].format(run="run-1"), AFFINE_NAMES["from-orig"].format(run="run-2")]
+
+
+@pytest.mark.parametrize("scheme", AFFINE_NAMES)
+def test_check_matches_run_affine(tmp_path, monkeypatch, scheme):
+    monkeypatch.chdir(tmp_path)
+    check = create_function_from_source(init_t1w_tpl_space_wf().get_node("check").inputs.function_str)
+    data = np.random.default_rng(0).random((8, 8, 8)).astype(np.float32)
+    for name in ["in", "reference", "brainmask"]:
+        nb.Nifti1Image(np.ones_like(data) if name == "brainmask" else data, np.eye(4)).to_filename(
+            str(tmp_path / f"{name}.nii.gz"))
+    xfms = {run: tmp_path / AFFINE_NAMES[scheme].format(run=run) for run in ["run-1", "run-10"]}
+    xfms["run-1"].write_text(ITK_IDENTITY)
+    # run-10's affine would send run-1 to FLIRT
+    xfms["run-10"].write_text("not an ITK transform")
+
+    out_file, out_matrix_file, needs_flirt, corr = check(
+        str(tmp_path / "in.nii.gz"), "/bids/sub-01/ses-tp1/anat/sub-01_ses-tp1_run-1_T1w.nii.gz",
+        [str(xfms["run-10"]), str(xfms["run-1"])], str(tmp_path / "reference.nii.gz"),
+        str(tmp_path / "brainmask.nii.gz"), 0.9, ".nii.gz")
+    assert not needs_flirt
+    assert corr == pytest.approx(1)
+    np.testing.assert_allclose(np.loadtxt(out_matrix_file), np.eye(4), atol=1e-8)
+
+    # no affine of the run: FLIRT
+    assert check(str(tmp_path / "in.nii.gz"), "/bids/sub-01/ses-tp1/anat/sub-01_ses-tp1_run-2_T1w.nii.gz",
+                 [str(x) for x in xfms.values()], str(tmp_path / "reference.nii.gz"),
+                 str(tmp_path / "brainmask.nii.gz"), 0.9, ".nii.gz")[2]
@@ -0,0 +1,75 @@
+import numpy as np
+import nibabel as nb
+import pytest
+
+from bianca.regions import distance_bands, ventricle_distance_regions
+
+CUTOFFS = (3, 5, 10, 20)
+
+
+def fsl_thr(x, t):
+    """fslmaths -thr t: zero anything below t"""
+    return np.where(x < t, 0, x)
+
+
+def fsl_uthr(x, t):
+    """fslmaths -uthr t: zero anything above t"""
+    return np.where(x > t, 0, x)
+
+
+def fsl_bin(x):
+    """fslmaths -bin: use (current image>0) to binarise"""
+    return (x > 0).astype(np.float32)
+
+
+@pytest.fixture
+def distance():
+    # integer distances (1 mm voxels) hit every cutoff exactly, half-voxel offsets lie between them
+    d = np.concatenate([np.arange(0, 26, dtype=np.float32), np.arange(0, 26, dtype=np.float32) + .5])
+    return np.tile(d.reshape(-1, 1, 1), (1, 3, 2))
+
+
+@pytest.fixture
+def brainmask(distance):
+    mask = np.ones(distance.shape, bool)
+    mask[:, 0] = False
+    return mask
+
+
+def test_bands_match_chained_uthr(distance, brainmask):
+    bands = distance_bands(distance, brainmask, CUTOFFS)
+    lower = np.zeros(distance.shape, bool)
+    for i, c in enumerate(CUTOFFS, start=1):
+        upto = fsl_bin(fsl_uthr(distance, c)).astype(bool) & brainmask
+        # band i: -uthr c_i -bin minus -uthr c_(i-1) -bin, i.e. a voxel exactly on a cutoff is in the lower band
+        np.testing.assert_array_equal(bands == i, upto & ~lower)
+        lower = upto
+    np.testing.assert_array_equal(bands == len(CUTOFFS) + 1, (distance > CUTOFFS[-1]) & brainmask)
+    assert not bands[~brainmask].any()
+    assert not bands[distance == 0].any()
+
+
+def test_bands_ignore_cutoff_order(distance, brainmask):
+    np.testing.assert_array_equal(distance_bands(distance, brainmask, CUTOFFS),
+                                  distance_bands(distance, brainmask, CUTOFFS[::-1]))
+
+
+@pytest.mark.parametrize("cutoff", [5, 10, 7.5])
+def test_regions_match_fslmaths(tmp_path, distance, brainmask, cutoff):
+    affine = np.diag([1., 1., 1., 1.])
+    nb.Nifti1Image(distance, affine).to_filename(str(tmp_path / "distancemap.nii.gz"))
+    nb.Nifti1Image(brainmask.astype(np.uint8), affine).to_filename(str(tmp_path / "brainmask.nii.gz"))
+    bands_file, perivent_file, deepwm_file = ventricle_distance_regions(
+        tmp_path / "distancemap.nii.gz", tmp_path / "brainmask.nii.gz", tmp_path, cutoffs=(cutoff,),
+        perivent_cutoff=cutoff)
+
+    # baseline: fslmaths distancemap -uthr/-thr cutoff -bin, then fslmaths -mas brainmask
+    perivent = fsl_bin(fsl_uthr(distance, cutoff)) * brainmask
+    deepwm = fsl_bin(fsl_thr(distance, cutoff)) * brainmask
+    np.testing.assert_array_equal(nb.load(perivent_file).get_fdata(), perivent)
+    np.testing.assert_array_equal(nb.load(deepwm_file).get_fdata(), deepwm)
+
+    bands = np.asanyarray(nb.load(bands_file).dataobj)
+    np.testing.assert_array_equal(bands == 1, perivent.astype(bool))
+    # voxels exactly on the cutoff are in both fslmaths masks, but only in the lower band
+    np.testing.assert_array_equal(bands == 2, deepwm.astype(bool) & (distance != cutoff))
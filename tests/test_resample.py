@@ -0,0 +1,216 @@
+import numpy as np
+import nibabel as nb
+import pytest
+
+from bianca.resample import (fsl_voxel_to_mm, reference_to_input_coords, apply_xfm, itk_field_to_fsl_warp,
+                             itk_field_to_flirt_matrix, read_itk_affine, itk_affine_to_flirt_matrix,
+                             masked_correlation)
+
+SHAPE = (12, 10, 8)
+
+# x axis flipped (radiological, negative determinant) or not (neurological, positive determinant)
+AFFINES = {"LAS": np.diag([-1., 1., 1., 1.]), "RAS": np.diag([1., 1., 1., 1.])}
+
+
+def translation(x):
+    xfm = np.eye(4)
+    xfm[0, 3] = x
+    return xfm
+
+
+def image(affine, shape=SHAPE, zooms=(1., 1., 1.), dtype=np.float32):
+    data = np.arange(np.prod(shape), dtype=dtype).reshape(shape)
+    affine = affine.copy()
+    affine[:3, :3] = affine[:3, :3] * np.array(zooms)
+    return nb.Nifti1Image(data, affine)
+
+
+@pytest.mark.parametrize("orient", AFFINES)
+def test_fsl_voxel_to_mm(orient):
+    img = image(AFFINES[orient], zooms=(2., 1., 3.))
+    corners = np.array([[0, 0, 0, 1], [SHAPE[0] - 1, 0, 0, 1]]).T
+    x = (fsl_voxel_to_mm(img) @ corners)[0]
+    # fsl's x coordinate grows from the image's left to its right (radiological voxel order)
+    assert list(x) == ([0, 2 * (SHAPE[0] - 1)] if orient == "LAS" else [2 * (SHAPE[0] - 1), 0])
+
+
+@pytest.mark.parametrize("orient, shift", [("LAS", 2), ("RAS", -2)])
+def test_translation(orient, shift):
+    # flirt matrix moving the input by +2 fsl mm in x: reference voxel i samples input voxel i - 2 in fsl voxel order,
+    # which is i + 2 in stored voxel order for images with a positive determinant
+    img = image(AFFINES[orient])
+    coords = reference_to_input_coords(img, img, translation(2)).reshape((3,) + SHAPE)
+    ijk = np.indices(SHAPE)
+    np.testing.assert_allclose(coords[0], ijk[0] - shift)
+    np.testing.assert_allclose(coords[1:], ijk[1:])
+
+
+@pytest.mark.parametrize("orient", AFFINES)
+def test_scaling(orient):
+    # identity matrix from a 1 mm input to a 2 mm reference: reference voxel i is at fsl mm 2 * i
+    in_img = image(AFFINES[orient])
+    ref_img = image(AFFINES[orient], shape=(6, 5, 4), zooms=(2., 2., 2.))
+    coords = reference_to_input_coords(in_img, ref_img, np.eye(4)).reshape((3, 6, 5, 4))
+    ijk = np.indices((6, 5, 4))
+    x = 2 * ijk[0] if orient == "LAS" else SHAPE[0] - 1 - 2 * (5 - ijk[0])
+    np.testing.assert_allclose(coords[0], x)
+    np.testing.assert_allclose(coords[1:], 2 * ijk[1:])
+
+
+@pytest.mark.parametrize("orient", AFFINES)
+def test_apply_xfm(tmp_path, orient):
+    flair = image(AFFINES[orient])
+    labels = image(AFFINES[orient], dtype=np.int16)
+    mask = nb.Nifti1Image((np.indices(SHAPE)[1] > 4).astype(np.uint8), flair.affine)
+    in_files = {}
+    for name, img in dict(flair=flair, labels=labels, mask=mask).items():
+        in_files[name] = tmp_path / f"{name}.nii.gz"
+        img.to_filename(str(in_files[name]))
+    np.savetxt(str(tmp_path / "xfm.mat"), translation(2))
+    out_files = {name: tmp_path / "out" / f"{name}.nii.gz" for name in in_files}
+    apply_xfm(in_files, in_files["flair"], tmp_path / "xfm.mat",
+              dict(flair="trilinear", labels="nearestneighbour", mask="nearestneighbour"), out_files,
+              mask_file="mask", masked=("flair",))
+
+    expected = np.zeros(SHAPE, np.float32)
+    src = slice(0, SHAPE[0] - 2) if orient == "LAS" else slice(2, SHAPE[0])
+    dst = slice(2, SHAPE[0]) if orient == "LAS" else slice(0, SHAPE[0] - 2)
+    expected[dst] = flair.get_fdata()[src]
+    out = {name: nb.load(str(f)) for name, f in out_files.items()}
+    np.testing.assert_array_equal(out["labels"].get_fdata(), expected)
+    assert out["labels"].get_data_dtype() == np.int16
+    mask_out = np.asanyarray(out["mask"].dataobj) != 0
+    np.testing.assert_array_equal(mask_out[dst], np.asanyarray(mask.dataobj)[src] != 0)
+    np.testing.assert_allclose(out["flair"].get_fdata(), expected * mask_out, atol=1e-4)
+    np.testing.assert_array_equal(out["flair"].affine, flair.affine)
+
+
+def itk_field(tmp_path, ref_img, world_xfm):
+    """ITK displacement field (LPS vectors, 5D like antsApplyTransforms writes them) on ref_img's grid of
+    world_xfm (RAS mm, reference -> input points)"""
+    ijk = np.indices(ref_img.shape + (1,)).reshape(4, -1)
+    ijk[3] = 1
+    world = ref_img.affine @ ijk
+    d = ((world_xfm @ world - world)[:3] * np.array([[-1], [-1], [1]])).T.reshape(ref_img.shape + (1, 3))
+    img = nb.Nifti1Image(d.astype(np.float32), ref_img.affine)
+    img.header.set_intent("vector")
+    img.to_filename(str(tmp_path / "field.nii.gz"))
+    return tmp_path / "field.nii.gz"
+
+
+@pytest.mark.parametrize("orient", AFFINES)
+def test_itk_field_to_fsl_warp_translation(tmp_path, orient):
+    img = image(AFFINES[orient])
+    img.to_filename(str(tmp_path / "in.nii.gz"))
+    # +2 mm in RAS x, i.e. -2 in fsl's x (radiological) for both orientations
+    field = itk_field(tmp_path, img, translation(2))
+    itk_field_to_fsl_warp(field, tmp_path / "in.nii.gz", tmp_path / "warp.nii.gz")
+    warp = nb.load(str(tmp_path / "warp.nii.gz"))
+    assert warp.header["intent_code"] == 2006
+    np.testing.assert_array_equal(warp.affine, img.affine)
+    data = warp.get_fdata()
+    assert data.shape == SHAPE + (3,)
+    np.testing.assert_allclose(data[..., 0], -2, atol=1e-5)
+    np.testing.assert_allclose(data[..., 1:], 0, atol=1e-5)
+
+
+@pytest.mark.parametrize("orient", AFFINES)
+def test_itk_field_to_flirt_matrix(tmp_path, orient):
+    # field on a 1 mm grid, input on a 2 mm grid; scaling and translation in RAS mm
+    ref_img = image(AFFINES[orient])
+    in_img = image(AFFINES[orient], shape=(6, 5, 4), zooms=(2., 2., 2.))
+    in_img.to_filename(str(tmp_path / "in.nii.gz"))
+    world_xfm = np.diag([1.5, 1., .8, 1.]) @ translation(3)
+    world_xfm[1:3, 3] = [-1, 2]
+    field = itk_field(tmp_path, ref_img, world_xfm)
+    mask = nb.Nifti1Image((np.indices(SHAPE)[2] > 3).astype(np.uint8), ref_img.affine)
+    mask.to_filename(str(tmp_path / "mask.nii.gz"))
+
+    itk_field_to_flirt_matrix(field, tmp_path / "in.nii.gz", tmp_path / "mask.nii.gz", tmp_path / "xfm.mat")
+    expected = fsl_voxel_to_mm(in_img) @ np.linalg.inv(in_img.affine) @ world_xfm @ ref_img.affine @ \
+        np.linalg.inv(fsl_voxel_to_mm(ref_img))
+    np.testing.assert_allclose(np.loadtxt(tmp_path / "xfm.mat"), expected, atol=1e-4)
+    # fsl mm are scaled like the world, up to the x flip
+    np.testing.assert_allclose(np.diag(expected)[:3], [1.5, 1., .8])
+
+    # the warp of the same field is the matrix's displacement
+    itk_field_to_fsl_warp(field, tmp_path / "in.nii.gz", tmp_path / "warp.nii.gz")
+    ref_mm = fsl_voxel_to_mm(ref_img) @ np.vstack([np.indices(SHAPE).reshape(3, -1), np.ones((1, np.prod(SHAPE)))])
+    displacement = (expected @ ref_mm - ref_mm)[:3].T.reshape(SHAPE + (3,))
+    np.testing.assert_allclose(nb.load(str(tmp_path / "warp.nii.gz")).get_fdata(), displacement, atol=1e-4)
+
+
+# rotation by 90 degrees around z (LPS), translation (LPS mm) and center of rotation
+ROTATION = np.array([[0., -1., 0.], [1., 0., 0.], [0., 0., 1.]])
+ITK_TRANSLATION = np.array([2., -1., 3.])
+CENTER = np.array([10., -20., 5.])
+
+
+def itk_affine(path, a=ROTATION, t=ITK_TRANSLATION, center=CENTER):
+    path.write_text("#Insight Transform File V1.0\n#Transform 0\nTransform: AffineTransform_double_3_3\n"
+                    f"Parameters: {' '.join(map(str, list(a.ravel()) + list(t)))}\n"
+                    f"FixedParameters: {' '.join(map(str, center))}\n")
+    return path
+
+
+def test_read_itk_affine(tmp_path):
+    xfm = read_itk_affine(itk_affine(tmp_path / "affine.txt"))
+    lps = np.diag([-1., -1., 1.])
+    # ITK: fixed point p (LPS) -> moving point a @ (p - center) + center + t
+    for p in [CENTER, CENTER + [1, 0, 0], np.array([0., 0., 0.])]:
+        moving = ROTATION @ (p - CENTER) + CENTER + ITK_TRANSLATION
+        np.testing.assert_allclose(xfm @ np.append(lps @ p, 1), np.append(lps @ moving, 1), atol=1e-12)
+
+    (tmp_path / "composite.txt").write_text((tmp_path / "affine.txt").read_text() * 2)
+    with pytest.raises(ValueError, match="not a single 3D affine"):
+        read_itk_affine(tmp_path / "composite.txt")
+
+
+@pytest.mark.parametrize("orient", AFFINES)
+def test_itk_affine_to_flirt_matrix_translation(tmp_path, orient):
+    # 2 mm to the left (LPS x) of the fixed point: the input is shifted by +2 fsl mm in x relative to the reference,
+    # whatever the center
+    img = image(AFFINES[orient])
+    img.to_filename(str(tmp_path / "img.nii.gz"))
+    xfm_file = itk_affine(tmp_path / "affine.txt", a=np.eye(3), t=np.array([2., 0., 0.]))
+    itk_affine_to_flirt_matrix(xfm_file, tmp_path / "img.nii.gz", tmp_path / "img.nii.gz", tmp_path / "xfm.mat")
+    np.testing.assert_allclose(np.loadtxt(tmp_path / "xfm.mat"), translation(-2), atol=1e-8)
+
+
+@pytest.mark.parametrize("orient", AFFINES)
+def test_itk_affine_to_flirt_matrix(tmp_path, orient):
+    in_img = image(AFFINES[orient], zooms=(1., 1.5, 2.))
+    ref_img = image(AFFINES[orient] @ translation(-3), shape=(6, 5, 4), zooms=(2., 2., 2.))
+    for name, img in dict(in_file=in_img, reference=ref_img).items():
+        img.to_filename(str(tmp_path / f"{name}.nii.gz"))
+    xfm_file = itk_affine(tmp_path / "affine.txt")
+    itk_affine_to_flirt_matrix(xfm_file, tmp_path / "in_file.nii.gz", tmp_path / "reference.nii.gz",
+                               tmp_path / "xfm.mat")
+    matrix = np.loadtxt(tmp_path / "xfm.mat")
+    # reference voxel -> (ITK affine, RAS mm) -> input voxel, and the flirt matrix from input to reference fsl mm
+    ref_to_in_voxels = np.linalg.inv(in_img.affine) @ read_itk_affine(xfm_file) @ ref_img.affine
+    np.testing.assert_allclose(matrix, fsl_voxel_to_mm(ref_img) @ np.linalg.inv(ref_to_in_voxels) @
+                               np.linalg.inv(fsl_voxel_to_mm(in_img)), atol=1e-8)
+    # rigid in mm
+    np.testing.assert_allclose(np.abs(np.linalg.det(matrix[:3, :3])), 1, atol=1e-8)
+    # the reference's center voxel samples the input where the ITK affine maps its center
+    ijk = np.array([3., 2., 2., 1.])
+    in_mm = np.linalg.inv(matrix) @ fsl_voxel_to_mm(ref_img) @ ijk
+    lps = np.diag([-1., -1., 1., 1.])
+    moving = lps @ np.append(ROTATION @ ((lps @ ref_img.affine @ ijk)[:3] - CENTER) + CENTER + ITK_TRANSLATION, 1)
+    np.testing.assert_allclose(in_img.affine @ np.linalg.inv(fsl_voxel_to_mm(in_img)) @ in_mm, moving, atol=1e-8)
+
+
+def test_masked_correlation(tmp_path):
+    data = np.random.default_rng(0).random(SHAPE).astype(np.float32)
+    inside = np.indices(SHAPE)[0] < 6
+    files = {}
+    # outside of the mask: unrelated values
+    for name, values in dict(a=data, same=np.where(inside, data, 0), negated=np.where(inside, -data, 5),
+                             constant=np.where(inside, 1, data), mask=inside.astype(np.uint8)).items():
+        files[name] = tmp_path / f"{name}.nii.gz"
+        nb.Nifti1Image(values, np.eye(4)).to_filename(str(files[name]))
+    assert masked_correlation(files["a"], files["same"], files["mask"]) == pytest.approx(1)
+    assert masked_correlation(files["a"], files["negated"], files["mask"]) == pytest.approx(-1)
+    assert masked_correlation(files["a"], files["constant"], files["mask"]) == 0
+    assert masked_correlation(files["a"], files["same"], files["a"]) < 1
@@ -0,0 +1,42 @@
+from nipype.interfaces.base.support import InterfaceResult, Bunch
+from nipype.interfaces.fsl import BET, FLIRT
+from nipype.utils.filemanip import savepkl
+
+from bianca.runtime_report import load_runtimes, summarize, critical_path
+
+
+def result_file(wd_dir, node_dir, interface, start, end, duration, inputs=None, mem_peak_gb=None):
+    node_dir = wd_dir / node_dir
+    node_dir.mkdir(parents=True)
+    runtime = Bunch(startTime=start, endTime=end, duration=duration, hostname="host", mem_peak_gb=mem_peak_gb)
+    savepkl(str(node_dir / f"result_{node_dir.name}.pklz"),
+            InterfaceResult(interface, runtime, inputs={k: str(wd_dir / v) for k, v in (inputs or {}).items()}))
+
+
+def test_runtime_report(tmp_path):
+    wd_dir = tmp_path / "wd"
+    sub01, sub02 = "wf/_session_tp1_subject_01", "wf/_session_tp1_subject_02"
+    # isoformat() without microseconds if they are 0
+    result_file(wd_dir, f"{sub01}/bet", BET, "2024-01-01T10:00:00+00:00", "2024-01-01T10:01:00+00:00", 60.,
+                mem_peak_gb=1.5)
+    result_file(wd_dir, f"{sub01}/flirt", FLIRT, "2024-01-01T10:01:00.500000+00:00",
+                "2024-01-01T10:01:50.500000+00:00", 50., inputs={"in_file": f"{sub01}/bet/brain.nii.gz"})
+    result_file(wd_dir, f"{sub02}/bet", BET, "2024-01-01T10:00:00.250000+00:00", "2024-01-01T10:01:40.250000+00:00",
+                100., mem_peak_gb=2.)
+
+    df = load_runtimes(wd_dir)
+    assert df.node.tolist() == [f"{sub01}/bet", f"{sub02}/bet", f"{sub01}/flirt"]
+    assert df.subject.tolist() == ["sub-01_ses-tp1", "sub-02_ses-tp1", "sub-01_ses-tp1"]
+    assert str(df.start.dt.tz) == "UTC"
+    assert (df.end - df.start).dt.total_seconds().tolist() == [60, 100, 50]
+
+    by_interface, by_subject = summarize(df)
+    assert by_interface.loc["BET", "n"] == 2 and by_interface.loc["BET", "max_s"] == 100
+    assert by_interface.loc["BET", "peak_rss_gb"] == 2
+    assert by_subject.loc["sub-01_ses-tp1", "wall_h"] * 3600 == 110.5
+    assert by_subject.loc["sub-01_ses-tp1", "total_h"] * 3600 == 110
+
+    # bet -> flirt of sub-01 (file dependency) is longer than bet of sub-02
+    path = critical_path(df, wd_dir)
+    assert path.node.tolist() == [f"{sub01}/bet", f"{sub01}/flirt"]
+    assert path.cumulative_s.tolist() == [60, 110]
@@ -0,0 +1,181 @@
+import os
+import sys
+import json
+import random
+import subprocess
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+from bianca.shards import make_shards, assign_shards, select_shard, merge_tables, merge_shards, plan_file
+
+
+def test_make_shards():
+    assert make_shards(range(5), 2) == [[0, 1], [2, 3], [4]]
+    assert make_shards(range(5)) == [[0, 1, 2, 3, 4]]
+    assert make_shards([], 2) == []
+
+
+def test_assign_shards_lpt():
+    # a: 5 -> shard 0, b: 4 -> shard 1, c: 3 -> shard 1 (4 < 5), d: 3 -> shard 0 (5 < 7), e: 3 -> shard 1 (7 < 8)
+    items = ["e", "c", "a", "d", "b"]
+    costs = [3, 3, 5, 3, 4]
+    assert assign_shards(items, 2, costs) == [["a", "d"], ["b", "c", "e"]]
+
+
+def test_assign_shards_deterministic():
+    rng = random.Random(0)
+    items = [(f"{s:02d}", ses) for s in range(30) for ses in ("tp1", "tp2")]
+    costs = {item: rng.choice([1, 2, 3, 10]) for item in items}
+    expected = assign_shards(items, 4, [costs[item] for item in items])
+    for _ in range(5):
+        rng.shuffle(items)
+        assert assign_shards(items, 4, [costs[item] for item in items]) == expected
+    assert sorted(item for shard in expected for item in shard) == sorted(items)
+    totals = [sum(costs[item] for item in shard) for shard in expected]
+    assert max(totals) - min(totals) <= max(costs.values())
+
+
+def test_assign_shards_more_shards_than_items():
+    assert assign_shards(["01", "02"], 3) == [["01"], ["02"], []]
+
+
+def write_table(f, rows):
+    pd.DataFrame(rows, columns=["subject", "session", "volume"]).to_csv(f, sep="\t", index=False)
+
+
+def test_merge_tables(tmp_path):
+    write_table(tmp_path / "volumes.tsv", [["01", "01", 1.], ["02", "01", 2.]])
+    write_table(tmp_path / "volumes_shard-1of2.tsv", [["02", "01", 20.]])
+    write_table(tmp_path / "volumes_shard-2of2.tsv", [["03", "01", 30.]])
+    df = merge_tables(tmp_path, "volumes")
+    assert not list(tmp_path.glob("volumes_shard-*.tsv"))
+    merged = pd.read_csv(tmp_path / "volumes.tsv", sep="\t", dtype={"subject": str, "session": str})
+    pd.testing.assert_frame_equal(merged, df)
+    # zero padded ids are kept, rows of re-run sessions replace the previous ones
+    assert sorted(zip(merged.subject, merged.session, merged.volume)) == \
+        [("01", "01", 1.), ("02", "01", 20.), ("03", "01", 30.)]
+    assert merge_tables(tmp_path, "volumes") is None
+
+
+def run_shards_of(tmp_path, items, n, record=lambda i, key: True):
+    for i in range(1, n + 1):
+        shard_items, wd_dir, crash_dir = select_shard(tmp_path, "flair", items, f"{i}/{n}", tmp_path / "wd",
+                                                      tmp_path / "crash")
+        assert wd_dir == tmp_path / "wd" / f"shard-{i}of{n}"
+        entries = {f"sub-{s}_ses-{ses}": {} for s, ses in shard_items if record(i, f"sub-{s}_ses-{ses}")}
+        (tmp_path / f"_manifest_flair_shard-{i}of{n}.json").write_text(json.dumps(entries))
+
+
+def test_merge_shards(tmp_path):
+    items = [(f"{s:02d}", "tp1") for s in range(7)]
+    run_shards_of(tmp_path, items, 3)
+    report = merge_shards(tmp_path, "flair")
+    assert (report.status == "done").all() and len(report) == 7
+    assert set(json.loads((tmp_path / "_manifest_flair.json").read_text())) == set(report.session)
+    assert not list(tmp_path.glob("_manifest_flair_shard-*.json"))
+    assert not list((tmp_path / "_shards" / "flair").glob("*.json"))
+
+
+def test_merge_shards_missing(tmp_path):
+    items = [(f"{s:02d}", "tp1") for s in range(7)]
+    run_shards_of(tmp_path, items, 3, record=lambda i, key: key != "sub-03_ses-tp1")
+    report = merge_shards(tmp_path, "flair")
+    assert report.set_index("session").status.to_dict()["sub-03_ses-tp1"] == "missing"
+    # nothing is merged or removed until all sessions are done
+    assert not (tmp_path / "_manifest_flair.json").exists()
+    assert len(list(tmp_path.glob("_manifest_flair_shard-*.json"))) == 3
+
+
+def test_merge_shards_inconsistent_plans(tmp_path):
+    items = [(f"{s:02d}", "tp1") for s in range(7)]
+    run_shards_of(tmp_path, items, 3)
+    plan_file(tmp_path, "flair", "2/3").unlink()
+    with pytest.raises(RuntimeError, match="have not run"):
+        merge_shards(tmp_path, "flair")
+    select_shard(tmp_path, "flair", items, "2/4", tmp_path / "wd", tmp_path / "crash")
+    with pytest.raises(RuntimeError, match="different shard counts"):
+        merge_shards(tmp_path, "flair")
+
+
+def test_merge_shards_assignment_differs(tmp_path):
+    items = [(f"{s:02d}", "tp1") for s in range(7)]
+    costs = [1, 2, 3, 4, 5, 6, 7]
+    for i, c in [(1, costs), (2, costs[::-1]), (3, costs)]:
+        select_shard(tmp_path, "flair", items, f"{i}/3", tmp_path / "wd", tmp_path / "crash", costs=c)
+    with pytest.raises(RuntimeError, match="assigned to shards|in no shard"):
+        merge_shards(tmp_path, "flair")
+
+    # a host that saw fewer sessions
+    select_shard(tmp_path, "flair", items[:-1], "2/3", tmp_path / "wd", tmp_path / "crash", costs=costs[:-1])
+    with pytest.raises(RuntimeError, match="different numbers of items"):
+        merge_shards(tmp_path, "flair")
+
+
+def test_merge_shards_in_no_shard(tmp_path):
+    items = [(f"{s:02d}", "tp1") for s in range(4)]
+    run_shards_of(tmp_path, items, 2)
+    plan = json.loads(plan_file(tmp_path, "flair", "2/2").read_text())
+    plan["sessions"] = plan["sessions"][1:]
+    plan_file(tmp_path, "flair", "2/2").write_text(json.dumps(plan))
+    with pytest.raises(RuntimeError, match="plans assign 3 of 4 items, 1 are in no shard"):
+        merge_shards(tmp_path, "flair")
+
+
+# one host of a sharded stage run: select_shard, skip complete sessions, "process" and record the shard's sessions
+SHARD_SCRIPT = """
+import sys
+from pathlib import Path
+from bianca.dataset_index import get_dataset_index
+from bianca.manifest import CompletionManifest
+from bianca.shards import select_shard, input_size_costs
+
+bids_dir, out_dir, shard = Path(sys.argv[1]), Path(sys.argv[2]), sys.argv[3]
+get_dataset_index(bids_dir)
+items = [(d.name[4:], "tp1") for d in sorted(bids_dir.glob("sub-*"))]
+shard_items, wd_dir, _ = select_shard(out_dir, "flair", items, shard, out_dir / "wd", out_dir / "crash",
+                                      costs=input_size_costs(bids_dir, items))
+manifest = CompletionManifest(out_dir, "flair", params={"flair_acq": "2D"}, shard=shard)
+out_files = []
+for subject, session in manifest.pending(shard_items):
+    out_file = out_dir / f"sub-{subject}" / f"ses-{session}" / "anat" / f"sub-{subject}_ses-{session}_FLAIR.nii.gz"
+    out_file.parent.mkdir(parents=True, exist_ok=True)
+    out_file.write_text(wd_dir.name)
+    out_files.append(out_file)
+manifest.record(out_files)
+"""
+
+
+def run_hosts(bids_dir, out_dir, n):
+    env = dict(os.environ, PYTHONPATH=str(Path(__file__).parent.parent), BIANCA_INDEX_DIR=str(out_dir / "index"))
+    procs = [subprocess.Popen([sys.executable, "-c", SHARD_SCRIPT, str(bids_dir), str(out_dir), f"{i}/{n}"], env=env,
+                              stdout=subprocess.PIPE, stderr=subprocess.STDOUT) for i in range(1, n + 1)]
+    for p in procs:
+        out, _ = p.communicate(timeout=120)
+        assert p.returncode == 0, out.decode()
+
+
+def test_shards_in_processes(tmp_path):
+    bids_dir, out_dir, n = tmp_path / "bids", tmp_path / "out", 3
+    for s in range(10):
+        anat = bids_dir / f"sub-{s:02d}" / "ses-tp1" / "anat"
+        anat.mkdir(parents=True)
+        (anat / f"sub-{s:02d}_ses-tp1_FLAIR.nii.gz").write_bytes(b"0" * (100 * (s % 4 + 1)))
+    run_hosts(bids_dir, out_dir, n)
+
+    report = merge_shards(out_dir, "flair")
+    assert len(report) == 10 and (report.status == "done").all()
+    manifest = json.loads((out_dir / "_manifest_flair.json").read_text())
+    assert sorted(manifest) == [f"sub-{s:02d}_ses-tp1" for s in range(10)]
+    # each session was processed by the shard it is assigned to
+    for row in report.itertuples():
+        out_file, = manifest[row.session]["outputs"]
+        assert Path(out_file).read_text() == f"shard-{row.shard}of{n}"
+
+    # a second sharded run skips all sessions as complete, and merges again
+    run_hosts(bids_dir, out_dir, n)
+    shard_manifests = list(out_dir.glob("_manifest_flair_shard-*.json"))
+    assert len(shard_manifests) == n and all(not json.loads(f.read_text()) for f in shard_manifests)
+    report = merge_shards(out_dir, "flair")
+    assert (report.status == "previous").all()
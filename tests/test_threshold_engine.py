@@ -0,0 +1,106 @@
+import numpy as np
+import pandas as pd
+import nibabel as nb
+import pytest
+from scipy import ndimage
+
+from bianca.threshold_engine import threshold_lpm, threshold_session, overlap_sweep, cluster_stats
+
+THRESHOLDS = [0.1, 0.5, 0.9, 0.95]
+
+
+def save(data, path, zooms=(1., 1., 2.)):
+    img = nb.Nifti1Image(np.asarray(data), np.diag(list(zooms) + [1]))
+    img.to_filename(str(path))
+    return path
+
+
+@pytest.fixture
+def session(tmp_path):
+    rng = np.random.default_rng(0)
+    shape = (20, 22, 12)
+    lpm = ndimage.gaussian_filter(rng.random(shape), 1)
+    lpm = ((lpm - lpm.min()) / (lpm.max() - lpm.min())).astype(np.float32)
+    wm = np.zeros(shape, np.uint8)
+    wm[2:-2, 2:-2, 1:-1] = 1
+    deepwm = np.zeros(shape, np.uint8)
+    deepwm[:10] = 1
+    manual = (lpm > 0.7).astype(np.uint8)
+    manual[:, :5] = 0
+    anat = tmp_path / "in" / "sub-01" / "ses-tp1" / "anat"
+    anat.mkdir(parents=True)
+    prefix = anat / "sub-01_ses-tp1_acq-2D_run-1_FLAIR"
+    return dict(subject="01", session="tp1", bianca_lpm=save(lpm, f"{prefix}_LPM.nii.gz"),
+                wm_mask=save(wm, f"{prefix}_wm.nii.gz"), deepwm_mask=save(deepwm, f"{prefix}_deepwm.nii.gz"),
+                pervent_mask=save(1 - deepwm, f"{prefix}_pervent.nii.gz"),
+                manual_mask=save(manual, f"{prefix}_manual.nii.gz"))
+
+
+def data(f):
+    return np.asanyarray(nb.load(str(f)).dataobj)
+
+
+def test_threshold_lpm_matches_fslmaths_semantics(session):
+    lpm, wm = data(session["bianca_lpm"]), data(session["wm_mask"]) != 0
+    lpm_masked, bin_maps = threshold_lpm(session["bianca_lpm"], session["wm_mask"],
+                                         {"deepwm": session["deepwm_mask"]}, THRESHOLDS)
+    np.testing.assert_array_equal(lpm_masked.get_fdata(), lpm * wm)
+    bin_maps = list(bin_maps)
+    assert [t for t, _, _ in bin_maps] == THRESHOLDS
+    for threshold, bin_map, stats in bin_maps:
+        expected = (lpm * wm >= threshold) & (lpm * wm != 0)
+        np.testing.assert_array_equal(bin_map.get_fdata() != 0, expected)
+        _, n_total = ndimage.label(expected, structure=np.ones((3, 3, 3)))
+        total = next(s for s in stats if s["region"] == "total")
+        assert total["n_clusters"] == n_total
+        assert total["n_voxels"] == expected.sum()
+        assert total["volume_mm3"] == pytest.approx(expected.sum() * 2)
+        deepwm = next(s for s in stats if s["region"] == "deepwm")
+        assert deepwm["n_voxels"] == (expected & (data(session["deepwm_mask"]) != 0)).sum()
+
+
+def test_cluster_stats_connectivity_and_min_size():
+    bin_map = np.zeros((6, 6, 6), bool)
+    bin_map[1, 1, 1] = bin_map[2, 2, 2] = True  # corner neighbours: one cluster with 26-connectivity
+    bin_map[4:6, 4:6, 4] = True
+    assert cluster_stats(bin_map, 1.)["n_clusters"] == 2
+    s = cluster_stats(bin_map, 0.5, min_cluster_size=3)
+    assert (s["n_clusters"], s["n_voxels"], s["volume_mm3"]) == (1, 4, 2.)
+
+
+def test_threshold_session_outputs(session, tmp_path):
+    out_dir = tmp_path / "out"
+    files = {k: v for k, v in session.items() if k != "manual_mask"}
+    stats, out_files = threshold_session(out_dir, thresholds=THRESHOLDS, **files)
+    assert len(stats) == len(THRESHOLDS) * 3
+    assert all(f.is_file() for f in out_files)
+    table = [f for f in out_files if f.name.endswith("_FLAIR_clusterstats.tsv")]
+    assert len(table) == 1
+    pd.testing.assert_frame_equal(pd.read_csv(table[0], sep="\t"), stats.drop(columns=["subject", "session"]),
+                                  check_dtype=False)
+
+    # one bianca_cluster_stats output file per threshold and region, with the fsl engine's names
+    anat = out_dir / "sub-01" / "ses-tp1" / "anat"
+    for row in stats.itertuples():
+        suffix = {"total": "ClusterStatsTotal", "deepwm": "ClusterStatsdeepwm", "perventwm": "ClusterStatsperventwm"}
+        f = anat / f"sub-01_ses-tp1_acq-2D_run-1_FLAIR_desc-thresh{row.threshold}_{suffix[row.region]}.txt"
+        assert f in out_files
+        assert f.read_text().splitlines() == [f"Number of clusters = {row.n_clusters}",
+                                              f"Total volume (mm3) = {row.volume_mm3}"]
+    assert len([f for f in out_files if "_ClusterStats" in f.name]) == len(stats)
+
+
+def test_overlap_sweep_matches_per_threshold(session):
+    df = overlap_sweep(session["bianca_lpm"], session["wm_mask"], session["manual_mask"], THRESHOLDS)
+    lpm, wm, manual = data(session["bianca_lpm"]), data(session["wm_mask"]) != 0, data(session["manual_mask"]) != 0
+    lpm_masked = lpm * wm
+    labels, n_lesions = ndimage.label(manual, structure=np.ones((3, 3, 3)))
+    for threshold, row in zip(THRESHOLDS, df.itertuples()):
+        pred = (lpm_masked >= threshold) & (lpm_masked != 0)
+        tp = (pred & manual).sum()
+        assert row.n_voxels_pred == pred.sum()
+        assert row.dice == pytest.approx(2 * tp / (pred.sum() + manual.sum()))
+        assert row.fpr == pytest.approx((pred & ~manual).sum() / (wm & ~manual).sum())
+        detected = sum(pred[labels == i].any() for i in range(1, n_lesions + 1))
+        assert row.n_lesions_detected == detected
+        assert row.n_lesions_manual == n_lesions
@@ -0,0 +1,104 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from bianca.workdir import WorkDirManager, node_subject_key, subject_dirs, LARGE_FILE_BYTES
+
+
+def node(subject=None, hierarchy="wf"):
+    return SimpleNamespace(parameterization=[f"_subject_{subject}"] if subject else [], _hierarchy=hierarchy)
+
+
+def test_node_subject_key():
+    assert node_subject_key(node("01")) == "_subject_01"
+    assert node_subject_key(node(hierarchy="t1w_wf.sub_01_ses_tp1")) == "sub_01_ses_tp1"
+    assert node_subject_key(node()) is None
+    assert node_subject_key(node(hierarchy=None)) is None
+
+
+def test_admits_new_subjects_within_budget(tmp_path):
+    manager = WorkDirManager(tmp_path, max_gb=1e-6, check_interval=0)
+    assert manager.admits(node("01"))
+    (tmp_path / "big.nii").write_bytes(b"0" * 10000)
+    # started subjects and nodes outside subjects always run, new subjects wait
+    assert manager.admits(node("01"))
+    assert manager.admits(node(hierarchy=None))
+    assert not manager.admits(node("02"))
+    (tmp_path / "big.nii").unlink()
+    assert manager.admits(node("02"))
+
+
+def test_admits_after_max_wait(tmp_path):
+    manager = WorkDirManager(tmp_path, max_gb=1e-6, check_interval=0, max_wait=0.1)
+    (tmp_path / "big.nii").write_bytes(b"0" * 10000)
+    assert not manager.admits(node("01"))
+    time.sleep(0.2)
+    with pytest.warns(UserWarning, match="over disk budget"):
+        assert manager.admits(node("01"))
+    # the next new subject is held back again
+    assert not manager.admits(node("02"))
+
+
+def write(path, n_bytes=10):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b"0" * n_bytes)
+    return path
+
+
+@pytest.fixture
+def wd_tree(tmp_path):
+    """nipype-like working dir of two subjects: a finished and an unfinished node each, and sunk derivatives"""
+    wd_dir = tmp_path / "wd"
+    for subject in ["01", "02"]:
+        finished = wd_dir / "wf" / f"_session_tp1_subject_{subject}" / "bet"
+        for name in ["result_bet.pklz", "_inputs.pklz", "_node.pklz", "_0x0123abcd.json", "small.txt"]:
+            write(finished / name)
+        write(finished / "brain.nii.gz")
+        write(finished / "brain.nii", 100)
+        write(finished / "transform.mat", LARGE_FILE_BYTES)
+        (finished / "linked.nii.gz").symlink_to(tmp_path / "in.nii.gz")
+        write(wd_dir / "wf" / f"_session_tp1_subject_{subject}" / "fast" / "seg.nii.gz")
+    write(tmp_path / "in.nii.gz")
+    out_files = [write(tmp_path / "out" / "sub-01" / "ses-tp1" / "anat" / f"sub-01_ses-tp1_{s}.nii.gz")
+                 for s in ["T1w", "FLAIR"]]
+    return wd_dir, out_files
+
+
+def test_collect(wd_tree):
+    wd_dir, out_files = wd_tree
+    manager = WorkDirManager(wd_dir)
+    bet = SimpleNamespace(parameterization=["_session_tp1_subject_01"], _hierarchy="wf")
+    dirs = subject_dirs(wd_dir, bet)
+    assert dirs == [wd_dir / "wf" / "_session_tp1_subject_01"]
+    freed = manager.collect(dirs, out_files)
+
+    finished = dirs[0] / "bet"
+    assert freed == 10 + 100 + LARGE_FILE_BYTES
+    # images and large files of finished nodes are removed, nipype bookkeeping, small files and links stay
+    assert sorted(f.name for f in finished.iterdir()) == ["_0x0123abcd.json", "_inputs.pklz", "_node.pklz",
+                                                          "linked.nii.gz", "result_bet.pklz", "small.txt"]
+    assert (wd_dir.parent / "in.nii.gz").is_file()
+    # nodes without a result file and other subjects are not touched
+    assert (dirs[0] / "fast" / "seg.nii.gz").is_file()
+    other = wd_dir / "wf" / "_session_tp1_subject_02" / "bet"
+    assert len(list(other.iterdir())) == 9
+
+    entry = manager.manifest["sub-01_ses-tp1"]
+    assert entry["freed_bytes"] == freed and entry["subject_dirs"] == ["wf/_session_tp1_subject_01"]
+    assert sorted(entry["outputs"]) == sorted(str(f) for f in out_files)
+
+
+def test_pending_skips_collected_until_outputs_change(wd_tree):
+    wd_dir, out_files = wd_tree
+    WorkDirManager(wd_dir).collect([wd_dir / "wf" / "_session_tp1_subject_01"], out_files)
+    subjects_sessions = [("01", "tp1"), ("02", "tp1")]
+    # the manifest is read by later runs
+    manager = WorkDirManager(wd_dir)
+    assert manager.pending(subjects_sessions) == [("02", "tp1")]
+    write(out_files[1], 20)
+    assert manager.pending(subjects_sessions) == subjects_sessions
+    write(out_files[1], 10)
+    assert manager.pending(subjects_sessions) == [("02", "tp1")]
+    out_files[0].unlink()
+    assert manager.pending(subjects_sessions) == subjects_sessions